@@ -89,20 +89,100 @@ class Settings:
     # Database
     DATA_DIR: str = os.getenv("DATA_DIR", "app")
     DB_FILE: str = os.path.join(DATA_DIR, "database.db")
+    # How long a connection waits for another writer's lock before failing
+    DB_BUSY_TIMEOUT_SECONDS: float = float(os.getenv("DB_BUSY_TIMEOUT_SECONDS", 30))
     
     # File uploads
     UPLOAD_DIR: str = "app/uploads"
     THUMBNAIL_DIR: str = os.path.join(UPLOAD_DIR, "thumbnails")
+    MAX_UPLOAD_FILE_BYTES: int = int(os.getenv("MAX_UPLOAD_FILE_BYTES", 25 * 1024 * 1024))
+    MAX_UPLOAD_REQUEST_BYTES: int = int(os.getenv("MAX_UPLOAD_REQUEST_BYTES", 100 * 1024 * 1024))
+    MAX_UPLOAD_PIXELS: int = int(os.getenv("MAX_UPLOAD_PIXELS", 50_000_000))
+    ALLOWED_UPLOAD_FORMATS: tuple = ("JPEG", "MPO", "PNG", "WEBP", "GIF")
     
     # Image optimization
     MAX_IMAGE_SIZE: tuple = (1920, 1920)
     IMAGE_QUALITY: int = 85
     THUMBNAIL_SIZE: tuple = (400, 400)
     THUMBNAIL_QUALITY: int = 80
+    PLACEHOLDER_SIZE: tuple = (16, 16)
+    PLACEHOLDER_QUALITY: int = 30
+    
+    # Per-image quality search: the lowest quality in the range whose result
+    # keeps at least this SSIM (luma, 8px blocks) against the resized image.
+    # The fixed qualities above are used when disabled.
+    IMAGE_AUTO_QUALITY: bool = os.getenv("IMAGE_AUTO_QUALITY", "true").lower() in ("1", "true", "yes")
+    IMAGE_TARGET_SSIM: float = float(os.getenv("IMAGE_TARGET_SSIM", 0.96))
+    IMAGE_AUTO_QUALITY_RANGE: tuple = (50, 95)
+    IMAGE_AUTO_QUALITY_MAX_TRIALS: int = 6
+    
+    # Background thumbnail regeneration
+    THUMBNAIL_JOB_WORKERS: int = int(os.getenv("THUMBNAIL_JOB_WORKERS", min(4, os.cpu_count() or 1)))
+    THUMBNAIL_JOB_POLL_INTERVAL: float = 0.5
+    THUMBNAIL_JOB_KEEPALIVE_SECONDS: int = 15
+    
+    # Orphaned image garbage collection (interval 0 disables the schedule)
+    IMAGE_GC_INTERVAL_SECONDS: int = int(os.getenv("IMAGE_GC_INTERVAL_SECONDS", 24 * 3600))
+    IMAGE_GC_GRACE_SECONDS: int = int(os.getenv("IMAGE_GC_GRACE_SECONDS", 24 * 3600))
+    IMAGE_GC_BATCH_SIZE: int = 200
+    
+    # Background re-rendering of thumbnails and cached variants made with an
+    # older profile, i.e. before a size or quality setting changed (interval
+    # 0 disables it). The worker runs at the lowest OS priority and sleeps
+    # between files to stay within the CPU budget (fraction of one core).
+    IMAGE_REFRESH_INTERVAL_SECONDS: int = int(os.getenv("IMAGE_REFRESH_INTERVAL_SECONDS", 600))
+    IMAGE_REFRESH_CPU_BUDGET: float = float(os.getenv("IMAGE_REFRESH_CPU_BUDGET", 0.25))
+    
+    # On-demand image variants (/img endpoint)
+    IMAGE_CACHE_DIR: str = os.path.join(UPLOAD_DIR, "cache")
+    IMAGE_CACHE_MAX_BYTES: int = int(os.getenv("IMAGE_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+    IMAGE_VARIANT_SIZES: tuple = (160, 320, 400, 480, 640, 800, 1200, 1600, 1920)
+    IMAGE_VARIANT_FITS: tuple = ("contain", "cover")
+    IMAGE_VARIANT_FORMATS: tuple = ("jpeg", "webp")
+    
+    # Image storage backend: "local" (files under UPLOAD_DIR) or "s3" (any
+    # S3-compatible object store). IMAGE_PUBLIC_BASE_URL is where clients can
+    # fetch stored images directly (CDN, bucket, or a web server serving
+    # UPLOAD_DIR); the app redirects there instead of streaming the bytes.
+    IMAGE_STORAGE_BACKEND: str = os.getenv("IMAGE_STORAGE_BACKEND", "local").lower()
+    IMAGE_PUBLIC_BASE_URL: str = os.getenv("IMAGE_PUBLIC_BASE_URL", "")
+    S3_BUCKET: str = os.getenv("S3_BUCKET", "")
+    S3_ENDPOINT_URL: str = os.getenv("S3_ENDPOINT_URL", "")
+    S3_REGION: str = os.getenv("S3_REGION", "")
+    S3_ACCESS_KEY_ID: str = os.getenv("S3_ACCESS_KEY_ID", "")
+    S3_SECRET_ACCESS_KEY: str = os.getenv("S3_SECRET_ACCESS_KEY", "")
+    S3_KEY_PREFIX: str = os.getenv("S3_KEY_PREFIX", "")
+    S3_PRESIGNED_URL_SECONDS: int = int(os.getenv("S3_PRESIGNED_URL_SECONDS", 3600))
+    
+    # Hand local image transfers to nginx: set to an internal location
+    # aliased to UPLOAD_DIR, e.g.
+    #   location /_protected_images/ { internal; alias /app/app/uploads/; }
+    IMAGE_ACCEL_REDIRECT_PREFIX: str = os.getenv("IMAGE_ACCEL_REDIRECT_PREFIX", "")
     
     # Stripe
     STRIPE_SECRET_KEY: str = os.getenv("STRIPE_SECRET_KEY", "")
     STRIPE_PUBLISHABLE_KEY: str = os.getenv("STRIPE_PUBLISHABLE_KEY", "")
+    # Signing secret of the /stripe/webhook endpoint (whsec_...). When set,
+    # orders are saved from payment_intent.succeeded events and
+    # /confirm-payment no longer asks Stripe for the payment's status.
+    STRIPE_WEBHOOK_SECRET: str = os.getenv("STRIPE_WEBHOOK_SECRET", "")
+    STRIPE_WEBHOOK_TOLERANCE_SECONDS: int = 300
+    STRIPE_EVENT_POLL_SECONDS: float = float(os.getenv("STRIPE_EVENT_POLL_SECONDS", 5))
+    STRIPE_EVENT_MAX_ATTEMPTS: int = int(os.getenv("STRIPE_EVENT_MAX_ATTEMPTS", 10))
+    # Stripe API calls: per-attempt connect and read timeouts, retries of
+    # failed attempts, calls run at once (also the connection pool size) and
+    # how many may be running or waiting before new ones are turned away.
+    # After STRIPE_BREAKER_FAILURES failures in a row calls fail fast for
+    # STRIPE_BREAKER_RESET_SECONDS. STRIPE_API_BASE points at another API
+    # host, e.g. a local fake.
+    STRIPE_API_BASE: str = os.getenv("STRIPE_API_BASE", "")
+    STRIPE_CONNECT_TIMEOUT_SECONDS: float = float(os.getenv("STRIPE_CONNECT_TIMEOUT_SECONDS", 3))
+    STRIPE_READ_TIMEOUT_SECONDS: float = float(os.getenv("STRIPE_READ_TIMEOUT_SECONDS", 10))
+    STRIPE_MAX_RETRIES: int = int(os.getenv("STRIPE_MAX_RETRIES", 2))
+    STRIPE_MAX_CONCURRENCY: int = int(os.getenv("STRIPE_MAX_CONCURRENCY", 8))
+    STRIPE_MAX_PENDING: int = int(os.getenv("STRIPE_MAX_PENDING", 32))
+    STRIPE_BREAKER_FAILURES: int = 5
+    STRIPE_BREAKER_RESET_SECONDS: float = 30.0
     
     # Email
     SMTP_SERVER: str = os.getenv("SMTP_SERVER", "")
@@ -110,6 +190,53 @@ class Settings:
     SMTP_USER: str = os.getenv("SMTP_USER", "")
     SMTP_PASSWORD: str = os.getenv("SMTP_PASSWORD", "")
     EMAIL_RECEIVER: str = os.getenv("EMAIL_RECEIVER", "")
+    SMTP_STARTTLS: bool = os.getenv("SMTP_STARTTLS", "true").lower() in ("1", "true", "yes")
+    SMTP_TIMEOUT_SECONDS: int = int(os.getenv("SMTP_TIMEOUT_SECONDS", 30))
+    # The outbox worker keeps its SMTP connection open between messages and
+    # closes it after this long without sending
+    SMTP_IDLE_SECONDS: int = int(os.getenv("SMTP_IDLE_SECONDS", 60))
+    
+    # Email outbox: failed sends are retried after EMAIL_RETRY_BASE_SECONDS,
+    # doubling up to EMAIL_RETRY_MAX_SECONDS, until EMAIL_MAX_ATTEMPTS. A
+    # message being sent is leased for EMAIL_SEND_LEASE_SECONDS so another
+    # worker process only picks it up if the sender died.
+    EMAIL_OUTBOX_POLL_SECONDS: float = float(os.getenv("EMAIL_OUTBOX_POLL_SECONDS", 5))
+    EMAIL_OUTBOX_BATCH_SIZE: int = 20
+    EMAIL_MAX_ATTEMPTS: int = int(os.getenv("EMAIL_MAX_ATTEMPTS", 8))
+    EMAIL_RETRY_BASE_SECONDS: int = int(os.getenv("EMAIL_RETRY_BASE_SECONDS", 30))
+    EMAIL_RETRY_MAX_SECONDS: int = int(os.getenv("EMAIL_RETRY_MAX_SECONDS", 3600))
+    EMAIL_SEND_LEASE_SECONDS: int = 120
+    
+    # Stock held for a cart from payment intent until the order is saved,
+    # and how often expired holds are deleted (0 disables the sweeper)
+    STOCK_HOLD_SECONDS: int = int(os.getenv("STOCK_HOLD_SECONDS", 900))
+    STOCK_HOLD_SWEEP_SECONDS: float = float(os.getenv("STOCK_HOLD_SWEEP_SECONDS", 60))
+    
+    # Checkout sessions reuse one payment intent per checkout; a session
+    # expires this long after it was last used
+    CHECKOUT_SESSION_TTL_SECONDS: int = int(os.getenv("CHECKOUT_SESSION_TTL_SECONDS", 3600))
+    CHECKOUT_SESSION_PURGE_SECONDS: int = 600
+    CHECKOUT_SESSION_MAX_TOKEN_LENGTH: int = 255
+    
+    # Delivery methods offered at checkout and their cost (SEK). A cart
+    # quote is valid for CART_QUOTE_TTL_SECONDS; with REQUIRE_CART_QUOTE
+    # checkout refuses orders that do not carry one, otherwise it prices
+    # them from the database.
+    DELIVERY_COSTS: dict = {"pickup": 0, "postnord": 82}
+    CART_QUOTE_TTL_SECONDS: int = int(os.getenv("CART_QUOTE_TTL_SECONDS", 900))
+    REQUIRE_CART_QUOTE: bool = os.getenv("REQUIRE_CART_QUOTE", "false").lower() in ("1", "true", "yes")
+    
+    # Idempotency-Key support: endpoints that honour the header, how long a
+    # stored response is replayed, how long a duplicate waits for the first
+    # request to finish (polling every IDEMPOTENCY_POLL_SECONDS), and after
+    # how long an unfinished request counts as abandoned
+    IDEMPOTENT_ENDPOINTS: tuple = (("POST", "/checkout"), ("POST", "/confirm-payment"), ("POST", "/orders"))
+    IDEMPOTENCY_TTL_SECONDS: int = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", 24 * 3600))
+    IDEMPOTENCY_WAIT_SECONDS: float = 30.0
+    IDEMPOTENCY_POLL_SECONDS: float = 0.05
+    IDEMPOTENCY_LOCK_SECONDS: int = 120
+    IDEMPOTENCY_PURGE_SECONDS: int = 600
+    IDEMPOTENCY_MAX_KEY_LENGTH: int = 255
     
     # CORS
     CORS_ORIGINS: list = [
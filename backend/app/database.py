@@ -5,6 +5,7 @@ import os
 import re
 import sqlite3
 from contextlib import contextmanager
+from datetime import datetime
 
 from .config import settings
 
@@ -13,7 +14,12 @@ from .config import settings
 _VALID_IDENTIFIER = re.compile(r'^[a-zA-Z_][a-zA-Z0-9_]*$')
 
 # Allowed tables for migrations (whitelist)
-_ALLOWED_TABLES = frozenset({'products', 'product_images', 'product_sizes', 'categories', 'product_categories', 'orders', 'order_items'})
+_ALLOWED_TABLES = frozenset({
+    'products', 'product_images', 'product_sizes', 'categories', 'product_categories',
+    'orders', 'order_items', 'image_metadata', 'thumbnail_jobs', 'thumbnail_job_items',
+    'email_outbox', 'stock_holds', 'idempotency_keys', 'stripe_payments', 'stripe_events',
+    'checkout_sessions',
+})
 
 # Allowed column types for migrations (whitelist)
 _ALLOWED_TYPES = frozenset({'TEXT', 'INTEGER', 'REAL', 'BLOB', 'INTEGER DEFAULT 0', "TEXT DEFAULT 'ej_betald'", "TEXT DEFAULT 'ej_hamtad'"})
@@ -22,19 +28,33 @@ _ALLOWED_TYPES = frozenset({'TEXT', 'INTEGER', 'REAL', 'BLOB', 'INTEGER DEFAULT
 os.makedirs(settings.DATA_DIR, exist_ok=True)
 os.makedirs(settings.UPLOAD_DIR, exist_ok=True)
 os.makedirs(settings.THUMBNAIL_DIR, exist_ok=True)
+os.makedirs(settings.IMAGE_CACHE_DIR, exist_ok=True)
 
 
 def get_db():
-    conn = sqlite3.connect(settings.DB_FILE)
+    conn = sqlite3.connect(settings.DB_FILE, timeout=settings.DB_BUSY_TIMEOUT_SECONDS)
     conn.row_factory = sqlite3.Row
     return conn
 
 
+def db_timestamp(moment: datetime) -> str:
+    """Fixed-width UTC timestamp, so stored values compare correctly as text."""
+    return moment.isoformat(timespec="microseconds")
+
+
 @contextmanager
-def get_db_context():
-    """Context manager for database connections."""
+def get_db_context(immediate: bool = False):
+    """
+    Context manager for database connections.
+    
+    Args:
+        immediate: Take the write lock up front (BEGIN IMMEDIATE), for
+            read-modify-write transactions that must not interleave
+    """
     conn = get_db()
     try:
+        if immediate:
+            conn.execute("BEGIN IMMEDIATE")
         yield conn
         conn.commit()
     except Exception:
@@ -154,6 +174,150 @@ def setup_database():
         )
     """)
 
+    # Image metadata table (one row per stored original/variant file)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS image_metadata (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            source_filename TEXT NOT NULL,
+            variant TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            width INTEGER,
+            height INTEGER,
+            bytes INTEGER,
+            format TEXT,
+            content_hash TEXT,
+            created_at TEXT,
+            UNIQUE(source_filename, variant)
+        )
+    """)
+
+    # Background thumbnail jobs and their per-file progress
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS thumbnail_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            status TEXT NOT NULL,
+            force INTEGER DEFAULT 0,
+            total INTEGER DEFAULT 0,
+            processed INTEGER DEFAULT 0,
+            skipped INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            error TEXT,
+            created_at TEXT,
+            updated_at TEXT,
+            finished_at TEXT
+        )
+    """)
+    
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS thumbnail_job_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id INTEGER NOT NULL,
+            filename TEXT NOT NULL,
+            status TEXT NOT NULL,
+            error TEXT,
+            FOREIGN KEY(job_id) REFERENCES thumbnail_jobs(id) ON DELETE CASCADE,
+            UNIQUE(job_id, filename)
+        )
+    """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_thumbnail_job_items_status ON thumbnail_job_items(job_id, status)"
+    )
+
+    # Notification emails waiting to be sent by the outbox worker
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS email_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER,
+            recipient TEXT,
+            subject TEXT NOT NULL,
+            body TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at TEXT NOT NULL,
+            last_error TEXT,
+            created_at TEXT,
+            sent_at TEXT
+        )
+    """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_email_outbox_due ON email_outbox(status, next_attempt_at)"
+    )
+
+    # Stock held for carts being paid for; rows past expires_at no longer count
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stock_holds (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            reference TEXT NOT NULL,
+            product_id INTEGER NOT NULL,
+            size TEXT NOT NULL,
+            quantity INTEGER NOT NULL,
+            expires_at TEXT NOT NULL,
+            created_at TEXT
+        )
+    """)
+    # Availability lookups filter on product and unexpired holds
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_stock_holds_active ON stock_holds(product_id, expires_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_stock_holds_reference ON stock_holds(reference)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_stock_holds_expires ON stock_holds(expires_at)")
+
+    # First responses to requests sent with an Idempotency-Key header
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            scope TEXT PRIMARY KEY,
+            request_hash TEXT NOT NULL,
+            status TEXT NOT NULL,
+            status_code INTEGER,
+            response_headers TEXT,
+            response_body BLOB,
+            locked_until TEXT,
+            created_at TEXT,
+            expires_at TEXT NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys(expires_at)")
+
+    # Cart behind each Stripe payment intent and the order saved for it
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stripe_payments (
+            payment_intent_id TEXT PRIMARY KEY,
+            order_data TEXT,
+            order_id INTEGER,
+            status TEXT NOT NULL,
+            created_at TEXT,
+            updated_at TEXT
+        )
+    """)
+
+    # Verified Stripe webhook events, processed by a background worker
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stripe_events (
+            id TEXT PRIMARY KEY,
+            type TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER DEFAULT 0,
+            last_error TEXT,
+            outcome TEXT,
+            received_at TEXT,
+            processed_at TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_stripe_events_status ON stripe_events(status, received_at)")
+
+    # Payment intent reused by each checkout session until it expires
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS checkout_sessions (
+            token TEXT PRIMARY KEY,
+            payment_intent_id TEXT NOT NULL,
+            client_secret TEXT NOT NULL,
+            params_hash TEXT,
+            created_at TEXT,
+            updated_at TEXT,
+            expires_at TEXT NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_checkout_sessions_expires ON checkout_sessions(expires_at)")
+
     # Add columns if they don't exist (migration support)
     _run_migrations(conn)
     
@@ -201,6 +365,12 @@ def _run_migrations(conn):
         ("orders", "pickup_status", "TEXT DEFAULT 'ej_hamtad'"),
         ("products", "cost", "INTEGER"),
         ("order_items", "cost", "INTEGER"),
+        ("product_images", "placeholder", "TEXT"),
+        ("categories", "image_placeholder", "TEXT"),
+        ("image_metadata", "quality", "INTEGER"),
+        ("image_metadata", "ssim", "REAL"),
+        ("image_metadata", "baseline_bytes", "INTEGER"),
+        ("image_metadata", "profile_version", "TEXT"),
     ]
     
     for table, column, col_type in migrations:
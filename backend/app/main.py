@@ -3,31 +3,64 @@ Yakimoto Dojo E-commerce API
 
 FastAPI application for managing products, categories, and orders.
 """
+from contextlib import asynccontextmanager
 from datetime import datetime
 
 from fastapi import Body, FastAPI
-from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 
 from .config import settings
 from .database import get_db_context, init_db
+from .middleware import IdempotencyMiddleware, UploadSizeLimitMiddleware
 from .routes import (
     products_router,
     categories_router,
     auth_router,
     checkout_router,
+    cart_router,
     admin_router,
     orders_router,
+    images_router,
 )
+from .services.email_outbox import EmailOutboxService
+from .services.image_gc import ImageGarbageCollector
+from .services.image_refresh import ImageProfileRefresher
+from .services.stock_holds import StockHoldService
+from .services.stripe_events import StripeEventService
+from .services.thumbnail_jobs import ThumbnailJobService
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start background workers and resume work interrupted by the last shutdown."""
+    ThumbnailJobService.resume_interrupted()
+    ImageGarbageCollector.start_scheduler()
+    ImageProfileRefresher.start_scheduler()
+    EmailOutboxService.start_worker()
+    StockHoldService.start_sweeper()
+    StripeEventService.start_worker()
+    yield
+    StripeEventService.stop_worker()
+    StockHoldService.stop_sweeper()
+    EmailOutboxService.stop_worker()
+    ImageProfileRefresher.stop_scheduler()
+    ImageGarbageCollector.stop_scheduler()
 
 
 # Initialize FastAPI app
 app = FastAPI(
     title="Yakimoto Dojo API",
     description="E-commerce API for Yakimoto Dojo",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
 )
 
+# Reject oversized uploads before they are spooled (added first so CORS wraps it)
+app.add_middleware(UploadSizeLimitMiddleware)
+
+# Replay stored responses to retried checkout and order requests
+app.add_middleware(IdempotencyMiddleware)
+
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -37,17 +70,15 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Static file serving
-app.mount("/uploads", StaticFiles(directory=settings.UPLOAD_DIR), name="uploads")
-app.mount("/thumbnails", StaticFiles(directory=settings.THUMBNAIL_DIR), name="thumbnails")
-
 # Register routers
 app.include_router(products_router)
 app.include_router(categories_router)
 app.include_router(auth_router)
 app.include_router(checkout_router)
+app.include_router(cart_router)
 app.include_router(admin_router)
 app.include_router(orders_router)
+app.include_router(images_router)
 
 # Initialize database on startup
 init_db()
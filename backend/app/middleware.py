@@ -0,0 +1,185 @@
+"""
+ASGI middleware.
+"""
+import json
+import time
+
+import anyio
+
+from .config import settings
+from .services.idempotency import IdempotencyKeyReused, IdempotencyService
+
+
+async def _reject(send, status_code: int, detail: str) -> None:
+    """Send a JSON error response in the same shape as HTTPException."""
+    body = json.dumps({"detail": detail}).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status_code,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode("latin-1")),
+            (b"connection", b"close"),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class UploadSizeLimitMiddleware:
+    """
+    Reject oversized multipart uploads before their body is read.
+    
+    Multipart requests must declare a Content-Length no larger than
+    settings.MAX_UPLOAD_REQUEST_BYTES. The server never reads past the
+    declared length, so this bounds how much a single request can spool
+    to disk. Other requests pass through untouched.
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        headers = dict(scope.get("headers") or [])
+        content_type = headers.get(b"content-type", b"").decode("latin-1").lower()
+        if not content_type.startswith("multipart/form-data"):
+            await self.app(scope, receive, send)
+            return
+        
+        content_length = headers.get(b"content-length")
+        if content_length is None:
+            await _reject(send, 411, "Content-Length required for uploads")
+            return
+        
+        try:
+            length = int(content_length)
+        except ValueError:
+            await _reject(send, 400, "Invalid Content-Length")
+            return
+        
+        if length > settings.MAX_UPLOAD_REQUEST_BYTES:
+            limit_mb = settings.MAX_UPLOAD_REQUEST_BYTES // (1024 * 1024)
+            await _reject(send, 413, f"Upload too large. Maximum total size is {limit_mb} MB")
+            return
+        
+        await self.app(scope, receive, send)
+
+
+class IdempotencyMiddleware:
+    """
+    Run requests that carry an Idempotency-Key header at most once.
+    
+    Applies to settings.IDEMPOTENT_ENDPOINTS. The first request with a key
+    runs normally and its response is stored; later requests with the same
+    key and body get the stored response (marked Idempotent-Replayed) with a
+    single lookup. A duplicate that arrives while the first request is still
+    running waits for it to finish. Responses with a 5xx status are not
+    stored, so the request can be retried. Requests without the header pass
+    through untouched.
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or (scope["method"], scope["path"]) not in settings.IDEMPOTENT_ENDPOINTS:
+            await self.app(scope, receive, send)
+            return
+        
+        headers = dict(scope.get("headers") or [])
+        key = headers.get(b"idempotency-key", b"").decode("latin-1").strip()
+        if not key:
+            await self.app(scope, receive, send)
+            return
+        if len(key) > settings.IDEMPOTENCY_MAX_KEY_LENGTH:
+            await _reject(send, 400, "Idempotency-Key is too long")
+            return
+        
+        body, receive = await self._buffer_body(receive)
+        storage_scope = IdempotencyService.scope(
+            scope["method"], scope["path"], headers.get(b"authorization", b"").decode("latin-1"), key
+        )
+        request_hash = IdempotencyService.request_hash(body)
+        
+        try:
+            stored = await anyio.to_thread.run_sync(IdempotencyService.lookup, storage_scope, request_hash)
+            deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT_SECONDS
+            while stored is None:
+                state = await anyio.to_thread.run_sync(IdempotencyService.claim, storage_scope, request_hash)
+                if state is None:
+                    break
+                stored = state["response"]
+                if stored is None:
+                    if time.monotonic() > deadline:
+                        await _reject(send, 409, "A request with this Idempotency-Key is still in progress")
+                        return
+                    await anyio.sleep(settings.IDEMPOTENCY_POLL_SECONDS)
+        except IdempotencyKeyReused as e:
+            await _reject(send, 422, str(e))
+            return
+        
+        if stored is not None:
+            await self._replay(send, stored)
+            return
+        
+        await self._run_and_store(scope, receive, send, storage_scope)
+    
+    @staticmethod
+    async def _buffer_body(receive):
+        """Read the whole request body and return it with a receive that replays it."""
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] != "http.request":
+                break
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+        body = b"".join(chunks)
+        replayed = False
+        
+        async def replay_receive():
+            nonlocal replayed
+            if not replayed:
+                replayed = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+        
+        return body, replay_receive
+    
+    @staticmethod
+    async def _replay(send, stored: dict) -> None:
+        headers = [(name.encode("latin-1"), value.encode("latin-1")) for name, value in stored["headers"]]
+        headers.append((b"idempotent-replayed", b"true"))
+        await send({"type": "http.response.start", "status": stored["status_code"], "headers": headers})
+        await send({"type": "http.response.body", "body": stored["body"] or b""})
+    
+    async def _run_and_store(self, scope, receive, send, storage_scope: str) -> None:
+        response = {"status": 500, "headers": [], "body": []}
+        
+        async def capture(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["headers"] = [
+                    (name.decode("latin-1"), value.decode("latin-1")) for name, value in message.get("headers", [])
+                ]
+            elif message["type"] == "http.response.body":
+                response["body"].append(message.get("body", b""))
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, capture)
+        except BaseException:
+            await anyio.to_thread.run_sync(IdempotencyService.release, storage_scope)
+            raise
+        
+        if response["status"] >= 500:
+            await anyio.to_thread.run_sync(IdempotencyService.release, storage_scope)
+        else:
+            await anyio.to_thread.run_sync(
+                IdempotencyService.complete,
+                storage_scope, response["status"], response["headers"], b"".join(response["body"])
+            )
@@ -5,5 +5,7 @@ from .products import router as products_router
 from .categories import router as categories_router
 from .auth import router as auth_router
 from .checkout import router as checkout_router
+from .cart import router as cart_router
 from .admin import router as admin_router
 from .orders import router as orders_router
+from .images import router as images_router
@@ -1,65 +1,66 @@
 """
 Admin utility endpoints.
 """
-import os
+import asyncio
+import json
 from datetime import datetime
+from typing import Optional
 
-from fastapi import APIRouter, Depends
-from fastapi.responses import Response
+import anyio
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import Response, StreamingResponse
 
 from ..config import settings
-from ..database import get_db
+from ..database import get_db, get_db_context
 from ..dependencies import verify_token
+from ..services.email_outbox import EmailOutboxService
 from ..services.image import ImageService
+from ..services.image_gc import ImageGarbageCollector
+from ..services.image_metadata import ImageMetadataService, VARIANT_THUMBNAIL
+from ..services.image_paths import ImagePaths
+from ..services.image_refresh import ImageProfileRefresher
+from ..services.image_status import ImageStatusService
+from ..services.storage import AREA_ORIGINALS, AREA_THUMBNAILS, LocalStorage, get_storage
+from ..services.stripe_gateway import StripeGateway
+from ..services.thumbnail_jobs import JOB_RUNNING, ThumbnailJobService
 
 
 router = APIRouter(tags=["admin"])
 
 
 @router.get("/admin/thumbnail-status")
-def get_thumbnail_status(auth=Depends(verify_token)):
-    conn = get_db()
-    cursor = conn.cursor()
+def get_thumbnail_status(
+    offset: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    auth=Depends(verify_token),
+):
+    """
+    Report which referenced images have an original and a thumbnail on disk,
+    and which files on disk nothing references.
     
-    cursor.execute("SELECT DISTINCT filename FROM product_images")
-    product_images = [row["filename"] for row in cursor.fetchall()]
-    
-    cursor.execute("SELECT DISTINCT image_filename FROM categories WHERE image_filename IS NOT NULL")
-    category_images = [row["image_filename"] for row in cursor.fetchall()]
+    Counts cover everything; each filename list is paginated with offset/limit.
+    """
+    conn = get_db()
+    status = ImageStatusService.get_status(conn.cursor())
+    conn.close()
     
-    all_images = set(product_images + category_images)
+    with_count = len(status["with_thumbnails"])
+    without_count = len(status["without_thumbnails"])
+    missing_count = len(status["missing_originals"])
     
-    status = {
-        "with_thumbnails": [],
-        "without_thumbnails": [],
-        "missing_originals": [],
-        "total": len(all_images),
-        "thumbnail_count": 0,
-        "missing_count": 0
+    response = {
+        "total": with_count + without_count + missing_count,
+        "thumbnail_count": with_count,
+        "without_count": without_count,
+        "missing_count": missing_count,
+        "orphan_original_count": len(status["orphan_originals"]),
+        "orphan_thumbnail_count": len(status["orphan_thumbnails"]),
+        "offset": offset,
+        "limit": limit,
     }
-    
-    for filename in all_images:
-        if not filename:
-            continue
-        
-        image_path = os.path.join(settings.UPLOAD_DIR, filename)
-        if not os.path.exists(image_path):
-            status["missing_originals"].append(filename)
-            status["missing_count"] += 1
-            continue
-        
-        base_name = os.path.splitext(filename)[0]
-        thumbnail_path = os.path.join(settings.THUMBNAIL_DIR, f"{base_name}_thumb.jpg")
-        
-        if os.path.exists(thumbnail_path):
-            status["with_thumbnails"].append(filename)
-            status["thumbnail_count"] += 1
-        else:
-            status["without_thumbnails"].append(filename)
-    
-    conn.close()
-    
-    return status
+    for name, filenames in status.items():
+        response[name] = filenames[offset:offset + limit]
+    return response
 
 
 @router.post("/admin/delete-thumbnails")
@@ -67,17 +68,21 @@ def delete_all_thumbnails(auth=Depends(verify_token)):
     deleted = 0
     errors = []
     
+    storage = get_storage()
+    
     try:
-        if os.path.exists(settings.THUMBNAIL_DIR):
-            for filename in os.listdir(settings.THUMBNAIL_DIR):
-                if filename.endswith('_thumb.jpg'):
-                    try:
-                        os.remove(os.path.join(settings.THUMBNAIL_DIR, filename))
+        for obj in list(storage.list(AREA_THUMBNAILS)):
+            if obj.name.endswith('_thumb.jpg'):
+                try:
+                    if storage.delete_object(obj):
                         deleted += 1
-                    except Exception as e:
-                        errors.append(f"Error deleting {filename}: {str(e)}")
+                except Exception as e:
+                    errors.append(f"Error deleting {obj.name}: {str(e)}")
     except Exception as e:
-        errors.append(f"Error accessing thumbnails directory: {str(e)}")
+        errors.append(f"Error accessing thumbnail storage: {str(e)}")
+    
+    with get_db_context() as conn:
+        conn.execute("DELETE FROM image_metadata WHERE variant = ?", (VARIANT_THUMBNAIL,))
     
     return {
         "message": "Thumbnail deletion completed",
@@ -87,62 +92,236 @@ def delete_all_thumbnails(auth=Depends(verify_token)):
 
 
 @router.post("/admin/generate-thumbnails")
-def generate_thumbnails_for_existing_images(auth=Depends(verify_token)):
+def generate_thumbnails_for_existing_images(force: bool = False, auth=Depends(verify_token)):
+    """
+    Start (or resume) background thumbnail regeneration.
+    
+    Progress can be polled at /admin/thumbnail-jobs/{job_id} or streamed
+    from /admin/thumbnail-jobs/{job_id}/events.
+    """
+    job_id = ThumbnailJobService.start(force=force)
+    job = ThumbnailJobService.get_job(job_id)
+    job["message"] = "Thumbnail generation started"
+    return job
+
+
+@router.get("/admin/thumbnail-jobs/{job_id}")
+def get_thumbnail_job(job_id: int, auth=Depends(verify_token)):
+    job = ThumbnailJobService.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@router.get("/admin/thumbnail-jobs/{job_id}/events")
+async def stream_thumbnail_job(job_id: int, auth=Depends(verify_token)):
+    """Stream job progress as Server-Sent Events until the job stops running."""
+    if not await anyio.to_thread.run_sync(ThumbnailJobService.get_job, job_id):
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    async def events():
+        last = None
+        idle = 0.0
+        while True:
+            job = await anyio.to_thread.run_sync(ThumbnailJobService.get_job, job_id)
+            if job != last:
+                yield f"event: progress\ndata: {json.dumps(job)}\n\n"
+                last = job
+                idle = 0.0
+            elif idle >= settings.THUMBNAIL_JOB_KEEPALIVE_SECONDS:
+                yield ": keepalive\n\n"
+                idle = 0.0
+            
+            if job["status"] != JOB_RUNNING:
+                yield f"event: done\ndata: {json.dumps(job)}\n\n"
+                return
+            
+            await asyncio.sleep(settings.THUMBNAIL_JOB_POLL_INTERVAL)
+            idle += settings.THUMBNAIL_JOB_POLL_INTERVAL
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.post("/admin/generate-placeholders")
+def generate_placeholders_for_existing_images(auth=Depends(verify_token)):
+    """Backfill low-quality placeholders for images uploaded before they existed."""
     conn = get_db()
     cursor = conn.cursor()
     
-    cursor.execute("SELECT DISTINCT filename FROM product_images")
+    cursor.execute("SELECT DISTINCT filename FROM product_images WHERE placeholder IS NULL")
     product_images = [row["filename"] for row in cursor.fetchall()]
     
-    cursor.execute("SELECT DISTINCT image_filename FROM categories WHERE image_filename IS NOT NULL")
+    cursor.execute(
+        "SELECT DISTINCT image_filename FROM categories "
+        "WHERE image_filename IS NOT NULL AND image_placeholder IS NULL"
+    )
     category_images = [row["image_filename"] for row in cursor.fetchall()]
     
     all_images = set(product_images + category_images)
     
     processed = 0
-    skipped = 0
     errors = []
+    storage = get_storage()
     
     for filename in all_images:
         if not filename:
             continue
         
-        base_name = os.path.splitext(filename)[0]
-        thumbnail_path = os.path.join(settings.THUMBNAIL_DIR, f"{base_name}_thumb.jpg")
-        
-        if os.path.exists(thumbnail_path):
-            skipped += 1
-            continue
-        
-        image_path = os.path.join(settings.UPLOAD_DIR, filename)
-        if not os.path.exists(image_path):
-            errors.append(f"Original image not found: {filename}")
-            continue
-        
         try:
-            with open(image_path, "rb") as f:
-                original_bytes = f.read()
-            
-            thumbnail_bytes = ImageService.create_thumbnail(original_bytes)
+            # The thumbnail is plenty of detail for a 16px preview and much cheaper to decode
+            source = storage.get(AREA_THUMBNAILS, ImagePaths.thumbnail_name(filename))
+            if source is None:
+                source = storage.get(AREA_ORIGINALS, filename)
+            if source is None:
+                errors.append(f"Original image not found: {filename}")
+                continue
             
-            with open(thumbnail_path, "wb") as f:
-                f.write(thumbnail_bytes)
+            placeholder = ImageService.create_placeholder(source)
             
+            cursor.execute(
+                "UPDATE product_images SET placeholder = ? WHERE filename = ?",
+                (placeholder, filename)
+            )
+            cursor.execute(
+                "UPDATE categories SET image_placeholder = ? WHERE image_filename = ?",
+                (placeholder, filename)
+            )
             processed += 1
         except Exception as e:
             errors.append(f"Error processing {filename}: {str(e)}")
     
+    conn.commit()
     conn.close()
     
     return {
-        "message": "Thumbnail generation completed",
+        "message": "Placeholder generation completed",
         "processed": processed,
-        "skipped": skipped,
         "errors": errors,
         "total": len(all_images)
     }
 
 
+@router.post("/admin/backfill-image-metadata")
+def backfill_image_metadata(auth=Depends(verify_token)):
+    """One-off: record metadata for images stored before it was tracked."""
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    cursor.execute("""
+        SELECT filename FROM product_images WHERE filename IS NOT NULL
+        UNION
+        SELECT image_filename FROM categories WHERE image_filename IS NOT NULL
+    """)
+    all_images = [row["filename"] for row in cursor.fetchall()]
+    
+    result = ImageMetadataService.backfill(cursor, all_images)
+    
+    conn.commit()
+    conn.close()
+    
+    return {
+        "message": "Image metadata backfill completed",
+        "originals": result["originals"],
+        "thumbnails": result["thumbnails"],
+        "errors": result["errors"],
+        "total": len(all_images)
+    }
+
+
+@router.get("/admin/image-encoding-stats")
+def get_image_encoding_stats(auth=Depends(verify_token)):
+    """Quality chosen by the auto-quality encoder and bytes saved against fixed quality."""
+    with get_db_context() as conn:
+        stats = ImageMetadataService.encoding_stats(conn.cursor())
+    
+    return {
+        "auto_quality": settings.IMAGE_AUTO_QUALITY,
+        "target_ssim": settings.IMAGE_TARGET_SSIM,
+        "variants": stats,
+    }
+
+
+@router.post("/admin/migrate-image-layout")
+def migrate_image_layout(
+    batch_size: int = Query(500, ge=1, le=5000),
+    auth=Depends(verify_token),
+):
+    """
+    Move one batch of flat-layout originals and thumbnails into shards.
+    
+    Call repeatedly until remaining is 0; files stay readable throughout.
+    Only applies to local storage.
+    """
+    storage = get_storage()
+    if not isinstance(storage, LocalStorage):
+        raise HTTPException(status_code=400, detail="Layout migration only applies to local image storage")
+    
+    originals = ImagePaths.migrate(storage.root(AREA_ORIGINALS), batch_size)
+    thumbnails = ImagePaths.migrate(storage.root(AREA_THUMBNAILS), max(0, batch_size - originals["moved"]))
+    
+    return {
+        "message": "Image layout migration batch completed",
+        "moved": originals["moved"] + thumbnails["moved"],
+        "remaining": originals["remaining"] + thumbnails["remaining"],
+    }
+
+
+@router.post("/admin/image-gc")
+def collect_orphaned_images(
+    dry_run: bool = True,
+    grace_hours: Optional[float] = Query(None, ge=0),
+    auth=Depends(verify_token),
+):
+    """
+    Remove image rows of deleted products and files nothing references.
+    
+    Defaults to a dry run; pass dry_run=false to actually delete.
+    """
+    grace_seconds = int(grace_hours * 3600) if grace_hours is not None else None
+    return ImageGarbageCollector.collect(dry_run=dry_run, grace_seconds=grace_seconds)
+
+
+@router.get("/admin/image-profiles")
+def get_image_profiles(auth=Depends(verify_token)):
+    """Current image profile versions and how many stored files are out of date."""
+    return ImageProfileRefresher.status()
+
+
+@router.post("/admin/image-profiles/refresh")
+def refresh_image_profiles(auth=Depends(verify_token)):
+    """Start a background re-render of out-of-date thumbnails and variants now."""
+    if not ImageProfileRefresher.trigger():
+        raise HTTPException(
+            status_code=409,
+            detail="Background re-rendering is disabled (IMAGE_REFRESH_INTERVAL_SECONDS=0)"
+        )
+    return {"message": "Re-rendering started"}
+
+
+@router.get("/admin/email-outbox")
+def get_email_outbox(auth=Depends(verify_token)):
+    """Queued, sent and failed notification emails."""
+    return EmailOutboxService.stats()
+
+
+@router.post("/admin/email-outbox/{message_id}/retry")
+def retry_email(message_id: int, auth=Depends(verify_token)):
+    """Send a failed or delayed notification email again right away."""
+    if not EmailOutboxService.retry(message_id):
+        raise HTTPException(status_code=404, detail="Unsent message not found")
+    return {"message": "Email queued"}
+
+
+@router.get("/admin/stripe-stats")
+def get_stripe_stats(auth=Depends(verify_token)):
+    """Stripe API call counts, errors and latencies, and the circuit breaker state."""
+    return StripeGateway.stats()
+
+
 @router.get("/sitemap.xml")
 def get_sitemap():
     conn = get_db()
@@ -0,0 +1,47 @@
+"""
+Cart endpoints.
+"""
+import anyio
+from fastapi import APIRouter, Body, HTTPException
+
+from ..config import settings
+from ..services.checkout_sessions import CheckoutSessionService
+from ..services.inventory import InvalidOrderLineError
+from ..services.quotes import QuoteError, QuoteService
+
+
+router = APIRouter(prefix="/cart", tags=["cart"])
+
+
+def _quote(items: list, delivery_method: str, session_token: str = None) -> dict:
+    session = CheckoutSessionService.get(session_token) if session_token else None
+    return QuoteService.quote(items, delivery_method, session["payment_intent_id"] if session else None)
+
+
+@router.post("/quote")
+async def quote_cart(cart: dict = Body(...)):
+    """
+    Price a cart with the shop's current prices and stock.
+    
+    The checkout shows these numbers rather than the ones it has cached,
+    and sends the quote token along with the order; checkout then charges
+    the quoted prices instead of the ones in the request.
+    
+    Args:
+        cart: items (id, selectedSize, quantity), deliveryMethod and,
+            optionally, the checkout's sessionToken so its own stock hold
+            counts as available
+        
+    Returns:
+        Lines with unit price, line total and available stock, totals, and
+        a quote_token when everything is in stock; 400 for an unknown
+        delivery method or an invalid quantity
+    """
+    items = cart.get("items") or []
+    token = cart.get("sessionToken")
+    if token and len(str(token)) > settings.CHECKOUT_SESSION_MAX_TOKEN_LENGTH:
+        raise HTTPException(status_code=400, detail="sessionToken is too long")
+    try:
+        return await anyio.to_thread.run_sync(_quote, items, cart.get("deliveryMethod") or "pickup", token)
+    except (QuoteError, InvalidOrderLineError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
@@ -9,7 +9,7 @@ from fastapi import APIRouter, Body, Depends, File, Form, HTTPException, UploadF
 from ..config import settings
 from ..database import get_db
 from ..dependencies import verify_token
-from ..services.image import ImageService
+from ..services.image import ImageService, ImageUploadError
 
 
 router = APIRouter(prefix="/categories", tags=["categories"])
@@ -51,32 +51,50 @@ def create_category(
     if not name:
         raise HTTPException(status_code=400, detail="Category name cannot be empty")
     
+    image_file = None
+    if image and image.filename:
+        try:
+            image_file = ImageService.probe_upload(image)
+        except ImageUploadError as e:
+            raise HTTPException(status_code=e.status_code, detail=str(e))
+    
+    # Encode and store the image before the write transaction is opened
+    image_filename = None
+    image_placeholder = None
+    if image_file is not None:
+        stored = ImageService.store_product_image(image_file, image.filename)
+        image_filename = stored["filename"]
+        image_placeholder = ImageService.create_placeholder(image_file)
+    
     conn = get_db()
     cursor = conn.cursor()
     
-    image_filename = None
-    if image and image.filename:
-        original_bytes = image.file.read()
-        image_filename, _ = ImageService.save_product_image(original_bytes, image.filename)
+    released = []
+    if image_file is not None:
+        ImageService.record_product_image(cursor, stored)
     
     # Check if category exists
-    cursor.execute("SELECT id FROM categories WHERE name = ?", (name,))
+    cursor.execute("SELECT id, image_filename FROM categories WHERE name = ?", (name,))
     existing = cursor.fetchone()
     
     if existing:
         if image_filename:
             cursor.execute(
-                "UPDATE categories SET image_filename = ? WHERE name = ?",
-                (image_filename, name)
+                "UPDATE categories SET image_filename = ?, image_placeholder = ? WHERE name = ?",
+                (image_filename, image_placeholder, name)
             )
+            if existing["image_filename"] != image_filename:
+                if ImageService.release_image(cursor, existing["image_filename"]):
+                    released.append(existing["image_filename"])
     else:
         cursor.execute(
-            "INSERT INTO categories (name, image_filename) VALUES (?, ?)",
-            (name, image_filename)
+            "INSERT INTO categories (name, image_filename, image_placeholder) VALUES (?, ?, ?)",
+            (name, image_filename, image_placeholder)
         )
     
     conn.commit()
     conn.close()
+    ImageService.delete_released(released)
     
     return {"message": "Category created/updated", "name": name}
 
@@ -93,6 +111,19 @@ def update_category(
     if not name:
         raise HTTPException(status_code=400, detail="Category name cannot be empty")
     
+    image_file = None
+    if image and image.filename:
+        try:
+            image_file = ImageService.probe_upload(image)
+        except ImageUploadError as e:
+            raise HTTPException(status_code=e.status_code, detail=str(e))
+    
+    # Encode and store the image before the write transaction is opened
+    stored = None
+    if image_file is not None:
+        stored = ImageService.store_product_image(image_file, image.filename)
+        image_placeholder = ImageService.create_placeholder(image_file)
+    
     conn = get_db()
     cursor = conn.cursor()
     
@@ -103,22 +134,26 @@ def update_category(
         raise HTTPException(status_code=404, detail="Category not found")
     
     image_filename = existing["image_filename"]
-    if image and image.filename:
-        # Delete old image
-        if existing["image_filename"]:
-            ImageService.delete_image(existing["image_filename"])
-        
-        # Save new image
-        original_bytes = image.file.read()
-        image_filename, _ = ImageService.save_product_image(original_bytes, image.filename)
+    if stored is not None:
+        ImageService.record_product_image(cursor, stored)
+        image_filename = stored["filename"]
+    else:
+        image_placeholder = existing["image_placeholder"]
     
     cursor.execute(
-        "UPDATE categories SET name = ?, image_filename = ? WHERE id = ?",
-        (name, image_filename, category_id)
+        "UPDATE categories SET name = ?, image_filename = ?, image_placeholder = ? WHERE id = ?",
+        (name, image_filename, image_placeholder, category_id)
     )
     
+    # Delete the replaced image unless something else still uses it
+    released = []
+    if existing["image_filename"] and existing["image_filename"] != image_filename:
+        if ImageService.release_image(cursor, existing["image_filename"]):
+            released.append(existing["image_filename"])
+    
     conn.commit()
     conn.close()
+    ImageService.delete_released(released)
     
     return {"message": "Category updated", "id": category_id, "name": name}
 
@@ -175,16 +210,18 @@ def delete_category(category_name: str, auth=Depends(verify_token)):
     
     print(f"Found category: id={category['id']}, name='{category['name']}'")
     
-    if category["image_filename"]:
-        ImageService.delete_image(category["image_filename"])
-    
     # Delete the category
     cursor.execute("DELETE FROM categories WHERE id = ?", (category["id"],))
     # Also clean up product_categories references
     cursor.execute("DELETE FROM product_categories WHERE category_id = ?", (category["id"],))
     
+    # Delete the image unless a product or another category still uses it
+    released = ImageService.release_image(cursor, category["image_filename"])
+    
     conn.commit()
     conn.close()
+    if released:
+        ImageService.delete_released([category["image_filename"]])
     
     print(f"Category deleted: id={category['id']}, name='{category['name']}'")
     return {"message": "Category deleted", "name": category["name"]}
@@ -1,82 +1,109 @@
 """
 Checkout and payment endpoints.
 """
-from datetime import datetime
-
+import anyio
 import stripe
-from fastapi import APIRouter, Body, HTTPException
+from fastapi import APIRouter, Body, HTTPException, Request
 
 from ..config import settings
 from ..database import get_db_context
-from ..services.email import EmailService
-from ..services.inventory import InventoryService
-
+from ..services.checkout_sessions import CheckoutSessionService
+from ..services.inventory import InsufficientStockError, InvalidOrderLineError, InventoryService
+from ..services.orders import PAYMENT_PENDING, PAYMENT_REFUNDED, OrderService, PaymentMismatchError
+from ..services.quotes import QuoteError, QuoteService
+from ..services.stripe_events import StripeEventService, StripeSignatureError
+from ..services.stripe_gateway import StripeGateway, StripeUnavailableError
 
-# Initialize Stripe
-stripe.api_key = settings.STRIPE_SECRET_KEY
 
 router = APIRouter(tags=["checkout"])
 
 
-def _save_order(customer, items, payment_method, delivery_method="pickup", delivery_cost=0, items_total=0):
-    """Save an order to the database."""
-    if not items_total:
-        items_total = sum(item.get("price", 0) * item.get("quantity", 1) for item in items)
-    total = items_total + delivery_cost
+def _out_of_stock(error: InsufficientStockError) -> HTTPException:
+    return HTTPException(
+        status_code=409,
+        detail={"message": "Some items are out of stock", "shortages": error.shortages},
+    )
 
-    with get_db_context() as conn:
+
+def _stripe_unavailable() -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail="Payment service is temporarily unavailable, please try again shortly",
+        headers={"Retry-After": str(int(settings.STRIPE_BREAKER_RESET_SECONDS))},
+    )
+
+
+def _quoted_order(order: dict) -> dict:
+    """
+    The order with the lines and totals of its quoteToken, so the customer
+    pays the shop's prices rather than whatever the browser sent.
+    
+    Orders without a token are refused when REQUIRE_CART_QUOTE is set and
+    otherwise priced from the database, so their prices and totals are
+    never taken from the request either.
+    """
+    if order.get("quoteToken"):
+        try:
+            return QuoteService.apply(order)
+        except QuoteError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    if settings.REQUIRE_CART_QUOTE:
+        raise HTTPException(status_code=400, detail="Cart quote required, please review your cart again")
+    try:
+        return QuoteService.reprice(order)
+    except (QuoteError, InvalidOrderLineError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def _hold_cart(payment_intent_id: str, order: dict) -> str:
+    """Hold the cart's stock and store the cart for its payment intent in one transaction."""
+    with get_db_context(immediate=True) as conn:
         cursor = conn.cursor()
-        customer_name = f"{customer.get('firstName', '')} {customer.get('lastName', '')}".strip()
-
-        payment_status = "betald" if payment_method == "stripe" else "ej_betald"
-        pickup_status = "ej_hamtad"
-
-        cursor.execute(
-            """INSERT INTO orders (customer_name, customer_email, customer_phone,
-               delivery_method, payment_method, items_total, delivery_cost, total,
-               payment_status, pickup_status, notes, created_at)
-               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-            (
-                customer_name,
-                customer.get("email", ""),
-                customer.get("phone", ""),
-                delivery_method,
-                payment_method,
-                items_total,
-                delivery_cost,
-                total,
-                payment_status,
-                pickup_status,
-                "",
-                datetime.utcnow().isoformat(),
-            )
-        )
-        order_id = cursor.lastrowid
-
-        for item in items:
-            item_cost = None
-            pid = item.get("id")
-            if pid:
-                cursor.execute("SELECT cost FROM products WHERE id = ?", (pid,))
-                row = cursor.fetchone()
-                if row:
-                    item_cost = row["cost"]
-            cursor.execute(
-                """INSERT INTO order_items (order_id, product_id, product_name, size, color, quantity, price, cost)
-                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
-                (
-                    order_id,
-                    pid,
-                    item.get("name", ""),
-                    item.get("selectedSize", ""),
-                    item.get("color", ""),
-                    item.get("quantity", 1),
-                    item.get("price", 0),
-                    item_cost,
-                )
+        hold_expires_at = InventoryService.hold_stock(cursor, payment_intent_id, order.get("items", []))
+        OrderService.record_payment_intent(cursor, payment_intent_id, order)
+    return hold_expires_at
+
+
+def _open_session(token: str):
+    """The session's intent if it can still be paid; sessions whose intent is settled are dropped."""
+    session = CheckoutSessionService.get(token)
+    if session is None:
+        return None
+    payment = OrderService.get_payment(session["payment_intent_id"])
+    if payment is not None and payment["status"] != PAYMENT_PENDING:
+        CheckoutSessionService.discard(token)
+        return None
+    return session
+
+
+async def _session_intent(session, params: dict, params_hash: str):
+    """
+    The payment intent for a checkout: the session's own when it has one,
+    updated if the amount or metadata changed, otherwise a new one.
+    
+    Returns:
+        Tuple of the intent id and client secret
+    """
+    if session is not None:
+        if session["params_hash"] == params_hash:
+            return session["payment_intent_id"], session["client_secret"]
+        try:
+            intent = await StripeGateway.run(
+                StripeGateway.update_payment_intent,
+                session["payment_intent_id"],
+                {"amount": params["amount"], "metadata": params["metadata"]},
             )
+            return intent.id, intent.client_secret
+        except stripe.InvalidRequestError as e:
+            # Paid, processing or canceled meanwhile: start over with a new intent
+            print(f"Cannot update payment intent {session['payment_intent_id']}: {e}")
+    intent = await StripeGateway.run(StripeGateway.create_payment_intent, params)
+    return intent.id, intent.client_secret
 
-    return order_id
+
+def _store_cart(payment_intent_id: str, order: dict) -> None:
+    with get_db_context() as conn:
+        OrderService.record_payment_intent(conn.cursor(), payment_intent_id, order)
 
 
 @router.get("/stripe-publishable-key")
@@ -88,37 +115,90 @@ def get_stripe_publishable_key():
 
 
 @router.post("/create-payment-intent")
-def create_payment_intent(order: dict = Body(...)):
+async def create_payment_intent(order: dict = Body(...)):
     """
-    Create a Stripe payment intent.
+    Create a Stripe payment intent and hold the cart's stock for
+    STOCK_HOLD_SECONDS while the customer pays.
+    
+    Calls that carry the same sessionToken reuse one intent: its amount
+    and metadata are updated when the cart changed, and nothing is sent to
+    Stripe when it did not. The hold is renewed either way.
+    
+    Stripe is called on the Stripe executor and the database work runs in
+    worker threads, so waiting on Stripe holds up no other requests.
     
     Args:
-        order: Order details including total amount
+        order: Order details including total amount and, optionally, the
+            checkout's sessionToken and a quoteToken from /cart/quote
         
     Returns:
-        Client secret for completing payment
+        Client secret for completing payment and when the hold expires;
+        409 with the shortages if any line is not available, 400 for an
+        invalid quantity, 503 if Stripe is unavailable
     """
+    order = _quoted_order(order)
+    items = order.get("items", [])
+    token = order.get("sessionToken")
+    if token and len(str(token)) > settings.CHECKOUT_SESSION_MAX_TOKEN_LENGTH:
+        raise HTTPException(status_code=400, detail="sessionToken is too long")
+    session = await anyio.to_thread.run_sync(_open_session, token) if token else None
+    
+    # Fail before talking to Stripe if the cart cannot be filled anyway; the
+    # session's own hold counts as available
     try:
-        total_amount = int(order.get("total", 0) * 100)  # Convert to cents
-        
-        intent = stripe.PaymentIntent.create(
-            amount=total_amount,
-            currency='sek',
-            automatic_payment_methods={'enabled': True},
-            metadata={
-                'customer_email': order.get("customer", {}).get("email", ""),
-                'customer_name': f"{order.get('customer', {}).get('firstName', '')} {order.get('customer', {}).get('lastName', '')}",
-                'items': str(len(order.get("items", [])))
-            }
+        shortages = await anyio.to_thread.run_sync(
+            InventoryService.check_stock, items, session["payment_intent_id"] if session else None
         )
-        
-        return {
-            "client_secret": intent.client_secret,
-            "publishable_key": settings.STRIPE_PUBLISHABLE_KEY
+    except InvalidOrderLineError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if shortages:
+        raise _out_of_stock(InsufficientStockError(shortages))
+    
+    total_amount = OrderService.payment_amount(order)
+    params = {
+        'amount': total_amount,
+        'currency': 'sek',
+        'automatic_payment_methods': {'enabled': True},
+        'metadata': {
+            'customer_email': order.get("customer", {}).get("email", ""),
+            'customer_name': f"{order.get('customer', {}).get('firstName', '')} {order.get('customer', {}).get('lastName', '')}",
+            'items': str(len(order.get("items", [])))
         }
+    }
+    params_hash = CheckoutSessionService.params_hash(params)
+    try:
+        intent_id, client_secret = await _session_intent(session, params, params_hash)
+    except StripeUnavailableError as e:
+        print(f"Stripe unavailable: {e}")
+        raise _stripe_unavailable()
     except Exception as e:
         print(f"Stripe error: {e}")
         raise HTTPException(status_code=500, detail="Failed to create payment intent")
+    
+    # Hold the cart's stock while the customer pays and store the cart, so
+    # the order can be saved from the webhook; saving the order turns the
+    # hold into the stock reduction
+    try:
+        hold_expires_at = await anyio.to_thread.run_sync(_hold_cart, intent_id, order)
+    except InsufficientStockError as e:
+        try:
+            await StripeGateway.run(StripeGateway.cancel_payment_intent, intent_id)
+        except Exception as cancel_error:
+            print(f"Failed to cancel payment intent {intent_id}: {cancel_error}")
+        # A reused intent still holds the stock of its previous cart
+        await anyio.to_thread.run_sync(OrderService.cancel_payment, intent_id)
+        if token:
+            await anyio.to_thread.run_sync(CheckoutSessionService.discard, token)
+        raise _out_of_stock(e)
+    
+    if token:
+        await anyio.to_thread.run_sync(CheckoutSessionService.save, token, intent_id, client_secret, params_hash)
+    
+    return {
+        "client_secret": client_secret,
+        "publishable_key": settings.STRIPE_PUBLISHABLE_KEY,
+        "hold_expires_at": hold_expires_at,
+    }
 
 
 @router.post("/checkout")
@@ -126,74 +206,135 @@ def create_order(order: dict = Body(...)):
     """
     Process a checkout order.
     
-    Sends email notification and updates inventory.
+    Reserves stock and saves the order in one transaction; the notification
+    email is queued with the order and sent in the background.
+    
+    Returns 409 with the shortages if any line is out of stock and 400 if
+    a quantity is invalid or the order's quoteToken is invalid or has
+    expired.
     """
     print("Received order:", order)
+    order = _quoted_order(order)
     
     customer = order.get("customer", {})
     items = order.get("items", [])
     payment = customer.get("payment") or order.get("payment")
     
-    # Send email notification
-    try:
-        EmailService.send_order_notification(customer, items, payment)
-    except Exception as e:
-        print(f"Failed to send email: {e}")
-        raise HTTPException(status_code=500, detail="Failed to send email")
-    
-    # Update stock levels
-    InventoryService.reduce_stock(items)
-
-    # Save order to database
+    # Reserve stock, save order and queue the notification email
     try:
         delivery_method = order.get("deliveryMethod", "pickup")
         delivery_cost = order.get("deliveryCost", 0)
         items_total = order.get("itemsTotal", 0)
-        _save_order(customer, items, payment, delivery_method, delivery_cost, items_total)
+        OrderService.save_order(customer, items, payment, delivery_method, delivery_cost, items_total)
+    except InsufficientStockError as e:
+        raise _out_of_stock(e)
+    except InvalidOrderLineError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         print(f"Failed to save order to database: {e}")
+        raise HTTPException(status_code=500, detail="Failed to save order")
 
-    return {"message": "Order received, email sent, and stock updated"}
+    return {"message": "Order received and stock updated"}
 
 
 @router.post("/confirm-payment")
-def confirm_payment(payment_data: dict = Body(...)):
+async def confirm_payment(payment_data: dict = Body(...)):
+    """
+    Called by the browser once Stripe has taken the payment.
+    
+    With STRIPE_WEBHOOK_SECRET set the order is saved from the
+    payment_intent.succeeded webhook, so this only makes sure the cart is
+    stored and answers straight away. Without it the payment's status is
+    fetched from Stripe and the order saved here.
+    
+    The cart stored when the intent was created is used rather than the
+    order in the request; an order sent for an intent without a stored
+    cart must total the amount Stripe charged.
+    
+    Returns 409 with the shortages if the order could not be filled (the
+    payment is refunded), 400 if the order does not match the payment and
+    503 if Stripe is unavailable.
+    """
     try:
         payment_intent_id = payment_data.get("payment_intent_id")
         order = payment_data.get("order")
         
+        payment = await anyio.to_thread.run_sync(OrderService.get_payment, payment_intent_id)
+        if payment and payment["order_id"]:
+            return {"message": "Payment confirmed and order processed", "order_id": payment["order_id"]}
+        if payment and payment["status"] == PAYMENT_REFUNDED:
+            raise _out_of_stock(InsufficientStockError([]))
+        if payment and payment["order"]:
+            order = payment["order"]
+        elif order:
+            order = _quoted_order(order)
+        
+        if settings.STRIPE_WEBHOOK_SECRET:
+            if (payment is None or payment["order"] is None) and order:
+                await anyio.to_thread.run_sync(_store_cart, payment_intent_id, order)
+                # An event that arrived before the cart was stored is retried
+                StripeEventService.notify()
+            return {"message": "Payment received, order is being processed", "status": "processing"}
+        
         # Verify payment intent
-        intent = stripe.PaymentIntent.retrieve(payment_intent_id)
+        try:
+            intent = await StripeGateway.run(StripeGateway.retrieve_payment_intent, payment_intent_id)
+        except StripeUnavailableError as e:
+            print(f"Stripe unavailable: {e}")
+            raise _stripe_unavailable()
         
         if intent.status != "succeeded":
             raise HTTPException(status_code=400, detail="Payment not completed")
         
-        customer = order.get("customer", {})
-        items = order.get("items", [])
-        
-        # Send email notification
+        # Reserve stock, save order and queue the notification email
         try:
-            EmailService.send_order_notification(customer, items, "stripe")
-        except Exception as e:
-            print(f"Failed to send email: {e}")
-            raise HTTPException(status_code=500, detail="Failed to send email")
-        
-        # Update stock levels
-        InventoryService.reduce_stock(items)
-
-        # Save order to database
-        try:
-            delivery_method = order.get("deliveryMethod", "pickup")
-            delivery_cost = order.get("deliveryCost", 0)
-            items_total = order.get("itemsTotal", 0)
-            _save_order(customer, items, "stripe", delivery_method, delivery_cost, items_total)
+            order_id = await anyio.to_thread.run_sync(
+                OrderService.complete_stripe_payment, payment_intent_id, order, intent.amount
+            )
+        except PaymentMismatchError as e:
+            print(f"Rejected payment confirmation: {e}")
+            raise HTTPException(status_code=400, detail="Order does not match the payment")
+        except InvalidOrderLineError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except InsufficientStockError as e:
+            # The hold expired and the stock was sold meanwhile: the money was given back
+            raise _out_of_stock(e)
         except Exception as e:
             print(f"Failed to save order to database: {e}")
+            raise HTTPException(status_code=500, detail="Failed to save order")
 
-        return {"message": "Payment confirmed and order processed"}
+        return {"message": "Payment confirmed and order processed", "order_id": order_id}
         
     except HTTPException:
         raise  # Re-raise HTTP exceptions as-is
     except Exception as e:
         print(f"Payment confirmation error: {e}")
         raise HTTPException(status_code=500, detail="Failed to confirm payment")
+
+
+@router.post("/stripe/webhook")
+async def stripe_webhook(request: Request):
+    """
+    Receive Stripe events.
+    
+    The signature is checked against STRIPE_WEBHOOK_SECRET and the event is
+    stored; the order is saved by a background worker, so Stripe gets its
+    answer without waiting for the database work. Redelivered events are
+    recognised by their id and processed only once.
+    
+    Returns:
+        {"received": True}; 400 if the signature is invalid
+    """
+    if not settings.STRIPE_WEBHOOK_SECRET:
+        raise HTTPException(status_code=500, detail="Stripe webhook secret not configured")
+    
+    payload = await request.body()
+    try:
+        event = StripeEventService.verify(payload, request.headers.get("stripe-signature", ""))
+    except StripeSignatureError as e:
+        print(f"Rejected Stripe webhook: {e}")
+        raise HTTPException(status_code=400, detail="Invalid signature")
+    
+    if await anyio.to_thread.run_sync(StripeEventService.record, event):
+        StripeEventService.notify()
+    return {"received": True}
@@ -0,0 +1,156 @@
+"""
+Image serving endpoints: stored originals, thumbnails and on-demand variants.
+"""
+import hashlib
+import mimetypes
+import os
+from functools import lru_cache
+from typing import Optional
+from urllib.parse import quote
+
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import FileResponse, RedirectResponse, Response
+
+from ..config import settings
+from ..services.image_cache import ImageVariantCache, VariantError
+from ..services.storage import AREA_ORIGINALS, AREA_THUMBNAILS, AREA_VARIANTS, CACHE_CONTROL, get_storage
+
+
+router = APIRouter(tags=["images"])
+
+ETAG_CHUNK_SIZE = 1024 * 1024
+
+
+@lru_cache(maxsize=4096)
+def _content_etag(path: str, mtime_ns: int, size: int) -> str:
+    """
+    Strong ETag from a file's contents.
+    
+    Keyed on path, mtime and size so each file is hashed once per change
+    rather than once per request.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(ETAG_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return f'"{digest.hexdigest()[:32]}"'
+
+
+def _not_modified(request: Request, etag: str) -> bool:
+    """Check If-None-Match against an ETag (weak comparison, as RFC 9110 requires)."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    tags = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    return etag in tags
+
+
+def _accel_redirect_uri(path: str) -> Optional[str]:
+    """
+    Internal nginx URI for a file under UPLOAD_DIR, or None if X-Accel-Redirect is off.
+    
+    IMAGE_ACCEL_REDIRECT_PREFIX must name an `internal` nginx location
+    aliased to the upload volume.
+    """
+    prefix = settings.IMAGE_ACCEL_REDIRECT_PREFIX.rstrip("/")
+    if not prefix:
+        return None
+    relative = os.path.relpath(path, settings.UPLOAD_DIR)
+    if relative.startswith(os.pardir):
+        return None
+    return f"{prefix}/{quote(relative.replace(os.sep, '/'))}"
+
+
+def _file_response(request: Request, path: str, cache_control: str, media_type: Optional[str] = None) -> Response:
+    """
+    Serve a local image file with caching headers.
+    
+    Sends a strong ETag and answers matching If-None-Match with 304. With
+    X-Accel-Redirect configured, the app only sends headers and nginx
+    transfers the file.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Not Found")
+    
+    etag = _content_etag(path, stat.st_mtime_ns, stat.st_size)
+    headers = {"Cache-Control": cache_control, "ETag": etag}
+    if _not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+    
+    media_type = media_type or mimetypes.guess_type(path)[0] or "application/octet-stream"
+    accel_uri = _accel_redirect_uri(path)
+    if accel_uri:
+        headers["X-Accel-Redirect"] = accel_uri
+        return Response(headers=headers, media_type=media_type)
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+
+def _serve_stored(request: Request, area: str, filename: str) -> Response:
+    """
+    Serve a stored file.
+    
+    When the storage backend has a public URL for the file (object storage,
+    a CDN, or a web server in front of the upload volume) the client is
+    redirected there, so the bytes never pass through the app.
+    """
+    storage = get_storage()
+    url = storage.url(area, filename)
+    if url:
+        return RedirectResponse(url, status_code=302)
+    
+    path = storage.local_path(area, filename)
+    if not path:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return _file_response(request, path, CACHE_CONTROL[area])
+
+
+@router.get("/uploads/{filename}")
+def get_upload(filename: str, request: Request):
+    return _serve_stored(request, AREA_ORIGINALS, filename)
+
+
+@router.get("/thumbnails/{filename}")
+def get_thumbnail(filename: str, request: Request):
+    return _serve_stored(request, AREA_THUMBNAILS, filename)
+
+
+@router.get("/img/{filename}")
+def get_image_variant(
+    filename: str,
+    request: Request,
+    w: Optional[int] = Query(None),
+    h: Optional[int] = Query(None),
+    fit: str = Query("contain"),
+    fmt: str = Query("jpeg"),
+):
+    """
+    Serve a resized variant of an uploaded image.
+    
+    Variants are rendered from the stored original on first request and
+    served from the disk cache afterwards. With remote storage they are
+    uploaded once and clients are redirected to them.
+    """
+    if os.path.basename(filename) != filename or filename.startswith("."):
+        raise HTTPException(status_code=400, detail="Invalid filename")
+    
+    storage = get_storage()
+    try:
+        if storage.remote:
+            url = ImageVariantCache.publish_variant(storage, filename, w, h, fit, fmt)
+            path = None
+        else:
+            path = ImageVariantCache.get_variant(filename, w, h, fit, fmt)
+            url = storage.url(AREA_VARIANTS, os.path.basename(path)) if path else None
+    except VariantError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    if url:
+        return RedirectResponse(url, status_code=302)
+    if not path:
+        raise HTTPException(status_code=404, detail="Image not found")
+    
+    return _file_response(request, path, CACHE_CONTROL[AREA_VARIANTS], ImageVariantCache.MEDIA_TYPES[fmt])
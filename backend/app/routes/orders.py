@@ -7,7 +7,7 @@ import jwt
 from fastapi import APIRouter, Body, Depends, HTTPException, Request
 
 from ..config import settings
-from ..database import get_db_context
+from ..database import db_timestamp, get_db_context
 
 
 router = APIRouter(prefix="/orders", tags=["orders"])
@@ -167,7 +167,7 @@ def update_order(order_id: int, body: dict = Body(...), request: Request = None,
                 body.get("payment_status", "ej_betald"),
                 body.get("pickup_status", "ej_hamtad"),
                 body.get("notes", ""),
-                body.get("created_at") or datetime.utcnow().isoformat(),
+                body.get("created_at") or db_timestamp(datetime.utcnow()),
                 items_total,
                 items_total,
                 order_id,
@@ -230,7 +230,7 @@ def create_order_manual(body: dict = Body(...), request: Request = None, _=Depen
         notes = body.get("notes", "")
         payment_status = body.get("payment_status", "ej_betald")
         pickup_status = body.get("pickup_status", "ej_hamtad")
-        created_at = body.get("created_at") or datetime.utcnow().isoformat()
+        created_at = body.get("created_at") or db_timestamp(datetime.utcnow())
 
         items_total = sum(item.get("price", 0) * item.get("quantity", 1) for item in items)
 
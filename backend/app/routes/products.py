@@ -7,13 +7,16 @@ import sqlite3
 from datetime import datetime
 from typing import List, Optional
 
+import anyio
 from fastapi import APIRouter, Depends, File, Form, HTTPException, Request, UploadFile
 
 from ..config import settings
 from ..database import get_db
 from ..dependencies import verify_token
-from ..services.image import ImageService
+from ..services.image import ImageService, ImageUploadError
 from ..services.inventory import normalize_sizes, move_between_locations
+from ..services.pricing import ensure_sale_price_from_discount
+from ..services.stock_holds import StockHoldService
 
 
 router = APIRouter(prefix="/products", tags=["products"])
@@ -21,7 +24,12 @@ router = APIRouter(prefix="/products", tags=["products"])
 
 def get_product_images(cursor, product_id: int) -> tuple:
     cursor.execute(
-        "SELECT filename, is_main FROM product_images WHERE product_id = ? ORDER BY is_main DESC, id ASC",
+        """SELECT pi.filename, pi.is_main, pi.placeholder, im.width, im.height
+           FROM product_images pi
+           LEFT JOIN image_metadata im
+               ON im.source_filename = pi.filename AND im.variant = 'original'
+           WHERE pi.product_id = ?
+           ORDER BY pi.is_main DESC, pi.id ASC""",
         (product_id,)
     )
     image_rows = cursor.fetchall()
@@ -30,7 +38,12 @@ def get_product_images(cursor, product_id: int) -> tuple:
         (img["filename"] for img in image_rows if img["is_main"]),
         images[0] if images else None
     )
-    return images, main_image
+    placeholders = {img["filename"]: img["placeholder"] for img in image_rows if img["placeholder"]}
+    dimensions = {
+        img["filename"]: {"width": img["width"], "height": img["height"]}
+        for img in image_rows if img["width"]
+    }
+    return images, main_image, placeholders, dimensions
 
 
 def get_product_categories(cursor, product_id: int) -> list:
@@ -45,44 +58,6 @@ def get_product_categories(cursor, product_id: int) -> list:
     return [{"id": cat["id"], "name": cat["name"]} for cat in category_rows]
 
 
-def ensure_sale_price_from_discount(product_dict: dict) -> dict:
-    discount_percent = product_dict.get("discount_percent")
-    price = product_dict.get("price")
-    current_sale_price = product_dict.get("sale_price")
-    
-    if discount_percent is not None:
-        try:
-            discount_percent = int(discount_percent) if not isinstance(discount_percent, int) else discount_percent
-        except (ValueError, TypeError):
-            discount_percent = None
-    
-    if price is not None:
-        try:
-            price = int(price) if not isinstance(price, int) else price
-        except (ValueError, TypeError):
-            price = None
-    
-    if discount_percent is not None and discount_percent > 0 and price and price > 0:
-        calculated_sale_price = int(price * (1 - discount_percent / 100))
-        if calculated_sale_price > 0 and calculated_sale_price < price:
-            product_dict["sale_price"] = calculated_sale_price
-        else:
-            product_dict["sale_price"] = None
-    elif current_sale_price is not None:
-        try:
-            current_sale_price = int(current_sale_price) if not isinstance(current_sale_price, int) else current_sale_price
-            if current_sale_price > 0 and price and current_sale_price < price:
-                product_dict["sale_price"] = current_sale_price
-            else:
-                product_dict["sale_price"] = None
-        except (ValueError, TypeError):
-            product_dict["sale_price"] = None
-    else:
-        product_dict["sale_price"] = None
-    
-    return product_dict
-
-
 def check_new_status(product_dict: dict) -> dict:
     """Check if product's 'new' status is still valid based on new_until date."""
     is_new = product_dict.get("is_new", 0)
@@ -101,7 +76,16 @@ def check_new_status(product_dict: dict) -> dict:
     return product_dict
 
 
-def build_product_response(cursor, product) -> dict:
+def build_product_response(cursor, product, held: dict = None) -> dict:
+    """
+    Build the API representation of a product row.
+    
+    Args:
+        cursor: Database cursor
+        product: Product row
+        held: Active stock holds keyed by (product id, size), as loaded by
+            StockHoldService.held_quantities; looked up for this product when None
+    """
     product_dict = dict(product)
     
     # Normalize sizes
@@ -112,10 +96,19 @@ def build_product_response(cursor, product) -> dict:
         except (json.JSONDecodeError, TypeError):
             pass
     
+    # Stock held for carts being paid for, so the shop can show what is left
+    if held is None:
+        held = StockHoldService.held_quantities(cursor, [product["id"]])
+    product_dict["held_sizes"] = {
+        size: quantity for (product_id, size), quantity in held.items() if product_id == product["id"]
+    }
+    
     # Fetch images
-    images, main_image = get_product_images(cursor, product["id"])
+    images, main_image, placeholders, dimensions = get_product_images(cursor, product["id"])
     product_dict["images"] = images
     product_dict["main_image"] = main_image
+    product_dict["image_placeholders"] = placeholders
+    product_dict["image_dimensions"] = dimensions
     
     # Fetch categories
     categories = get_product_categories(cursor, product["id"])
@@ -137,8 +130,9 @@ def read_products():
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM products")
     products = cursor.fetchall()
+    held = StockHoldService.held_quantities(cursor, [product["id"] for product in products])
     
-    result = [build_product_response(cursor, product) for product in products]
+    result = [build_product_response(cursor, product, held) for product in products]
     
     conn.close()
     return result
@@ -157,8 +151,9 @@ def get_grouped_products(category: str):
         WHERE c.name = ?
     """, (category,))
     products = cursor.fetchall()
+    held = StockHoldService.held_quantities(cursor, [product["id"] for product in products])
     
-    result = [build_product_response(cursor, product) for product in products]
+    result = [build_product_response(cursor, product, held) for product in products]
     
     conn.close()
     return result
@@ -177,8 +172,9 @@ def get_products_by_category(category: str):
         WHERE c.name = ?
     """, (category,))
     products = cursor.fetchall()
+    held = StockHoldService.held_quantities(cursor, [product["id"] for product in products])
     
-    result = [build_product_response(cursor, product) for product in products]
+    result = [build_product_response(cursor, product, held) for product in products]
     
     conn.close()
     return result
@@ -255,6 +251,47 @@ def link_product_categories(cursor, product_id: int, category_ids: Optional[str]
         print("No categories to link")
 
 
+def store_product_images(images: list, image_files: list) -> list:
+    """
+    Encode and store uploaded images before the product's transaction is
+    opened, so the database write lock is not held while they are encoded.
+    
+    Returns:
+        (stored image, placeholder) per upload
+    """
+    return [
+        (ImageService.store_product_image(image_file, image.filename), ImageService.create_placeholder(image_file))
+        for image, image_file in zip(images, image_files)
+    ]
+
+
+def attach_product_images(cursor, product_id: int, uploads: list) -> None:
+    """
+    Link images stored by store_product_images() to a product.
+    
+    A photo the product already has, or one uploaded twice in the same
+    request, is linked only once. If the product has no main image, the
+    first image actually linked becomes it.
+    """
+    cursor.execute("SELECT filename, is_main FROM product_images WHERE product_id = ?", (product_id,))
+    rows = cursor.fetchall()
+    linked = {row["filename"] for row in rows}
+    has_main = any(row["is_main"] for row in rows)
+    
+    for stored, placeholder in uploads:
+        ImageService.record_product_image(cursor, stored)
+        filename = stored["filename"]
+        if filename in linked:
+            continue
+        
+        cursor.execute(
+            "INSERT INTO product_images (product_id, filename, is_main, placeholder) VALUES (?, ?, ?, ?)",
+            (product_id, filename, 0 if has_main else 1, placeholder)
+        )
+        linked.add(filename)
+        has_main = True
+
+
 @router.post("")
 def create_product(
     name: str = Form(...),
@@ -274,6 +311,14 @@ def create_product(
     new_until: str = Form(None),
     auth=Depends(verify_token),
 ):
+    # Check uploads from their headers, then encode and store them, before
+    # touching the database
+    try:
+        image_files = ImageService.probe_uploads(images)
+    except ImageUploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    uploads = store_product_images(images, image_files)
+    
     conn = get_db()
     cursor = conn.cursor()
 
@@ -313,16 +358,8 @@ def create_product(
     # Link categories
     link_product_categories(cursor, product_id, category_ids, category)
     
-    # Save images
-    for idx, image in enumerate(images):
-        original_bytes = image.file.read()
-        filename, _ = ImageService.save_product_image(original_bytes, image.filename)
-        
-        is_main = 1 if idx == 0 else 0
-        cursor.execute(
-            "INSERT INTO product_images (product_id, filename, is_main) VALUES (?, ?, ?)",
-            (product_id, filename, is_main)
-        )
+    # Link the stored images
+    attach_product_images(cursor, product_id, uploads)
     
     conn.commit()
     conn.close()
@@ -350,6 +387,19 @@ async def update_product(
     new_until: str = Form(None),
     auth=Depends(verify_token),
 ):
+    # Check new uploads from their headers, then encode and store them,
+    # before touching the database
+    form = await request.form()
+    images = [
+        image for image in form.getlist("images")
+        if hasattr(image, 'filename') and image.filename
+    ]
+    try:
+        image_files = ImageService.probe_uploads(images)
+    except ImageUploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    uploads = await anyio.to_thread.run_sync(store_product_images, images, image_files)
+    
     conn = get_db()
     cursor = conn.cursor()
 
@@ -392,26 +442,9 @@ async def update_product(
     cursor.execute("DELETE FROM product_categories WHERE product_id = ?", (product_id,))
     link_product_categories(cursor, product_id, category_ids, category)
     
-    # Handle new images
-    form = await request.form()
-    if "images" in form:
-        images = form.getlist("images")
-        cursor.execute(
-            "SELECT COUNT(*) as count FROM product_images WHERE product_id = ? AND is_main = 1",
-            (product_id,)
-        )
-        has_main = cursor.fetchone()["count"] > 0
-        
-        for idx, image in enumerate(images):
-            if hasattr(image, 'filename') and image.filename:
-                original_bytes = await image.read()
-                filename, _ = ImageService.save_product_image(original_bytes, image.filename)
-                
-                is_main = 1 if (not has_main and idx == 0) else 0
-                cursor.execute(
-                    "INSERT INTO product_images (product_id, filename, is_main) VALUES (?, ?, ?)",
-                    (product_id, filename, is_main)
-                )
+    # Link new images
+    if uploads:
+        attach_product_images(cursor, product_id, uploads)
     
     conn.commit()
     conn.close()
@@ -523,15 +556,15 @@ def delete_product_image(
     
     was_main = image["is_main"] == 1
     
-    # Delete files
-    ImageService.delete_image(filename)
-    
     # Remove from database
     cursor.execute(
         "DELETE FROM product_images WHERE product_id = ? AND filename = ?",
         (product_id, filename)
     )
     
+    # Delete files unless another product or category still uses them
+    released = ImageService.release_image(cursor, filename)
+    
     # Set new main image if needed
     if was_main:
         cursor.execute(
@@ -544,6 +577,8 @@ def delete_product_image(
     
     conn.commit()
     conn.close()
+    if released:
+        ImageService.delete_released([filename])
     
     return {"message": "Image deleted", "filename": filename}
 
@@ -551,8 +586,20 @@ def delete_product_image(
 @router.delete("/{product_id}")
 def delete_product(product_id: int, auth=Depends(verify_token)):
     conn = get_db()
-    conn.execute("DELETE FROM products WHERE id = ?", (product_id,))
+    cursor = conn.cursor()
+    
+    cursor.execute("SELECT DISTINCT filename FROM product_images WHERE product_id = ?", (product_id,))
+    filenames = [row["filename"] for row in cursor.fetchall()]
+    
+    cursor.execute("DELETE FROM product_images WHERE product_id = ?", (product_id,))
+    cursor.execute("DELETE FROM product_categories WHERE product_id = ?", (product_id,))
+    cursor.execute("DELETE FROM products WHERE id = ?", (product_id,))
+    
+    # Delete image files unless another product or category still uses them
+    released = [filename for filename in filenames if ImageService.release_image(cursor, filename)]
+    
     conn.commit()
     conn.close()
+    ImageService.delete_released(released)
     
     return {"message": "Product deleted", "id": product_id}
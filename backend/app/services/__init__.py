@@ -2,5 +2,15 @@
 Business logic services.
 """
 from .image import ImageService
+from .checkout_sessions import CheckoutSessionService
 from .email import EmailService
+from .email_outbox import EmailOutboxService
 from .inventory import InventoryService
+from .image_cache import ImageVariantCache
+from .image_metadata import ImageMetadataService
+from .orders import OrderService
+from .quotes import QuoteService
+from .stock_holds import StockHoldService
+from .stripe_events import StripeEventService
+from .stripe_gateway import StripeGateway
+from .storage import LocalStorage, S3Storage, get_storage
@@ -0,0 +1,117 @@
+"""
+Background threads and throttled cleanup shared by the services.
+"""
+import threading
+import time
+from typing import Callable, Optional
+
+
+class PurgeThrottle:
+    """
+    Lets a lazy cleanup run at most once per interval.
+    
+    Services that delete their expired rows from the request path (rather
+    than from a worker) keep one of these, so only the first request after
+    each interval pays for the DELETE.
+    """
+    
+    def __init__(self):
+        self._last_run = 0.0
+    
+    def due(self, interval_seconds: float, force: bool = False) -> bool:
+        """
+        Whether the cleanup should run now; if so, the interval starts again.
+        
+        Args:
+            interval_seconds: Minimum time between runs
+            force: Run regardless of the interval
+        """
+        now = time.monotonic()
+        if not force and now - self._last_run < interval_seconds:
+            return False
+        self._last_run = now
+        return True
+
+
+class BackgroundWorker:
+    """
+    A daemon thread that runs one step of work over and over.
+    
+    After each step the thread waits interval_seconds or until wake() is
+    called. A step that returns True (not merely a truthy result) has more
+    work due already and is run again straight away. Errors are printed
+    and the loop carries on.
+    """
+    
+    def __init__(
+        self,
+        name: str,
+        step: Callable[[], Optional[bool]],
+        interval_seconds: float,
+        on_exit: Callable[[], None] = None,
+        wait_first: bool = False
+    ):
+        """
+        Args:
+            name: Thread name, also used in error messages
+            step: The work to repeat
+            interval_seconds: Wait between steps
+            on_exit: Called on the thread once it has been stopped
+            wait_first: Wait one interval before the first step
+        """
+        self.name = name
+        self._step = step
+        self._interval_seconds = interval_seconds
+        self._on_exit = on_exit
+        self._wait_first = wait_first
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+    
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+    
+    def start(self) -> bool:
+        """
+        Returns:
+            False if the thread is already running
+        """
+        if self.running:
+            return False
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+        return True
+    
+    def stop(self) -> None:
+        """Ask the thread to finish after its current step."""
+        self._stop.set()
+        self._wake.set()
+    
+    def wake(self) -> None:
+        """Run the next step now instead of at the end of the wait."""
+        self._wake.set()
+    
+    def join(self, timeout: float = None) -> None:
+        if self._thread is not None:
+            self._thread.join(timeout)
+    
+    def _wait(self) -> None:
+        self._wake.wait(self._interval_seconds)
+        self._wake.clear()
+    
+    def _run(self) -> None:
+        if self._wait_first:
+            self._wait()
+        while not self._stop.is_set():
+            busy = False
+            try:
+                busy = self._step() is True
+            except Exception as e:
+                print(f"{self.name} worker error: {e}")
+            if not busy and not self._stop.is_set():
+                self._wait()
+        
+        if self._on_exit is not None:
+            self._on_exit()
@@ -0,0 +1,100 @@
+"""
+Checkout sessions: the Stripe payment intent behind a customer's checkout.
+"""
+import hashlib
+import json
+from datetime import datetime, timedelta
+from typing import Optional
+
+from ..config import settings
+from ..database import db_timestamp, get_db_context
+from .background import PurgeThrottle
+
+
+class CheckoutSessionService:
+    """
+    Remembers the payment intent created for a checkout session.
+    
+    Sessions are keyed by a token the browser generates once per checkout.
+    When /create-payment-intent is called again for the same session (the
+    customer changed a quantity or the delivery method) the existing intent
+    is updated rather than a new one created, or returned as it is when the
+    amount and metadata have not changed. A session expires
+    CHECKOUT_SESSION_TTL_SECONDS after it was last used; expired sessions
+    are purged at most once per CHECKOUT_SESSION_PURGE_SECONDS.
+    """
+    
+    _purge_throttle = PurgeThrottle()
+    
+    @staticmethod
+    def params_hash(params: dict) -> str:
+        """Fingerprint of the parameters an intent was created or last updated with."""
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+    
+    @staticmethod
+    def get(token: str) -> Optional[dict]:
+        """
+        An unexpired session.
+        
+        Returns:
+            Dict with payment_intent_id, client_secret and params_hash, or None
+        """
+        with get_db_context() as conn:
+            row = conn.execute(
+                """SELECT payment_intent_id, client_secret, params_hash FROM checkout_sessions
+                   WHERE token = ? AND expires_at > ?""",
+                (token, db_timestamp(datetime.utcnow()))
+            ).fetchone()
+        return dict(row) if row else None
+    
+    @classmethod
+    def save(cls, token: str, payment_intent_id: str, client_secret: str, params_hash: str) -> None:
+        """Store or refresh a session's intent and extend its lifetime."""
+        now = datetime.utcnow()
+        with get_db_context() as conn:
+            conn.execute(
+                """INSERT INTO checkout_sessions
+                   (token, payment_intent_id, client_secret, params_hash, created_at, updated_at, expires_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(token) DO UPDATE SET
+                       payment_intent_id = excluded.payment_intent_id,
+                       client_secret = excluded.client_secret,
+                       params_hash = excluded.params_hash,
+                       updated_at = excluded.updated_at,
+                       expires_at = excluded.expires_at""",
+                (
+                    token,
+                    payment_intent_id,
+                    client_secret,
+                    params_hash,
+                    db_timestamp(now),
+                    db_timestamp(now),
+                    db_timestamp(now + timedelta(seconds=settings.CHECKOUT_SESSION_TTL_SECONDS)),
+                )
+            )
+        cls.purge_expired()
+    
+    @staticmethod
+    def discard(token: str) -> None:
+        """Forget a session, so its next call creates a new intent."""
+        with get_db_context() as conn:
+            conn.execute("DELETE FROM checkout_sessions WHERE token = ?", (token,))
+    
+    @classmethod
+    def purge_expired(cls, force: bool = False) -> int:
+        """
+        Delete expired sessions, at most once per CHECKOUT_SESSION_PURGE_SECONDS
+        unless forced.
+        
+        Returns:
+            Number of sessions removed
+        """
+        if not cls._purge_throttle.due(settings.CHECKOUT_SESSION_PURGE_SECONDS, force):
+            return 0
+        with get_db_context() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "DELETE FROM checkout_sessions WHERE expires_at <= ?",
+                (db_timestamp(datetime.utcnow()),)
+            )
+            return cursor.rowcount
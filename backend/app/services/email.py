@@ -2,14 +2,21 @@
 Email notification service.
 """
 import json
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+from functools import lru_cache
 from typing import List, Dict, Any
 
-from ..config import settings
-from ..database import get_db
-from .inventory import normalize_sizes
+from ..database import get_db_context
+from .email_outbox import EmailOutboxService
+from .inventory import InventoryService, normalize_sizes
+
+
+@lru_cache(maxsize=256)
+def _stocked_sizes(sizes_json: str) -> frozenset:
+    """Size names in a product's sizes JSON, parsed once per distinct value."""
+    try:
+        return frozenset(normalize_sizes(json.loads(sizes_json)))
+    except (TypeError, ValueError, AttributeError):
+        return frozenset()
 
 
 class EmailService:
@@ -31,7 +38,9 @@ class EmailService:
         cls,
         customer: Dict[str, Any],
         items: List[Dict[str, Any]],
-        payment_method: str
+        payment_method: str,
+        cursor=None,
+        products: Dict[int, Any] = None
     ) -> str:
         """
         Compose order notification email body.
@@ -40,6 +49,10 @@ class EmailService:
             customer: Customer information
             items: List of order items
             payment_method: Payment method used
+            cursor: Database cursor to look up stock with when products is
+                not given (a new connection is opened when None)
+            products: Product rows with sizes keyed by id, as already loaded
+                for the order
             
         Returns:
             Formatted email body
@@ -52,23 +65,17 @@ class EmailService:
         body += f"Betalning: {payment_display}\n\n"
         body += "Produkter:\n"
         
-        # Look up existing sizes for each product
-        product_sizes = {}
-        try:
-            conn = get_db()
-            cursor = conn.cursor()
-            for item in items:
-                product_id = item.get('id')
-                if product_id and product_id not in product_sizes:
-                    cursor.execute("SELECT sizes FROM products WHERE id = ?", (product_id,))
-                    row = cursor.fetchone()
-                    if row and row["sizes"]:
-                        product_sizes[product_id] = normalize_sizes(json.loads(row["sizes"]))
-                    else:
-                        product_sizes[product_id] = {}
-            conn.close()
-        except Exception:
-            product_sizes = {}
+        if products is None:
+            product_ids = [item.get('id') for item in items]
+            try:
+                if cursor is None:
+                    with get_db_context() as conn:
+                        products = InventoryService.get_products(conn.cursor(), product_ids)
+                else:
+                    products = InventoryService.get_products(cursor, product_ids)
+            except Exception as e:
+                print(f"Could not look up stock for order email: {e}")
+                products = {}
 
         for item in items:
             color = item.get('color', '')
@@ -77,7 +84,8 @@ class EmailService:
             line = f"- {item.get('name')}{color_str} ({size}) x{item.get('quantity')} – {item.get('price')} kr"
 
             # Check if ordered size exists in product stock
-            existing = product_sizes.get(item.get('id'), {})
+            product = products.get(item.get('id'))
+            existing = _stocked_sizes(product["sizes"]) if product and product["sizes"] else frozenset()
             if existing and str(size) not in existing:
                 line += "  ⚠️ Storlek finns ej i lager"
 
@@ -86,42 +94,38 @@ class EmailService:
         return body
     
     @classmethod
-    def send_order_notification(
+    def queue_order_notification(
         cls,
+        cursor,
         customer: Dict[str, Any],
         items: List[Dict[str, Any]],
-        payment_method: str
-    ) -> bool:
+        payment_method: str,
+        order_id: int = None,
+        products: Dict[int, Any] = None
+    ) -> int:
         """
-        Send order notification email.
+        Queue the order notification email in the outbox.
+        
+        The message is written with the order's cursor, so it is only sent
+        if the order is committed. The outbox worker delivers it.
         
         Args:
+            cursor: Cursor of the transaction saving the order
             customer: Customer information
             items: List of order items
             payment_method: Payment method used
+            order_id: Id of the saved order
+            products: Product rows already loaded for the order, so
+                composing the email needs no extra queries
             
         Returns:
-            True if email was sent successfully
-            
-        Raises:
-            Exception: If email sending fails
+            Outbox message id
         """
         payment_display = cls.get_payment_display_name(payment_method)
-        body = cls.compose_order_email(customer, items, payment_method)
-        
-        msg = MIMEMultipart()
-        msg["From"] = settings.SMTP_USER
-        msg["To"] = settings.EMAIL_RECEIVER
-        msg["Subject"] = f"Ny beställning på Yakimoto Dojo ({payment_display})"
-        msg.attach(MIMEText(body, "plain"))
-        
-        try:
-            with smtplib.SMTP(settings.SMTP_SERVER, settings.SMTP_PORT) as server:
-                server.starttls()
-                server.login(settings.SMTP_USER, settings.SMTP_PASSWORD)
-                server.send_message(msg)
-                print("Email sent.")
-                return True
-        except Exception as e:
-            print(f"Failed to send email: {e}")
-            raise
+        body = cls.compose_order_email(customer, items, payment_method, cursor, products)
+        return EmailOutboxService.enqueue(
+            cursor,
+            f"Ny beställning på Yakimoto Dojo ({payment_display})",
+            body,
+            order_id=order_id,
+        )
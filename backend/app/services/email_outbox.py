@@ -0,0 +1,297 @@
+"""
+Transactional outbox for notification emails.
+"""
+import smtplib
+import threading
+import time
+from datetime import datetime, timedelta
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from typing import Optional
+
+from ..config import settings
+from ..database import db_timestamp, get_db_context
+from .background import BackgroundWorker
+
+
+# Message states; 'sending' rows whose lease ran out are picked up again
+OUTBOX_PENDING = "pending"
+OUTBOX_SENDING = "sending"
+OUTBOX_SENT = "sent"
+OUTBOX_FAILED = "failed"
+
+# Failed messages listed in the stats
+RECENT_FAILURE_LIMIT = 20
+
+
+class EmailOutboxService:
+    """
+    Queues emails in the database and sends them from a background thread.
+    
+    Messages are inserted with the caller's cursor, so they are committed
+    (or rolled back) together with the data they describe. The worker claims
+    due messages with a lease, sends them over one SMTP connection that stays
+    open between messages, and reschedules failures with exponential backoff
+    until EMAIL_MAX_ATTEMPTS is reached.
+    """
+    
+    _worker: Optional[BackgroundWorker] = None
+    _send_lock = threading.Lock()
+    _smtp: Optional[smtplib.SMTP] = None
+    _smtp_used_at = 0.0
+    
+    @staticmethod
+    def enqueue(cursor, subject: str, body: str, recipient: str = None, order_id: int = None) -> int:
+        """
+        Add a message to the outbox.
+        
+        Args:
+            cursor: Cursor of the transaction the message belongs to
+            subject: Subject line
+            body: Plain-text body
+            recipient: Address to send to (EMAIL_RECEIVER when None)
+            order_id: Order the message is about, if any
+        
+        Returns:
+            Outbox message id
+        """
+        now = db_timestamp(datetime.utcnow())
+        cursor.execute(
+            """INSERT INTO email_outbox
+               (order_id, recipient, subject, body, status, attempts, next_attempt_at, created_at)
+               VALUES (?, ?, ?, ?, ?, 0, ?, ?)""",
+            (order_id, recipient, subject, body, OUTBOX_PENDING, now, now)
+        )
+        return cursor.lastrowid
+    
+    @classmethod
+    def notify(cls) -> None:
+        """Wake the worker after committing new messages."""
+        if cls._worker is not None:
+            cls._worker.wake()
+    
+    @staticmethod
+    def backoff_seconds(attempts: int) -> int:
+        """Delay before retrying a message that has failed `attempts` times."""
+        return min(settings.EMAIL_RETRY_BASE_SECONDS * 2 ** (attempts - 1), settings.EMAIL_RETRY_MAX_SECONDS)
+    
+    @staticmethod
+    def build_message(row: dict) -> MIMEMultipart:
+        """Turn an outbox row into a MIME message."""
+        msg = MIMEMultipart()
+        msg["From"] = settings.SMTP_USER
+        msg["To"] = row["recipient"] or settings.EMAIL_RECEIVER
+        msg["Subject"] = row["subject"]
+        msg.attach(MIMEText(row["body"], "plain"))
+        return msg
+    
+    @staticmethod
+    def _claim(limit: int) -> list:
+        """
+        Lease up to `limit` due messages to this worker.
+        
+        Each row is claimed with a compare-and-set on its state, so when
+        several processes run a worker only one of them sends a message.
+        """
+        now = datetime.utcnow()
+        lease_until = db_timestamp(now + timedelta(seconds=settings.EMAIL_SEND_LEASE_SECONDS))
+        claimed = []
+        with get_db_context() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """SELECT * FROM email_outbox
+                   WHERE status IN (?, ?) AND next_attempt_at <= ?
+                   ORDER BY next_attempt_at, id LIMIT ?""",
+                (OUTBOX_PENDING, OUTBOX_SENDING, db_timestamp(now), limit)
+            )
+            for row in cursor.fetchall():
+                cursor.execute(
+                    """UPDATE email_outbox SET status = ?, next_attempt_at = ?
+                       WHERE id = ? AND status = ? AND next_attempt_at = ?""",
+                    (OUTBOX_SENDING, lease_until, row["id"], row["status"], row["next_attempt_at"])
+                )
+                if cursor.rowcount:
+                    claimed.append(dict(row))
+        return claimed
+    
+    @classmethod
+    def _connection(cls) -> smtplib.SMTP:
+        """The shared SMTP connection, (re)opened when missing or idle too long."""
+        if cls._smtp is not None and time.monotonic() - cls._smtp_used_at > settings.SMTP_IDLE_SECONDS:
+            cls._close()
+        
+        if cls._smtp is None:
+            if not settings.SMTP_SERVER:
+                raise RuntimeError("SMTP_SERVER is not configured")
+            server = smtplib.SMTP(settings.SMTP_SERVER, settings.SMTP_PORT, timeout=settings.SMTP_TIMEOUT_SECONDS)
+            try:
+                if settings.SMTP_STARTTLS:
+                    server.starttls()
+                if settings.SMTP_PASSWORD:
+                    server.login(settings.SMTP_USER, settings.SMTP_PASSWORD)
+            except Exception:
+                server.close()
+                raise
+            cls._smtp = server
+        return cls._smtp
+    
+    @classmethod
+    def _close(cls) -> None:
+        if cls._smtp is None:
+            return
+        try:
+            cls._smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            cls._smtp.close()
+        cls._smtp = None
+    
+    @classmethod
+    def _send(cls, msg: MIMEMultipart) -> None:
+        """Send over the shared connection, reconnecting once if the server dropped it."""
+        try:
+            cls._connection().send_message(msg)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            cls._close()
+            cls._connection().send_message(msg)
+        cls._smtp_used_at = time.monotonic()
+    
+    @classmethod
+    def _record_failure(cls, cursor, row: dict, error: Exception) -> str:
+        """Schedule a retry for a failed message, or give up on it. Returns the new status."""
+        attempts = row["attempts"] + 1
+        if attempts >= settings.EMAIL_MAX_ATTEMPTS:
+            status, next_attempt = OUTBOX_FAILED, datetime.utcnow()
+            print(f"Giving up on email {row['id']} after {attempts} attempts: {error}")
+        else:
+            status = OUTBOX_PENDING
+            next_attempt = datetime.utcnow() + timedelta(seconds=cls.backoff_seconds(attempts))
+        cursor.execute(
+            "UPDATE email_outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+            (status, attempts, db_timestamp(next_attempt), str(error)[:500], row["id"])
+        )
+        return status
+    
+    @classmethod
+    def send_due(cls, limit: int = None) -> dict:
+        """
+        Send the messages that are due, once each.
+        
+        Args:
+            limit: Maximum number of messages (EMAIL_OUTBOX_BATCH_SIZE by default)
+        
+        Returns:
+            Dict with the number of messages claimed, sent, rescheduled for
+            a retry and given up on
+        """
+        with cls._send_lock:
+            rows = cls._claim(limit or settings.EMAIL_OUTBOX_BATCH_SIZE)
+            result = {"claimed": len(rows), "sent": 0, "retrying": 0, "failed": 0}
+            for row in rows:
+                try:
+                    cls._send(cls.build_message(row))
+                except Exception as e:
+                    print(f"Failed to send email {row['id']}: {e}")
+                    cls._close()
+                    with get_db_context() as conn:
+                        status = cls._record_failure(conn.cursor(), row, e)
+                    result["failed" if status == OUTBOX_FAILED else "retrying"] += 1
+                    continue
+                
+                with get_db_context() as conn:
+                    conn.execute(
+                        "UPDATE email_outbox SET status = ?, attempts = ?, sent_at = ?, last_error = NULL WHERE id = ?",
+                        (OUTBOX_SENT, row["attempts"] + 1, db_timestamp(datetime.utcnow()), row["id"])
+                    )
+                result["sent"] += 1
+            return result
+    
+    @classmethod
+    def retry(cls, message_id: int) -> bool:
+        """
+        Queue a message again right away, e.g. after fixing the SMTP settings.
+        
+        Returns:
+            False if the message does not exist or was already sent
+        """
+        with get_db_context() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE email_outbox SET status = ?, attempts = 0, next_attempt_at = ? WHERE id = ? AND status != ?",
+                (OUTBOX_PENDING, db_timestamp(datetime.utcnow()), message_id, OUTBOX_SENT)
+            )
+            updated = cursor.rowcount > 0
+        if updated:
+            cls.notify()
+        return updated
+    
+    @staticmethod
+    def stats() -> dict:
+        """
+        Outbox counts per status, the age of the oldest unsent message and
+        the most recent failures.
+        """
+        with get_db_context() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT status, COUNT(*) AS count FROM email_outbox GROUP BY status")
+            counts = {row["status"]: row["count"] for row in cursor.fetchall()}
+            cursor.execute(
+                "SELECT MIN(created_at) AS oldest FROM email_outbox WHERE status IN (?, ?)",
+                (OUTBOX_PENDING, OUTBOX_SENDING)
+            )
+            oldest = cursor.fetchone()["oldest"]
+            cursor.execute(
+                """SELECT id, order_id, subject, attempts, last_error, next_attempt_at, status
+                   FROM email_outbox WHERE last_error IS NOT NULL AND status != ?
+                   ORDER BY id DESC LIMIT ?""",
+                (OUTBOX_SENT, RECENT_FAILURE_LIMIT)
+            )
+            failures = [dict(row) for row in cursor.fetchall()]
+        
+        return {
+            "counts": {status: counts.get(status, 0) for status in (OUTBOX_PENDING, OUTBOX_SENDING, OUTBOX_SENT, OUTBOX_FAILED)},
+            "oldest_unsent_seconds": (
+                round((datetime.utcnow() - datetime.fromisoformat(oldest)).total_seconds())
+                if oldest else None
+            ),
+            "recent_failures": failures,
+        }
+    
+    @classmethod
+    def start_worker(cls) -> bool:
+        """
+        Start the background sender.
+        
+        Returns:
+            False if SMTP is not configured or the worker is already running
+        """
+        if not settings.SMTP_SERVER:
+            print("SMTP_SERVER not set; notification emails stay in the outbox")
+            return False
+        if cls._worker is not None and cls._worker.running:
+            return False
+        
+        cls._worker = BackgroundWorker(
+            "email-outbox", cls._send_batch, settings.EMAIL_OUTBOX_POLL_SECONDS, on_exit=cls._disconnect
+        )
+        return cls._worker.start()
+    
+    @classmethod
+    def stop_worker(cls) -> None:
+        if cls._worker is not None:
+            cls._worker.stop()
+    
+    @classmethod
+    def _send_batch(cls) -> bool:
+        """Send what is due; True when the batch was full and more may be due already."""
+        try:
+            result = cls.send_due()
+        finally:
+            with cls._send_lock:
+                if cls._smtp is not None and time.monotonic() - cls._smtp_used_at > settings.SMTP_IDLE_SECONDS:
+                    cls._close()
+        return result["claimed"] >= settings.EMAIL_OUTBOX_BATCH_SIZE
+    
+    @classmethod
+    def _disconnect(cls) -> None:
+        with cls._send_lock:
+            cls._close()
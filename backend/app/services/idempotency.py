@@ -0,0 +1,171 @@
+"""
+Stored responses for requests sent with an Idempotency-Key header.
+"""
+import hashlib
+import json
+from datetime import datetime, timedelta
+from typing import Optional
+
+from ..config import settings
+from ..database import db_timestamp, get_db_context
+from .background import PurgeThrottle
+
+
+# Request states
+IDEMPOTENCY_IN_PROGRESS = "in_progress"
+IDEMPOTENCY_COMPLETED = "completed"
+
+
+class IdempotencyKeyReused(ValueError):
+    """Raised when a key is sent again with a different request body."""
+
+
+class IdempotencyService:
+    """
+    Records the first response to each idempotency key.
+    
+    A request claims its key by inserting an in-progress row; the response
+    is stored in that row when the request finishes and replayed to every
+    later request with the same key until IDEMPOTENCY_TTL_SECONDS have
+    passed. Keys are scoped to the method, path and Authorization header,
+    and bound to a hash of the request body.
+    
+    An in-progress row carries a lock that expires after
+    IDEMPOTENCY_LOCK_SECONDS, so a key whose request died with its process
+    can be claimed again.
+    """
+    
+    _purge_throttle = PurgeThrottle()
+    
+    @staticmethod
+    def scope(method: str, path: str, authorization: str, key: str) -> str:
+        """Storage key for an idempotency key sent to one endpoint by one caller."""
+        return hashlib.sha256("\n".join((method, path, authorization, key)).encode("utf-8")).hexdigest()
+    
+    @staticmethod
+    def request_hash(body: bytes) -> str:
+        return hashlib.sha256(body).hexdigest()
+    
+    @staticmethod
+    def _replay(row) -> dict:
+        return {
+            "status_code": row["status_code"],
+            "headers": [tuple(header) for header in json.loads(row["response_headers"])],
+            "body": row["response_body"],
+        }
+    
+    @classmethod
+    def lookup(cls, scope: str, request_hash: str) -> Optional[dict]:
+        """
+        The stored response for a key, if its request has completed.
+        
+        Raises:
+            IdempotencyKeyReused: If the key belongs to a different request body
+        """
+        with get_db_context() as conn:
+            row = conn.execute(
+                "SELECT * FROM idempotency_keys WHERE scope = ? AND expires_at > ?",
+                (scope, db_timestamp(datetime.utcnow()))
+            ).fetchone()
+        if row is None:
+            return None
+        if row["request_hash"] != request_hash:
+            raise IdempotencyKeyReused("Idempotency-Key was already used for a different request")
+        if row["status"] == IDEMPOTENCY_COMPLETED:
+            return cls._replay(row)
+        return None
+    
+    @classmethod
+    def claim(cls, scope: str, request_hash: str) -> Optional[dict]:
+        """
+        Claim a key for a request that is about to run.
+        
+        Args:
+            scope: Storage key (see scope())
+            request_hash: Hash of the request body
+        
+        Returns:
+            None if this request now owns the key and should run, otherwise
+            the state of the existing entry: {"response": ...} once it has
+            completed, or {"response": None} while it is still running
+        
+        Raises:
+            IdempotencyKeyReused: If the key belongs to a different request body
+        """
+        now = datetime.utcnow()
+        with get_db_context(immediate=True) as conn:
+            row = conn.execute("SELECT * FROM idempotency_keys WHERE scope = ?", (scope,)).fetchone()
+            expired = row is not None and row["expires_at"] <= db_timestamp(now)
+            abandoned = (
+                row is not None and row["status"] == IDEMPOTENCY_IN_PROGRESS
+                and row["locked_until"] <= db_timestamp(now)
+            )
+            if row is None or expired or abandoned:
+                if row is not None and not expired and row["request_hash"] != request_hash:
+                    raise IdempotencyKeyReused("Idempotency-Key was already used for a different request")
+                conn.execute(
+                    """INSERT OR REPLACE INTO idempotency_keys
+                       (scope, request_hash, status, locked_until, created_at, expires_at)
+                       VALUES (?, ?, ?, ?, ?, ?)""",
+                    (
+                        scope,
+                        request_hash,
+                        IDEMPOTENCY_IN_PROGRESS,
+                        db_timestamp(now + timedelta(seconds=settings.IDEMPOTENCY_LOCK_SECONDS)),
+                        db_timestamp(now),
+                        db_timestamp(now + timedelta(seconds=settings.IDEMPOTENCY_TTL_SECONDS)),
+                    )
+                )
+                return None
+        
+        if row["request_hash"] != request_hash:
+            raise IdempotencyKeyReused("Idempotency-Key was already used for a different request")
+        if row["status"] == IDEMPOTENCY_COMPLETED:
+            return {"response": cls._replay(row)}
+        return {"response": None}
+    
+    @classmethod
+    def complete(cls, scope: str, status_code: int, headers: list, body: bytes) -> None:
+        """Store the response of a request that owns its key."""
+        with get_db_context() as conn:
+            conn.execute(
+                """UPDATE idempotency_keys
+                   SET status = ?, status_code = ?, response_headers = ?, response_body = ?
+                   WHERE scope = ?""",
+                (
+                    IDEMPOTENCY_COMPLETED,
+                    status_code,
+                    json.dumps([[name, value] for name, value in headers]),
+                    body,
+                    scope,
+                )
+            )
+        cls.purge_expired()
+    
+    @staticmethod
+    def release(scope: str) -> None:
+        """Give up a claimed key without a response, so a retry runs the request again."""
+        with get_db_context() as conn:
+            conn.execute(
+                "DELETE FROM idempotency_keys WHERE scope = ? AND status = ?",
+                (scope, IDEMPOTENCY_IN_PROGRESS)
+            )
+    
+    @classmethod
+    def purge_expired(cls, force: bool = False) -> int:
+        """
+        Delete expired keys, at most once per IDEMPOTENCY_PURGE_SECONDS
+        unless forced.
+        
+        Returns:
+            Number of keys removed
+        """
+        if not cls._purge_throttle.due(settings.IDEMPOTENCY_PURGE_SECONDS, force):
+            return 0
+        with get_db_context() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "DELETE FROM idempotency_keys WHERE expires_at <= ?",
+                (db_timestamp(datetime.utcnow()),)
+            )
+            return cursor.rowcount
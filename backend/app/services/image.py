@@ -1,12 +1,61 @@
 """
 Image processing and optimization service.
 """
+import base64
+import hashlib
 import io
+import math
 import os
-import uuid
-from PIL import Image, ImageOps
+import warnings
+from typing import BinaryIO, Union
+
+from PIL import Image, ImageChops, ImageOps, ImageStat, UnidentifiedImageError
 
 from ..config import settings
+from ..database import get_db_context
+from .image_quality import SsimReference
+from .image_metadata import ImageMetadataService, VARIANT_ORIGINAL, VARIANT_THUMBNAIL
+from .image_profiles import ImageProfiles
+from .image_paths import ImagePaths
+from .storage import AREA_ORIGINALS, AREA_THUMBNAILS, get_storage
+
+
+# Hex characters of the content hash used in stored filenames
+CONTENT_HASH_LENGTH = 32
+
+# Fast downscaling never shrinks below this multiple of the output size.
+# DCT-domain scaling in the JPEG decoder is close to an area average, so it
+# can get nearer to the output size than the nearest-neighbour-ish reduce().
+DRAFT_REDUCING_GAP = 1
+REDUCING_GAP = 2
+
+EXIF_ORIENTATION_TAG = 0x0112
+
+# Chunk size used when hashing uploads from their spooled file
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Raw bytes, or a binary file object such as an upload's spooled temp file
+ImageSource = Union[bytes, BinaryIO]
+
+# Pass as quality to pick it per image against IMAGE_TARGET_SSIM
+AUTO_QUALITY = "auto"
+
+# JPEG chroma subsampling values understood by Pillow
+SUBSAMPLING_444 = 0
+SUBSAMPLING_420 = 2
+
+# Mean absolute chroma error (0-255) from halving chroma resolution above
+# which an image keeps full-resolution chroma (fine saturated detail such
+# as coloured embroidery or piping on a white gi)
+CHROMA_DETAIL_THRESHOLD = 1.5
+
+
+class ImageUploadError(ValueError):
+    """Raised when an upload is too large or not an acceptable image."""
+    
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
 
 
 class ImageService:
@@ -37,101 +86,606 @@ class ImageService:
             return img.convert('RGB')
         return img
     
+    @staticmethod
+    def open_image(source: ImageSource) -> Image.Image:
+        """Open an image lazily from bytes or from the start of a file object."""
+        if isinstance(source, (bytes, bytearray)):
+            return Image.open(io.BytesIO(source))
+        source.seek(0)
+        return Image.open(source)
+    
+    @classmethod
+    def probe_upload(cls, upload) -> BinaryIO:
+        """
+        Check an uploaded file before any pixel data is decoded.
+        
+        Only the image header is parsed, so non-images, oversized files and
+        decompression bombs are rejected without loading the file into memory.
+        
+        Args:
+            upload: UploadFile whose content has been spooled to its temp file
+            
+        Returns:
+            The upload's file object, rewound and ready for processing
+            
+        Raises:
+            ImageUploadError: If the upload is too large or not an allowed image
+        """
+        fileobj = upload.file
+        size = upload.size
+        if size is None:
+            fileobj.seek(0, os.SEEK_END)
+            size = fileobj.tell()
+        if size > settings.MAX_UPLOAD_FILE_BYTES:
+            limit_mb = settings.MAX_UPLOAD_FILE_BYTES // (1024 * 1024)
+            raise ImageUploadError(
+                f"{upload.filename}: file too large. Maximum size is {limit_mb} MB",
+                status_code=413
+            )
+        
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("error", Image.DecompressionBombWarning)
+                img = cls.open_image(fileobj)
+        except (Image.DecompressionBombWarning, Image.DecompressionBombError):
+            raise ImageUploadError(f"{upload.filename}: image dimensions too large")
+        except (UnidentifiedImageError, OSError, SyntaxError):
+            raise ImageUploadError(f"{upload.filename}: not a valid image")
+        
+        if img.format not in settings.ALLOWED_UPLOAD_FORMATS:
+            raise ImageUploadError(
+                f"{upload.filename}: unsupported image format {img.format}. "
+                f"Allowed formats: {list(settings.ALLOWED_UPLOAD_FORMATS)}"
+            )
+        if img.size[0] * img.size[1] > settings.MAX_UPLOAD_PIXELS:
+            raise ImageUploadError(f"{upload.filename}: image dimensions too large")
+        
+        fileobj.seek(0)
+        return fileobj
+    
+    @classmethod
+    def probe_uploads(cls, uploads: list) -> list:
+        """
+        Probe a batch of uploads and check their combined size.
+        
+        Args:
+            uploads: UploadFiles from one request
+            
+        Returns:
+            List of rewound file objects, in the same order
+            
+        Raises:
+            ImageUploadError: If any upload is rejected or the batch is too large
+        """
+        files = [cls.probe_upload(upload) for upload in uploads]
+        total = sum(upload.size or 0 for upload in uploads)
+        if total > settings.MAX_UPLOAD_REQUEST_BYTES:
+            limit_mb = settings.MAX_UPLOAD_REQUEST_BYTES // (1024 * 1024)
+            raise ImageUploadError(
+                f"Upload too large. Maximum total size is {limit_mb} MB", status_code=413
+            )
+        return files
+    
+    @classmethod
+    def oriented_size(cls, source: ImageSource) -> tuple:
+        """Read the displayed (EXIF-oriented) size of an image from its header."""
+        img = cls.open_image(source)
+        if img.getexif().get(EXIF_ORIENTATION_TAG, 1) in (5, 6, 7, 8):
+            return img.size[1], img.size[0]
+        return img.size
+    
+    @staticmethod
+    def fit_size(source_size: tuple, box: tuple) -> tuple:
+        """Size an image of source_size takes when fitted inside box (never upscaled)."""
+        ratio = min(box[0] / source_size[0], box[1] / source_size[1])
+        if ratio >= 1:
+            return source_size
+        return (
+            max(1, round(source_size[0] * ratio)),
+            max(1, round(source_size[1] * ratio)),
+        )
+    
+    @classmethod
+    def load_scaled(cls, source: ImageSource, size: tuple, cover: bool = False) -> tuple:
+        """
+        Open an image already shrunk close to the size it will be resampled to.
+        
+        JPEGs are decoded in draft mode, letting libjpeg scale by 1/2, 1/4 or
+        1/8 in the DCT domain instead of decoding every source pixel. Any
+        remaining large factor is removed with Image.reduce, keeping at least
+        REDUCING_GAP times the output size so the final LANCZOS resample
+        still has enough detail to work with.
+        
+        Args:
+            source: Raw image bytes or a binary file object
+            size: Output box (width, height)
+            cover: True if the output will fill the box (crop), False to fit inside it
+            
+        Returns:
+            Tuple of (oriented RGB image, full-resolution oriented size)
+        """
+        img = cls.open_image(source)
+        
+        # EXIF orientations 5-8 rotate by 90 degrees, swapping width and height
+        stored_width, stored_height = img.size
+        orientation = img.getexif().get(EXIF_ORIENTATION_TAG, 1)
+        if orientation in (5, 6, 7, 8):
+            source_size = (stored_height, stored_width)
+        else:
+            source_size = (stored_width, stored_height)
+        
+        pick = max if cover else min
+        scale = pick(size[0] / source_size[0], size[1] / source_size[1])
+        
+        if img.format in ("JPEG", "MPO") and scale * DRAFT_REDUCING_GAP < 1:
+            img.draft(None, (
+                max(1, math.ceil(stored_width * scale * DRAFT_REDUCING_GAP)),
+                max(1, math.ceil(stored_height * scale * DRAFT_REDUCING_GAP)),
+            ))
+        
+        img = cls.apply_exif_orientation(img)
+        img = cls.convert_to_rgb(img)
+        
+        factor = int(min(
+            img.size[0] / (source_size[0] * scale * REDUCING_GAP),
+            img.size[1] / (source_size[1] * scale * REDUCING_GAP),
+        ))
+        if factor >= 2:
+            img = img.reduce(factor)
+        
+        return img, source_size
+    
+    @staticmethod
+    def default_quality(fixed_quality: int):
+        """The quality to encode with when none is given: AUTO_QUALITY or the fixed setting."""
+        return AUTO_QUALITY if settings.IMAGE_AUTO_QUALITY else fixed_quality
+    
+    @staticmethod
+    def chroma_subsampling(img: Image.Image) -> int:
+        """
+        Pick JPEG chroma subsampling for an image.
+        
+        Halves the chroma planes and scales them back up; if that loses
+        noticeable colour detail the image keeps 4:4:4, otherwise 4:2:0
+        saves the bytes.
+        """
+        half = (max(1, img.size[0] // 2), max(1, img.size[1] // 2))
+        _, cb, cr = img.convert("YCbCr").split()
+        for channel in (cb, cr):
+            degraded = channel.resize(half, Image.Resampling.BOX).resize(img.size, Image.Resampling.BILINEAR)
+            if ImageStat.Stat(ImageChops.difference(channel, degraded)).mean[0] > CHROMA_DETAIL_THRESHOLD:
+                return SUBSAMPLING_444
+        return SUBSAMPLING_420
+    
+    @staticmethod
+    def _save(img: Image.Image, fmt: str, quality: int, subsampling: int = None, final: bool = True) -> bytes:
+        """
+        Encode an image once.
+        
+        Trial encodes (final=False) skip Huffman optimization and progressive
+        scans; both are lossless, so the decoded pixels match the final file.
+        """
+        output = io.BytesIO()
+        if fmt == "webp":
+            img.save(output, format='WEBP', quality=quality, method=4)
+        else:
+            options = {"quality": quality, "exif": b''}
+            if subsampling is not None:
+                options["subsampling"] = subsampling
+            if final:
+                try:
+                    img.save(output, format='JPEG', optimize=True, progressive=True, **options)
+                    return output.getvalue()
+                except OSError:
+                    # Pillow sizes the optimize/progressive buffer at one byte
+                    # per pixel, which near-incompressible content can exceed
+                    output = io.BytesIO()
+            img.save(output, format='JPEG', **options)
+        return output.getvalue()
+    
+    @classmethod
+    def encode(
+        cls,
+        img: Image.Image,
+        fmt: str = "jpeg",
+        quality=AUTO_QUALITY,
+        fixed_quality: int = None,
+        report: dict = None
+    ) -> bytes:
+        """
+        Encode an image as JPEG or WebP.
+        
+        With quality=AUTO_QUALITY the lowest quality in
+        IMAGE_AUTO_QUALITY_RANGE whose decoded result still reaches
+        IMAGE_TARGET_SSIM against img is found by binary search, using at
+        most IMAGE_AUTO_QUALITY_MAX_TRIALS trial encodes. Smooth studio
+        shots end up well below the fixed quality and detailed close-ups
+        above it.
+        
+        Args:
+            img: RGB image at its final size
+            fmt: 'jpeg' or 'webp'
+            quality: Encoder quality (1-100) or AUTO_QUALITY
+            fixed_quality: The fixed quality auto mode is compared against
+            report: Optional dict filled with quality, ssim, trials and
+                baseline_bytes (size at fixed_quality, auto mode only)
+        
+        Returns:
+            Encoded image bytes
+        """
+        fixed_quality = fixed_quality or settings.IMAGE_QUALITY
+        subsampling = cls.chroma_subsampling(img) if fmt == "jpeg" else None
+        
+        if quality != AUTO_QUALITY:
+            if report is not None:
+                report.update(quality=quality, ssim=None, trials=0, baseline_bytes=None)
+            return cls._save(img, fmt, quality, subsampling)
+        
+        low, high = settings.IMAGE_AUTO_QUALITY_RANGE
+        target = settings.IMAGE_TARGET_SSIM
+        reference = SsimReference(img)
+        chosen, chosen_score, trials = high, None, 0
+        while low <= high and trials < settings.IMAGE_AUTO_QUALITY_MAX_TRIALS:
+            mid = (low + high) // 2
+            trial = cls._save(img, fmt, mid, subsampling, final=False)
+            score = reference.compare(Image.open(io.BytesIO(trial)))
+            trials += 1
+            if score >= target:
+                chosen, chosen_score = mid, score
+                high = mid - 1
+            else:
+                low = mid + 1
+        
+        data = cls._save(img, fmt, chosen, subsampling)
+        if report is not None:
+            # What the fixed-quality pipeline would have stored
+            baseline = io.BytesIO()
+            if fmt == "webp":
+                img.save(baseline, format='WEBP', quality=fixed_quality, method=4)
+            else:
+                try:
+                    img.save(baseline, format='JPEG', quality=fixed_quality, optimize=True, exif=b'')
+                except OSError:
+                    baseline = io.BytesIO()
+                    img.save(baseline, format='JPEG', quality=fixed_quality, exif=b'')
+            report.update(
+                quality=chosen,
+                ssim=round(chosen_score, 5) if chosen_score is not None else None,
+                trials=trials,
+                baseline_bytes=len(baseline.getvalue()),
+            )
+        return data
+    
     @classmethod
     def optimize_image(
         cls,
-        image_bytes: bytes,
+        source: ImageSource,
         max_size: tuple = None,
-        quality: int = None
+        quality=None,
+        report: dict = None
     ) -> bytes:
         """
         Resize and compress an image.
         
         Args:
-            image_bytes: Raw image bytes
+            source: Raw image bytes or a binary file object
             max_size: Maximum dimensions (width, height)
-            quality: JPEG quality (1-100)
+            quality: JPEG quality (1-100) or AUTO_QUALITY
+            report: Optional dict filled with encoding details (see encode)
             
         Returns:
             Optimized image bytes
         """
         max_size = max_size or settings.MAX_IMAGE_SIZE
-        quality = quality or settings.IMAGE_QUALITY
+        quality = quality or cls.default_quality(settings.IMAGE_QUALITY)
         
-        img = Image.open(io.BytesIO(image_bytes))
-        img = cls.apply_exif_orientation(img)
-        img = cls.convert_to_rgb(img)
-        img.thumbnail(max_size, Image.Resampling.LANCZOS)
+        img, source_size = cls.load_scaled(source, max_size)
+        img = img.resize(cls.fit_size(source_size, max_size), Image.Resampling.LANCZOS)
         
-        output = io.BytesIO()
-        img.save(output, format='JPEG', quality=quality, optimize=True, exif=b'')
-        return output.getvalue()
+        return cls.encode(img, "jpeg", quality, settings.IMAGE_QUALITY, report)
     
     @classmethod
     def create_thumbnail(
         cls,
-        image_bytes: bytes,
+        source: ImageSource,
         size: tuple = None,
-        quality: int = None
+        quality=None,
+        report: dict = None
     ) -> bytes:
         """
         Create a thumbnail version of an image.
         
         Args:
-            image_bytes: Raw image bytes
+            source: Raw image bytes or a binary file object
             size: Thumbnail dimensions (width, height)
-            quality: JPEG quality (1-100)
+            quality: JPEG quality (1-100) or AUTO_QUALITY
+            report: Optional dict filled with encoding details (see encode)
             
         Returns:
             Thumbnail image bytes
         """
         size = size or settings.THUMBNAIL_SIZE
-        quality = quality or settings.THUMBNAIL_QUALITY
+        quality = quality or cls.default_quality(settings.THUMBNAIL_QUALITY)
         
-        img = Image.open(io.BytesIO(image_bytes))
-        img = cls.apply_exif_orientation(img)
-        img = cls.convert_to_rgb(img)
-        img.thumbnail(size, Image.Resampling.LANCZOS)
+        img, source_size = cls.load_scaled(source, size)
+        img = img.resize(cls.fit_size(source_size, size), Image.Resampling.LANCZOS)
+        
+        return cls.encode(img, "jpeg", quality, settings.THUMBNAIL_QUALITY, report)
+    
+    @classmethod
+    def create_placeholder(cls, source: ImageSource) -> str:
+        """
+        Create a tiny low-quality preview of an image as a data URI.
+        
+        The result is a few hundred bytes of WebP that the frontend can paint
+        (scaled up and blurred by the browser) while the real image loads.
+        
+        Args:
+            source: Raw image bytes or a binary file object
+            
+        Returns:
+            data:image/webp;base64,... URI
+        """
+        size = settings.PLACEHOLDER_SIZE
+        img, source_size = cls.load_scaled(source, size)
+        img = img.resize(cls.fit_size(source_size, size), Image.Resampling.BOX)
         
         output = io.BytesIO()
-        img.save(output, format='JPEG', quality=quality, optimize=True, exif=b'')
-        return output.getvalue()
+        img.save(output, format='WEBP', quality=settings.PLACEHOLDER_QUALITY, method=6)
+        encoded = base64.b64encode(output.getvalue()).decode('ascii')
+        return f"data:image/webp;base64,{encoded}"
+    
+    @staticmethod
+    def store_placeholder(cursor, filename: str, placeholder: str) -> None:
+        """Set the placeholder on every product image and category using an image."""
+        cursor.execute(
+            "UPDATE product_images SET placeholder = ? WHERE filename = ?",
+            (placeholder, filename)
+        )
+        cursor.execute(
+            "UPDATE categories SET image_placeholder = ? WHERE image_filename = ?",
+            (placeholder, filename)
+        )
     
     @classmethod
-    def save_product_image(cls, image_bytes: bytes, original_filename: str) -> tuple:
+    def render_variant(
+        cls,
+        source: ImageSource,
+        width: int = None,
+        height: int = None,
+        fit: str = "contain",
+        fmt: str = "jpeg",
+        quality=None
+    ) -> bytes:
         """
-        Save an optimized product image and its thumbnail.
+        Render a resized variant of an image.
         
         Args:
-            image_bytes: Raw image bytes
-            original_filename: Original filename for naming
+            source: Raw image bytes (or file object) of the stored original
+            width: Target width (None keeps aspect ratio from height)
+            height: Target height (None keeps aspect ratio from width)
+            fit: 'contain' fits inside the box, 'cover' crops to fill it
+            fmt: Output format ('jpeg' or 'webp')
+            quality: Encoder quality (1-100) or AUTO_QUALITY
+        
+        Returns:
+            Encoded variant bytes
+        """
+        quality = quality or cls.default_quality(settings.IMAGE_QUALITY)
+        
+        src_width, src_height = cls.oriented_size(source)
+        if width and not height:
+            height = max(1, round(src_height * width / src_width))
+        elif height and not width:
+            width = max(1, round(src_width * height / src_height))
+        elif not width and not height:
+            width, height = src_width, src_height
+        
+        img, source_size = cls.load_scaled(source, (width, height), cover=(fit == "cover"))
+        if fit == "cover":
+            img = ImageOps.fit(img, (width, height), Image.Resampling.LANCZOS)
+        else:
+            img = img.resize(cls.fit_size(source_size, (width, height)), Image.Resampling.LANCZOS)
+        
+        return cls.encode(img, fmt, quality, settings.IMAGE_QUALITY)
+    
+    @staticmethod
+    def content_hash(source: ImageSource) -> str:
+        """Return the content hash used to name stored images."""
+        if isinstance(source, (bytes, bytearray)):
+            return hashlib.sha256(source).hexdigest()
+        
+        digest = hashlib.sha256()
+        source.seek(0)
+        for chunk in iter(lambda: source.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+        return digest.hexdigest()
+    
+    @classmethod
+    def store_product_image(cls, source: ImageSource, original_filename: str = None) -> dict:
+        """
+        Encode and store an optimized product image and its thumbnail,
+        without touching the database.
+        
+        Images are content-addressed: the filename is derived from a hash of
+        the uploaded bytes, so re-uploading the same photo reuses the stored
+        file and thumbnail without re-encoding them. A reused file is
+        touched, so the garbage collector's grace period starts over.
+        
+        The slow part of an upload (encoding, the quality search and the
+        upload to S3) happens here, before the caller opens its write
+        transaction; record_product_image() then links the files under the
+        write lock.
+        
+        Args:
+            source: Raw image bytes, or the upload's file object (read in
+                place, never copied into memory as a whole)
+            original_filename: Original upload filename (kept for logging only)
+            
+        Returns:
+            Dict with filename, thumbnail_filename, source and files, one
+            (variant, area, stored filename, data, encoding) tuple per
+            stored file; data is None for a reused file
+        """
+        digest = cls.content_hash(source)[:CONTENT_HASH_LENGTH]
+        filename = f"{digest}.jpg"
+        thumbnail_filename = ImagePaths.thumbnail_name(filename)
+        storage = get_storage()
+        
+        files = []
+        for variant, area, stored_filename in (
+            (VARIANT_ORIGINAL, AREA_ORIGINALS, filename),
+            (VARIANT_THUMBNAIL, AREA_THUMBNAILS, thumbnail_filename),
+        ):
+            if storage.touch(area, stored_filename):
+                if variant == VARIANT_ORIGINAL:
+                    print(f"Reusing stored image {filename} for upload {original_filename}")
+                files.append((variant, area, stored_filename, None, None))
+                continue
+            
+            encoding = {}
+            data = cls._renderer(variant)(source, report=encoding)
+            storage.put(area, stored_filename, data)
+            files.append((variant, area, stored_filename, data, encoding))
+        
+        return {"filename": filename, "thumbnail_filename": thumbnail_filename, "source": source, "files": files}
+    
+    @classmethod
+    def record_product_image(cls, cursor, stored: dict) -> None:
+        """
+        Record the metadata of files stored by store_product_image().
+        
+        The cursor's transaction takes the write lock (if it does not hold
+        it yet) and keeps it until the caller commits the new reference;
+        delete_released() and the garbage collector count references under
+        the same lock. A file that was deleted between storing and locking
+        is stored again, which is safe because its name is its content.
+        
+        Args:
+            cursor: Cursor of the transaction that references the image
+            stored: Result of store_product_image()
+        """
+        if not cursor.connection.in_transaction:
+            cursor.execute("BEGIN IMMEDIATE")
+        storage = get_storage()
+        filename = stored["filename"]
+        
+        for variant, area, stored_filename, data, encoding in stored["files"]:
+            if not storage.touch(area, stored_filename):
+                encoding = {}
+                data = cls._renderer(variant)(stored["source"], report=encoding)
+                storage.put(area, stored_filename, data)
+            
+            if data is not None:
+                ImageMetadataService.record(
+                    cursor, filename, variant, stored_filename, data, encoding,
+                    profile_version=ImageProfiles.version(variant)
+                )
+            elif not ImageMetadataService.exists(cursor, filename, variant):
+                data = storage.get(area, stored_filename)
+                if data is not None:
+                    ImageMetadataService.record(cursor, filename, variant, stored_filename, data)
+    
+    @classmethod
+    def _renderer(cls, variant: str):
+        return cls.optimize_image if variant == VARIANT_ORIGINAL else cls.create_thumbnail
+    
+    @classmethod
+    def save_product_image(cls, source: ImageSource, original_filename: str = None, cursor=None) -> tuple:
+        """
+        Store a product image and its thumbnail, and record their metadata
+        when a cursor is given.
+        
+        Callers that hold other writes in the same transaction should call
+        store_product_image() before opening it and record_product_image()
+        inside it, so the write lock is not held while the image is encoded.
+        
+        Args:
+            source: Raw image bytes or the upload's file object
+            original_filename: Original upload filename (kept for logging only)
+            cursor: Database cursor; when given, image metadata is recorded
+                for the stored files
             
         Returns:
             Tuple of (main_filename, thumbnail_filename)
         """
-        # Generate unique filenames
-        base_filename = f"{uuid.uuid4()}_{original_filename}"
-        filename = os.path.splitext(base_filename)[0] + ".jpg"
-        thumbnail_filename = os.path.splitext(base_filename)[0] + "_thumb.jpg"
+        stored = cls.store_product_image(source, original_filename)
+        if cursor is not None:
+            cls.record_product_image(cursor, stored)
+        return stored["filename"], stored["thumbnail_filename"]
+    
+    @staticmethod
+    def count_references(cursor, filename: str) -> int:
+        """
+        Count how many product images and categories use a stored file.
+        
+        Args:
+            cursor: Database cursor (sees uncommitted changes on its connection)
+            filename: Image filename
+            
+        Returns:
+            Number of referencing rows
+        """
+        cursor.execute(
+            """SELECT
+                   (SELECT COUNT(*) FROM product_images WHERE filename = ?) +
+                   (SELECT COUNT(*) FROM categories WHERE image_filename = ?) AS refs""",
+            (filename, filename)
+        )
+        return cursor.fetchone()["refs"]
+    
+    @classmethod
+    def release_image(cls, cursor, filename: str) -> bool:
+        """
+        Drop an image's metadata once nothing references it any more.
         
-        # Optimize and save main image
-        optimized_bytes = cls.optimize_image(image_bytes)
-        image_path = os.path.join(settings.UPLOAD_DIR, filename)
-        with open(image_path, "wb") as f:
-            f.write(optimized_bytes)
+        Call this after removing or replacing the referencing row, using the
+        same cursor so the pending change is counted. The files are kept
+        until the transaction has committed: pass the released filenames to
+        delete_released() then, so a rollback never leaves rows pointing at
+        deleted files.
+        
+        Args:
+            cursor: Database cursor
+            filename: Image filename
+            
+        Returns:
+            True if nothing references the image any more
+        """
+        if not filename or cls.count_references(cursor, filename) > 0:
+            return False
+        ImageMetadataService.delete(cursor, filename)
+        return True
+    
+    @classmethod
+    def delete_released(cls, filenames) -> list:
+        """
+        Delete the files of images released by a committed transaction.
         
-        # Create and save thumbnail
-        thumbnail_bytes = cls.create_thumbnail(image_bytes)
-        thumbnail_path = os.path.join(settings.THUMBNAIL_DIR, thumbnail_filename)
-        with open(thumbnail_path, "wb") as f:
-            f.write(thumbnail_bytes)
+        References are counted again under the write lock, so a file that
+        an upload has reused since it was released is kept.
         
-        return filename, thumbnail_filename
+        Args:
+            filenames: Filenames release_image() returned True for
+            
+        Returns:
+            Filenames whose files were deleted
+        """
+        filenames = [filename for filename in dict.fromkeys(filenames) if filename]
+        deleted = []
+        if not filenames:
+            return deleted
+        with get_db_context(immediate=True) as conn:
+            cursor = conn.cursor()
+            for filename in filenames:
+                if cls.count_references(cursor, filename) == 0 and cls.delete_image(filename):
+                    deleted.append(filename)
+        return deleted
     
     @staticmethod
     def delete_image(filename: str) -> bool:
         """
-        Delete an image and its thumbnail from disk.
+        Delete an image and its thumbnail from storage.
         
         Args:
             filename: Image filename
@@ -140,24 +694,19 @@ class ImageService:
             True if deletion was successful
         """
         deleted = False
+        storage = get_storage()
         
         # Delete main image
-        image_path = os.path.join(settings.UPLOAD_DIR, filename)
-        if os.path.exists(image_path):
-            try:
-                os.remove(image_path)
-                deleted = True
-            except Exception as e:
-                print(f"Error deleting image file {image_path}: {e}")
+        try:
+            deleted = storage.delete(AREA_ORIGINALS, filename)
+        except Exception as e:
+            print(f"Error deleting image file {filename}: {e}")
         
         # Delete thumbnail
-        base_name = os.path.splitext(filename)[0]
-        thumbnail_filename = f"{base_name}_thumb.jpg"
-        thumbnail_path = os.path.join(settings.THUMBNAIL_DIR, thumbnail_filename)
-        if os.path.exists(thumbnail_path):
-            try:
-                os.remove(thumbnail_path)
-            except Exception as e:
-                print(f"Error deleting thumbnail {thumbnail_path}: {e}")
+        thumbnail_filename = ImagePaths.thumbnail_name(filename)
+        try:
+            storage.delete(AREA_THUMBNAILS, thumbnail_filename)
+        except Exception as e:
+            print(f"Error deleting thumbnail {thumbnail_filename}: {e}")
         
         return deleted
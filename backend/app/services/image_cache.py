@@ -0,0 +1,420 @@
+"""
+Disk cache for on-demand image variants.
+"""
+import os
+import re
+import threading
+from typing import Optional
+
+from ..config import settings
+from .image import ImageService
+from .image_paths import ImagePaths, TEMP_PREFIX
+from .image_profiles import ImageProfiles, PROFILE_VARIANT
+from .storage import AREA_ORIGINALS, AREA_VARIANTS, get_storage
+
+
+class VariantError(ValueError):
+    """Raised when a requested variant is not in the allowed set."""
+    pass
+
+
+class _InflightRender:
+    """Per-variant render lock and the number of requests holding or waiting on it."""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = 0
+
+
+class ImageVariantCache:
+    """
+    Renders image variants lazily and keeps them in a size-capped disk cache.
+    
+    Cache entries are evicted least-recently-used first, using the file
+    modification time as the recency marker (bumped on every hit). The
+    cache size and an index of cached filenames by variant are loaded from
+    one directory scan and kept up to date as entries are written and
+    removed.
+    """
+    
+    FORMAT_EXTENSIONS = {"jpeg": "jpg", "webp": "webp"}
+    MEDIA_TYPES = {"jpeg": "image/jpeg", "webp": "image/webp"}
+    
+    # <base>_<w>x<h>_<fit>_<profile version>.<ext>; entries cached before
+    # profiles were versioned have no version part
+    VARIANT_NAME = re.compile(
+        r"^(?P<base>.+)_(?P<width>\d+)x(?P<height>\d+)_(?P<fit>[a-z]+)(?:_(?P<version>[0-9a-f]{8}))?\.(?P<ext>[a-z]+)$"
+    )
+    
+    # Evict down to this fraction of the cap so we don't evict on every write
+    EVICT_TARGET_RATIO = 0.9
+    
+    _state_lock = threading.Lock()
+    _inflight: dict = {}
+    _cache_bytes: Optional[int] = None
+    
+    # Cached filenames keyed by (base, width, height, fit, fmt), so entries
+    # rendered under other profile versions are found without a scan
+    _index: Optional[dict] = None
+    
+    # Variants already uploaded to a remote storage backend
+    _published: set = set()
+    
+    @classmethod
+    def validate(cls, width: Optional[int], height: Optional[int], fit: str, fmt: str) -> None:
+        """
+        Check a variant request against the configured allow-lists.
+        
+        Raises:
+            VariantError: If any parameter is not allowed
+        """
+        if width is None and height is None:
+            raise VariantError("At least one of w or h is required")
+        for value in (width, height):
+            if value is not None and value not in settings.IMAGE_VARIANT_SIZES:
+                raise VariantError(
+                    f"Size {value} not allowed. Allowed sizes: {list(settings.IMAGE_VARIANT_SIZES)}"
+                )
+        if fit not in settings.IMAGE_VARIANT_FITS:
+            raise VariantError(f"Invalid fit '{fit}'. Must be one of: {list(settings.IMAGE_VARIANT_FITS)}")
+        if fmt not in settings.IMAGE_VARIANT_FORMATS:
+            raise VariantError(f"Invalid format '{fmt}'. Must be one of: {list(settings.IMAGE_VARIANT_FORMATS)}")
+    
+    @classmethod
+    def variant_filename(cls, filename: str, width: Optional[int], height: Optional[int], fit: str, fmt: str) -> str:
+        """Build the cache filename for a variant of an original image under the current profile."""
+        base_name = os.path.splitext(filename)[0]
+        version = ImageProfiles.version(PROFILE_VARIANT)
+        return f"{base_name}_{width or 0}x{height or 0}_{fit}_{version}.{cls.FORMAT_EXTENSIONS[fmt]}"
+    
+    @classmethod
+    def parse_variant_filename(cls, name: str) -> Optional[dict]:
+        """
+        Split a cache filename back into its variant parameters.
+        
+        Returns:
+            Dict with base, width, height, fit, fmt and version (None for
+            unversioned entries), or None if the name is not a variant
+        """
+        match = cls.VARIANT_NAME.match(name)
+        if not match:
+            return None
+        formats = {ext: fmt for fmt, ext in cls.FORMAT_EXTENSIONS.items()}
+        if match["ext"] not in formats:
+            return None
+        return {
+            "base": match["base"],
+            "width": int(match["width"]) or None,
+            "height": int(match["height"]) or None,
+            "fit": match["fit"],
+            "fmt": formats[match["ext"]],
+            "version": match["version"],
+        }
+    
+    @classmethod
+    def get_variant(
+        cls,
+        filename: str,
+        width: Optional[int],
+        height: Optional[int],
+        fit: str = "contain",
+        fmt: str = "jpeg",
+        allow_stale: bool = True
+    ) -> Optional[str]:
+        """
+        Return the path of a cached variant, rendering it on a cache miss.
+        
+        Concurrent requests for the same uncached variant share one render:
+        the first caller renders while the others wait on a per-variant lock
+        and then pick up the file it wrote.
+        
+        After a profile change, an entry rendered with an older profile is
+        returned instead of rendering while the background refresher is
+        enabled; it replaces the entry shortly.
+        
+        Args:
+            filename: Original image filename in UPLOAD_DIR
+            width: Target width
+            height: Target height
+            fit: 'contain' or 'cover'
+            fmt: 'jpeg' or 'webp'
+            allow_stale: Accept an entry rendered with an older profile
+        
+        Returns:
+            Path to the variant file, or None if the original does not exist
+        
+        Raises:
+            VariantError: If the requested variant is not allowed
+        """
+        cls.validate(width, height, fit, fmt)
+        
+        variant_name = cls.variant_filename(filename, width, height, fit, fmt)
+        variant_path = os.path.join(settings.IMAGE_CACHE_DIR, variant_name)
+        
+        if cls._touch(variant_path):
+            return variant_path
+        
+        # The lock stays in the table until no request holds or waits on
+        # it, so a late request cannot start a second render alongside them
+        with cls._state_lock:
+            inflight = cls._inflight.get(variant_name)
+            if inflight is None:
+                inflight = cls._inflight[variant_name] = _InflightRender()
+            inflight.users += 1
+        
+        try:
+            with inflight.lock:
+                # Another request may have rendered it while we waited
+                if cls._touch(variant_path):
+                    return variant_path
+                
+                if allow_stale and settings.IMAGE_REFRESH_INTERVAL_SECONDS > 0:
+                    stale_path = cls._stale_entry(variant_name)
+                    if stale_path:
+                        return stale_path
+                
+                original_bytes = get_storage().get(AREA_ORIGINALS, filename)
+                if original_bytes is None:
+                    return None
+                
+                variant_bytes = ImageService.render_variant(
+                    original_bytes, width, height, fit, fmt
+                )
+                ImagePaths.write_atomic(variant_path, variant_bytes)
+                cls._account(variant_name, len(variant_bytes))
+                return variant_path
+        finally:
+            with cls._state_lock:
+                inflight.users -= 1
+                if inflight.users == 0:
+                    del cls._inflight[variant_name]
+    
+    @classmethod
+    def publish_variant(
+        cls,
+        storage,
+        filename: str,
+        width: Optional[int],
+        height: Optional[int],
+        fit: str = "contain",
+        fmt: str = "jpeg"
+    ) -> Optional[str]:
+        """
+        Make a variant available from a remote storage backend.
+        
+        The variant is rendered through the local cache once and uploaded;
+        after that clients fetch it from the returned URL.
+        
+        Args:
+            storage: Remote storage backend
+            filename: Original image filename
+            width, height, fit, fmt: As for get_variant
+        
+        Returns:
+            URL of the variant, or None if the original does not exist
+        
+        Raises:
+            VariantError: If the requested variant is not allowed
+        """
+        cls.validate(width, height, fit, fmt)
+        variant_name = cls.variant_filename(filename, width, height, fit, fmt)
+        if variant_name not in cls._published and not storage.exists(AREA_VARIANTS, variant_name):
+            path = cls.get_variant(filename, width, height, fit, fmt, allow_stale=False)
+            if not path:
+                return None
+            with open(path, "rb") as f:
+                storage.put(AREA_VARIANTS, variant_name, f.read(), content_type=cls.MEDIA_TYPES[fmt])
+        with cls._state_lock:
+            cls._published.add(variant_name)
+        return storage.url(AREA_VARIANTS, variant_name)
+    
+    @staticmethod
+    def _touch(path: str) -> bool:
+        """Mark a cache entry as recently used. Returns False if it is missing."""
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+    
+    @classmethod
+    def _index_key(cls, name: str) -> Optional[tuple]:
+        """Index key of a cache filename: its variant parameters without the profile version."""
+        parsed = cls.parse_variant_filename(name)
+        if not parsed:
+            return None
+        return (parsed["base"], parsed["width"], parsed["height"], parsed["fit"], parsed["fmt"])
+    
+    @classmethod
+    def _index_add(cls, name: str) -> None:
+        """Record a cache filename in the index (caller holds _state_lock)."""
+        key = cls._index_key(name)
+        if key is not None:
+            cls._index.setdefault(key, set()).add(name)
+    
+    @classmethod
+    def _index_remove(cls, name: str) -> None:
+        """Drop a cache filename from the index (caller holds _state_lock)."""
+        if cls._index is None:
+            return
+        key = cls._index_key(name)
+        names = cls._index.get(key)
+        if names is not None:
+            names.discard(name)
+            if not names:
+                del cls._index[key]
+    
+    @classmethod
+    def _load(cls) -> bool:
+        """
+        Load the cache size and index from one scan if they are not loaded
+        (caller holds _state_lock).
+        
+        Returns:
+            True if a scan was made
+        """
+        if cls._cache_bytes is not None and cls._index is not None:
+            return False
+        entries = cls._scan()
+        cls._cache_bytes = sum(size for _, size, _ in entries)
+        cls._index = {}
+        for _, _, path in entries:
+            cls._index_add(os.path.basename(path))
+        return True
+    
+    @classmethod
+    def _stale_entry(cls, variant_name: str) -> Optional[str]:
+        """
+        Find a cached rendering of the same variant made with an older
+        profile and mark it as recently used.
+        
+        Returns:
+            Path of the entry, or None if there is none
+        """
+        key = cls._index_key(variant_name)
+        with cls._state_lock:
+            cls._load()
+            names = sorted(cls._index.get(key, ()))
+        
+        for name in names:
+            if name == variant_name:
+                continue
+            path = os.path.join(settings.IMAGE_CACHE_DIR, name)
+            if cls._touch(path):
+                return path
+            # Removed behind the cache's back
+            with cls._state_lock:
+                cls._index_remove(name)
+        return None
+    
+    @classmethod
+    def _scan(cls) -> list:
+        """List cache entries as (mtime, size, path) tuples."""
+        entries = []
+        try:
+            with os.scandir(settings.IMAGE_CACHE_DIR) as it:
+                for entry in it:
+                    if entry.is_file() and not entry.name.startswith(TEMP_PREFIX):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except FileNotFoundError:
+            pass
+        return entries
+    
+    @classmethod
+    def _account(cls, name: str, added_bytes: int) -> None:
+        """Track a new cache entry and evict when the cache goes over the cap."""
+        with cls._state_lock:
+            # A fresh scan already includes the new entry
+            if not cls._load():
+                cls._cache_bytes += added_bytes
+                cls._index_add(name)
+            
+            if cls._cache_bytes > settings.IMAGE_CACHE_MAX_BYTES:
+                cls._cache_bytes = cls._evict()
+    
+    @classmethod
+    def _evict(cls) -> int:
+        """
+        Remove least-recently-used entries until under the target size.
+        
+        Returns:
+            Remaining cache size in bytes
+        """
+        entries = sorted(cls._scan())
+        total = sum(size for _, size, _ in entries)
+        target = int(settings.IMAGE_CACHE_MAX_BYTES * cls.EVICT_TARGET_RATIO)
+        
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                total -= size
+            except Exception as e:
+                print(f"Error evicting cached variant {path}: {e}")
+                continue
+            cls._index_remove(os.path.basename(path))
+        
+        return total
+    
+    @classmethod
+    def discard(cls, path: str) -> bool:
+        """
+        Remove one cache entry.
+        
+        Returns:
+            False if the entry was already gone
+        """
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        with cls._state_lock:
+            if cls._cache_bytes is not None:
+                cls._cache_bytes = max(0, cls._cache_bytes - size)
+            cls._index_remove(os.path.basename(path))
+        return True
+    
+    @classmethod
+    def purge(cls, filename: str) -> int:
+        """
+        Remove every cached variant of an original image.
+        
+        Args:
+            filename: Original image filename
+            
+        Returns:
+            Number of cache entries removed
+        """
+        prefix = f"{os.path.splitext(filename)[0]}_"
+        removed = 0
+        for _, _, path in cls._scan():
+            if os.path.basename(path).startswith(prefix):
+                try:
+                    os.remove(path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+        if removed:
+            cls.reset()
+        
+        storage = get_storage()
+        if storage.remote:
+            for obj in list(storage.list(AREA_VARIANTS, prefix=prefix)):
+                storage.delete_object(obj)
+                removed += 1
+            with cls._state_lock:
+                cls._published = {name for name in cls._published if not name.startswith(prefix)}
+        return removed
+    
+    @classmethod
+    def reset(cls) -> None:
+        """Forget the tracked cache size, index and published variants (used when storage changes)."""
+        with cls._state_lock:
+            cls._cache_bytes = None
+            cls._index = None
+            cls._published = set()
@@ -0,0 +1,221 @@
+"""
+Garbage collection of orphaned image rows and files.
+"""
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+
+from ..config import settings
+from ..database import get_db_context
+from .background import BackgroundWorker
+from .image_cache import ImageVariantCache
+from .image_paths import ImagePaths, TEMP_PREFIX
+from .storage import AREA_ORIGINALS, AREA_THUMBNAILS, AREA_VARIANTS, LocalStorage, get_storage
+
+
+# Child tables whose rows are orphaned once their product is gone
+PRODUCT_CHILD_TABLES = ("product_images", "product_sizes", "product_categories")
+
+# Filenames listed in a report (the counts always cover everything)
+REPORT_FILE_LIMIT = 100
+
+
+class ImageGarbageCollector:
+    """
+    Removes image rows that point at deleted products and image files that
+    nothing references any more.
+    
+    Files younger than the grace period are never touched, and before a
+    batch of files is deleted the references are read again under the
+    database write lock, which is held until the files are gone. Uploads
+    take the same lock before they reuse a stored file (see
+    ImageService.save_product_image), so a file claimed after the first
+    scan is kept. Work is done in batches so the write lock is held only
+    briefly.
+    """
+    
+    _run_lock = threading.Lock()
+    _scheduler: Optional[BackgroundWorker] = None
+    
+    @staticmethod
+    def _referenced_images(cursor) -> set:
+        """Filenames referenced by live products or categories."""
+        cursor.execute("""
+            SELECT pi.filename FROM product_images pi
+            INNER JOIN products p ON p.id = pi.product_id
+            WHERE pi.filename IS NOT NULL
+            UNION
+            SELECT image_filename FROM categories WHERE image_filename IS NOT NULL
+        """)
+        return {row["filename"] for row in cursor.fetchall() if row["filename"]}
+    
+    @staticmethod
+    def _is_referenced(obj, referenced: set) -> bool:
+        """Whether a stored file belongs to one of the referenced images."""
+        if obj.name.startswith(TEMP_PREFIX) or obj.area == AREA_VARIANTS:
+            return False
+        if obj.area == AREA_THUMBNAILS:
+            return obj.name in {ImagePaths.thumbnail_name(filename) for filename in referenced}
+        return obj.name in referenced
+    
+    @staticmethod
+    def _dangling_row_ids(cursor, table: str) -> list:
+        """Ids of rows in a product child table whose product no longer exists."""
+        cursor.execute(
+            f"""SELECT t.id FROM "{table}" t
+                LEFT JOIN products p ON p.id = t.product_id
+                WHERE p.id IS NULL"""
+        )
+        return [row["id"] for row in cursor.fetchall()]
+    
+    @classmethod
+    def _orphan_files(cls, referenced: set, cutoff: float) -> list:
+        """
+        Find unreferenced stored files older than the cutoff.
+        
+        Returns:
+            List of (object, storage, source_filename) tuples sorted by
+            location; source_filename is the original image name for
+            originals and None otherwise
+        """
+        expected_thumbnails = {ImagePaths.thumbnail_name(f) for f in referenced}
+        storage = get_storage()
+        candidates = []
+        
+        for obj in storage.list(AREA_ORIGINALS, include_temp=True):
+            if obj.name.startswith(TEMP_PREFIX):
+                candidates.append((obj, storage, None))
+            elif obj.name not in referenced:
+                candidates.append((obj, storage, obj.name))
+        for obj in storage.list(AREA_THUMBNAILS, include_temp=True):
+            if obj.name.startswith(TEMP_PREFIX) or obj.name not in expected_thumbnails:
+                candidates.append((obj, storage, None))
+        
+        # Temp files left behind by interrupted writes to the local variant cache
+        cache = LocalStorage()
+        for obj in cache.list(AREA_VARIANTS, include_temp=True):
+            if obj.name.startswith(TEMP_PREFIX):
+                candidates.append((obj, cache, None))
+        
+        orphans = [candidate for candidate in candidates if candidate[0].mtime <= cutoff]
+        return sorted(orphans, key=lambda candidate: candidate[0].location)
+    
+    @classmethod
+    def collect(
+        cls,
+        dry_run: bool = True,
+        grace_seconds: Optional[int] = None,
+        batch_size: Optional[int] = None
+    ) -> dict:
+        """
+        Find (and unless dry_run, delete) orphaned image rows and files.
+        
+        Args:
+            dry_run: Only report what would be removed
+            grace_seconds: Minimum file age before it may be removed
+            batch_size: Rows or files removed per batch
+        
+        Returns:
+            Report with dangling row counts per table, orphan file count,
+            files kept because they were referenced again before deletion,
+            reclaimed bytes and the first REPORT_FILE_LIMIT file paths
+        """
+        grace_seconds = settings.IMAGE_GC_GRACE_SECONDS if grace_seconds is None else grace_seconds
+        batch_size = batch_size or settings.IMAGE_GC_BATCH_SIZE
+        cutoff = time.time() - grace_seconds
+        
+        with cls._run_lock:
+            report = {
+                "dry_run": dry_run,
+                "grace_seconds": grace_seconds,
+                "dangling_rows": {},
+                "orphan_files": 0,
+                "kept_files": 0,
+                "reclaimed_bytes": 0,
+                "files": [],
+                "errors": [],
+                "started_at": datetime.utcnow().isoformat(),
+            }
+            
+            # Rows pointing at deleted products
+            with get_db_context() as conn:
+                cursor = conn.cursor()
+                dangling = {table: cls._dangling_row_ids(cursor, table) for table in PRODUCT_CHILD_TABLES}
+                referenced = cls._referenced_images(cursor)
+            
+            for table, row_ids in dangling.items():
+                report["dangling_rows"][table] = len(row_ids)
+                if dry_run:
+                    continue
+                for start in range(0, len(row_ids), batch_size):
+                    batch = row_ids[start:start + batch_size]
+                    placeholders = ",".join("?" * len(batch))
+                    with get_db_context() as conn:
+                        conn.execute(f'DELETE FROM "{table}" WHERE id IN ({placeholders})', batch)
+            
+            # Files nothing live references (judged without the dangling rows)
+            orphans = cls._orphan_files(referenced, cutoff)
+            report["orphan_files"] = len(orphans)
+            report["files"] = [obj.location for obj, _, _ in orphans[:REPORT_FILE_LIMIT]]
+            
+            for start in range(0, len(orphans), batch_size):
+                batch = orphans[start:start + batch_size]
+                if dry_run:
+                    report["reclaimed_bytes"] += sum(obj.size for obj, _, _ in batch)
+                    continue
+                
+                sources = []
+                with get_db_context(immediate=True) as conn:
+                    referenced_now = cls._referenced_images(conn.cursor())
+                    for obj, storage, source in batch:
+                        if cls._is_referenced(obj, referenced_now):
+                            report["kept_files"] += 1
+                            continue
+                        try:
+                            if storage.delete_object(obj):
+                                report["reclaimed_bytes"] += obj.size
+                                if source:
+                                    sources.append(source)
+                        except Exception as e:
+                            report["errors"].append(f"Error deleting {obj.location}: {str(e)}")
+                    
+                    if sources:
+                        placeholders = ",".join("?" * len(sources))
+                        conn.execute(
+                            f"DELETE FROM image_metadata WHERE source_filename IN ({placeholders})",
+                            sources
+                        )
+                
+                for source in sources:
+                    ImageVariantCache.purge(source)
+            
+            if not dry_run:
+                print(
+                    f"Image GC removed {sum(report['dangling_rows'].values())} rows and "
+                    f"{report['orphan_files']} files ({report['reclaimed_bytes']} bytes)"
+                )
+            return report
+    
+    @classmethod
+    def start_scheduler(cls) -> bool:
+        """
+        Run the collector every IMAGE_GC_INTERVAL_SECONDS in a background thread.
+        
+        Returns:
+            False if scheduling is disabled (interval 0) or already running
+        """
+        if settings.IMAGE_GC_INTERVAL_SECONDS <= 0:
+            return False
+        if cls._scheduler is not None and cls._scheduler.running:
+            return False
+        
+        cls._scheduler = BackgroundWorker(
+            "image-gc", lambda: cls.collect(dry_run=False), settings.IMAGE_GC_INTERVAL_SECONDS, wait_first=True
+        )
+        return cls._scheduler.start()
+    
+    @classmethod
+    def stop_scheduler(cls) -> None:
+        if cls._scheduler is not None:
+            cls._scheduler.stop()
@@ -0,0 +1,219 @@
+"""
+Persisted metadata for stored images and their variants.
+"""
+import hashlib
+import io
+from datetime import datetime
+
+from PIL import Image
+
+from .image_paths import ImagePaths
+from .storage import AREA_ORIGINALS, AREA_THUMBNAILS, get_storage
+
+
+VARIANT_ORIGINAL = "original"
+VARIANT_THUMBNAIL = "thumbnail"
+
+
+class ImageMetadataService:
+    """Records width, height, size, format and hash of every stored image file."""
+    
+    @staticmethod
+    def describe(data: bytes) -> dict:
+        """
+        Read the metadata of an encoded image.
+        
+        Only the image header is decoded, so this is cheap even for large files.
+        
+        Args:
+            data: Encoded image bytes
+        
+        Returns:
+            Dict with width, height, bytes, format and content_hash
+        """
+        img = Image.open(io.BytesIO(data))
+        return {
+            "width": img.size[0],
+            "height": img.size[1],
+            "bytes": len(data),
+            "format": img.format,
+            "content_hash": hashlib.sha256(data).hexdigest(),
+        }
+    
+    @classmethod
+    def record(
+        cls,
+        cursor,
+        source_filename: str,
+        variant: str,
+        filename: str,
+        data: bytes,
+        encoding: dict = None,
+        profile_version: str = None
+    ) -> dict:
+        """
+        Store (or replace) the metadata row for one stored file.
+        
+        Args:
+            cursor: Database cursor
+            source_filename: Original image filename the file belongs to
+            variant: VARIANT_ORIGINAL or VARIANT_THUMBNAIL
+            filename: Filename of the stored file itself
+            data: The stored file's bytes
+            encoding: Encoder report (quality, ssim, baseline_bytes) when
+                the file was just encoded
+            profile_version: Version of the profile the file was rendered
+                with (see ImageProfiles); None when unknown
+        
+        Returns:
+            The recorded metadata
+        """
+        info = cls.describe(data)
+        encoding = encoding or {}
+        cursor.execute(
+            """INSERT INTO image_metadata
+               (source_filename, variant, filename, width, height, bytes, format, content_hash,
+                quality, ssim, baseline_bytes, profile_version, created_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT(source_filename, variant) DO UPDATE SET
+                   filename = excluded.filename,
+                   width = excluded.width,
+                   height = excluded.height,
+                   bytes = excluded.bytes,
+                   format = excluded.format,
+                   content_hash = excluded.content_hash,
+                   quality = excluded.quality,
+                   ssim = excluded.ssim,
+                   baseline_bytes = excluded.baseline_bytes,
+                   profile_version = excluded.profile_version,
+                   created_at = excluded.created_at""",
+            (
+                source_filename, variant, filename,
+                info["width"], info["height"], info["bytes"], info["format"], info["content_hash"],
+                encoding.get("quality"), encoding.get("ssim"), encoding.get("baseline_bytes"),
+                profile_version, datetime.now().isoformat(),
+            )
+        )
+        return info
+    
+    @staticmethod
+    def encoding_stats(cursor) -> dict:
+        """
+        Summarize auto-quality encoding per variant.
+        
+        Only files whose fixed-quality baseline size was recorded are
+        counted, so the savings compare like with like.
+        
+        Args:
+            cursor: Database cursor
+        
+        Returns:
+            Dict keyed by variant with files, average and min/max quality,
+            average SSIM, stored and baseline bytes, and saved bytes/percent
+        """
+        cursor.execute("""
+            SELECT variant, COUNT(*) AS files,
+                   AVG(quality) AS avg_quality, MIN(quality) AS min_quality, MAX(quality) AS max_quality,
+                   AVG(ssim) AS avg_ssim, SUM(bytes) AS bytes, SUM(baseline_bytes) AS baseline_bytes
+            FROM image_metadata
+            WHERE baseline_bytes IS NOT NULL
+            GROUP BY variant
+        """)
+        stats = {}
+        for row in cursor.fetchall():
+            saved = row["baseline_bytes"] - row["bytes"]
+            stats[row["variant"]] = {
+                "files": row["files"],
+                "avg_quality": round(row["avg_quality"], 1),
+                "min_quality": row["min_quality"],
+                "max_quality": row["max_quality"],
+                "avg_ssim": round(row["avg_ssim"], 4) if row["avg_ssim"] is not None else None,
+                "bytes": row["bytes"],
+                "baseline_bytes": row["baseline_bytes"],
+                "saved_bytes": saved,
+                "saved_percent": round(100 * saved / row["baseline_bytes"], 1) if row["baseline_bytes"] else 0.0,
+            }
+        return stats
+    
+    @staticmethod
+    def exists(cursor, source_filename: str, variant: str) -> bool:
+        """Check whether a metadata row exists for a stored file."""
+        cursor.execute(
+            "SELECT 1 FROM image_metadata WHERE source_filename = ? AND variant = ?",
+            (source_filename, variant)
+        )
+        return cursor.fetchone() is not None
+    
+    @staticmethod
+    def get_dimensions(cursor, filenames: list) -> dict:
+        """
+        Look up the stored dimensions of original images.
+        
+        Args:
+            cursor: Database cursor
+            filenames: Original image filenames
+        
+        Returns:
+            Dict mapping filename to {"width": ..., "height": ...}; unknown
+            images are left out
+        """
+        if not filenames:
+            return {}
+        placeholders = ",".join("?" * len(filenames))
+        cursor.execute(
+            f"""SELECT source_filename, width, height FROM image_metadata
+                WHERE variant = ? AND source_filename IN ({placeholders})""",
+            [VARIANT_ORIGINAL, *filenames]
+        )
+        return {
+            row["source_filename"]: {"width": row["width"], "height": row["height"]}
+            for row in cursor.fetchall()
+        }
+    
+    @staticmethod
+    def delete(cursor, source_filename: str, variant: str = None) -> None:
+        """Remove the metadata rows of an image (or just one of its variants)."""
+        if variant:
+            cursor.execute(
+                "DELETE FROM image_metadata WHERE source_filename = ? AND variant = ?",
+                (source_filename, variant)
+            )
+        else:
+            cursor.execute("DELETE FROM image_metadata WHERE source_filename = ?", (source_filename,))
+    
+    @classmethod
+    def backfill(cls, cursor, filenames: list) -> dict:
+        """
+        Record metadata for existing images that have none yet.
+        
+        Args:
+            cursor: Database cursor
+            filenames: Original image filenames to check
+        
+        Returns:
+            Dict with counts of recorded originals and thumbnails, plus errors
+        """
+        result = {"originals": 0, "thumbnails": 0, "errors": []}
+        storage = get_storage()
+        
+        for filename in filenames:
+            if not filename:
+                continue
+            
+            stored = (
+                (VARIANT_ORIGINAL, AREA_ORIGINALS, filename, "originals"),
+                (VARIANT_THUMBNAIL, AREA_THUMBNAILS, ImagePaths.thumbnail_name(filename), "thumbnails"),
+            )
+            for variant, area, name, counter in stored:
+                if cls.exists(cursor, filename, variant):
+                    continue
+                try:
+                    data = storage.get(area, name)
+                    if data is None:
+                        continue
+                    cls.record(cursor, filename, variant, name, data)
+                    result[counter] += 1
+                except Exception as e:
+                    result["errors"].append(f"Error reading {name}: {str(e)}")
+        
+        return result
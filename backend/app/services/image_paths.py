@@ -0,0 +1,184 @@
+"""
+On-disk layout of stored images.
+"""
+import hashlib
+import os
+import re
+import tempfile
+from typing import Iterator, Optional
+
+
+# Shard directory names: two lowercase hex characters
+_SHARD_NAME = re.compile(r"^[0-9a-f]{2}$")
+
+# Temp files written by atomic writes before they are renamed into place
+TEMP_PREFIX = ".tmp-"
+
+
+class ImagePaths:
+    """
+    Maps image filenames to paths in a two-level sharded layout.
+    
+    New files are written to <root>/ab/cd/<name>, where ab and cd come from
+    a hash of the name, keeping every directory small. Files from the old
+    flat layout (<root>/<name>) are still found by resolve() until they have
+    been migrated, so filenames (and public URLs) never change.
+    
+    Writers touch the root directory after adding or removing a file so its
+    mtime keeps signalling changes anywhere below it.
+    """
+    
+    @staticmethod
+    def thumbnail_name(filename: str) -> str:
+        """Thumbnail filename for an original image filename."""
+        return f"{os.path.splitext(filename)[0]}_thumb.jpg"
+    
+    @staticmethod
+    def shard(name: str) -> tuple:
+        """Return the two shard directory names for a filename."""
+        digest = hashlib.sha256(name.encode("utf-8")).hexdigest()
+        return digest[0:2], digest[2:4]
+    
+    @classmethod
+    def sharded_path(cls, root: str, name: str) -> str:
+        """Path of a file in the sharded layout (where new files are written)."""
+        first, second = cls.shard(name)
+        return os.path.join(root, first, second, name)
+    
+    @staticmethod
+    def flat_path(root: str, name: str) -> str:
+        """Path of a file in the legacy flat layout."""
+        return os.path.join(root, name)
+    
+    @classmethod
+    def resolve(cls, root: str, name: str) -> Optional[str]:
+        """
+        Find a stored file in either layout.
+        
+        Args:
+            root: Storage root (UPLOAD_DIR or THUMBNAIL_DIR)
+            name: Filename
+        
+        Returns:
+            Path of the existing file, or None if it is in neither layout
+        """
+        if not name or name != os.path.basename(name) or name.startswith("."):
+            return None
+        for path in (cls.sharded_path(root, name), cls.flat_path(root, name)):
+            if os.path.isfile(path):
+                return path
+        return None
+    
+    @classmethod
+    def exists(cls, root: str, name: str) -> bool:
+        return cls.resolve(root, name) is not None
+    
+    @classmethod
+    def remove(cls, root: str, name: str) -> bool:
+        """
+        Delete a stored file from whichever layout holds it.
+        
+        Returns:
+            True if a file was deleted
+        """
+        deleted = False
+        for path in (cls.sharded_path(root, name), cls.flat_path(root, name)):
+            try:
+                os.remove(path)
+                deleted = True
+            except FileNotFoundError:
+                pass
+        if deleted:
+            cls.touch(root)
+        return deleted
+    
+    @staticmethod
+    def write_atomic(path: str, data: bytes) -> None:
+        """Write a file via a temp file + rename so readers never see partial data."""
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=TEMP_PREFIX)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    
+    @staticmethod
+    def touch(root: str) -> None:
+        """Bump the root directory's mtime to signal a change below it."""
+        try:
+            os.utime(root)
+        except OSError:
+            pass
+    
+    @staticmethod
+    def iter_files(root: str, include_temp: bool = False) -> Iterator[tuple]:
+        """
+        Yield (name, path) for every stored file in both layouts.
+        
+        Args:
+            root: Storage root
+            include_temp: Also yield leftover temp files from atomic writes
+        """
+        def entries(directory):
+            try:
+                with os.scandir(directory) as it:
+                    return list(it)
+            except FileNotFoundError:
+                return []
+        
+        for entry in entries(root):
+            if entry.is_dir():
+                if not _SHARD_NAME.match(entry.name):
+                    continue
+                for sub in entries(entry.path):
+                    if not (sub.is_dir() and _SHARD_NAME.match(sub.name)):
+                        continue
+                    for leaf in entries(sub.path):
+                        if leaf.is_file() and (include_temp or not leaf.name.startswith(TEMP_PREFIX)):
+                            yield leaf.name, leaf.path
+            elif entry.is_file() and (include_temp or not entry.name.startswith(TEMP_PREFIX)):
+                yield entry.name, entry.path
+    
+    @classmethod
+    def migrate(cls, root: str, batch_size: int) -> dict:
+        """
+        Move up to batch_size files from the flat layout into shards.
+        
+        Each move is an atomic rename within the same filesystem, and
+        resolve() checks the sharded path first, so readers see the file
+        throughout. Safe to run while the app is serving traffic.
+        
+        Args:
+            root: Storage root
+            batch_size: Maximum number of files to move in this call
+        
+        Returns:
+            Dict with moved and remaining (flat files left) counts
+        """
+        flat = []
+        try:
+            with os.scandir(root) as it:
+                for entry in it:
+                    if entry.is_file() and not entry.name.startswith(TEMP_PREFIX):
+                        flat.append(entry.name)
+        except FileNotFoundError:
+            pass
+        
+        moved = 0
+        for name in sorted(flat)[:batch_size]:
+            target = cls.sharded_path(root, name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            try:
+                os.replace(cls.flat_path(root, name), target)
+                moved += 1
+            except FileNotFoundError:
+                pass
+        if moved:
+            cls.touch(root)
+        
+        return {"moved": moved, "remaining": len(flat) - moved}
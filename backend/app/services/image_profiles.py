@@ -0,0 +1,87 @@
+"""
+Versioned rendering profiles for stored image variants.
+"""
+import hashlib
+import json
+
+from ..config import settings
+
+
+PROFILE_ORIGINAL = "original"
+PROFILE_THUMBNAIL = "thumbnail"
+PROFILE_VARIANT = "variant"
+
+# Bump when the rendering code changes output for the same settings
+ENCODER_REVISION = 1
+
+
+class ImageProfiles:
+    """
+    Describes how each kind of stored file is rendered.
+    
+    A profile's version is a short hash of the settings that shape its
+    output, so changing MAX_IMAGE_SIZE, THUMBNAIL_SIZE or a quality setting
+    gives the affected profile a new version. Files record the version they
+    were rendered with; anything else is stale.
+    """
+    
+    @staticmethod
+    def _encoder_settings() -> dict:
+        return {
+            "auto_quality": settings.IMAGE_AUTO_QUALITY,
+            "target_ssim": settings.IMAGE_TARGET_SSIM,
+            "quality_range": list(settings.IMAGE_AUTO_QUALITY_RANGE),
+        }
+    
+    @classmethod
+    def parameters(cls, profile: str) -> dict:
+        """
+        The settings a profile's output depends on.
+        
+        Args:
+            profile: PROFILE_ORIGINAL, PROFILE_THUMBNAIL or PROFILE_VARIANT
+        
+        Returns:
+            Dict of setting values
+        
+        Raises:
+            ValueError: If the profile is unknown
+        """
+        if profile == PROFILE_ORIGINAL:
+            params = {"size": list(settings.MAX_IMAGE_SIZE), "quality": settings.IMAGE_QUALITY}
+        elif profile == PROFILE_THUMBNAIL:
+            # Placeholders are derived from the thumbnail and re-rendered with it
+            params = {
+                "size": list(settings.THUMBNAIL_SIZE),
+                "quality": settings.THUMBNAIL_QUALITY,
+                "placeholder_size": list(settings.PLACEHOLDER_SIZE),
+                "placeholder_quality": settings.PLACEHOLDER_QUALITY,
+            }
+        elif profile == PROFILE_VARIANT:
+            params = {"quality": settings.IMAGE_QUALITY}
+        else:
+            raise ValueError(f"Unknown image profile '{profile}'")
+        params.update(cls._encoder_settings())
+        return params
+    
+    @classmethod
+    def version(cls, profile: str) -> str:
+        """
+        Current version of a profile.
+        
+        Args:
+            profile: PROFILE_ORIGINAL, PROFILE_THUMBNAIL or PROFILE_VARIANT
+        
+        Returns:
+            8-character hex version
+        """
+        key = json.dumps([ENCODER_REVISION, profile, cls.parameters(profile)], sort_keys=True)
+        return hashlib.sha256(key.encode()).hexdigest()[:8]
+    
+    @classmethod
+    def versions(cls) -> dict:
+        """Current version of every profile, keyed by profile name."""
+        return {
+            profile: cls.version(profile)
+            for profile in (PROFILE_ORIGINAL, PROFILE_THUMBNAIL, PROFILE_VARIANT)
+        }
@@ -0,0 +1,119 @@
+"""
+Image quality metrics (PSNR and SSIM) implemented with Pillow only.
+"""
+import array
+import math
+
+from PIL import Image, ImageChops, ImageMath
+
+
+# SSIM stabilising constants for 8-bit images
+_SSIM_C1 = (0.01 * 255) ** 2
+_SSIM_C2 = (0.03 * 255) ** 2
+
+# Side of the square windows SSIM statistics are computed over
+SSIM_BLOCK_SIZE = 8
+
+
+def _match_size(reference: Image.Image, candidate: Image.Image) -> Image.Image:
+    """Resize the candidate to the reference size if they differ."""
+    if candidate.size != reference.size:
+        candidate = candidate.resize(reference.size, Image.Resampling.LANCZOS)
+    return candidate
+
+
+def _pixels(img: Image.Image) -> array.array:
+    """Return the pixel values of a mode 'F' image as a flat float array."""
+    return array.array("f", img.tobytes())
+
+
+def psnr(reference: Image.Image, candidate: Image.Image) -> float:
+    """
+    Peak signal-to-noise ratio between two images, in dB.
+    
+    Args:
+        reference: Reference image
+        candidate: Image to compare (resized to the reference if needed)
+    
+    Returns:
+        PSNR in dB (infinity for identical images)
+    """
+    reference = reference.convert("RGB")
+    candidate = _match_size(reference, candidate.convert("RGB"))
+    
+    diff = ImageChops.difference(reference, candidate)
+    histogram = diff.histogram()
+    squared_error = sum(
+        count * ((index % 256) ** 2) for index, count in enumerate(histogram)
+    )
+    mse = squared_error / (reference.size[0] * reference.size[1] * 3)
+    if mse == 0:
+        return math.inf
+    return 10 * math.log10(255 ** 2 / mse)
+
+
+class SsimReference:
+    """
+    Precomputed luma statistics of a reference image for repeated SSIM checks.
+    
+    Statistics are taken over non-overlapping SSIM_BLOCK_SIZE windows
+    (box-filter means), which tracks windowed SSIM closely and is cheap
+    enough to run per upload. Comparing several candidates (e.g. trial
+    encodes at different qualities) reuses the reference side.
+    """
+    
+    def __init__(self, reference: Image.Image):
+        self.reference = reference.convert("L")
+        self._a = self.reference.convert("F")
+        self._blocks = (
+            max(1, self._a.size[0] // SSIM_BLOCK_SIZE),
+            max(1, self._a.size[1] // SSIM_BLOCK_SIZE),
+        )
+        self._mu_a = self._block_mean(self._a)
+        self._mean_aa = self._block_mean(self._product(self._a, self._a))
+    
+    def _block_mean(self, img: Image.Image) -> array.array:
+        return _pixels(img.resize(self._blocks, Image.Resampling.BOX))
+    
+    @staticmethod
+    def _product(x: Image.Image, y: Image.Image) -> Image.Image:
+        return ImageMath.lambda_eval(lambda args: args["x"] * args["y"], x=x, y=y)
+    
+    def compare(self, candidate: Image.Image) -> float:
+        """
+        SSIM of a candidate against the reference.
+        
+        Args:
+            candidate: Image to compare (resized to the reference if needed)
+        
+        Returns:
+            Mean SSIM in [-1, 1], 1 meaning identical
+        """
+        b = _match_size(self.reference, candidate.convert("L")).convert("F")
+        mu_b = self._block_mean(b)
+        mean_bb = self._block_mean(self._product(b, b))
+        mean_ab = self._block_mean(self._product(self._a, b))
+        
+        total = 0.0
+        for ma, mb, aa, bb, ab in zip(self._mu_a, mu_b, self._mean_aa, mean_bb, mean_ab):
+            var_a = aa - ma * ma
+            var_b = bb - mb * mb
+            cov = ab - ma * mb
+            total += ((2 * ma * mb + _SSIM_C1) * (2 * cov + _SSIM_C2)) / (
+                (ma * ma + mb * mb + _SSIM_C1) * (var_a + var_b + _SSIM_C2)
+            )
+        return total / len(self._mu_a)
+
+
+def ssim(reference: Image.Image, candidate: Image.Image) -> float:
+    """
+    Structural similarity between two images on the luma channel.
+    
+    Args:
+        reference: Reference image
+        candidate: Image to compare (resized to the reference if needed)
+    
+    Returns:
+        Mean SSIM in [-1, 1], 1 meaning identical
+    """
+    return SsimReference(reference).compare(candidate)
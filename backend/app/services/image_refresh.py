@@ -0,0 +1,312 @@
+"""
+Background re-rendering of image files made with an outdated profile.
+"""
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+
+from ..config import settings
+from ..database import get_db_context
+from .image import ImageService
+from .image_cache import ImageVariantCache
+from .image_metadata import ImageMetadataService, VARIANT_ORIGINAL, VARIANT_THUMBNAIL
+from .image_paths import ImagePaths
+from .image_profiles import ImageProfiles, PROFILE_ORIGINAL, PROFILE_THUMBNAIL, PROFILE_VARIANT
+from .storage import AREA_ORIGINALS, AREA_THUMBNAILS, AREA_VARIANTS, LocalStorage, get_storage
+
+
+# Lowest scheduling priority for the worker thread (Unix nice value)
+REFRESH_NICE = 19
+
+
+class ImageProfileRefresher:
+    """
+    Re-renders thumbnails and cached variants whose profile version is out
+    of date, one file at a time.
+    
+    Replacements are written next to (variants) or atomically over
+    (thumbnails) the stale files, which keep being served until then. The
+    worker thread runs at the lowest OS priority and, after each file, sleeps
+    long enough to use at most IMAGE_REFRESH_CPU_BUDGET of one core.
+    
+    Stored originals are the master copies every other file is rendered
+    from, so they are never re-encoded; originals from an older profile are
+    only counted.
+    """
+    
+    _run_lock = threading.Lock()
+    _scheduler: Optional[threading.Thread] = None
+    _stop = threading.Event()
+    _wake = threading.Event()
+    _last_run: Optional[dict] = None
+    
+    @staticmethod
+    def _referenced_images(cursor) -> list:
+        """Filenames referenced by products or categories."""
+        cursor.execute("""
+            SELECT filename FROM product_images WHERE filename IS NOT NULL
+            UNION
+            SELECT image_filename FROM categories WHERE image_filename IS NOT NULL
+        """)
+        return [row["filename"] for row in cursor.fetchall() if row["filename"]]
+    
+    @staticmethod
+    def stale_thumbnails(cursor) -> list:
+        """
+        Referenced images whose thumbnail was not rendered with the current
+        thumbnail profile (or has no recorded version).
+        
+        Returns:
+            Original image filenames
+        """
+        cursor.execute(
+            """SELECT r.filename FROM (
+                   SELECT filename FROM product_images WHERE filename IS NOT NULL
+                   UNION
+                   SELECT image_filename FROM categories WHERE image_filename IS NOT NULL
+               ) r
+               LEFT JOIN image_metadata m ON m.source_filename = r.filename AND m.variant = ?
+               WHERE m.profile_version IS NULL OR m.profile_version != ?
+               ORDER BY r.filename""",
+            (VARIANT_THUMBNAIL, ImageProfiles.version(PROFILE_THUMBNAIL))
+        )
+        return [row["filename"] for row in cursor.fetchall() if row["filename"]]
+    
+    @staticmethod
+    def stale_variants() -> list:
+        """
+        Cached and published variants rendered with an older variant profile.
+        
+        Returns:
+            List of (object, storage, parsed variant name) tuples
+        """
+        version = ImageProfiles.version(PROFILE_VARIANT)
+        stores = [LocalStorage()]
+        storage = get_storage()
+        if storage.remote:
+            stores.append(storage)
+        
+        stale = []
+        for store in stores:
+            for obj in store.list(AREA_VARIANTS):
+                parsed = ImageVariantCache.parse_variant_filename(obj.name)
+                if parsed and parsed["version"] != version:
+                    stale.append((obj, store, parsed))
+        return stale
+    
+    @classmethod
+    def status(cls) -> dict:
+        """
+        Current profile versions and how many files are out of date.
+        
+        Returns:
+            Dict with versions, stale counts per kind of file, whether the
+            background worker is running and the result of its last pass
+        """
+        with get_db_context() as conn:
+            cursor = conn.cursor()
+            thumbnails = len(cls.stale_thumbnails(cursor))
+            cursor.execute(
+                """SELECT COUNT(*) AS count FROM image_metadata
+                   WHERE variant = ? AND (profile_version IS NULL OR profile_version != ?)""",
+                (VARIANT_ORIGINAL, ImageProfiles.version(PROFILE_ORIGINAL))
+            )
+            originals = cursor.fetchone()["count"]
+        
+        return {
+            "versions": ImageProfiles.versions(),
+            "stale": {
+                "thumbnails": thumbnails,
+                "variants": len(cls.stale_variants()),
+                "originals": originals,
+            },
+            "refresh_interval_seconds": settings.IMAGE_REFRESH_INTERVAL_SECONDS,
+            "cpu_budget": settings.IMAGE_REFRESH_CPU_BUDGET,
+            "running": cls._run_lock.locked(),
+            "last_run": cls._last_run,
+        }
+    
+    @staticmethod
+    def refresh_thumbnail(filename: str) -> None:
+        """
+        Re-render the thumbnail and placeholder of one image.
+        
+        Raises:
+            FileNotFoundError: If the original is missing
+        """
+        storage = get_storage()
+        original = storage.get(AREA_ORIGINALS, filename)
+        if original is None:
+            raise FileNotFoundError("Original image not found")
+        
+        version = ImageProfiles.version(PROFILE_THUMBNAIL)
+        encoding = {}
+        thumbnail_bytes = ImageService.create_thumbnail(original, report=encoding)
+        placeholder = ImageService.create_placeholder(thumbnail_bytes)
+        thumbnail_name = ImagePaths.thumbnail_name(filename)
+        storage.put(AREA_THUMBNAILS, thumbnail_name, thumbnail_bytes)
+        
+        with get_db_context() as conn:
+            cursor = conn.cursor()
+            ImageMetadataService.record(
+                cursor, filename, VARIANT_THUMBNAIL, thumbnail_name, thumbnail_bytes,
+                encoding=encoding, profile_version=version
+            )
+            ImageService.store_placeholder(cursor, filename, placeholder)
+    
+    @staticmethod
+    def refresh_variant(obj, storage, parsed: dict, originals: dict) -> bool:
+        """
+        Render the current version of a stale variant, then drop the stale one.
+        
+        Args:
+            obj: Stored object of the stale variant
+            storage: Storage holding it (the local cache or a remote backend)
+            parsed: Its parsed variant name
+            originals: Original filenames of live images keyed by base name
+        
+        Returns:
+            False if the variant is not in the current allow-lists or its
+            original is no longer referenced; the stale entry is dropped
+            either way
+        """
+        filename = originals.get(parsed["base"])
+        params = (parsed["width"], parsed["height"], parsed["fit"], parsed["fmt"])
+        rendered = False
+        if filename:
+            try:
+                ImageVariantCache.validate(*params)
+                if storage.remote:
+                    rendered = ImageVariantCache.publish_variant(storage, filename, *params) is not None
+                else:
+                    rendered = ImageVariantCache.get_variant(filename, *params, allow_stale=False) is not None
+            except ValueError:
+                rendered = False
+        
+        if storage.remote:
+            storage.delete_object(obj)
+        else:
+            ImageVariantCache.discard(obj.location)
+        return rendered
+    
+    @classmethod
+    def _throttle(cls, cpu_seconds: float) -> None:
+        """Sleep so that cpu_seconds of work uses at most the CPU budget."""
+        budget = settings.IMAGE_REFRESH_CPU_BUDGET
+        if 0 < budget < 1:
+            cls._stop.wait(cpu_seconds * (1 / budget - 1))
+    
+    @classmethod
+    def run(cls, limit: Optional[int] = None, throttle: bool = True) -> dict:
+        """
+        Re-render stale thumbnails, then stale variants.
+        
+        Args:
+            limit: Maximum number of files to re-render in this pass
+            throttle: Sleep between files to honour the CPU budget
+        
+        Returns:
+            Report with refreshed thumbnail and variant counts and errors,
+            or one with skipped=True if a pass is already running
+        """
+        if not cls._run_lock.acquire(blocking=False):
+            return {"skipped": True}
+        
+        try:
+            report = {
+                "thumbnails": 0,
+                "variants": 0,
+                "errors": [],
+                "started_at": datetime.utcnow().isoformat(),
+            }
+            with get_db_context() as conn:
+                cursor = conn.cursor()
+                thumbnails = cls.stale_thumbnails(cursor)
+                originals = {os.path.splitext(f)[0]: f for f in cls._referenced_images(cursor)}
+            
+            work = [("thumbnails", filename) for filename in thumbnails]
+            work += [("variants", stale) for stale in cls.stale_variants()]
+            if limit is not None:
+                work = work[:limit]
+            
+            for kind, item in work:
+                if cls._stop.is_set():
+                    break
+                start = time.thread_time()
+                try:
+                    if kind == "thumbnails":
+                        cls.refresh_thumbnail(item)
+                        report["thumbnails"] += 1
+                    elif cls.refresh_variant(*item, originals):
+                        report["variants"] += 1
+                except Exception as e:
+                    name = item if kind == "thumbnails" else item[0].name
+                    report["errors"].append(f"Error refreshing {name}: {str(e)}")
+                if throttle:
+                    cls._throttle(time.thread_time() - start)
+            
+            report["finished_at"] = datetime.utcnow().isoformat()
+            if report["thumbnails"] or report["variants"]:
+                print(
+                    f"Image refresh re-rendered {report['thumbnails']} thumbnails and "
+                    f"{report['variants']} variants ({len(report['errors'])} errors)"
+                )
+            cls._last_run = report
+            return report
+        finally:
+            cls._run_lock.release()
+    
+    @classmethod
+    def start_scheduler(cls) -> bool:
+        """
+        Run a pass at startup and then every IMAGE_REFRESH_INTERVAL_SECONDS
+        in a background thread.
+        
+        Returns:
+            False if refreshing is disabled (interval 0) or already running
+        """
+        if settings.IMAGE_REFRESH_INTERVAL_SECONDS <= 0:
+            return False
+        if cls._scheduler is not None and cls._scheduler.is_alive():
+            return False
+        
+        cls._stop.clear()
+        cls._scheduler = threading.Thread(target=cls._schedule_loop, name="image-refresh", daemon=True)
+        cls._scheduler.start()
+        return True
+    
+    @classmethod
+    def stop_scheduler(cls) -> None:
+        cls._stop.set()
+        cls._wake.set()
+    
+    @classmethod
+    def trigger(cls) -> bool:
+        """
+        Start a pass now instead of at the next interval.
+        
+        Returns:
+            False if the background worker is not running
+        """
+        if cls._scheduler is None or not cls._scheduler.is_alive():
+            return False
+        cls._wake.set()
+        return True
+    
+    @classmethod
+    def _schedule_loop(cls) -> None:
+        # Linux gives each thread its own nice value
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), REFRESH_NICE)
+        except (AttributeError, OSError):
+            pass
+        
+        while not cls._stop.is_set():
+            try:
+                cls.run()
+            except Exception as e:
+                print(f"Image refresh failed: {e}")
+            cls._wake.wait(settings.IMAGE_REFRESH_INTERVAL_SECONDS)
+            cls._wake.clear()
@@ -0,0 +1,120 @@
+"""
+Reconciliation of stored image files against the database.
+"""
+import threading
+import time
+
+from .image_paths import ImagePaths
+from .storage import AREA_ORIGINALS, AREA_THUMBNAILS, ImageStorage, get_storage
+
+
+# Directory mtimes this recent may still change within the same timestamp
+# tick, so a scan taken now is not safe to cache yet
+MTIME_RACE_SECONDS = 2.0
+
+
+class ImageStatusService:
+    """
+    Compares the images the database references with the stored files.
+    
+    Each storage area is listed once into a set, and the result is cached
+    until the area's version (the root mtime for local storage; writers into
+    shard directories touch the root) or the set of referenced images
+    changes. Backends without a version are listed on every call.
+    """
+    
+    _lock = threading.Lock()
+    _cached_key = None
+    _cached_status = None
+    
+    @staticmethod
+    def scan_area(storage: ImageStorage, area: str) -> set:
+        """Names of the stored files in a storage area."""
+        return {obj.name for obj in storage.list(area)}
+    
+    @staticmethod
+    def _referenced_fingerprint(cursor) -> tuple:
+        """
+        Cheap fingerprint of the referenced image set.
+        
+        Product image rows are only ever inserted or deleted, so their count
+        and highest id change whenever the set does. Category images are
+        updated in place, but there are few categories, so their filenames
+        are folded in directly.
+        """
+        cursor.execute("SELECT COUNT(*) AS count, MAX(id) AS max_id FROM product_images")
+        images = cursor.fetchone()
+        cursor.execute(
+            "SELECT group_concat(COALESCE(image_filename, ''), '|') AS names FROM "
+            "(SELECT image_filename FROM categories ORDER BY id)"
+        )
+        categories = cursor.fetchone()
+        return images["count"], images["max_id"], categories["names"]
+    
+    @staticmethod
+    def referenced_images(cursor) -> set:
+        """Filenames referenced by product images or categories."""
+        cursor.execute("""
+            SELECT filename FROM product_images WHERE filename IS NOT NULL
+            UNION
+            SELECT image_filename FROM categories WHERE image_filename IS NOT NULL
+        """)
+        return {row["filename"] for row in cursor.fetchall() if row["filename"]}
+    
+    @classmethod
+    def get_status(cls, cursor) -> dict:
+        """
+        Reconcile referenced images with the stored files.
+        
+        Args:
+            cursor: Database cursor
+        
+        Returns:
+            Dict of sorted lists: with_thumbnails, without_thumbnails,
+            missing_originals, orphan_originals and orphan_thumbnails
+        """
+        storage = get_storage()
+        upload_version = storage.version(AREA_ORIGINALS)
+        thumbnail_version = storage.version(AREA_THUMBNAILS)
+        key = (
+            storage.root(AREA_ORIGINALS), upload_version,
+            storage.root(AREA_THUMBNAILS), thumbnail_version,
+            cls._referenced_fingerprint(cursor),
+        )
+        
+        with cls._lock:
+            if key == cls._cached_key:
+                return cls._cached_status
+        
+        referenced = cls.referenced_images(cursor)
+        originals = cls.scan_area(storage, AREA_ORIGINALS)
+        thumbnails = cls.scan_area(storage, AREA_THUMBNAILS)
+        expected_thumbnails = {ImagePaths.thumbnail_name(filename) for filename in referenced}
+        
+        present = referenced & originals
+        with_thumbnails = {f for f in present if ImagePaths.thumbnail_name(f) in thumbnails}
+        status = {
+            "with_thumbnails": sorted(with_thumbnails),
+            "without_thumbnails": sorted(present - with_thumbnails),
+            "missing_originals": sorted(referenced - originals),
+            "orphan_originals": sorted(originals - referenced),
+            "orphan_thumbnails": sorted(thumbnails - expected_thumbnails),
+        }
+        
+        # Only cache once the directories have been quiet for a while
+        if upload_version is None or thumbnail_version is None:
+            return status
+        newest = max(upload_version, thumbnail_version) / 1e9
+        if time.time() - newest >= MTIME_RACE_SECONDS:
+            with cls._lock:
+                cls._cached_key = key
+                cls._cached_status = status
+        
+        return status
+    
+    @classmethod
+    def reset(cls) -> None:
+        """Drop the cached status."""
+        with cls._lock:
+            cls._cached_key = None
+            cls._cached_status = None
@@ -5,6 +5,7 @@ import json
 from typing import Dict, Any, List
 
 from ..database import get_db
+from .stock_holds import StockHoldService
 
 
 def normalize_sizes(sizes_dict: Dict) -> Dict:
@@ -132,57 +133,256 @@ def move_between_locations(sizes_dict: Dict, size: str, quantity: int, from_loca
     return sizes_dict
 
 
+def take_from_sizes(sizes_dict: Dict, size: str, quantity: int) -> Dict:
+    """
+    Deduct a quantity of one size, from online stock first and then club stock.
+    
+    Args:
+        sizes_dict: Normalized sizes dictionary (modified in place)
+        size: The size to deduct
+        quantity: How many to deduct (clamped at the available stock)
+        
+    Returns:
+        Updated sizes dictionary
+    """
+    if size not in sizes_dict:
+        return sizes_dict
+    
+    remaining = quantity
+    online_qty = sizes_dict[size].get("online", 0)
+    club_qty = sizes_dict[size].get("club", 0)
+    
+    # Reduce from online first
+    if online_qty >= remaining:
+        sizes_dict[size]["online"] = online_qty - remaining
+        remaining = 0
+    else:
+        sizes_dict[size]["online"] = 0
+        remaining -= online_qty
+    
+    # Then reduce from club if needed
+    if remaining > 0:
+        sizes_dict[size]["club"] = max(0, club_qty - remaining)
+    return sizes_dict
+
+
+class InvalidOrderLineError(ValueError):
+    """Raised when an order line is not an object or its quantity is not a whole number."""
+
+
+def line_quantity(item: Dict[str, Any]) -> int:
+    """
+    The quantity of an order line, 1 when it is left out.
+    
+    Whole numbers sent as strings or floats (2, "2", 2.0) are accepted.
+    Zero and negative quantities are returned as they are and reported as
+    shortages by find_shortages.
+    
+    Raises:
+        InvalidOrderLineError: If the line is not a dict or its quantity is
+            not a whole number
+    """
+    if not isinstance(item, dict):
+        raise InvalidOrderLineError("Order lines must be objects")
+    value = item.get("quantity", 1)
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise InvalidOrderLineError(f"Invalid quantity: {value!r}")
+    try:
+        quantity = int(value)
+    except ValueError:
+        raise InvalidOrderLineError(f"Invalid quantity: {value!r}")
+    if isinstance(value, float) and quantity != value:
+        raise InvalidOrderLineError(f"Invalid quantity: {value!r}")
+    return quantity
+
+
+class InsufficientStockError(ValueError):
+    """Raised when an order asks for more of a size than is in stock."""
+    
+    def __init__(self, shortages: List[Dict[str, Any]]):
+        self.shortages = shortages
+        lines = ", ".join(
+            f"product {s['id']} size {s['size']}: requested {s['requested']}, available {s['available']}"
+            for s in shortages
+        )
+        super().__init__(f"Insufficient stock ({lines})")
+
+
 class InventoryService:
     """Service for managing product inventory."""
     
     @staticmethod
-    def reduce_stock(items: List[Dict[str, Any]]) -> None:
+    def get_products(cursor, product_ids) -> Dict[int, Any]:
+        """
+        Load the cost and sizes of several products with one query.
+        
+        Args:
+            cursor: Database cursor
+            product_ids: Product ids (duplicates and None are ignored)
+            
+        Returns:
+            Rows with id, cost and sizes keyed by product id
+        """
+        ids = sorted({pid for pid in product_ids if pid})
+        if not ids:
+            return {}
+        placeholders = ",".join("?" * len(ids))
+        cursor.execute(f"SELECT id, cost, sizes FROM products WHERE id IN ({placeholders})", ids)
+        return {row["id"]: row for row in cursor.fetchall()}
+    
+    @staticmethod
+    def _requested(items: List[Dict[str, Any]]) -> Dict[tuple, int]:
+        """
+        Total quantity per (product id, size) over all order lines.
+        
+        Raises:
+            InvalidOrderLineError: If a line's quantity is not a whole number
         """
-        Reduce stock levels after an order.
+        requested = {}
+        for item in items:
+            quantity = line_quantity(item)
+            key = (item.get("id"), str(item.get("selectedSize")))
+            requested[key] = requested.get(key, 0) + quantity
+        return requested
+    
+    @classmethod
+    def find_shortages(
+        cls,
+        products: Dict[int, Any],
+        items: List[Dict[str, Any]],
+        held: Dict[tuple, int] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Order lines that cannot be filled from the given stock.
+        
+        Quantities of the same product and size are added up before they
+        are compared, and a product or size that does not exist counts as
+        zero stock.
         
-        Deducts from online stock first, then club stock if needed.
+        Args:
+            products: Product rows with sizes keyed by id (see get_products)
+            items: List of order items with id, selectedSize, quantity
+            held: Quantities held for other carts, keyed by (product id, size)
+            
+        Returns:
+            List of shortages with id, size, requested and available
+            
+        Raises:
+            InvalidOrderLineError: If a line's quantity is not a whole number
+        """
+        held = held or {}
+        shortages = []
+        for (product_id, size), quantity in cls._requested(items).items():
+            product = products.get(product_id)
+            sizes = normalize_sizes(json.loads(product["sizes"])) if product and product["sizes"] else {}
+            available = max(0, get_size_quantity(sizes, size) - held.get((product_id, size), 0))
+            if quantity < 1 or available < quantity:
+                shortages.append({
+                    "id": product_id,
+                    "size": size,
+                    "requested": quantity,
+                    "available": available,
+                })
+        return shortages
+    
+    @classmethod
+    def check_stock(cls, items: List[Dict[str, Any]], hold_reference: str = None) -> List[Dict[str, Any]]:
+        """
+        Check whether an order could be filled right now, without reserving it.
         
         Args:
             items: List of order items with id, selectedSize, quantity
+            hold_reference: The order's own hold, which does not count
+                against it
+            
+        Returns:
+            List of shortages (empty if everything is in stock)
+            
+        Raises:
+            InvalidOrderLineError: If a line's quantity is not a whole number
         """
+        # Malformed lines are rejected before any query is made
+        cls._requested(items)
         conn = get_db()
-        cursor = conn.cursor()
+        try:
+            cursor = conn.cursor()
+            product_ids = [item.get("id") for item in items]
+            products = cls.get_products(cursor, product_ids)
+            held = StockHoldService.held_quantities(cursor, product_ids, exclude_reference=hold_reference)
+        finally:
+            conn.close()
+        return cls.find_shortages(products, items, held)
+    
+    @classmethod
+    def hold_stock(cls, cursor, reference: str, items: List[Dict[str, Any]], ttl_seconds: int = None) -> str:
+        """
+        Hold stock for a cart while it is being paid for.
         
-        for item in items:
-            product_id = item["id"]
-            size = str(item["selectedSize"])
-            quantity = int(item["quantity"])
+        Held stock is not deducted, but counts as unavailable to every other
+        order until the hold is converted by reserve_stock or expires.
+        Placing a hold again with the same reference replaces it.
+        
+        Args:
+            cursor: Cursor of a write transaction started with BEGIN IMMEDIATE
+            reference: Hold reference (the payment intent id)
+            items: List of order items with id, selectedSize, quantity
+            ttl_seconds: Hold lifetime (STOCK_HOLD_SECONDS by default)
             
-            cursor.execute("SELECT sizes FROM products WHERE id = ?", (product_id,))
-            row = cursor.fetchone()
-            if not row:
-                continue
+        Returns:
+            Expiry timestamp of the hold (UTC, ISO format)
             
-            sizes = json.loads(row["sizes"])
-            sizes = normalize_sizes(sizes)
+        Raises:
+            InsufficientStockError: If any line asks for more than is
+                available; no hold is placed
+        """
+        product_ids = [item.get("id") for item in items]
+        products = cls.get_products(cursor, product_ids)
+        held = StockHoldService.held_quantities(cursor, product_ids, exclude_reference=reference)
+        shortages = cls.find_shortages(products, items, held)
+        if shortages:
+            raise InsufficientStockError(shortages)
+        return StockHoldService.add(cursor, reference, cls._requested(items), ttl_seconds)
+    
+    @classmethod
+    def reserve_stock(cls, cursor, items: List[Dict[str, Any]], hold_reference: str = None) -> Dict[int, Any]:
+        """
+        Deduct the stock of every order line, or of none of them.
+        
+        The cursor must belong to a write transaction that was started with
+        BEGIN IMMEDIATE (get_db_context(immediate=True)), so no other order
+        can read the same stock between the check and the update. Stock held
+        for other carts is not available; the order's own hold, if any, is
+        converted into the deduction and released.
+        
+        Args:
+            cursor: Cursor of the order's write transaction
+            items: List of order items with id, selectedSize, quantity
+            hold_reference: Reference of the hold placed for this order
             
-            if size in sizes:
-                remaining = quantity
-                online_qty = sizes[size].get("online", 0)
-                club_qty = sizes[size].get("club", 0)
-                
-                # Reduce from online first
-                if online_qty >= remaining:
-                    sizes[size]["online"] = online_qty - remaining
-                    remaining = 0
-                else:
-                    sizes[size]["online"] = 0
-                    remaining -= online_qty
-                
-                # Then reduce from club if needed
-                if remaining > 0:
-                    sizes[size]["club"] = max(0, club_qty - remaining)
+        Returns:
+            Product rows as they were before the deduction, keyed by id
             
-            updated_sizes = json.dumps(sizes)
-            cursor.execute(
-                "UPDATE products SET sizes = ? WHERE id = ?",
-                (updated_sizes, product_id)
-            )
+        Raises:
+            InsufficientStockError: If any line asks for more than is in stock;
+                nothing is deducted
+        """
+        product_ids = [item.get("id") for item in items]
+        products = cls.get_products(cursor, product_ids)
+        held = StockHoldService.held_quantities(cursor, product_ids, exclude_reference=hold_reference)
+        shortages = cls.find_shortages(products, items, held)
+        if shortages:
+            raise InsufficientStockError(shortages)
+        
+        updated = {}
+        for (product_id, size), quantity in cls._requested(items).items():
+            if product_id not in updated:
+                updated[product_id] = normalize_sizes(json.loads(products[product_id]["sizes"]))
+            take_from_sizes(updated[product_id], size, quantity)
         
-        conn.commit()
-        conn.close()
+        cursor.executemany(
+            "UPDATE products SET sizes = ? WHERE id = ?",
+            [(json.dumps(sizes), product_id) for product_id, sizes in updated.items()]
+        )
+        if hold_reference:
+            StockHoldService.release(cursor, hold_reference)
+        return products
@@ -0,0 +1,262 @@
+"""
+Order creation shared by checkout, payment confirmation and Stripe webhooks.
+"""
+import json
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from ..database import db_timestamp, get_db, get_db_context
+from .email import EmailService
+from .email_outbox import EmailOutboxService
+from .inventory import InsufficientStockError, InventoryService, line_quantity
+from .stock_holds import StockHoldService
+from .stripe_gateway import StripeGateway
+
+
+# Stripe payment states
+PAYMENT_PENDING = "pending"
+PAYMENT_PAID = "paid"
+PAYMENT_REFUNDED = "refunded"
+PAYMENT_CANCELED = "canceled"
+
+
+class PaymentMismatchError(ValueError):
+    """Raised when an order's total is not the amount its payment intent charged."""
+
+
+class OrderService:
+    """Service for saving orders and the Stripe payments behind them."""
+    
+    @staticmethod
+    def payment_amount(order: Dict[str, Any]) -> int:
+        """The order's total in öre, as charged by Stripe."""
+        return int(order.get("total", 0) * 100)
+    
+    @staticmethod
+    def save_order(
+        customer: Dict[str, Any],
+        items: List[Dict[str, Any]],
+        payment_method: str,
+        delivery_method: str = "pickup",
+        delivery_cost: int = 0,
+        items_total: int = 0,
+        hold_reference: str = None,
+        payment_intent_id: str = None
+    ) -> int:
+        """
+        Reserve stock, save the order and queue its notification email in one
+        write transaction.
+        
+        Args:
+            customer: Customer information
+            items: List of order items with id, selectedSize, quantity
+            payment_method: Payment method used
+            delivery_method: 'pickup' or a delivery option
+            delivery_cost: Delivery cost in SEK
+            items_total: Sum of the item prices (computed when 0)
+            hold_reference: Stock hold to convert into the reservation
+            payment_intent_id: Stripe payment the order is for; if an order
+                was already saved for it, that order's id is returned and
+                nothing else happens
+        
+        Returns:
+            Order id
+        
+        Raises:
+            InsufficientStockError: If any line is out of stock; nothing is saved
+            InvalidOrderLineError: If a line's quantity is not a whole number
+        """
+        quantities = [line_quantity(item) for item in items]
+        if not items_total:
+            items_total = sum(item.get("price", 0) * quantity for item, quantity in zip(items, quantities))
+        total = items_total + delivery_cost
+        
+        with get_db_context(immediate=True) as conn:
+            cursor = conn.cursor()
+            if payment_intent_id:
+                cursor.execute(
+                    "SELECT order_id FROM stripe_payments WHERE payment_intent_id = ?",
+                    (payment_intent_id,)
+                )
+                row = cursor.fetchone()
+                if row and row["order_id"]:
+                    return row["order_id"]
+            
+            # Also serves the item costs and the email's stock check
+            products = InventoryService.reserve_stock(cursor, items, hold_reference)
+            customer_name = f"{customer.get('firstName', '')} {customer.get('lastName', '')}".strip()
+            
+            payment_status = "betald" if payment_method == "stripe" else "ej_betald"
+            pickup_status = "ej_hamtad"
+            
+            cursor.execute(
+                """INSERT INTO orders (customer_name, customer_email, customer_phone,
+                   delivery_method, payment_method, items_total, delivery_cost, total,
+                   payment_status, pickup_status, notes, created_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (
+                    customer_name,
+                    customer.get("email", ""),
+                    customer.get("phone", ""),
+                    delivery_method,
+                    payment_method,
+                    items_total,
+                    delivery_cost,
+                    total,
+                    payment_status,
+                    pickup_status,
+                    "",
+                    db_timestamp(datetime.utcnow()),
+                )
+            )
+            order_id = cursor.lastrowid
+            
+            for item, quantity in zip(items, quantities):
+                pid = item.get("id")
+                product = products.get(pid)
+                item_cost = product["cost"] if product else None
+                cursor.execute(
+                    """INSERT INTO order_items (order_id, product_id, product_name, size, color, quantity, price, cost)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                    (
+                        order_id,
+                        pid,
+                        item.get("name", ""),
+                        item.get("selectedSize", ""),
+                        item.get("color", ""),
+                        quantity,
+                        item.get("price", 0),
+                        item_cost,
+                    )
+                )
+            
+            EmailService.queue_order_notification(cursor, customer, items, payment_method, order_id, products)
+            
+            if payment_intent_id:
+                OrderService._set_payment(cursor, payment_intent_id, PAYMENT_PAID, order_id=order_id)
+        
+        EmailOutboxService.notify()
+        return order_id
+    
+    @staticmethod
+    def _set_payment(cursor, payment_intent_id: str, status: str, order: dict = None, order_id: int = None) -> None:
+        """Insert or update a payment's state, keeping fields that are not given."""
+        now = db_timestamp(datetime.utcnow())
+        cursor.execute(
+            """INSERT INTO stripe_payments (payment_intent_id, order_data, order_id, status, created_at, updated_at)
+               VALUES (?, ?, ?, ?, ?, ?)
+               ON CONFLICT(payment_intent_id) DO UPDATE SET
+                   order_data = COALESCE(excluded.order_data, order_data),
+                   order_id = COALESCE(excluded.order_id, order_id),
+                   status = excluded.status,
+                   updated_at = excluded.updated_at""",
+            (payment_intent_id, json.dumps(order) if order is not None else None, order_id, status, now, now)
+        )
+    
+    @classmethod
+    def record_payment_intent(cls, cursor, payment_intent_id: str, order: dict) -> None:
+        """
+        Store the cart a payment intent was created for, so the order can be
+        saved when Stripe reports the payment.
+        
+        Args:
+            cursor: Database cursor
+            payment_intent_id: Stripe payment intent id
+            order: Order details as sent to /create-payment-intent
+        """
+        cls._set_payment(cursor, payment_intent_id, PAYMENT_PENDING, order=order)
+    
+    @staticmethod
+    def get_payment(payment_intent_id: str) -> Optional[dict]:
+        """
+        A Stripe payment's stored state.
+        
+        Returns:
+            Dict with status, order_id and the stored order, or None
+        """
+        conn = get_db()
+        try:
+            row = conn.execute(
+                "SELECT * FROM stripe_payments WHERE payment_intent_id = ?", (payment_intent_id,)
+            ).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        return {
+            "status": row["status"],
+            "order_id": row["order_id"],
+            "order": json.loads(row["order_data"]) if row["order_data"] else None,
+        }
+    
+    @classmethod
+    def complete_stripe_payment(cls, payment_intent_id: str, order: dict = None, amount: int = None) -> int:
+        """
+        Save the order for a succeeded payment, once.
+        
+        Both /confirm-payment and the payment_intent.succeeded webhook end
+        here; whichever comes second gets the order saved by the first. If
+        the stock is gone (the hold expired and someone else bought it),
+        the payment is refunded.
+        
+        Args:
+            payment_intent_id: Stripe payment intent id
+            order: Order details (the stored cart is used when None)
+            amount: Amount the payment intent charged, in öre; the order's
+                total must match it
+        
+        Returns:
+            Order id
+        
+        Raises:
+            LookupError: If no order details are known for the payment
+            PaymentMismatchError: If the order's total differs from amount
+            InsufficientStockError: If the order could not be filled; the
+                payment has been refunded (now or by an earlier attempt)
+        """
+        payment = cls.get_payment(payment_intent_id)
+        if payment and payment["order_id"]:
+            return payment["order_id"]
+        if payment and payment["status"] == PAYMENT_REFUNDED:
+            raise InsufficientStockError([])
+        if order is None:
+            order = payment["order"] if payment else None
+            if not order:
+                raise LookupError(f"No order stored for payment intent {payment_intent_id}")
+        if amount is not None and cls.payment_amount(order) != amount:
+            raise PaymentMismatchError(
+                f"Order total {cls.payment_amount(order)} does not match the {amount} paid with {payment_intent_id}"
+            )
+        
+        try:
+            return cls.save_order(
+                order.get("customer", {}),
+                order.get("items", []),
+                "stripe",
+                order.get("deliveryMethod", "pickup"),
+                order.get("deliveryCost", 0),
+                order.get("itemsTotal", 0),
+                hold_reference=payment_intent_id,
+                payment_intent_id=payment_intent_id,
+            )
+        except InsufficientStockError as e:
+            print(f"Refunding {payment_intent_id}: {e}")
+            try:
+                StripeGateway.refund(payment_intent_id)
+            except Exception as refund_error:
+                print(f"Refund of {payment_intent_id} failed: {refund_error}")
+            else:
+                with get_db_context() as conn:
+                    cls._set_payment(conn.cursor(), payment_intent_id, PAYMENT_REFUNDED)
+            raise
+    
+    @classmethod
+    def cancel_payment(cls, payment_intent_id: str) -> None:
+        """Release the stock held for a payment that will not complete."""
+        with get_db_context() as conn:
+            cursor = conn.cursor()
+            StockHoldService.release(cursor, payment_intent_id)
+            cursor.execute(
+                "UPDATE stripe_payments SET status = ?, updated_at = ? WHERE payment_intent_id = ? AND order_id IS NULL",
+                (PAYMENT_CANCELED, db_timestamp(datetime.utcnow()), payment_intent_id)
+            )
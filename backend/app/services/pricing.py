@@ -0,0 +1,57 @@
+"""
+Product pricing.
+"""
+
+
+def ensure_sale_price_from_discount(product_dict: dict) -> dict:
+    """
+    Set a product's sale_price from its discount_percent, or drop a stored
+    sale price that is not below the regular price.
+    
+    Args:
+        product_dict: Product fields, updated in place
+        
+    Returns:
+        The same dict
+    """
+    discount_percent = product_dict.get("discount_percent")
+    price = product_dict.get("price")
+    current_sale_price = product_dict.get("sale_price")
+    
+    if discount_percent is not None:
+        try:
+            discount_percent = int(discount_percent) if not isinstance(discount_percent, int) else discount_percent
+        except (ValueError, TypeError):
+            discount_percent = None
+    
+    if price is not None:
+        try:
+            price = int(price) if not isinstance(price, int) else price
+        except (ValueError, TypeError):
+            price = None
+    
+    if discount_percent is not None and discount_percent > 0 and price and price > 0:
+        calculated_sale_price = int(price * (1 - discount_percent / 100))
+        if calculated_sale_price > 0 and calculated_sale_price < price:
+            product_dict["sale_price"] = calculated_sale_price
+        else:
+            product_dict["sale_price"] = None
+    elif current_sale_price is not None:
+        try:
+            current_sale_price = int(current_sale_price) if not isinstance(current_sale_price, int) else current_sale_price
+            if current_sale_price > 0 and price and current_sale_price < price:
+                product_dict["sale_price"] = current_sale_price
+            else:
+                product_dict["sale_price"] = None
+        except (ValueError, TypeError):
+            product_dict["sale_price"] = None
+    else:
+        product_dict["sale_price"] = None
+    
+    return product_dict
+
+
+def effective_price(product_dict: dict) -> int:
+    """Price a customer pays for one unit: the sale price if there is one."""
+    priced = ensure_sale_price_from_discount(dict(product_dict))
+    return priced["sale_price"] or int(priced["price"] or 0)
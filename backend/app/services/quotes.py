@@ -0,0 +1,220 @@
+"""
+Cart quotes: current prices, stock and totals for a cart, signed for checkout.
+"""
+import hashlib
+import json
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+import jwt
+
+from ..config import settings
+from ..database import get_db
+from .inventory import InventoryService, get_size_quantity, line_quantity, normalize_sizes
+from .pricing import effective_price
+from .stock_holds import StockHoldService
+
+
+# Audience claim of quote tokens, so they cannot pass for any other token
+QUOTE_AUDIENCE = "cart-quote"
+
+# Order fields a quote decides; everything else comes from the request
+QUOTED_FIELDS = ("items", "deliveryMethod", "deliveryCost", "itemsTotal", "total")
+
+
+class QuoteError(ValueError):
+    """Raised for an unknown delivery method or an invalid or expired quote token."""
+
+
+class QuoteService:
+    """
+    Prices a cart from the database and signs the result.
+    
+    A quote lists every line with its current price (sale and discount
+    applied), the stock available in its size and the line total, plus the
+    delivery cost and grand total. When every line can be filled it carries
+    a quote token: a JWT, signed with a key derived from JWT_SECRET, that
+    checkout accepts for CART_QUOTE_TTL_SECONDS instead of the prices and
+    totals sent by the browser.
+    """
+    
+    @staticmethod
+    def _signing_key() -> str:
+        return hashlib.sha256(f"{QUOTE_AUDIENCE}:{settings.JWT_SECRET}".encode("utf-8")).hexdigest()
+    
+    @staticmethod
+    def delivery_cost(delivery_method: str) -> int:
+        """
+        Raises:
+            QuoteError: If the delivery method is not offered
+        """
+        if delivery_method not in settings.DELIVERY_COSTS:
+            raise QuoteError(f"Unknown delivery method: {delivery_method}")
+        return settings.DELIVERY_COSTS[delivery_method]
+    
+    @staticmethod
+    def _load_products(cursor, product_ids) -> Dict[int, Any]:
+        """Price, name and sizes of every product in the cart, with one query."""
+        ids = sorted({pid for pid in product_ids if pid})
+        if not ids:
+            return {}
+        placeholders = ",".join("?" * len(ids))
+        cursor.execute(
+            f"""SELECT id, name, color, price, sale_price, discount_percent, sizes
+                FROM products WHERE id IN ({placeholders})""",
+            ids
+        )
+        return {row["id"]: row for row in cursor.fetchall()}
+    
+    @classmethod
+    def quote(cls, items: List[Dict[str, Any]], delivery_method: str = "pickup", hold_reference: str = None) -> dict:
+        """
+        Price a cart.
+        
+        Args:
+            items: Cart lines with id, selectedSize and quantity
+            delivery_method: One of DELIVERY_COSTS
+            hold_reference: The cart's own stock hold, which does not count
+                against it
+        
+        Returns:
+            Dict with lines, availability per product and size, shortages,
+            items_total, delivery_cost, total, valid, and quote_token and
+            expires_at when valid
+        
+        Raises:
+            QuoteError: If the delivery method is not offered
+            InvalidOrderLineError: If a line's quantity is not a whole number
+        """
+        delivery_cost = cls.delivery_cost(delivery_method)
+        quantities = [line_quantity(item) for item in items]
+        product_ids = [item.get("id") for item in items]
+        
+        conn = get_db()
+        try:
+            cursor = conn.cursor()
+            products = cls._load_products(cursor, product_ids)
+            held = StockHoldService.held_quantities(cursor, list(products), exclude_reference=hold_reference)
+        finally:
+            conn.close()
+        
+        availability = {}
+        for product_id, product in products.items():
+            sizes = normalize_sizes(json.loads(product["sizes"])) if product["sizes"] else {}
+            availability[product_id] = {
+                size: max(0, get_size_quantity(sizes, size) - held.get((product_id, size), 0))
+                for size in sizes
+            }
+        
+        shortages = InventoryService.find_shortages(products, items, held)
+        short = {(shortage["id"], shortage["size"]) for shortage in shortages}
+        
+        lines = []
+        for item, quantity in zip(items, quantities):
+            product_id = item.get("id")
+            size = str(item.get("selectedSize"))
+            product = products.get(product_id)
+            unit_price = effective_price(dict(product)) if product else None
+            lines.append({
+                "id": product_id,
+                "name": product["name"] if product else None,
+                "color": product["color"] if product else None,
+                "selectedSize": size,
+                "quantity": quantity,
+                "price": unit_price,
+                "regular_price": product["price"] if product else None,
+                "line_total": unit_price * quantity if product else 0,
+                "available": availability.get(product_id, {}).get(size, 0),
+                "in_stock": product is not None and (product_id, size) not in short,
+            })
+        
+        items_total = sum(line["line_total"] for line in lines)
+        result = {
+            "lines": lines,
+            "availability": availability,
+            "shortages": shortages,
+            "delivery_method": delivery_method,
+            "items_total": items_total,
+            "delivery_cost": delivery_cost,
+            "total": items_total + delivery_cost,
+            "valid": bool(lines) and not shortages,
+            "quote_token": None,
+            "expires_at": None,
+        }
+        if result["valid"]:
+            expires_at = datetime.utcnow() + timedelta(seconds=settings.CART_QUOTE_TTL_SECONDS)
+            result["quote_token"] = jwt.encode(
+                {
+                    "aud": QUOTE_AUDIENCE,
+                    "exp": expires_at,
+                    "items": [
+                        {key: line[key] for key in ("id", "name", "color", "selectedSize", "quantity", "price")}
+                        for line in lines
+                    ],
+                    "deliveryMethod": delivery_method,
+                    "deliveryCost": delivery_cost,
+                    "itemsTotal": items_total,
+                    "total": result["total"],
+                },
+                cls._signing_key(),
+                algorithm="HS256",
+            )
+            result["expires_at"] = expires_at.isoformat()
+        return result
+    
+    @classmethod
+    def verify(cls, token: str) -> dict:
+        """
+        Check a quote token's signature and expiry.
+        
+        Returns:
+            The quoted order fields (see QUOTED_FIELDS)
+        
+        Raises:
+            QuoteError: If the token is invalid or has expired
+        """
+        try:
+            payload = jwt.decode(token, cls._signing_key(), algorithms=["HS256"], audience=QUOTE_AUDIENCE)
+        except jwt.ExpiredSignatureError:
+            raise QuoteError("Quote has expired, please review your cart again")
+        except jwt.InvalidTokenError:
+            raise QuoteError("Invalid quote")
+        return {field: payload[field] for field in QUOTED_FIELDS}
+    
+    @classmethod
+    def reprice(cls, order: dict) -> dict:
+        """
+        The order with its lines and totals priced from the database, for
+        orders sent without a quoteToken.
+        
+        Lines keep their quantities; prices, names and totals come from the
+        shop, and products that do not exist are left for the stock check
+        to turn away.
+        
+        Raises:
+            QuoteError: If the delivery method is not offered
+            InvalidOrderLineError: If a line's quantity is not a whole number
+        """
+        quote = cls.quote(order.get("items") or [], order.get("deliveryMethod") or "pickup")
+        return {
+            **order,
+            "items": [
+                {key: line[key] for key in ("id", "name", "color", "selectedSize", "quantity", "price")}
+                for line in quote["lines"]
+            ],
+            "deliveryMethod": quote["delivery_method"],
+            "deliveryCost": quote["delivery_cost"],
+            "itemsTotal": quote["items_total"],
+            "total": quote["total"],
+        }
+    
+    @classmethod
+    def apply(cls, order: dict) -> dict:
+        """
+        The order with the lines and totals of its quoteToken in place of
+        those sent by the client.
+        
+        Raises:
+            QuoteError: If the token is invalid or has expired
+        """
+        return {**order, **cls.verify(order["quoteToken"])}
@@ -0,0 +1,131 @@
+"""
+Time-limited stock holds for carts that are being paid for.
+"""
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional
+
+from ..config import settings
+from ..database import db_timestamp, get_db_context
+from .background import BackgroundWorker
+
+
+class StockHoldService:
+    """
+    Soft reservations of stock while a customer pays.
+    
+    A hold is a set of rows (one per product and size) sharing a reference,
+    normally the Stripe payment intent id. Active holds count as sold when
+    availability is checked, are turned into a real stock reduction when the
+    order is saved, and simply stop counting once they expire; a background
+    sweeper deletes expired rows.
+    """
+    
+    _sweeper: Optional[BackgroundWorker] = None
+    
+    @staticmethod
+    def held_quantities(cursor, product_ids: Iterable[int] = None, exclude_reference: str = None) -> Dict[tuple, int]:
+        """
+        Quantities under active holds.
+        
+        Args:
+            cursor: Database cursor
+            product_ids: Only these products (all products when None)
+            exclude_reference: Leave out the hold with this reference, e.g.
+                the one being converted into an order
+        
+        Returns:
+            Held quantity keyed by (product id, size)
+        """
+        query = "SELECT product_id, size, SUM(quantity) AS quantity FROM stock_holds WHERE expires_at > ?"
+        params = [db_timestamp(datetime.utcnow())]
+        if product_ids is not None:
+            ids = sorted({pid for pid in product_ids if pid})
+            if not ids:
+                return {}
+            query += f" AND product_id IN ({','.join('?' * len(ids))})"
+            params += ids
+        if exclude_reference:
+            query += " AND reference != ?"
+            params.append(exclude_reference)
+        cursor.execute(query + " GROUP BY product_id, size", params)
+        return {(row["product_id"], row["size"]): row["quantity"] for row in cursor.fetchall()}
+    
+    @staticmethod
+    def add(cursor, reference: str, quantities: Dict[tuple, int], ttl_seconds: int = None) -> str:
+        """
+        Store a hold, replacing an earlier one with the same reference.
+        
+        Availability must already have been checked in the same write
+        transaction (see InventoryService.hold_stock).
+        
+        Args:
+            cursor: Cursor of a BEGIN IMMEDIATE transaction
+            reference: Hold reference
+            quantities: Quantity keyed by (product id, size)
+            ttl_seconds: Hold lifetime (STOCK_HOLD_SECONDS by default)
+        
+        Returns:
+            Expiry timestamp (UTC, ISO format)
+        """
+        now = datetime.utcnow()
+        expires_at = db_timestamp(now + timedelta(seconds=ttl_seconds or settings.STOCK_HOLD_SECONDS))
+        cursor.execute("DELETE FROM stock_holds WHERE reference = ?", (reference,))
+        cursor.executemany(
+            """INSERT INTO stock_holds (reference, product_id, size, quantity, expires_at, created_at)
+               VALUES (?, ?, ?, ?, ?, ?)""",
+            [
+                (reference, product_id, size, quantity, expires_at, db_timestamp(now))
+                for (product_id, size), quantity in quantities.items()
+            ]
+        )
+        return expires_at
+    
+    @staticmethod
+    def release(cursor, reference: str) -> int:
+        """
+        Drop a hold, e.g. once it has been converted into an order.
+        
+        Returns:
+            Number of rows removed
+        """
+        cursor.execute("DELETE FROM stock_holds WHERE reference = ?", (reference,))
+        return cursor.rowcount
+    
+    @staticmethod
+    def sweep() -> int:
+        """
+        Delete expired holds.
+        
+        Returns:
+            Number of rows removed
+        """
+        with get_db_context() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM stock_holds WHERE expires_at <= ?", (db_timestamp(datetime.utcnow()),))
+            removed = cursor.rowcount
+        if removed:
+            print(f"Released {removed} expired stock holds")
+        return removed
+    
+    @classmethod
+    def start_sweeper(cls) -> bool:
+        """
+        Sweep expired holds every STOCK_HOLD_SWEEP_SECONDS in a background thread.
+        
+        Returns:
+            False if sweeping is disabled (interval 0) or already running
+        """
+        if settings.STOCK_HOLD_SWEEP_SECONDS <= 0:
+            return False
+        if cls._sweeper is not None and cls._sweeper.running:
+            return False
+        
+        cls._sweeper = BackgroundWorker(
+            "stock-hold-sweeper", cls.sweep, settings.STOCK_HOLD_SWEEP_SECONDS, wait_first=True
+        )
+        return cls._sweeper.start()
+    
+    @classmethod
+    def stop_sweeper(cls) -> None:
+        if cls._sweeper is not None:
+            cls._sweeper.stop()
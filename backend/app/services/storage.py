@@ -0,0 +1,405 @@
+"""
+Object storage backends for stored images.
+"""
+import mimetypes
+import os
+import threading
+from typing import Iterator, NamedTuple, Optional
+
+from ..config import settings
+from .image_paths import ImagePaths, TEMP_PREFIX
+
+
+# Storage areas: optimized originals, their thumbnails, and /img variants
+AREA_ORIGINALS = "uploads"
+AREA_THUMBNAILS = "thumbnails"
+AREA_VARIANTS = "variants"
+
+# Cache-Control for stored images, locally served or uploaded with remote
+# objects. Originals are content-addressed and variants derive from them, so
+# both never change; thumbnails keep their name when rebuilt, so they are
+# revalidated against their ETag instead.
+CACHE_CONTROL = {
+    AREA_ORIGINALS: "public, max-age=31536000, immutable",
+    AREA_THUMBNAILS: "public, max-age=3600",
+    AREA_VARIANTS: "public, max-age=31536000, immutable",
+}
+
+# S3 error codes that mean the object does not exist
+_MISSING_CODES = frozenset({"404", "NoSuchKey", "NotFound"})
+
+
+class StoredObject(NamedTuple):
+    """A stored file as listed by a backend."""
+    area: str
+    name: str
+    size: int
+    mtime: float
+    location: str
+
+
+def _valid_name(name: str) -> bool:
+    return bool(name) and name == os.path.basename(name) and not name.startswith(".")
+
+
+class ImageStorage:
+    """
+    Interface of an image storage backend.
+    
+    Files are addressed by area and filename; the backend decides where
+    they live. Backends must be picklable so thumbnail job workers can use
+    them.
+    """
+    
+    # True if files live outside this host and are only reachable by URL
+    remote = False
+    
+    def put(self, area: str, name: str, data: bytes, content_type: Optional[str] = None) -> None:
+        raise NotImplementedError
+    
+    def get(self, area: str, name: str) -> Optional[bytes]:
+        """Return a file's contents, or None if it does not exist."""
+        raise NotImplementedError
+    
+    def exists(self, area: str, name: str) -> bool:
+        raise NotImplementedError
+    
+    def delete(self, area: str, name: str) -> bool:
+        """Delete a file. Returns True if it existed."""
+        raise NotImplementedError
+    
+    def delete_object(self, obj: StoredObject) -> bool:
+        """Delete exactly the object returned by list() (including temp files)."""
+        raise NotImplementedError
+    
+    def touch(self, area: str, name: str) -> bool:
+        """Set a file's modification time to now. Returns True if it exists."""
+        raise NotImplementedError
+    
+    def list(self, area: str, prefix: str = "", include_temp: bool = False) -> Iterator[StoredObject]:
+        raise NotImplementedError
+    
+    def url(self, area: str, name: str) -> Optional[str]:
+        """Public URL clients can fetch the file from directly, or None to serve it from the app."""
+        return None
+    
+    def local_path(self, area: str, name: str) -> Optional[str]:
+        """Path of the file on this host, or None if it is missing or not stored locally."""
+        return None
+    
+    def version(self, area: str) -> Optional[int]:
+        """
+        Token that changes whenever files in an area change, or None if the
+        backend cannot tell cheaply. Local storage returns the root's mtime
+        in nanoseconds.
+        """
+        return None
+    
+    def root(self, area: str) -> str:
+        """Human-readable location of an area."""
+        raise NotImplementedError
+    
+    @staticmethod
+    def content_type(name: str) -> str:
+        return mimetypes.guess_type(name)[0] or "application/octet-stream"
+
+
+class LocalStorage(ImageStorage):
+    """
+    Stores files on local disk in the sharded layout of ImagePaths.
+    
+    Variants stay flat in IMAGE_CACHE_DIR, which ImageVariantCache manages
+    as a size-capped cache. With IMAGE_PUBLIC_BASE_URL set, url() points at
+    a web server or CDN serving UPLOAD_DIR, so the app only redirects.
+    """
+    
+    def __init__(self, roots: Optional[dict] = None, public_root: Optional[str] = None, public_base_url: Optional[str] = None):
+        """
+        Args:
+            roots: Directory per area (defaults to the configured directories)
+            public_root: Directory published at public_base_url
+            public_base_url: Base URL serving public_root, empty to serve from the app
+        """
+        self.roots = roots or {
+            AREA_ORIGINALS: settings.UPLOAD_DIR,
+            AREA_THUMBNAILS: settings.THUMBNAIL_DIR,
+            AREA_VARIANTS: settings.IMAGE_CACHE_DIR,
+        }
+        self.public_root = public_root or settings.UPLOAD_DIR
+        self.public_base_url = (
+            settings.IMAGE_PUBLIC_BASE_URL if public_base_url is None else public_base_url
+        ).rstrip("/")
+    
+    def root(self, area: str) -> str:
+        return self.roots[area]
+    
+    def put(self, area: str, name: str, data: bytes, content_type: Optional[str] = None) -> None:
+        root = self.roots[area]
+        ImagePaths.write_atomic(ImagePaths.sharded_path(root, name), data)
+        # A stale copy in the flat layout would linger unused after a rewrite
+        try:
+            os.remove(ImagePaths.flat_path(root, name))
+        except FileNotFoundError:
+            pass
+        ImagePaths.touch(root)
+    
+    def get(self, area: str, name: str) -> Optional[bytes]:
+        path = self.local_path(area, name)
+        if not path:
+            return None
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+    
+    def exists(self, area: str, name: str) -> bool:
+        return ImagePaths.exists(self.roots[area], name)
+    
+    def delete(self, area: str, name: str) -> bool:
+        if not _valid_name(name):
+            return False
+        return ImagePaths.remove(self.roots[area], name)
+    
+    def delete_object(self, obj: StoredObject) -> bool:
+        try:
+            os.remove(obj.location)
+        except FileNotFoundError:
+            return False
+        ImagePaths.touch(self.roots[obj.area])
+        return True
+    
+    def touch(self, area: str, name: str) -> bool:
+        path = self.local_path(area, name)
+        if not path:
+            return False
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        return True
+    
+    def list(self, area: str, prefix: str = "", include_temp: bool = False) -> Iterator[StoredObject]:
+        for name, path in ImagePaths.iter_files(self.roots[area], include_temp=include_temp):
+            if not name.startswith(prefix):
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            yield StoredObject(area, name, stat.st_size, stat.st_mtime, path)
+    
+    def url(self, area: str, name: str) -> Optional[str]:
+        if not self.public_base_url:
+            return None
+        path = self.local_path(area, name)
+        if not path:
+            return None
+        relative = os.path.relpath(path, self.public_root)
+        if relative.startswith(os.pardir):
+            return None
+        return f"{self.public_base_url}/{relative.replace(os.sep, '/')}"
+    
+    def local_path(self, area: str, name: str) -> Optional[str]:
+        return ImagePaths.resolve(self.roots[area], name)
+    
+    def version(self, area: str) -> Optional[int]:
+        try:
+            return os.stat(self.roots[area]).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+
+class S3Storage(ImageStorage):
+    """
+    Stores files in an S3-compatible bucket (AWS S3, MinIO, R2, ...).
+    
+    Objects are keyed <prefix><area>/<name> and uploaded with a content type
+    and Cache-Control, so clients fetch them straight from the bucket (or a
+    CDN in front of it) via url(). boto3 is only imported when the backend
+    is used.
+    """
+    
+    remote = True
+    
+    def __init__(
+        self,
+        bucket: str,
+        endpoint_url: Optional[str] = None,
+        region: Optional[str] = None,
+        access_key_id: Optional[str] = None,
+        secret_access_key: Optional[str] = None,
+        key_prefix: str = "",
+        public_base_url: str = "",
+        url_expires_seconds: int = 3600,
+        client=None,
+    ):
+        """
+        Args:
+            bucket: Bucket name
+            endpoint_url: Endpoint of an S3-compatible service (None for AWS)
+            region: Bucket region
+            access_key_id: Access key (None to use the default credential chain)
+            secret_access_key: Secret key
+            key_prefix: Prefix for every object key
+            public_base_url: Public or CDN URL of the bucket; when empty,
+                url() returns presigned URLs instead
+            url_expires_seconds: Lifetime of presigned URLs
+            client: Ready-made S3 client (otherwise created on first use)
+        """
+        self.bucket = bucket
+        self.endpoint_url = endpoint_url or None
+        self.region = region or None
+        self.access_key_id = access_key_id or None
+        self.secret_access_key = secret_access_key or None
+        self.key_prefix = key_prefix
+        self.public_base_url = public_base_url.rstrip("/")
+        self.url_expires_seconds = url_expires_seconds
+        self._client = client
+    
+    @classmethod
+    def from_settings(cls) -> "S3Storage":
+        return cls(
+            bucket=settings.S3_BUCKET,
+            endpoint_url=settings.S3_ENDPOINT_URL,
+            region=settings.S3_REGION,
+            access_key_id=settings.S3_ACCESS_KEY_ID,
+            secret_access_key=settings.S3_SECRET_ACCESS_KEY,
+            key_prefix=settings.S3_KEY_PREFIX,
+            public_base_url=settings.IMAGE_PUBLIC_BASE_URL,
+            url_expires_seconds=settings.S3_PRESIGNED_URL_SECONDS,
+        )
+    
+    def __getstate__(self):
+        # Clients are not picklable; workers create their own
+        state = dict(self.__dict__)
+        state["_client"] = None
+        return state
+    
+    @property
+    def client(self):
+        if self._client is None:
+            import boto3
+            self._client = boto3.client(
+                "s3",
+                endpoint_url=self.endpoint_url,
+                region_name=self.region,
+                aws_access_key_id=self.access_key_id,
+                aws_secret_access_key=self.secret_access_key,
+            )
+        return self._client
+    
+    @staticmethod
+    def _is_missing(error: Exception) -> bool:
+        response = getattr(error, "response", None) or {}
+        return str(response.get("Error", {}).get("Code")) in _MISSING_CODES
+    
+    def key(self, area: str, name: str) -> str:
+        return f"{self.key_prefix}{area}/{name}"
+    
+    def root(self, area: str) -> str:
+        return f"s3://{self.bucket}/{self.key(area, '')}"
+    
+    def put(self, area: str, name: str, data: bytes, content_type: Optional[str] = None) -> None:
+        if not _valid_name(name):
+            raise ValueError(f"Invalid filename: {name!r}")
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=self.key(area, name),
+            Body=data,
+            ContentType=content_type or self.content_type(name),
+            CacheControl=CACHE_CONTROL[area],
+        )
+    
+    def get(self, area: str, name: str) -> Optional[bytes]:
+        if not _valid_name(name):
+            return None
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.key(area, name))
+        except Exception as e:
+            if self._is_missing(e):
+                return None
+            raise
+        return response["Body"].read()
+    
+    def exists(self, area: str, name: str) -> bool:
+        if not _valid_name(name):
+            return False
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key(area, name))
+            return True
+        except Exception as e:
+            if self._is_missing(e):
+                return False
+            raise
+    
+    def delete(self, area: str, name: str) -> bool:
+        # DeleteObject succeeds for missing keys, so check first to report it
+        if not self.exists(area, name):
+            return False
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(area, name))
+        return True
+    
+    def delete_object(self, obj: StoredObject) -> bool:
+        self.client.delete_object(Bucket=self.bucket, Key=obj.location)
+        return True
+    
+    def touch(self, area: str, name: str) -> bool:
+        # Objects are immutable; copying one onto itself renews LastModified
+        if not self.exists(area, name):
+            return False
+        key = self.key(area, name)
+        self.client.copy_object(
+            Bucket=self.bucket,
+            Key=key,
+            CopySource={"Bucket": self.bucket, "Key": key},
+            MetadataDirective="REPLACE",
+            ContentType=self.content_type(name),
+            CacheControl=CACHE_CONTROL[area],
+        )
+        return True
+    
+    def list(self, area: str, prefix: str = "", include_temp: bool = False) -> Iterator[StoredObject]:
+        area_prefix = self.key(area, "")
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=area_prefix + prefix):
+            for item in page.get("Contents", []):
+                name = item["Key"][len(area_prefix):]
+                if "/" in name or (name.startswith(TEMP_PREFIX) and not include_temp):
+                    continue
+                yield StoredObject(area, name, item["Size"], item["LastModified"].timestamp(), item["Key"])
+    
+    def url(self, area: str, name: str) -> Optional[str]:
+        if not _valid_name(name):
+            return None
+        key = self.key(area, name)
+        if self.public_base_url:
+            return f"{self.public_base_url}/{key}"
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": key},
+            ExpiresIn=self.url_expires_seconds,
+        )
+
+
+_remote_lock = threading.Lock()
+_remote_storage: dict = {}
+
+
+def get_storage() -> ImageStorage:
+    """
+    Return the configured image storage backend.
+    
+    Raises:
+        ValueError: If IMAGE_STORAGE_BACKEND names an unknown backend
+    """
+    backend = settings.IMAGE_STORAGE_BACKEND
+    if backend == "local":
+        return LocalStorage()
+    if backend == "s3":
+        # Reuse one client per configuration; creating one is slow
+        storage = S3Storage.from_settings()
+        key = tuple(sorted(storage.__getstate__().items()))
+        with _remote_lock:
+            return _remote_storage.setdefault(key, storage)
+    raise ValueError(f"Unknown IMAGE_STORAGE_BACKEND '{backend}'. Must be 'local' or 's3'")
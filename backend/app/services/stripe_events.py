@@ -0,0 +1,169 @@
+"""
+Verified Stripe webhook events, processed in the background.
+"""
+import json
+import threading
+from datetime import datetime
+from typing import Optional
+
+import stripe
+
+from ..config import settings
+from ..database import db_timestamp, get_db_context
+from .background import BackgroundWorker
+from .inventory import InsufficientStockError
+from .orders import OrderService
+
+
+# Event states
+EVENT_PENDING = "pending"
+EVENT_PROCESSED = "processed"
+EVENT_FAILED = "failed"
+
+
+class StripeSignatureError(ValueError):
+    """Raised when a webhook payload does not carry a valid Stripe signature."""
+
+
+class StripeEventService:
+    """
+    Stores Stripe webhook events and acts on them outside the request.
+    
+    The webhook endpoint only verifies the signature and inserts the event
+    (Stripe redelivers events, so the event id is the primary key and
+    duplicates are ignored). A worker thread then processes pending events:
+    payment_intent.succeeded saves the order through the same path as
+    /confirm-payment, and payment_intent.canceled releases the stock hold.
+    Failed events are retried on the next pass until
+    STRIPE_EVENT_MAX_ATTEMPTS is reached.
+    """
+    
+    _worker: Optional[BackgroundWorker] = None
+    _process_lock = threading.Lock()
+    
+    @staticmethod
+    def verify(payload: bytes, signature: str) -> dict:
+        """
+        Check a webhook payload's Stripe-Signature header and parse it.
+        
+        Args:
+            payload: Raw request body
+            signature: Stripe-Signature header value
+        
+        Returns:
+            The event as a dict
+        
+        Raises:
+            StripeSignatureError: If the signature is missing, wrong or too old
+        """
+        try:
+            stripe.WebhookSignature.verify_header(
+                payload, signature, settings.STRIPE_WEBHOOK_SECRET, settings.STRIPE_WEBHOOK_TOLERANCE_SECONDS
+            )
+        except stripe.SignatureVerificationError as e:
+            raise StripeSignatureError(str(e))
+        try:
+            return json.loads(payload)
+        except ValueError:
+            raise StripeSignatureError("Invalid JSON payload")
+    
+    @staticmethod
+    def record(event: dict) -> bool:
+        """
+        Store an event for processing.
+        
+        Returns:
+            False if the event was already received
+        """
+        with get_db_context() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """INSERT OR IGNORE INTO stripe_events (id, type, payload, status, attempts, received_at)
+                   VALUES (?, ?, ?, ?, 0, ?)""",
+                (event["id"], event.get("type", ""), json.dumps(event), EVENT_PENDING, db_timestamp(datetime.utcnow()))
+            )
+            return cursor.rowcount > 0
+    
+    @classmethod
+    def notify(cls) -> None:
+        """Wake the worker after recording an event."""
+        if cls._worker is not None:
+            cls._worker.wake()
+    
+    @staticmethod
+    def handle(event: dict) -> str:
+        """
+        Act on one event.
+        
+        Returns:
+            Short description of what was done
+        """
+        event_type = event.get("type")
+        intent = event.get("data", {}).get("object", {})
+        if event_type == "payment_intent.succeeded":
+            try:
+                order_id = OrderService.complete_stripe_payment(intent["id"], amount=intent.get("amount"))
+            except InsufficientStockError:
+                return f"out of stock, {intent['id']} refunded"
+            return f"order {order_id}"
+        if event_type == "payment_intent.canceled":
+            OrderService.cancel_payment(intent["id"])
+            return "hold released"
+        return "ignored"
+    
+    @classmethod
+    def process_pending(cls, limit: int = 50) -> dict:
+        """
+        Process events that have not been handled yet, oldest first.
+        
+        Returns:
+            Dict with the number of events processed and failed
+        """
+        result = {"processed": 0, "failed": 0}
+        with cls._process_lock:
+            with get_db_context() as conn:
+                rows = conn.execute(
+                    "SELECT id, payload, attempts FROM stripe_events WHERE status = ? ORDER BY received_at LIMIT ?",
+                    (EVENT_PENDING, limit)
+                ).fetchall()
+            
+            for row in rows:
+                attempts = row["attempts"] + 1
+                try:
+                    outcome = cls.handle(json.loads(row["payload"]))
+                    status, error = EVENT_PROCESSED, None
+                    result["processed"] += 1
+                except Exception as e:
+                    print(f"Stripe event {row['id']} failed (attempt {attempts}): {e}")
+                    outcome = None
+                    status = EVENT_FAILED if attempts >= settings.STRIPE_EVENT_MAX_ATTEMPTS else EVENT_PENDING
+                    error = str(e)[:500]
+                    result["failed"] += 1
+                with get_db_context() as conn:
+                    conn.execute(
+                        """UPDATE stripe_events SET status = ?, attempts = ?, last_error = ?, outcome = ?,
+                           processed_at = ? WHERE id = ?""",
+                        (status, attempts, error, outcome, db_timestamp(datetime.utcnow()), row["id"])
+                    )
+        return result
+    
+    @classmethod
+    def start_worker(cls) -> bool:
+        """
+        Start the background event processor.
+        
+        Returns:
+            False if no webhook secret is configured or the worker is already running
+        """
+        if not settings.STRIPE_WEBHOOK_SECRET:
+            return False
+        if cls._worker is not None and cls._worker.running:
+            return False
+        
+        cls._worker = BackgroundWorker("stripe-events", cls.process_pending, settings.STRIPE_EVENT_POLL_SECONDS)
+        return cls._worker.start()
+    
+    @classmethod
+    def stop_worker(cls) -> None:
+        if cls._worker is not None:
+            cls._worker.stop()
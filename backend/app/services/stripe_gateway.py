@@ -0,0 +1,276 @@
+"""
+Stripe API access with pooled connections, timeouts and a circuit breaker.
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+import requests
+import stripe
+
+from ..config import settings
+
+
+# Circuit states
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+# Latencies kept per operation for the stats
+LATENCY_SAMPLES = 200
+
+# Errors that mean Stripe, or the network to it, is in trouble; other Stripe
+# errors (declined cards, invalid requests) are answers and do not count
+_OUTAGE_ERRORS = (stripe.APIConnectionError, stripe.APIError, stripe.RateLimitError)
+
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000, 1)
+
+
+class StripeUnavailableError(Exception):
+    """Raised without calling Stripe while the circuit is open or too many calls are waiting."""
+
+
+class CircuitBreaker:
+    """
+    Fails fast after repeated failures.
+    
+    After failure_threshold failures in a row the circuit opens and calls
+    are refused for reset_seconds. Then one trial call is let through:
+    success closes the circuit, failure opens it again.
+    """
+    
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+    
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return CIRCUIT_CLOSED
+        if time.monotonic() - self._opened_at < self.reset_seconds:
+            return CIRCUIT_OPEN
+        return CIRCUIT_HALF_OPEN
+    
+    def allow(self) -> bool:
+        """Whether a call may go ahead now."""
+        with self._lock:
+            state = self.state
+            if state == CIRCUIT_CLOSED:
+                return True
+            if state == CIRCUIT_HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+    
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+    
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial_running = False
+
+
+class StripeGateway:
+    """
+    All calls to the Stripe API go through here.
+    
+    A single StripeClient keeps its connections alive in a pool sized for
+    STRIPE_MAX_CONCURRENCY, gives each attempt STRIPE_CONNECT_TIMEOUT_SECONDS
+    to connect and STRIPE_READ_TIMEOUT_SECONDS to answer, and retries failed
+    attempts up to STRIPE_MAX_RETRIES times (with Stripe's idempotency keys,
+    so a retried create is not charged twice). A circuit breaker refuses
+    calls for a while once Stripe keeps failing.
+    
+    Request handlers use run(), which makes the call on a dedicated executor
+    of STRIPE_MAX_CONCURRENCY threads, so a slow Stripe ties up neither the
+    event loop nor the threadpool serving the rest of the shop. Background
+    workers call the operations directly.
+    """
+    
+    _client: Optional[stripe.StripeClient] = None
+    _session: Optional[requests.Session] = None
+    _executor: Optional[ThreadPoolExecutor] = None
+    _breaker: Optional[CircuitBreaker] = None
+    _lock = threading.Lock()
+    _pending = 0
+    _metrics: dict = {}
+    
+    @classmethod
+    def client(cls) -> stripe.StripeClient:
+        """The shared Stripe client, created on first use."""
+        with cls._lock:
+            if cls._client is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1, pool_maxsize=settings.STRIPE_MAX_CONCURRENCY
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                options = {}
+                if settings.STRIPE_API_BASE:
+                    options["base_addresses"] = {"api": settings.STRIPE_API_BASE}
+                cls._session = session
+                cls._client = stripe.StripeClient(
+                    settings.STRIPE_SECRET_KEY,
+                    http_client=stripe.RequestsClient(
+                        timeout=(settings.STRIPE_CONNECT_TIMEOUT_SECONDS, settings.STRIPE_READ_TIMEOUT_SECONDS),
+                        session=session,
+                    ),
+                    max_network_retries=settings.STRIPE_MAX_RETRIES,
+                    **options
+                )
+            return cls._client
+    
+    @classmethod
+    def breaker(cls) -> CircuitBreaker:
+        with cls._lock:
+            if cls._breaker is None:
+                cls._breaker = CircuitBreaker(settings.STRIPE_BREAKER_FAILURES, settings.STRIPE_BREAKER_RESET_SECONDS)
+            return cls._breaker
+    
+    @classmethod
+    def reset(cls) -> None:
+        """Drop the client, circuit state and metrics; the next call starts afresh from the settings."""
+        with cls._lock:
+            if cls._session is not None:
+                cls._session.close()
+            cls._client = None
+            cls._session = None
+            cls._breaker = None
+            cls._metrics = {}
+    
+    @classmethod
+    def _record(cls, operation: str, seconds: float = None, error: bool = False, rejected: bool = False) -> None:
+        with cls._lock:
+            metrics = cls._metrics.setdefault(
+                operation, {"calls": 0, "errors": 0, "rejected": 0, "latencies": deque(maxlen=LATENCY_SAMPLES)}
+            )
+            if rejected:
+                metrics["rejected"] += 1
+                return
+            metrics["calls"] += 1
+            if error:
+                metrics["errors"] += 1
+            metrics["latencies"].append(seconds)
+    
+    @classmethod
+    def call(cls, operation: str, request: Callable[[stripe.StripeClient], Any]) -> Any:
+        """
+        Make one Stripe API call through the circuit breaker.
+        
+        Args:
+            operation: Name the call is counted under in the stats
+            request: Function making the call with the client
+        
+        Returns:
+            The Stripe object returned
+        
+        Raises:
+            StripeUnavailableError: If the circuit is open
+            stripe.StripeError: If the call failed
+        """
+        breaker = cls.breaker()
+        if not breaker.allow():
+            cls._record(operation, rejected=True)
+            raise StripeUnavailableError("Stripe is unavailable, try again shortly")
+        
+        started = time.monotonic()
+        try:
+            result = request(cls.client())
+        except stripe.StripeError as e:
+            if isinstance(e, _OUTAGE_ERRORS):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            cls._record(operation, time.monotonic() - started, error=True)
+            raise
+        except Exception:
+            breaker.record_failure()
+            cls._record(operation, time.monotonic() - started, error=True)
+            raise
+        breaker.record_success()
+        cls._record(operation, time.monotonic() - started)
+        return result
+    
+    @classmethod
+    async def run(cls, method: Callable, *args) -> Any:
+        """
+        Run a gateway operation on the Stripe executor and wait for it
+        without blocking the event loop.
+        
+        Raises:
+            StripeUnavailableError: If STRIPE_MAX_PENDING calls are already
+                running or waiting, or the circuit is open
+        """
+        with cls._lock:
+            if cls._pending >= settings.STRIPE_MAX_PENDING:
+                raise StripeUnavailableError("Too many Stripe calls waiting")
+            cls._pending += 1
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(
+                    max_workers=settings.STRIPE_MAX_CONCURRENCY, thread_name_prefix="stripe"
+                )
+            executor = cls._executor
+        try:
+            return await asyncio.wrap_future(executor.submit(method, *args))
+        finally:
+            with cls._lock:
+                cls._pending -= 1
+    
+    @classmethod
+    def create_payment_intent(cls, params: dict) -> stripe.PaymentIntent:
+        return cls.call("create_payment_intent", lambda client: client.v1.payment_intents.create(params))
+    
+    @classmethod
+    def update_payment_intent(cls, payment_intent_id: str, params: dict) -> stripe.PaymentIntent:
+        return cls.call(
+            "update_payment_intent", lambda client: client.v1.payment_intents.update(payment_intent_id, params)
+        )
+    
+    @classmethod
+    def retrieve_payment_intent(cls, payment_intent_id: str) -> stripe.PaymentIntent:
+        return cls.call("retrieve_payment_intent", lambda client: client.v1.payment_intents.retrieve(payment_intent_id))
+    
+    @classmethod
+    def cancel_payment_intent(cls, payment_intent_id: str) -> stripe.PaymentIntent:
+        return cls.call("cancel_payment_intent", lambda client: client.v1.payment_intents.cancel(payment_intent_id))
+    
+    @classmethod
+    def refund(cls, payment_intent_id: str) -> stripe.Refund:
+        return cls.call("refund", lambda client: client.v1.refunds.create({"payment_intent": payment_intent_id}))
+    
+    @classmethod
+    def stats(cls) -> dict:
+        """
+        Circuit state, calls in flight and, per operation, call and error
+        counts and latencies (ms) over the last LATENCY_SAMPLES calls.
+        """
+        with cls._lock:
+            operations = {}
+            for operation, metrics in cls._metrics.items():
+                latencies = sorted(metrics["latencies"])
+                operations[operation] = {
+                    "calls": metrics["calls"],
+                    "errors": metrics["errors"],
+                    "rejected": metrics["rejected"],
+                    "avg_ms": _ms(sum(latencies) / len(latencies)) if latencies else None,
+                    "p95_ms": _ms(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]) if latencies else None,
+                    "max_ms": _ms(latencies[-1]) if latencies else None,
+                }
+            pending = cls._pending
+        return {"circuit": cls.breaker().state, "pending": pending, "operations": operations}
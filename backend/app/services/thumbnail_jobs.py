@@ -0,0 +1,306 @@
+"""
+Background thumbnail regeneration jobs.
+"""
+import multiprocessing
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime
+from typing import Optional
+
+from ..config import settings
+from ..database import db_timestamp, get_db_context
+from .image import ImageService
+from .image_cache import ImageVariantCache
+from .image_metadata import ImageMetadataService, VARIANT_THUMBNAIL
+from .image_paths import ImagePaths
+from .image_profiles import ImageProfiles, PROFILE_THUMBNAIL
+from .storage import AREA_ORIGINALS, AREA_THUMBNAILS, get_storage
+
+
+# Job states; 'running' jobs with no live runner were interrupted and can resume
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+
+# Per-file states
+ITEM_PENDING = "pending"
+ITEM_DONE = "done"
+ITEM_SKIPPED = "skipped"
+ITEM_ERROR = "error"
+
+
+def render_job_item(filename: str, options: dict) -> dict:
+    """
+    Regenerate the thumbnail of one image. Runs in a worker process.
+    
+    Everything the worker needs is passed in options, since worker
+    processes start fresh and do not see settings patched at runtime.
+    
+    Args:
+        filename: Original image filename
+        options: storage, thumbnail_size, thumbnail_quality,
+            profile_version, force
+    
+    Returns:
+        Dict with status, and for rebuilt thumbnails their bytes, encoding
+        details and (in force mode) a fresh placeholder
+    """
+    storage = options["storage"]
+    thumbnail_name = ImagePaths.thumbnail_name(filename)
+    if not options["force"] and storage.exists(AREA_THUMBNAILS, thumbnail_name):
+        return {"status": ITEM_SKIPPED}
+    
+    original = storage.get(AREA_ORIGINALS, filename)
+    if original is None:
+        return {"status": ITEM_ERROR, "error": "Original image not found"}
+    
+    encoding = {}
+    thumbnail_bytes = ImageService.create_thumbnail(
+        original, options["thumbnail_size"], options["thumbnail_quality"], report=encoding
+    )
+    storage.put(AREA_THUMBNAILS, thumbnail_name, thumbnail_bytes)
+    
+    return {
+        "status": ITEM_DONE,
+        "thumbnail": thumbnail_bytes,
+        "encoding": encoding,
+        "profile_version": options["profile_version"],
+        "placeholder": ImageService.create_placeholder(thumbnail_bytes) if options["force"] else None,
+    }
+
+
+class ThumbnailJobService:
+    """
+    Runs thumbnail regeneration as a resumable background job.
+    
+    A job row tracks overall progress and one item row per image records
+    whether that file is done. The work fans out over a process pool driven
+    by a runner thread; if the process dies, the next start (or app startup)
+    picks up the remaining pending items instead of starting over.
+    """
+    
+    _lock = threading.Lock()
+    _runners: dict = {}
+    
+    @classmethod
+    def start(cls, force: bool = False) -> int:
+        """
+        Start a regeneration job, or return the one already in progress.
+        
+        An unfinished job with the same force flag is resumed rather than
+        replaced; one with a different flag is cancelled.
+        
+        Args:
+            force: Rebuild every thumbnail (and placeholder and cached
+                variant) even if it exists, e.g. after a settings change
+        
+        Returns:
+            Job id
+        """
+        with cls._lock:
+            with get_db_context() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "SELECT id, force FROM thumbnail_jobs WHERE status IN (?, ?) ORDER BY id DESC LIMIT 1",
+                    (JOB_RUNNING, JOB_FAILED)
+                )
+                unfinished = cursor.fetchone()
+                
+                if unfinished and cls._is_running(unfinished["id"]):
+                    return unfinished["id"]
+                
+                if unfinished and bool(unfinished["force"]) == force:
+                    job_id = unfinished["id"]
+                    cursor.execute(
+                        "UPDATE thumbnail_jobs SET status = ?, error = NULL, updated_at = ? WHERE id = ?",
+                        (JOB_RUNNING, db_timestamp(datetime.utcnow()), job_id)
+                    )
+                else:
+                    if unfinished:
+                        cursor.execute(
+                            "UPDATE thumbnail_jobs SET status = ?, updated_at = ? WHERE id = ?",
+                            (JOB_CANCELLED, db_timestamp(datetime.utcnow()), unfinished["id"])
+                        )
+                    job_id = cls._create_job(cursor, force)
+            
+            cls._launch(job_id)
+            return job_id
+    
+    @classmethod
+    def resume_interrupted(cls) -> list:
+        """
+        Restart runners for jobs left 'running' by a previous process.
+        
+        Returns:
+            Ids of the resumed jobs
+        """
+        with get_db_context() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id FROM thumbnail_jobs WHERE status = ?", (JOB_RUNNING,))
+            job_ids = [row["id"] for row in cursor.fetchall()]
+        
+        with cls._lock:
+            for job_id in job_ids:
+                if not cls._is_running(job_id):
+                    print(f"Resuming thumbnail job {job_id}")
+                    cls._launch(job_id)
+        return job_ids
+    
+    @staticmethod
+    def get_job(job_id: int) -> Optional[dict]:
+        """
+        Return the progress of a job.
+        
+        Returns:
+            Job dict (with up to 50 recent errors), or None if not found
+        """
+        with get_db_context() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM thumbnail_jobs WHERE id = ?", (job_id,))
+            job = cursor.fetchone()
+            if not job:
+                return None
+            
+            cursor.execute(
+                """SELECT filename, error FROM thumbnail_job_items
+                   WHERE job_id = ? AND status = ? ORDER BY id DESC LIMIT 50""",
+                (job_id, ITEM_ERROR)
+            )
+            errors = [f"{row['filename']}: {row['error']}" for row in cursor.fetchall()]
+        
+        result = dict(job)
+        result["force"] = bool(result["force"])
+        result["completed"] = result["processed"] + result["skipped"] + result["failed"]
+        result["errors"] = errors
+        return result
+    
+    @classmethod
+    def _is_running(cls, job_id: int) -> bool:
+        runner = cls._runners.get(job_id)
+        return runner is not None and runner.is_alive()
+    
+    @staticmethod
+    def _create_job(cursor, force: bool) -> int:
+        """Create a job with one pending item per referenced image."""
+        cursor.execute("""
+            SELECT filename FROM product_images WHERE filename IS NOT NULL
+            UNION
+            SELECT image_filename FROM categories WHERE image_filename IS NOT NULL
+        """)
+        filenames = [row["filename"] for row in cursor.fetchall() if row["filename"]]
+        
+        now = db_timestamp(datetime.utcnow())
+        cursor.execute(
+            """INSERT INTO thumbnail_jobs
+               (status, force, total, processed, skipped, failed, created_at, updated_at)
+               VALUES (?, ?, ?, 0, 0, 0, ?, ?)""",
+            (JOB_RUNNING, 1 if force else 0, len(filenames), now, now)
+        )
+        job_id = cursor.lastrowid
+        cursor.executemany(
+            "INSERT INTO thumbnail_job_items (job_id, filename, status) VALUES (?, ?, ?)",
+            [(job_id, filename, ITEM_PENDING) for filename in filenames]
+        )
+        return job_id
+    
+    @classmethod
+    def _launch(cls, job_id: int) -> None:
+        """Start the runner thread for a job. Caller holds _lock."""
+        runner = threading.Thread(
+            target=cls._run, args=(job_id,), name=f"thumbnail-job-{job_id}", daemon=True
+        )
+        cls._runners[job_id] = runner
+        runner.start()
+    
+    @classmethod
+    def _run(cls, job_id: int) -> None:
+        """Process the pending items of a job across a worker pool."""
+        try:
+            with get_db_context() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT force FROM thumbnail_jobs WHERE id = ?", (job_id,))
+                force = bool(cursor.fetchone()["force"])
+                cursor.execute(
+                    "SELECT filename FROM thumbnail_job_items WHERE job_id = ? AND status = ? ORDER BY id",
+                    (job_id, ITEM_PENDING)
+                )
+                pending = [row["filename"] for row in cursor.fetchall()]
+            
+            options = {
+                "storage": get_storage(),
+                "thumbnail_size": settings.THUMBNAIL_SIZE,
+                "thumbnail_quality": ImageService.default_quality(settings.THUMBNAIL_QUALITY),
+                "profile_version": ImageProfiles.version(PROFILE_THUMBNAIL),
+                "force": force,
+            }
+            workers = max(1, settings.THUMBNAIL_JOB_WORKERS)
+            queue = iter(pending)
+            inflight = {}
+            
+            # Spawn rather than fork: this runs in a thread of a threaded server
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+                def fill():
+                    # Keep a bounded number of files in flight so results are
+                    # recorded as they finish rather than all at the end
+                    while len(inflight) < workers * 2:
+                        filename = next(queue, None)
+                        if filename is None:
+                            return
+                        inflight[pool.submit(render_job_item, filename, options)] = filename
+                
+                fill()
+                while inflight:
+                    done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                    with get_db_context() as conn:
+                        cursor = conn.cursor()
+                        for future in done:
+                            cls._record_result(cursor, job_id, inflight.pop(future), future, force)
+                    fill()
+            
+            cls._finish(job_id, JOB_COMPLETED)
+        except Exception as e:
+            print(f"Thumbnail job {job_id} failed: {e}")
+            cls._finish(job_id, JOB_FAILED, str(e))
+        finally:
+            with cls._lock:
+                cls._runners.pop(job_id, None)
+    
+    @staticmethod
+    def _record_result(cursor, job_id: int, filename: str, future, force: bool) -> None:
+        """Store the outcome of one file and bump the job counters."""
+        try:
+            result = future.result()
+        except Exception as e:
+            result = {"status": ITEM_ERROR, "error": str(e)}
+        
+        status = result["status"]
+        if status == ITEM_DONE:
+            ImageMetadataService.record(
+                cursor, filename, VARIANT_THUMBNAIL, ImagePaths.thumbnail_name(filename), result["thumbnail"],
+                encoding=result.get("encoding"), profile_version=result.get("profile_version")
+            )
+            if result.get("placeholder"):
+                ImageService.store_placeholder(cursor, filename, result["placeholder"])
+            if force:
+                ImageVariantCache.purge(filename)
+        
+        counter = {ITEM_DONE: "processed", ITEM_SKIPPED: "skipped", ITEM_ERROR: "failed"}[status]
+        cursor.execute(
+            "UPDATE thumbnail_job_items SET status = ?, error = ? WHERE job_id = ? AND filename = ?",
+            (status, result.get("error"), job_id, filename)
+        )
+        cursor.execute(
+            f"UPDATE thumbnail_jobs SET {counter} = {counter} + 1, updated_at = ? WHERE id = ?",
+            (db_timestamp(datetime.utcnow()), job_id)
+        )
+    
+    @staticmethod
+    def _finish(job_id: int, status: str, error: str = None) -> None:
+        now = db_timestamp(datetime.utcnow())
+        with get_db_context() as conn:
+            conn.execute(
+                "UPDATE thumbnail_jobs SET status = ?, error = ?, updated_at = ?, finished_at = ? WHERE id = ?",
+                (status, error, now, now, job_id)
+            )
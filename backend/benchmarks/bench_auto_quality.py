@@ -0,0 +1,85 @@
+"""
+Benchmark per-image quality selection against the fixed-quality pipeline.
+
+Runs each sample image in backend/app/uploads through optimize_image and
+create_thumbnail with the fixed quality from settings and with the SSIM
+search, and reports the stored size, chosen quality, achieved SSIM and
+encode time of both. The totals line shows the bytes saved against the
+extra CPU spent.
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_auto_quality [--target SSIM] [--repeat N]
+"""
+import argparse
+import os
+import time
+
+from benchmarks.bench_downscale import sample_images
+
+
+def timed(func, repeat: int) -> tuple:
+    """Run func repeat times and return (result of the last run, mean seconds)."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return result, (time.perf_counter() - start) / repeat
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", type=float, help="SSIM target (default: IMAGE_TARGET_SSIM)")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per image and mode (default: 1)")
+    args = parser.parse_args()
+    
+    from app.config import settings
+    from app.services.image import AUTO_QUALITY, ImageService
+    
+    if args.target is not None:
+        settings.IMAGE_TARGET_SSIM = args.target
+    
+    variants = [
+        ("optimized", ImageService.optimize_image, settings.IMAGE_QUALITY),
+        ("thumbnail", ImageService.create_thumbnail, settings.THUMBNAIL_QUALITY),
+    ]
+    
+    header = (
+        f"{'image':<28} {'variant':<10} {'fixed KB':>9} {'auto KB':>8} {'saved':>7} "
+        f"{'q':>3} {'ssim':>7} {'fixed ms':>9} {'auto ms':>8}"
+    )
+    print(f"target SSIM {settings.IMAGE_TARGET_SSIM}, quality range {settings.IMAGE_AUTO_QUALITY_RANGE}")
+    print(header)
+    print("-" * len(header))
+    totals = {"fixed_bytes": 0, "auto_bytes": 0, "fixed_s": 0.0, "auto_s": 0.0}
+    for path in sample_images():
+        name = os.path.basename(path)
+        label = name if len(name) <= 28 else name[:25] + "..."
+        with open(path, "rb") as f:
+            image_bytes = f.read()
+        for variant, func, fixed_quality in variants:
+            fixed, fixed_s = timed(lambda: func(image_bytes, quality=fixed_quality), args.repeat)
+            report = {}
+            auto, auto_s = timed(lambda: func(image_bytes, quality=AUTO_QUALITY, report=report), args.repeat)
+            
+            totals["fixed_bytes"] += len(fixed)
+            totals["auto_bytes"] += len(auto)
+            totals["fixed_s"] += fixed_s
+            totals["auto_s"] += auto_s
+            saved = 100 * (len(fixed) - len(auto)) / len(fixed)
+            ssim = f"{report['ssim']:.4f}" if report["ssim"] is not None else "-"
+            print(
+                f"{label:<28} {variant:<10} {len(fixed) / 1024:>9.1f} {len(auto) / 1024:>8.1f} {saved:>6.1f}% "
+                f"{report['quality']:>3} {ssim:>7} {fixed_s * 1000:>9.1f} {auto_s * 1000:>8.1f}"
+            )
+    
+    saved_bytes = totals["fixed_bytes"] - totals["auto_bytes"]
+    extra_s = totals["auto_s"] - totals["fixed_s"]
+    print("-" * len(header))
+    print(
+        f"total: {totals['fixed_bytes'] / 1024:.0f} KB fixed, {totals['auto_bytes'] / 1024:.0f} KB auto "
+        f"({100 * saved_bytes / max(1, totals['fixed_bytes']):.1f}% saved), "
+        f"{extra_s:.2f}s extra CPU ({saved_bytes / 1024 / max(extra_s, 1e-9):.0f} KB saved per CPU second)"
+    )
+
+
+if __name__ == "__main__":
+    main()
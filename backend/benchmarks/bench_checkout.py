@@ -0,0 +1,502 @@
+"""
+Concurrent checkout load test and correctness check.
+
+Seeds a fresh database with a catalog and drives concurrent customers
+through the real ASGI app (routes, middleware, the email outbox worker and
+the Stripe gateway included), with SMTP and the Stripe API replaced by
+local stand-ins on free ports. Reports orders/sec, p50/p99 latency and the
+share of requests sold out or failed per endpoint, then checks that:
+
+- no size's stock went negative,
+- the number of orders equals the number of successful checkouts,
+- sold plus remaining stock equals the seeded stock for every size,
+- every order line has its product cost,
+- no stock is still held once every payment has been confirmed,
+- every order's notification email reached the SMTP stand-in.
+
+Scenarios:
+    checkout  POST /checkout (Swish/invoice orders), as the cart page does
+    stripe    POST /create-payment-intent, then /confirm-payment once the
+              stand-in reports the payment succeeded
+
+Stock is kept scarce by default, so sold-out answers (409) are expected
+and oversell shows up as a broken invariant. The run exits with status 1
+if any invariant fails. Results are written as JSON (by default to
+benchmarks/results/, named after the scenario and current commit).
+
+The app's image workers are not started: they would work on the real
+upload directory.
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_checkout [--scenario checkout|stripe]
+        [--customers N] [--concurrency N] [--products N] [--stock N]
+        [--seed N] [--verbose] [--output FILE]
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(BACKEND_DIR, "benchmarks", "results")
+SCENARIOS = ("checkout", "stripe")
+SIZES = ("150", "160", "170", "180")
+
+# How long to wait for the outbox worker to send the last emails
+EMAIL_DRAIN_SECONDS = 30
+
+
+def percentile(values: list, pct: float) -> float:
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    rank = max(1, round(pct / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+class SmtpSink(socketserver.ThreadingTCPServer):
+    """
+    Minimal SMTP server that accepts and counts every message.
+    
+    Speaks just enough of the protocol for smtplib: no TLS, no login.
+    """
+    
+    daemon_threads = True
+    allow_reuse_address = True
+    
+    def __init__(self):
+        self.messages = 0
+        self._lock = threading.Lock()
+        super().__init__(("127.0.0.1", 0), self._handler_class())
+    
+    def _handler_class(self):
+        sink = self
+        
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line: str) -> None:
+                self.wfile.write(f"{line}\r\n".encode())
+            
+            def handle(self):
+                self.reply("220 localhost SMTP sink")
+                for raw in self.rfile:
+                    command = raw.decode(errors="replace").strip().split(" ", 1)[0].upper()
+                    if command in ("EHLO", "HELO"):
+                        self.reply("250 localhost")
+                    elif command == "DATA":
+                        self.reply("354 End data with <CR><LF>.<CR><LF>")
+                        for line in self.rfile:
+                            if line in (b".\r\n", b".\n"):
+                                break
+                        with sink._lock:
+                            sink.messages += 1
+                        self.reply("250 OK")
+                    elif command == "QUIT":
+                        self.reply("221 Bye")
+                        return
+                    elif command in ("MAIL", "RCPT", "RSET", "NOOP"):
+                        self.reply("250 OK")
+                    else:
+                        self.reply("502 Command not implemented")
+        
+        return Handler
+
+
+class StripeStandIn(ThreadingHTTPServer):
+    """
+    Local stand-in for the Stripe API.
+    
+    Creates payment intents and refunds in memory. A retrieved intent
+    reports "succeeded", as if the customer had paid by the time the
+    browser confirms.
+    """
+    
+    daemon_threads = True
+    
+    def __init__(self):
+        self.intents = {}
+        self.refunds = 0
+        self._lock = threading.Lock()
+        super().__init__(("127.0.0.1", 0), self._handler_class())
+    
+    def handle_call(self, method: str, path: str, params: dict):
+        """Answer one API request: (status code, JSON body)."""
+        parts = path.strip("/").split("/")
+        with self._lock:
+            if method == "POST" and parts == ["v1", "payment_intents"]:
+                intent_id = f"pi_{len(self.intents) + 1}"
+                self.intents[intent_id] = {
+                    "id": intent_id,
+                    "object": "payment_intent",
+                    "amount": int(params.get("amount", 0)),
+                    "currency": params.get("currency", "sek"),
+                    "client_secret": f"{intent_id}_secret",
+                    "status": "requires_payment_method",
+                }
+                return 200, self.intents[intent_id]
+            if parts[:2] == ["v1", "payment_intents"] and parts[2:3] and parts[2] in self.intents:
+                intent = self.intents[parts[2]]
+                if parts[3:] == ["cancel"]:
+                    intent["status"] = "canceled"
+                elif method == "GET" and intent["status"] != "canceled":
+                    intent["status"] = "succeeded"
+                return 200, intent
+            if method == "POST" and parts == ["v1", "refunds"]:
+                self.refunds += 1
+                return 200, {"id": f"re_{self.refunds}", "object": "refund", "status": "succeeded"}
+        return 404, {"error": {"type": "invalid_request_error", "message": f"Unrecognized request URL {path}"}}
+    
+    def _handler_class(self):
+        stand_in = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            
+            def _respond(self):
+                url = urlsplit(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length).decode() if length else url.query
+                status, payload = stand_in.handle_call(self.command, url.path, dict(parse_qsl(body)))
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            
+            do_GET = do_POST = do_DELETE = _respond
+            
+            def log_message(self, format, *args):
+                pass
+        
+        return Handler
+
+
+def serve(server) -> None:
+    threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+
+
+def seed_catalog(products: int, stock: int, rng: random.Random) -> dict:
+    """
+    Insert the products to sell.
+    
+    Returns:
+        Seeded stock keyed by (product id, size), plus the product rows
+        used to build carts
+    """
+    from app.database import get_db_context
+    
+    catalog = []
+    seeded = {}
+    with get_db_context() as conn:
+        cursor = conn.cursor()
+        for index in range(products):
+            price = rng.randrange(200, 2000, 50)
+            sizes = {size: {"online": stock, "club": 0} for size in SIZES}
+            cursor.execute(
+                """INSERT INTO products (name, price, cost, sizes, category, color, description)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (f"Load test product {index + 1}", price, price // 2, json.dumps(sizes), "Gi", "white", "")
+            )
+            product_id = cursor.lastrowid
+            catalog.append({"id": product_id, "name": f"Load test product {index + 1}", "price": price})
+            for size in SIZES:
+                seeded[(product_id, size)] = stock
+    return {"catalog": catalog, "seeded": seeded}
+
+
+def make_order(index: int, catalog: list, rng: random.Random) -> dict:
+    """A cart of one to three lines, as the checkout page sends it."""
+    items = []
+    for product in rng.sample(catalog, min(len(catalog), rng.randint(1, 3))):
+        items.append({
+            "id": product["id"],
+            "name": product["name"],
+            "price": product["price"],
+            "color": "white",
+            "selectedSize": rng.choice(SIZES),
+            "quantity": rng.randint(1, 2),
+        })
+    items_total = sum(item["price"] * item["quantity"] for item in items)
+    return {
+        "customer": {
+            "firstName": "Load",
+            "lastName": f"Test {index}",
+            "email": f"customer{index}@example.com",
+            "phone": "0700000000",
+        },
+        "items": items,
+        "itemsTotal": items_total,
+        "deliveryMethod": "pickup",
+        "deliveryCost": 0,
+        "total": items_total,
+        "payment": "swish",
+    }
+
+
+class Recorder:
+    """Latency and status code of every request, per endpoint."""
+    
+    def __init__(self):
+        self.calls = {}
+    
+    async def post(self, client, path: str, payload: dict, headers: dict = None):
+        started = time.perf_counter()
+        try:
+            response = await client.post(path, json=payload, headers=headers or {})
+            status = response.status_code
+        except Exception as e:
+            response, status = None, f"error: {type(e).__name__}"
+        self.calls.setdefault(path, []).append((status, time.perf_counter() - started))
+        return response
+    
+    def summary(self) -> dict:
+        endpoints = {}
+        for path, calls in self.calls.items():
+            latencies = [seconds for _, seconds in calls]
+            statuses = {}
+            for status, _ in calls:
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+            failed = sum(1 for status, _ in calls if not isinstance(status, int) or status >= 500)
+            endpoints[path] = {
+                "requests": len(calls),
+                "statuses": statuses,
+                "sold_out_rate": round(statuses.get("409", 0) / len(calls), 4),
+                "error_rate": round(failed / len(calls), 4),
+                "p50_ms": round(1000 * percentile(latencies, 50), 2),
+                "p99_ms": round(1000 * percentile(latencies, 99), 2),
+                "max_ms": round(1000 * max(latencies), 2),
+            }
+        return endpoints
+
+
+async def checkout_customer(client, recorder: Recorder, order: dict, index: int) -> bool:
+    response = await recorder.post(client, "/checkout", order, {"Idempotency-Key": f"load-{index}"})
+    return response is not None and response.status_code == 200
+
+
+async def stripe_customer(client, recorder: Recorder, order: dict, index: int) -> bool:
+    response = await recorder.post(client, "/create-payment-intent", order)
+    if response is None or response.status_code != 200:
+        return False
+    payment_intent_id = response.json()["client_secret"].rsplit("_secret", 1)[0]
+    response = await recorder.post(
+        client,
+        "/confirm-payment",
+        {"payment_intent_id": payment_intent_id, "order": order},
+        {"Idempotency-Key": f"confirm-{payment_intent_id}"},
+    )
+    return response is not None and response.status_code == 200
+
+
+async def drive(app, scenario: str, orders: list, concurrency: int) -> dict:
+    """Run every customer through the app, at most `concurrency` at a time."""
+    import httpx
+    
+    customer = checkout_customer if scenario == "checkout" else stripe_customer
+    recorder = Recorder()
+    limit = asyncio.Semaphore(concurrency)
+    
+    async def run(index, order):
+        async with limit:
+            return await customer(client, recorder, order, index)
+    
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=None) as client:
+        started = time.perf_counter()
+        results = await asyncio.gather(*(run(index, order) for index, order in enumerate(orders)))
+        elapsed = time.perf_counter() - started
+    
+    return {"succeeded": sum(results), "seconds": elapsed, "endpoints": recorder.summary()}
+
+
+def wait_for_emails(sink: SmtpSink, expected: int) -> None:
+    """Give the outbox worker time to send the last emails."""
+    deadline = time.monotonic() + EMAIL_DRAIN_SECONDS
+    while sink.messages < expected and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+
+def check_invariants(seeded: dict, succeeded: int, emails: int) -> list:
+    """
+    Check the database after the run.
+    
+    Returns:
+        List of (invariant, passed, detail)
+    """
+    from app.database import get_db_context
+    from app.services.inventory import normalize_sizes
+    
+    with get_db_context() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, sizes FROM products")
+        remaining = {}
+        negative = []
+        for row in cursor.fetchall():
+            for size, locations in normalize_sizes(json.loads(row["sizes"])).items():
+                remaining[(row["id"], size)] = sum(locations.values())
+                if any(quantity < 0 for quantity in locations.values()):
+                    negative.append(f"{row['id']}/{size}")
+        orders = cursor.execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+        cursor.execute("SELECT product_id, size, SUM(quantity) AS sold FROM order_items GROUP BY product_id, size")
+        sold = {(row["product_id"], row["size"]): row["sold"] for row in cursor.fetchall()}
+        missing_cost = cursor.execute("SELECT COUNT(*) FROM order_items WHERE cost IS NULL").fetchone()[0]
+        held = cursor.execute("SELECT COALESCE(SUM(quantity), 0) FROM stock_holds").fetchone()[0]
+    
+    unbalanced = [
+        f"{product_id}/{size}: {quantity} seeded, {sold.get((product_id, size), 0)} sold, "
+        f"{remaining.get((product_id, size))} left"
+        for (product_id, size), quantity in seeded.items()
+        if sold.get((product_id, size), 0) + remaining.get((product_id, size), 0) != quantity
+    ]
+    return [
+        ("stock never negative", not negative, ", ".join(negative[:5]) or "ok"),
+        ("orders match successful checkouts", orders == succeeded, f"{orders} orders, {succeeded} successful"),
+        ("sold + remaining = seeded", not unbalanced, "; ".join(unbalanced[:5]) or "ok"),
+        ("item costs populated", missing_cost == 0, f"{missing_cost} lines without cost"),
+        ("no stock left held", held == 0, f"{held} units held"),
+        ("every order emailed", emails == orders, f"{emails} emails for {orders} orders"),
+    ]
+
+
+def environment(args) -> dict:
+    """Commit, interpreter and run parameters recorded with a run."""
+    import platform
+    
+    def git(*command):
+        try:
+            return subprocess.run(
+                ["git", *command], cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+    
+    return {
+        "commit": git("rev-parse", "--short", "HEAD"),
+        "dirty": bool(git("status", "--porcelain", "--", ".")),
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "scenario": args.scenario,
+        "customers": args.customers,
+        "concurrency": args.concurrency,
+        "products": args.products,
+        "stock": args.stock,
+        "seed": args.seed,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=SCENARIOS, default="checkout", help="Checkout flow to drive")
+    parser.add_argument("--customers", type=int, default=500, help="Orders to attempt (default: 500)")
+    parser.add_argument("--concurrency", type=int, default=16, help="Customers checking out at once (default: 16)")
+    parser.add_argument("--products", type=int, default=20, help="Products in the catalog (default: 20)")
+    parser.add_argument("--stock", type=int, default=5, help=f"Stock per size, {len(SIZES)} sizes each (default: 5)")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the generated carts (default: 1)")
+    parser.add_argument("--verbose", action="store_true", help="Show the app's own output during the run")
+    parser.add_argument("--output", help="JSON result file (default: benchmarks/results/checkout_<scenario>_<commit>.json)")
+    args = parser.parse_args()
+    
+    smtp = SmtpSink()
+    stripe_api = StripeStandIn()
+    serve(smtp)
+    serve(stripe_api)
+    
+    with tempfile.TemporaryDirectory(prefix="bench_checkout_") as scratch:
+        # Settings are read from the environment when the app is imported
+        os.environ.update({
+            "DATA_DIR": scratch,
+            "JWT_SECRET": "load-test-secret-of-sufficient-length",
+            "SMTP_SERVER": "127.0.0.1",
+            "SMTP_PORT": str(smtp.server_address[1]),
+            "SMTP_STARTTLS": "false",
+            "SMTP_USER": "shop@example.com",
+            "SMTP_PASSWORD": "",
+            "EMAIL_RECEIVER": "shop@example.com",
+            "EMAIL_OUTBOX_POLL_SECONDS": "0.1",
+            "STRIPE_SECRET_KEY": "sk_test_load",
+            "STRIPE_API_BASE": f"http://127.0.0.1:{stripe_api.server_address[1]}",
+            "STRIPE_WEBHOOK_SECRET": "",
+        })
+        from app.main import app
+        from app.services.email_outbox import EmailOutboxService
+        from app.services.stock_holds import StockHoldService
+        
+        rng = random.Random(args.seed)
+        seeded = seed_catalog(args.products, args.stock, rng)
+        orders = [make_order(index, seeded["catalog"], rng) for index in range(args.customers)]
+        
+        run = {"environment": environment(args)}
+        print(
+            f"{args.customers} customers, {args.concurrency} at a time, {args.products} products x "
+            f"{len(SIZES)} sizes x {args.stock} in stock, scenario {args.scenario}, "
+            f"commit {run['environment']['commit']}"
+        )
+        
+        EmailOutboxService.start_worker()
+        StockHoldService.start_sweeper()
+        try:
+            app_output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+            with app_output:
+                result = asyncio.run(drive(app, args.scenario, orders, args.concurrency))
+                wait_for_emails(smtp, result["succeeded"])
+            invariants = check_invariants(seeded["seeded"], result["succeeded"], smtp.messages)
+        finally:
+            StockHoldService.stop_sweeper()
+            EmailOutboxService.stop_worker()
+            smtp.shutdown()
+            stripe_api.shutdown()
+    
+    run["result"] = {
+        "orders": result["succeeded"],
+        "seconds": round(result["seconds"], 3),
+        "orders_per_sec": round(result["succeeded"] / result["seconds"], 2),
+        "endpoints": result["endpoints"],
+    }
+    run["invariants"] = [{"name": name, "passed": passed, "detail": detail} for name, passed, detail in invariants]
+    
+    header = f"{'endpoint':<24} {'requests':>9} {'sold out':>9} {'errors':>7} {'p50 ms':>8} {'p99 ms':>8}  statuses"
+    print(header)
+    print("-" * len(header))
+    for path, endpoint in result["endpoints"].items():
+        print(
+            f"{path:<24} {endpoint['requests']:>9} {100 * endpoint['sold_out_rate']:>8.1f}% "
+            f"{100 * endpoint['error_rate']:>6.1f}% {endpoint['p50_ms']:>8.1f} {endpoint['p99_ms']:>8.1f}  "
+            f"{endpoint['statuses']}"
+        )
+    print(
+        f"\n{result['succeeded']} orders in {run['result']['seconds']:.2f}s: "
+        f"{run['result']['orders_per_sec']:.1f} orders/s"
+    )
+    print()
+    for name, passed, detail in invariants:
+        print(f"{'PASS' if passed else 'FAIL'}  {name:<34} {detail}")
+    
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(
+            RESULTS_DIR, f"checkout_{args.scenario}_{run['environment']['commit'] or 'unknown'}.json"
+        )
+    with open(output, "w") as f:
+        json.dump(run, f, indent=2)
+    print(f"\nWrote {output}")
+    
+    if not all(passed for _, passed, _ in invariants):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
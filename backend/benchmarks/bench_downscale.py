@@ -0,0 +1,112 @@
+"""
+Benchmark the JPEG draft/reduce downscale path against a full decode.
+
+Runs each sample image in backend/app/uploads through create_thumbnail and
+optimize_image twice: once with the fast path and once with the previous
+full-decode + LANCZOS path. Each run happens in a fresh process so the
+peak RSS reported is per image rather than the high-water mark of the
+whole benchmark.
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_downscale [--repeat N]
+"""
+import argparse
+import io
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+UPLOAD_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app", "uploads")
+SAMPLE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+def sample_images() -> list:
+    """Original sample photos shipped in app/uploads (top level only)."""
+    return sorted(
+        os.path.join(UPLOAD_DIR, name)
+        for name in os.listdir(UPLOAD_DIR)
+        if name.lower().endswith(SAMPLE_EXTENSIONS)
+    )
+
+
+def full_decode(image_bytes: bytes, size: tuple, quality: int) -> bytes:
+    """The pre-draft pipeline: decode every pixel, then LANCZOS."""
+    from PIL import Image
+    from app.services.image import ImageService
+    
+    img = Image.open(io.BytesIO(image_bytes))
+    img = ImageService.apply_exif_orientation(img)
+    img = ImageService.convert_to_rgb(img)
+    img.thumbnail(size, Image.Resampling.LANCZOS, reducing_gap=None)
+    output = io.BytesIO()
+    img.save(output, format="JPEG", quality=quality, optimize=True, exif=b"")
+    return output.getvalue()
+
+
+def fast_path(image_bytes: bytes, size: tuple, quality: int) -> bytes:
+    """The draft/reduce pipeline used by ImageService."""
+    from app.services.image import ImageService
+    
+    return ImageService.optimize_image(image_bytes, max_size=size, quality=quality)
+
+
+def _run(task: tuple, results) -> None:
+    """Child process body: run one variant and report time and peak RSS."""
+    path, pipeline, size, quality, repeat = task
+    with open(path, "rb") as f:
+        image_bytes = f.read()
+    
+    func = fast_path if pipeline == "fast" else full_decode
+    start = time.perf_counter()
+    for _ in range(repeat):
+        output = func(image_bytes, size, quality)
+    elapsed = (time.perf_counter() - start) / repeat
+    
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_mb = peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+    results.put((elapsed, peak_mb, len(output)))
+
+
+def measure(task: tuple) -> tuple:
+    """Run a task in a fresh interpreter and return (seconds, peak MB, bytes)."""
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    process = ctx.Process(target=_run, args=(task, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per image and pipeline (default: 3)")
+    args = parser.parse_args()
+    
+    from app.config import settings
+    
+    variants = [
+        ("thumbnail", settings.THUMBNAIL_SIZE, settings.THUMBNAIL_QUALITY),
+        ("optimized", settings.MAX_IMAGE_SIZE, settings.IMAGE_QUALITY),
+    ]
+    
+    header = f"{'image':<28} {'variant':<10} {'full ms':>8} {'fast ms':>8} {'speedup':>8} {'full MB':>8} {'fast MB':>8}"
+    print(header)
+    print("-" * len(header))
+    for path in sample_images():
+        name = os.path.basename(path)
+        label = name if len(name) <= 28 else name[:25] + "..."
+        for variant, size, quality in variants:
+            full_s, full_mb, _ = measure((path, "full", size, quality, args.repeat))
+            fast_s, fast_mb, _ = measure((path, "fast", size, quality, args.repeat))
+            print(
+                f"{label:<28} {variant:<10} {full_s * 1000:>8.1f} {fast_s * 1000:>8.1f} "
+                f"{full_s / fast_s:>7.2f}x {full_mb:>8.1f} {fast_mb:>8.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
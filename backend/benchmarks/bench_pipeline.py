@@ -0,0 +1,267 @@
+"""
+Throughput benchmark for the image pipeline.
+
+Runs convert_to_rgb, optimize_image and create_thumbnail over the sample
+uploads in backend/app/uploads plus a set of synthetic large images, and
+reports images/sec, p50/p95 latency, peak RSS and output bytes per stage.
+Each stage runs in a fresh process so the peak RSS belongs to that stage
+alone. Synthetic images are generated deterministically, so runs on the
+same machine are comparable across commits.
+
+Results are written as JSON (by default to benchmarks/results/, named after
+the current commit); pass --compare with an earlier file to print the
+change per stage.
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_pipeline [--repeat N] [--fixed-quality]
+        [--stages convert_to_rgb,optimize_image,create_thumbnail]
+        [--no-samples] [--no-synthetic] [--output FILE] [--compare FILE]
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from benchmarks.bench_downscale import sample_images
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(BACKEND_DIR, "benchmarks", "results")
+STAGES = ("convert_to_rgb", "optimize_image", "create_thumbnail")
+
+# (name, size, mode, format): a 24 MP phone photo, a large PNG with alpha
+# and a CMYK JPEG from print tooling
+SYNTHETIC_IMAGES = (
+    ("synthetic_24mp.jpg", (6000, 4000), "RGB", "JPEG"),
+    ("synthetic_12mp_alpha.png", (4000, 3000), "RGBA", "PNG"),
+    ("synthetic_8mp_cmyk.jpg", (3500, 2300), "CMYK", "JPEG"),
+)
+
+
+def make_synthetic(size: tuple, mode: str, fmt: str) -> bytes:
+    """Render a deterministic detailed test image."""
+    from PIL import Image, ImageOps
+    
+    detail = Image.effect_mandelbrot(size, (-2.0, -1.2, 0.8, 1.2), 64)
+    gradient = Image.linear_gradient("L").resize(size)
+    bands = [detail, gradient, ImageOps.invert(detail)]
+    if mode in ("RGBA", "CMYK"):
+        bands.append(gradient.transpose(Image.Transpose.ROTATE_180))
+    img = Image.merge(mode, bands)
+    
+    output = io.BytesIO()
+    if fmt == "JPEG":
+        img.save(output, format=fmt, quality=95)
+    else:
+        img.save(output, format=fmt)
+    return output.getvalue()
+
+
+def synthetic_images(directory: str) -> list:
+    """Write the synthetic images into directory and return their paths."""
+    paths = []
+    for name, size, mode, fmt in SYNTHETIC_IMAGES:
+        path = os.path.join(directory, name)
+        with open(path, "wb") as f:
+            f.write(make_synthetic(size, mode, fmt))
+        paths.append(path)
+    return paths
+
+
+def run_stage(stage: str, image_bytes: bytes) -> int:
+    """Run one pipeline stage on an image and return the output size in bytes."""
+    from PIL import Image
+    from app.services.image import ImageService
+    
+    if stage == "convert_to_rgb":
+        img = ImageService.convert_to_rgb(Image.open(io.BytesIO(image_bytes)))
+        img.load()
+        return 0
+    if stage == "optimize_image":
+        return len(ImageService.optimize_image(image_bytes))
+    if stage == "create_thumbnail":
+        return len(ImageService.create_thumbnail(image_bytes))
+    raise ValueError(f"Unknown stage '{stage}'")
+
+
+def percentile(values: list, pct: float) -> float:
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    rank = max(1, round(pct / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def _run(task: tuple, results) -> None:
+    """Child process body: run one stage over every input and report timings."""
+    stage, paths, repeat = task
+    inputs = []
+    for path in paths:
+        with open(path, "rb") as f:
+            inputs.append((os.path.basename(path), f.read()))
+    
+    # Warm up imports and codec tables outside the measurement
+    run_stage(stage, inputs[0][1])
+    
+    latencies = []
+    images = []
+    start = time.perf_counter()
+    for name, image_bytes in inputs:
+        times = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            output_bytes = run_stage(stage, image_bytes)
+            times.append(time.perf_counter() - t0)
+        latencies.extend(times)
+        images.append({
+            "name": name,
+            "input_bytes": len(image_bytes),
+            "output_bytes": output_bytes,
+            "mean_ms": round(1000 * sum(times) / len(times), 2),
+        })
+    elapsed = time.perf_counter() - start
+    
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_mb = peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+    results.put({
+        "runs": len(latencies),
+        "seconds": round(elapsed, 3),
+        "images_per_sec": round(len(latencies) / elapsed, 2),
+        "p50_ms": round(1000 * percentile(latencies, 50), 2),
+        "p95_ms": round(1000 * percentile(latencies, 95), 2),
+        "peak_rss_mb": round(peak_mb, 1),
+        "output_bytes": sum(image["output_bytes"] for image in images),
+        "images": images,
+    })
+
+
+def measure(task: tuple) -> dict:
+    """Run a stage in a fresh interpreter and return its measurements."""
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    process = ctx.Process(target=_run, args=(task, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def environment(args) -> dict:
+    """Commit, interpreter, library and settings details recorded with a run."""
+    import PIL
+    from app.config import settings
+    
+    def git(*command):
+        try:
+            return subprocess.run(
+                ["git", *command], cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+    
+    return {
+        "commit": git("rev-parse", "--short", "HEAD"),
+        "dirty": bool(git("status", "--porcelain", "--", ".")),
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "repeat": args.repeat,
+        "settings": {
+            "MAX_IMAGE_SIZE": list(settings.MAX_IMAGE_SIZE),
+            "IMAGE_QUALITY": settings.IMAGE_QUALITY,
+            "THUMBNAIL_SIZE": list(settings.THUMBNAIL_SIZE),
+            "THUMBNAIL_QUALITY": settings.THUMBNAIL_QUALITY,
+            "IMAGE_AUTO_QUALITY": settings.IMAGE_AUTO_QUALITY,
+            "IMAGE_TARGET_SSIM": settings.IMAGE_TARGET_SSIM,
+        },
+    }
+
+
+def compare(current: dict, baseline: dict) -> None:
+    """Print the change of each stage's headline numbers against a baseline run."""
+    print(f"\nvs {baseline['environment'].get('commit')} ({baseline['environment'].get('created_at')})")
+    if current["inputs"] != baseline.get("inputs") or current["environment"]["repeat"] != baseline["environment"].get("repeat"):
+        print("note: the runs used different inputs or repeat counts")
+    metrics = ("images_per_sec", "p50_ms", "p95_ms", "peak_rss_mb", "output_bytes")
+    header = f"{'stage':<18}" + "".join(f"{metric:>16}" for metric in metrics)
+    print(header)
+    print("-" * len(header))
+    for stage, result in current["stages"].items():
+        before = baseline["stages"].get(stage)
+        if not before:
+            continue
+        cells = []
+        for metric in metrics:
+            if before[metric]:
+                cells.append(f"{100 * (result[metric] - before[metric]) / before[metric]:>+15.1f}%")
+            else:
+                cells.append(f"{'-':>16}")
+        print(f"{stage:<18}" + "".join(cells))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per image and stage (default: 3)")
+    parser.add_argument("--stages", default=",".join(STAGES), help="Comma-separated stages to run")
+    parser.add_argument("--fixed-quality", action="store_true", help="Encode at the fixed qualities (no SSIM search)")
+    parser.add_argument("--no-samples", action="store_true", help="Skip the sample uploads")
+    parser.add_argument("--no-synthetic", action="store_true", help="Skip the synthetic large images")
+    parser.add_argument("--output", help="JSON result file (default: benchmarks/results/pipeline_<commit>.json)")
+    parser.add_argument("--compare", help="Earlier JSON result file to compare against")
+    args = parser.parse_args()
+    
+    stages = [stage for stage in args.stages.split(",") if stage]
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error(f"Unknown stage '{stage}'. Choose from: {', '.join(STAGES)}")
+    
+    # Worker processes read settings from the environment when they start
+    if args.fixed_quality:
+        os.environ["IMAGE_AUTO_QUALITY"] = "false"
+    
+    with tempfile.TemporaryDirectory(prefix="bench_pipeline_") as scratch:
+        paths = [] if args.no_samples else sample_images()
+        if not args.no_synthetic:
+            paths += synthetic_images(scratch)
+        if not paths:
+            parser.error("No input images")
+        
+        run = {"environment": environment(args), "inputs": [os.path.basename(p) for p in paths], "stages": {}}
+        header = (
+            f"{'stage':<18} {'images/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'peak MB':>8} {'output KB':>10}"
+        )
+        print(f"{len(paths)} images x {args.repeat} runs, commit {run['environment']['commit']}")
+        print(header)
+        print("-" * len(header))
+        for stage in stages:
+            result = measure((stage, paths, args.repeat))
+            run["stages"][stage] = result
+            print(
+                f"{stage:<18} {result['images_per_sec']:>9.2f} {result['p50_ms']:>8.1f} {result['p95_ms']:>8.1f} "
+                f"{result['peak_rss_mb']:>8.1f} {result['output_bytes'] / 1024:>10.1f}"
+            )
+    
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"pipeline_{run['environment']['commit'] or 'unknown'}.json")
+    with open(output, "w") as f:
+        json.dump(run, f, indent=2)
+    print(f"\nWrote {output}")
+    
+    if args.compare:
+        with open(args.compare) as f:
+            compare(run, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 """
 Pytest fixtures for Yakimoto Dojo backend tests.
 """
+import io
 import json
 import os
 import sqlite3
@@ -10,6 +11,7 @@ from typing import Generator
 
 import jwt
 import pytest
+from PIL import Image
 
 # Set test environment variables before importing app
 os.environ["ADMIN_PASSWORD"] = "test_password"
@@ -156,6 +158,8 @@ def app_with_test_db(test_db, tmp_path, monkeypatch):
     upload_dir.mkdir()
     thumbnail_dir = upload_dir / "thumbnails"
     thumbnail_dir.mkdir()
+    cache_dir = upload_dir / "cache"
+    cache_dir.mkdir()
     
     # Patch settings
     monkeypatch.setenv("DATA_DIR", str(tmp_path))
@@ -165,10 +169,15 @@ def app_with_test_db(test_db, tmp_path, monkeypatch):
     monkeypatch.setattr(settings, "DATA_DIR", str(tmp_path))
     monkeypatch.setattr(settings, "UPLOAD_DIR", str(upload_dir))
     monkeypatch.setattr(settings, "THUMBNAIL_DIR", str(thumbnail_dir))
+    monkeypatch.setattr(settings, "IMAGE_CACHE_DIR", str(cache_dir))
+    
+    from app.services.image_cache import ImageVariantCache
+    ImageVariantCache.reset()
     
     # Import after patching
     from app.main import app
     from app.database import setup_database
+    setup_database()
     
     return app
 
@@ -260,3 +269,247 @@ def sample_order_data() -> dict:
         ],
         "total": 1500
     }
+
+
+def make_jpeg(size=(1000, 800), color=(200, 40, 40)) -> bytes:
+    """Create JPEG bytes for a solid-colour test image."""
+    output = io.BytesIO()
+    Image.new("RGB", size, color).save(output, format="JPEG")
+    return output.getvalue()
+
+
+@pytest.fixture
+def uploaded_image(app_with_test_db) -> str:
+    """
+    Write an original image into the test upload directory.
+    
+    Returns the image filename.
+    """
+    from app.config import settings
+    filename = "test-original.jpg"
+    with open(os.path.join(settings.UPLOAD_DIR, filename), "wb") as f:
+        f.write(make_jpeg())
+    return filename
+
+
+@pytest.fixture
+def stored_originals(app_with_test_db, test_db_with_data) -> str:
+    """
+    Write originals for the two product images of the sample data into
+    the test upload directory.
+    
+    Returns the path to the test database.
+    """
+    from app.config import settings
+    for filename in ("test_image_1.jpg", "test_image_2.jpg"):
+        with open(os.path.join(settings.UPLOAD_DIR, filename), "wb") as f:
+            f.write(make_jpeg())
+    return test_db_with_data
+
+
+class StripeEventStub:
+    """
+    Local stand-in for Stripe's webhook delivery.
+    
+    Builds events the way Stripe sends them and signs them with the test
+    webhook secret, so /stripe/webhook can be exercised without Stripe.
+    """
+    
+    SECRET = "whsec_test_secret"
+    
+    def __init__(self, client):
+        self.client = client
+        self._next_id = 0
+    
+    def event(self, event_type: str, payment_intent_id: str, event_id: str = None, amount: int = None) -> dict:
+        self._next_id += 1
+        intent = {"id": payment_intent_id, "object": "payment_intent"}
+        if amount is not None:
+            intent["amount"] = amount
+        return {
+            "id": event_id or f"evt_{self._next_id}",
+            "object": "event",
+            "type": event_type,
+            "data": {"object": intent},
+        }
+    
+    def sign(self, payload: bytes, secret: str = None, timestamp: int = None) -> str:
+        import hashlib
+        import hmac
+        timestamp = int(time.time()) if timestamp is None else timestamp
+        signed = f"{timestamp}.".encode() + payload
+        signature = hmac.new((secret or self.SECRET).encode(), signed, hashlib.sha256).hexdigest()
+        return f"t={timestamp},v1={signature}"
+    
+    def send(self, event: dict, **sign_options):
+        """POST an event to /stripe/webhook with a valid signature."""
+        payload = json.dumps(event).encode()
+        return self.client.post(
+            "/stripe/webhook",
+            content=payload,
+            headers={"Stripe-Signature": self.sign(payload, **sign_options), "Content-Type": "application/json"},
+        )
+
+
+@pytest.fixture
+def stripe_webhook(client, monkeypatch) -> StripeEventStub:
+    """
+    Configure a webhook secret and return a stub that delivers signed events.
+    """
+    from app.config import settings
+    monkeypatch.setattr(settings, "STRIPE_WEBHOOK_SECRET", StripeEventStub.SECRET)
+    return StripeEventStub(client)
+
+
+class FakeStripe:
+    """
+    Local stand-in for the Stripe API, served over HTTP on a free port.
+    
+    Payment intents and refunds are kept in memory. Every request is
+    recorded in `requests` with its parameters, idempotency key and the
+    client port it came from (one port per pooled connection).
+    fail_next() makes the next requests answer with an error and `delay`
+    slows every answer down.
+    """
+    
+    def __init__(self):
+        from http.server import ThreadingHTTPServer
+        import threading
+        self.intents = {}
+        self.refunds = []
+        self.requests = []
+        self.delay = 0
+        self._failures = []
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        self._thread = threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+    
+    def start(self):
+        self._thread.start()
+        return self
+    
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+    
+    def pay(self, payment_intent_id: str, status: str = "succeeded", amount: int = None) -> None:
+        """Put a payment intent into a status, as if the customer had paid (amount in öre)."""
+        with self._lock:
+            intent = self.intents.setdefault(payment_intent_id, self._intent(payment_intent_id, {}))
+            intent["status"] = status
+            if amount is not None:
+                intent["amount"] = amount
+    
+    def fail_next(self, count: int = 1, status: int = 500) -> None:
+        with self._lock:
+            self._failures.extend([status] * count)
+    
+    def calls(self, method: str, path: str) -> list:
+        """Parameters of the requests made to one endpoint."""
+        return [r["params"] for r in self.requests if r["method"] == method and r["path"] == path]
+    
+    def _intent(self, payment_intent_id: str, params: dict) -> dict:
+        return {
+            "id": payment_intent_id,
+            "object": "payment_intent",
+            "amount": int(params.get("amount", 0)),
+            "currency": params.get("currency", "sek"),
+            "client_secret": f"{payment_intent_id}_secret",
+            "status": "requires_payment_method",
+        }
+    
+    def handle(self, method: str, path: str, params: dict):
+        """Answer one API request: (status code, JSON body)."""
+        with self._lock:
+            if self._failures:
+                status = self._failures.pop(0)
+                error_type = "api_error" if status >= 500 else "invalid_request_error"
+                return status, {"error": {"type": error_type, "message": "Fake Stripe failure"}}
+            
+            parts = path.strip("/").split("/")
+            if method == "POST" and parts == ["v1", "payment_intents"]:
+                self._next_id += 1
+                intent = self._intent(f"pi_{self._next_id}", params)
+                self.intents[intent["id"]] = intent
+                return 200, intent
+            if parts[:2] == ["v1", "payment_intents"] and len(parts) >= 3:
+                intent = self.intents.get(parts[2])
+                if intent is None:
+                    return 404, {"error": {"type": "invalid_request_error", "message": "No such payment_intent"}}
+                if method == "POST" and parts[3:] == ["cancel"]:
+                    intent["status"] = "canceled"
+                elif method == "POST":
+                    if intent["status"] in ("succeeded", "processing", "canceled"):
+                        return 400, {"error": {
+                            "type": "invalid_request_error",
+                            "message": f"This PaymentIntent's amount could not be updated because it has a status of {intent['status']}",
+                        }}
+                    intent["amount"] = int(params.get("amount", intent["amount"]))
+                return 200, intent
+            if method == "POST" and parts == ["v1", "refunds"]:
+                refund = {
+                    "id": f"re_{len(self.refunds) + 1}",
+                    "object": "refund",
+                    "payment_intent": params.get("payment_intent"),
+                    "status": "succeeded",
+                }
+                self.refunds.append(refund)
+                return 200, refund
+            return 404, {"error": {"type": "invalid_request_error", "message": f"Unrecognized request URL {path}"}}
+    
+    def _handler_class(self):
+        from http.server import BaseHTTPRequestHandler
+        from urllib.parse import parse_qsl, urlsplit
+        fake = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            
+            def _respond(self):
+                url = urlsplit(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length).decode() if length else url.query
+                params = dict(parse_qsl(body))
+                fake.requests.append({
+                    "method": self.command,
+                    "path": url.path,
+                    "params": params,
+                    "idempotency_key": self.headers.get("Idempotency-Key"),
+                    "client_port": self.client_address[1],
+                })
+                if fake.delay:
+                    time.sleep(fake.delay)
+                status, payload = fake.handle(self.command, url.path, params)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                if status >= 500:
+                    self.send_header("Stripe-Should-Retry", "true")
+                self.end_headers()
+                self.wfile.write(data)
+            
+            do_GET = do_POST = do_DELETE = _respond
+            
+            def log_message(self, format, *args):
+                pass
+        
+        return Handler
+
+
+@pytest.fixture
+def fake_stripe(monkeypatch) -> Generator[FakeStripe, None, None]:
+    """
+    Point the Stripe client at a local fake Stripe API.
+    """
+    from app.config import settings
+    from app.services.stripe_gateway import StripeGateway
+    fake = FakeStripe().start()
+    monkeypatch.setattr(settings, "STRIPE_API_BASE", fake.url)
+    StripeGateway.reset()
+    yield fake
+    StripeGateway.reset()
+    fake.stop()
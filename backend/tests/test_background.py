@@ -0,0 +1,92 @@
+"""
+Tests for the shared background worker and purge throttle.
+"""
+import threading
+
+
+class TestPurgeThrottle:
+    """Tests for PurgeThrottle."""
+    
+    def test_runs_once_per_interval(self):
+        from app.services.background import PurgeThrottle
+        throttle = PurgeThrottle()
+        
+        assert throttle.due(3600) is True
+        assert throttle.due(3600) is False
+        assert throttle.due(3600, force=True) is True
+        assert throttle.due(0) is True
+
+
+class TestBackgroundWorker:
+    """Tests for BackgroundWorker."""
+    
+    def test_wake_runs_the_next_step_early(self):
+        from app.services.background import BackgroundWorker
+        steps = []
+        ran = threading.Event()
+        
+        def step():
+            steps.append(len(steps))
+            ran.set()
+        
+        worker = BackgroundWorker("test-worker", step, 3600)
+        assert worker.start()
+        try:
+            assert ran.wait(5)
+            ran.clear()
+            worker.wake()
+            assert ran.wait(5)
+            assert worker.start() is False
+        finally:
+            worker.stop()
+            worker.join(timeout=5)
+        
+        assert steps[:2] == [0, 1]
+        assert not worker.running
+    
+    def test_busy_step_runs_again_and_errors_do_not_stop_the_loop(self):
+        from app.services.background import BackgroundWorker
+        calls = []
+        done = threading.Event()
+        exited = threading.Event()
+        
+        def step():
+            calls.append(None)
+            if len(calls) == 1:
+                raise RuntimeError("boom")
+            if len(calls) < 4:
+                return True
+            done.set()
+        
+        worker = BackgroundWorker("test-worker", step, 3600, on_exit=exited.set)
+        worker.start()
+        try:
+            # Only the erroring step waits for a wake-up
+            worker.wake()
+            assert done.wait(5)
+        finally:
+            worker.stop()
+            worker.join(timeout=5)
+        
+        assert len(calls) == 4
+        assert exited.is_set()
+    
+    def test_truthy_result_is_not_busy(self):
+        from app.services.background import BackgroundWorker
+        calls = []
+        ran = threading.Event()
+        
+        def step():
+            calls.append(None)
+            ran.set()
+            return {"processed": 1}
+        
+        worker = BackgroundWorker("test-worker", step, 3600)
+        worker.start()
+        try:
+            assert ran.wait(5)
+        finally:
+            worker.stop()
+            worker.join(timeout=5)
+        
+        assert len(calls) == 1
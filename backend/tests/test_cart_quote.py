@@ -0,0 +1,195 @@
+"""
+Tests for server-side cart quotes and their use at checkout.
+"""
+import sqlite3
+
+import jwt
+import pytest
+
+
+@pytest.fixture
+def shop_db(client, test_db_with_data, monkeypatch):
+    from app.config import settings
+    monkeypatch.setattr(settings, "DB_FILE", test_db_with_data)
+    conn = sqlite3.connect(test_db_with_data)
+    # 10% off the gi
+    conn.execute("UPDATE products SET discount_percent = 10 WHERE id = 1")
+    conn.commit()
+    conn.close()
+    return test_db_with_data
+
+
+def quote(client, items, delivery_method="pickup", **extra):
+    return client.post("/cart/quote", json={"items": items, "deliveryMethod": delivery_method, **extra})
+
+
+def gi(quantity=1, size="170", price=1):
+    return {"id": 1, "name": "Judo Gi", "price": price, "quantity": quantity, "selectedSize": size}
+
+
+def saved_order(db_file):
+    conn = sqlite3.connect(db_file)
+    order = conn.execute("SELECT items_total, delivery_cost, total FROM orders").fetchone()
+    items = conn.execute("SELECT product_id, quantity, price FROM order_items").fetchall()
+    conn.close()
+    return order, items
+
+
+class TestCartQuote:
+    """Tests for POST /cart/quote."""
+    
+    def test_prices_come_from_the_database(self, client, shop_db):
+        belt = {"id": 2, "quantity": 2, "selectedSize": "S", "price": 1}
+        
+        data = quote(client, [gi(2), belt], "postnord").json()
+        
+        assert [(line["price"], line["line_total"]) for line in data["lines"]] == [(1350, 2700), (250, 500)]
+        assert data["lines"][0]["regular_price"] == 1500
+        assert data["items_total"] == 3200
+        assert data["delivery_cost"] == 82
+        assert data["total"] == 3282
+        assert data["valid"] is True
+        assert data["quote_token"]
+    
+    def test_availability_excludes_other_carts_holds(self, client, shop_db, fake_stripe):
+        client.post("/create-payment-intent", json={"total": 1350, "items": [gi(2)], "sessionToken": "mine"})
+        
+        others = quote(client, [gi(1)]).json()
+        own = quote(client, [gi(1)], sessionToken="mine").json()
+        
+        assert others["availability"]["1"] == {"170": 5, "180": 3}
+        assert own["lines"][0]["available"] == 7
+    
+    def test_short_cart_has_no_token(self, client, shop_db):
+        data = quote(client, [gi(4, size="180")]).json()
+        
+        assert data["valid"] is False
+        assert data["quote_token"] is None
+        assert data["lines"][0]["in_stock"] is False
+        assert data["shortages"] == [{"id": 1, "size": "180", "requested": 4, "available": 3}]
+    
+    def test_unknown_product_is_not_in_stock(self, client, shop_db):
+        data = quote(client, [{"id": 999, "quantity": 1, "selectedSize": "M"}]).json()
+        
+        assert data["valid"] is False
+        assert data["lines"][0]["line_total"] == 0
+    
+    def test_unknown_delivery_method_is_rejected(self, client, shop_db):
+        assert quote(client, [gi()], "drone").status_code == 400
+    
+    def test_invalid_quantity_is_rejected(self, client, shop_db):
+        response = quote(client, [gi(quantity="lots")])
+        
+        assert response.status_code == 400
+        assert "quantity" in response.json()["detail"]
+    
+    def test_products_are_loaded_with_one_query(self, client, shop_db, monkeypatch):
+        from app.services import quotes
+        statements = []
+        original = quotes.get_db
+        
+        def traced_db():
+            conn = original()
+            conn.set_trace_callback(statements.append)
+            return conn
+        
+        monkeypatch.setattr(quotes, "get_db", traced_db)
+        quote(client, [gi(), gi(size="180"), {"id": 2, "quantity": 1, "selectedSize": "S"}])
+        
+        assert len([s for s in statements if "FROM products" in s]) == 1
+
+
+class TestQuotedCheckout:
+    """Tests for how checkout prices orders, with and without a quote token."""
+    
+    def test_checkout_charges_quoted_prices(self, client, shop_db):
+        token = quote(client, [gi(2)], "postnord").json()["quote_token"]
+        
+        response = client.post("/checkout", json={
+            "customer": {"firstName": "Anna", "lastName": "Berg", "email": "anna@example.com"},
+            "items": [gi(2, price=1)],
+            "itemsTotal": 2,
+            "deliveryMethod": "postnord",
+            "deliveryCost": 0,
+            "total": 2,
+            "payment": "swish",
+            "quoteToken": token,
+        })
+        
+        assert response.status_code == 200
+        assert saved_order(shop_db) == ((2700, 82, 2782), [(1, 2, 1350)])
+    
+    def test_payment_intent_uses_quoted_total(self, client, shop_db, fake_stripe):
+        token = quote(client, [gi()], "postnord").json()["quote_token"]
+        
+        response = client.post("/create-payment-intent", json={"total": 1, "items": [gi()], "quoteToken": token})
+        
+        assert response.status_code == 200
+        assert fake_stripe.intents["pi_1"]["amount"] == 143200
+    
+    def test_confirm_payment_uses_the_quoted_cart(self, client, shop_db, fake_stripe):
+        token = quote(client, [gi()]).json()["quote_token"]
+        client.post("/create-payment-intent", json={"total": 1350, "items": [gi()], "quoteToken": token})
+        fake_stripe.pay("pi_1")
+        
+        response = client.post("/confirm-payment", json={
+            "payment_intent_id": "pi_1", "order": {"items": [gi(price=1)], "itemsTotal": 1, "total": 1},
+        })
+        
+        assert response.status_code == 200
+        assert saved_order(shop_db) == ((1350, 0, 1350), [(1, 1, 1350)])
+    
+    def test_tampered_token_is_rejected(self, client, shop_db):
+        from app.services.quotes import QuoteService
+        token = quote(client, [gi()]).json()["quote_token"]
+        payload = jwt.decode(token, options={"verify_signature": False})
+        payload["items"][0]["price"] = 1
+        forged = jwt.encode(payload, "x" * 32, algorithm="HS256")
+        
+        response = client.post("/checkout", json={"items": [gi()], "quoteToken": forged})
+        
+        assert response.status_code == 400
+        assert QuoteService.verify(token)["items"][0]["price"] == 1350
+    
+    def test_expired_token_is_rejected(self, client, shop_db, monkeypatch):
+        from app.config import settings
+        monkeypatch.setattr(settings, "CART_QUOTE_TTL_SECONDS", -1)
+        token = quote(client, [gi()]).json()["quote_token"]
+        
+        response = client.post("/checkout", json={"items": [gi()], "quoteToken": token})
+        
+        assert response.status_code == 400
+        assert "expired" in response.json()["detail"]
+    
+    def test_quote_token_is_not_an_admin_token(self, client, shop_db):
+        token = quote(client, [gi()]).json()["quote_token"]
+        
+        response = client.get("/orders", headers={"Authorization": f"Bearer {token}"})
+        
+        assert response.status_code == 401
+    
+    def test_quote_can_be_required(self, client, shop_db, monkeypatch):
+        from app.config import settings
+        monkeypatch.setattr(settings, "REQUIRE_CART_QUOTE", True)
+        
+        response = client.post("/checkout", json={"items": [gi()], "total": 1})
+        
+        assert response.status_code == 400
+    
+    def test_order_without_token_is_priced_by_the_shop(self, client, shop_db, fake_stripe):
+        tampered = {
+            "customer": {"firstName": "Anna", "lastName": "Berg", "email": "anna@example.com"},
+            "items": [gi(2, price=1)],
+            "itemsTotal": 2,
+            "deliveryMethod": "postnord",
+            "deliveryCost": 0,
+            "total": 2,
+            "payment": "swish",
+        }
+        
+        intent = client.post("/create-payment-intent", json=tampered)
+        checkout = client.post("/checkout", json=tampered)
+        
+        assert intent.status_code == checkout.status_code == 200
+        assert fake_stripe.intents["pi_1"]["amount"] == 278200
+        assert saved_order(shop_db) == ((2700, 82, 2782), [(1, 2, 1350)])
@@ -3,7 +3,7 @@ Tests for checkout and payment flow.
 """
 import json
 import sqlite3
-from unittest.mock import MagicMock, patch
+from unittest.mock import patch
 
 import pytest
 
@@ -33,12 +33,10 @@ class TestStripePublishableKey:
 class TestCreatePaymentIntent:
     """Tests for payment intent creation."""
     
-    @patch("stripe.PaymentIntent.create")
-    def test_create_payment_intent_success(self, mock_create, client):
+    def test_create_payment_intent_success(self, client, test_db_with_data, monkeypatch, fake_stripe):
         """Should create payment intent successfully."""
-        mock_intent = MagicMock()
-        mock_intent.client_secret = "pi_test_secret"
-        mock_create.return_value = mock_intent
+        from app.config import settings
+        monkeypatch.setattr(settings, "DB_FILE", test_db_with_data)
         
         order_data = {
             "total": 1500,
@@ -47,7 +45,7 @@ class TestCreatePaymentIntent:
                 "firstName": "John",
                 "lastName": "Doe"
             },
-            "items": [{"id": 1, "name": "Test Product"}]
+            "items": [{"id": 1, "name": "Test Product", "quantity": 1, "selectedSize": "170"}]
         }
         
         response = client.post("/create-payment-intent", json=order_data)
@@ -55,28 +53,43 @@ class TestCreatePaymentIntent:
         assert response.status_code == 200
         data = response.json()
         assert "client_secret" in data
-        assert data["client_secret"] == "pi_test_secret"
+        assert data["client_secret"] == "pi_1_secret"
     
-    @patch("stripe.PaymentIntent.create")
-    def test_create_payment_intent_amount_in_cents(self, mock_create, client):
-        """Should convert amount to cents for Stripe."""
-        mock_intent = MagicMock()
-        mock_intent.client_secret = "pi_test_secret"
-        mock_create.return_value = mock_intent
+    def test_create_payment_intent_out_of_stock(self, client, test_db_with_data, monkeypatch, fake_stripe):
+        """Should refuse to take payment for items that are not in stock."""
+        from app.config import settings
+        monkeypatch.setattr(settings, "DB_FILE", test_db_with_data)
         
-        order_data = {"total": 1500}  # 1500 SEK
+        order_data = {
+            "total": 15000,
+            "customer": {"email": "test@example.com"},
+            "items": [{"id": 1, "name": "Judo Gi", "quantity": 8, "selectedSize": "170"}]
+        }
+        
+        response = client.post("/create-payment-intent", json=order_data)
+        
+        assert response.status_code == 409
+        assert response.json()["detail"]["shortages"] == [
+            {"id": 1, "size": "170", "requested": 8, "available": 7}
+        ]
+        assert fake_stripe.requests == []
+    
+    def test_create_payment_intent_amount_in_cents(self, client, test_db_with_data, monkeypatch, fake_stripe):
+        """Should convert amount to cents for Stripe."""
+        from app.config import settings
+        monkeypatch.setattr(settings, "DB_FILE", test_db_with_data)
+        order_data = {"total": 1500, "items": [{"id": 1, "quantity": 1, "selectedSize": "170"}]}  # 1500 SEK
         
         client.post("/create-payment-intent", json=order_data)
         
         # Verify Stripe was called with amount in cents
-        call_kwargs = mock_create.call_args.kwargs
-        assert call_kwargs["amount"] == 150000  # 1500 * 100
-        assert call_kwargs["currency"] == "sek"
+        params = fake_stripe.calls("POST", "/v1/payment_intents")[0]
+        assert params["amount"] == "150000"  # 1500 * 100
+        assert params["currency"] == "sek"
     
-    @patch("stripe.PaymentIntent.create")
-    def test_create_payment_intent_stripe_error(self, mock_create, client):
+    def test_create_payment_intent_stripe_error(self, client, fake_stripe):
         """Should handle Stripe errors gracefully."""
-        mock_create.side_effect = Exception("Stripe API error")
+        fake_stripe.fail_next(status=400)
         
         order_data = {"total": 1500}
         
@@ -89,9 +102,7 @@ class TestCreatePaymentIntent:
 class TestCheckout:
     """Tests for checkout order processing."""
     
-    @patch("app.services.email.EmailService.send_order_notification")
-    @patch("app.services.inventory.InventoryService.reduce_stock")
-    def test_checkout_success(self, mock_reduce, mock_email, client, test_db_with_data, monkeypatch):
+    def test_checkout_success(self, client, test_db_with_data, monkeypatch):
         """Should process checkout successfully."""
         from app.config import settings
         monkeypatch.setattr(settings, "DB_FILE", test_db_with_data)
@@ -119,16 +130,24 @@ class TestCheckout:
         
         assert response.status_code == 200
         assert "Order received" in response.json()["message"]
-        mock_email.assert_called_once()
-        mock_reduce.assert_called_once()
+        
+        conn = sqlite3.connect(test_db_with_data)
+        conn.row_factory = sqlite3.Row
+        sizes = json.loads(conn.execute("SELECT sizes FROM products WHERE id = 1").fetchone()["sizes"])
+        assert sizes["170"] == {"online": 4, "club": 2}
+        order = conn.execute("SELECT id FROM orders").fetchone()
+        message = conn.execute("SELECT * FROM email_outbox").fetchone()
+        conn.close()
+        assert message["order_id"] == order["id"]
+        assert message["status"] == "pending"
+        assert "Swish" in message["subject"]
+        assert "Judo Gi" in message["body"]
     
-    @patch("app.services.email.EmailService.send_order_notification")
-    def test_checkout_email_failure(self, mock_email, client, test_db_with_data, monkeypatch):
-        """Should return 500 if email fails."""
+    def test_checkout_does_not_wait_for_smtp(self, client, test_db_with_data, monkeypatch):
+        """An unreachable mail server should not fail the checkout."""
         from app.config import settings
         monkeypatch.setattr(settings, "DB_FILE", test_db_with_data)
-        
-        mock_email.side_effect = Exception("SMTP error")
+        monkeypatch.setattr(settings, "SMTP_SERVER", "smtp.invalid")
         
         order_data = {
             "customer": {
@@ -140,25 +159,243 @@ class TestCheckout:
             "items": []
         }
         
+        with patch("smtplib.SMTP") as smtp:
+            response = client.post("/checkout", json=order_data)
+        
+        assert response.status_code == 200
+        smtp.assert_not_called()
+    
+    @patch("app.services.email.EmailService.queue_order_notification")
+    def test_checkout_save_failure_rolls_back_order(self, mock_queue, client, test_db_with_data, monkeypatch):
+        """If the notification cannot be queued, the order is not saved either."""
+        from app.config import settings
+        monkeypatch.setattr(settings, "DB_FILE", test_db_with_data)
+        mock_queue.side_effect = sqlite3.OperationalError("database is locked")
+        
+        order_data = {
+            "customer": {"firstName": "John", "lastName": "Doe", "email": "john@example.com"},
+            "items": []
+        }
+        
         response = client.post("/checkout", json=order_data)
         
         assert response.status_code == 500
-        assert "Failed to send email" in response.json()["detail"]
+        assert "Failed to save order" in response.json()["detail"]
+        conn = sqlite3.connect(test_db_with_data)
+        assert conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0] == 0
+        conn.close()
+
+
+class TestStockReservation:
+    """Tests for reserving stock when an order is placed."""
+    
+    @staticmethod
+    def order(*items):
+        return {
+            "customer": {"firstName": "Anna", "lastName": "Berg", "email": "anna@example.com", "payment": "swish"},
+            "items": [
+                {"id": pid, "name": "Item", "price": 100, "quantity": quantity, "selectedSize": size}
+                for pid, size, quantity in items
+            ],
+        }
+    
+    @staticmethod
+    def stock(db_file):
+        conn = sqlite3.connect(db_file)
+        rows = conn.execute("SELECT id, sizes FROM products ORDER BY id").fetchall()
+        conn.close()
+        return {pid: json.loads(sizes) for pid, sizes in rows}
+    
+    def test_out_of_stock_line_rejects_whole_order(self, client, test_db_with_data, monkeypatch):
+        from app.config import settings
+        monkeypatch.setattr(settings, "DB_FILE", test_db_with_data)
+        before = self.stock(test_db_with_data)
+        
+        response = client.post("/checkout", json=self.order((2, "S", 1), (1, "180", 2), (1, "180", 2)))
+        
+        assert response.status_code == 409
+        assert response.json()["detail"]["shortages"] == [
+            {"id": 1, "size": "180", "requested": 4, "available": 3}
+        ]
+        assert self.stock(test_db_with_data) == before
+        conn = sqlite3.connect(test_db_with_data)
+        assert conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0] == 0
+        assert conn.execute("SELECT COUNT(*) FROM email_outbox").fetchone()[0] == 0
+        conn.close()
+    
+    def test_unknown_size_is_rejected(self, client, test_db_with_data, monkeypatch):
+        from app.config import settings
+        monkeypatch.setattr(settings, "DB_FILE", test_db_with_data)
+        
+        response = client.post("/checkout", json=self.order((1, "200", 1)))
+        
+        assert response.status_code == 409
+    
+    def test_last_item_can_be_bought(self, client, test_db_with_data, monkeypatch):
+        from app.config import settings
+        monkeypatch.setattr(settings, "DB_FILE", test_db_with_data)
+        
+        assert client.post("/checkout", json=self.order((1, "170", 7))).status_code == 200
+        assert self.stock(test_db_with_data)[1]["170"] == {"online": 0, "club": 0}
+        assert client.post("/checkout", json=self.order((1, "170", 1))).status_code == 409
+    
+    def test_confirm_payment_out_of_stock_refunds(self, client, test_db_with_data, monkeypatch, fake_stripe):
+        from app.config import settings
+        monkeypatch.setattr(settings, "DB_FILE", test_db_with_data)
+        fake_stripe.pay("pi_sold_out", amount=1200000)
+        
+        response = client.post("/confirm-payment", json={
+            "payment_intent_id": "pi_sold_out",
+            "order": self.order((1, "170", 8)),
+        })
+        
+        assert response.status_code == 409
+        assert fake_stripe.calls("POST", "/v1/refunds") == [{"payment_intent": "pi_sold_out"}]
+        conn = sqlite3.connect(test_db_with_data)
+        assert conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0] == 0
+        conn.close()
+    
+    def test_parallel_checkouts_never_oversell(self, client, test_db_with_data, monkeypatch):
+        """Hundreds of concurrent buyers of scarce stock: every unit is sold at most once."""
+        from concurrent.futures import ThreadPoolExecutor
+        from app.config import settings
+        monkeypatch.setattr(settings, "DB_FILE", test_db_with_data)
+        conn = sqlite3.connect(test_db_with_data)
+        conn.execute("UPDATE products SET sizes = ? WHERE id = 1", (json.dumps({"170": {"online": 30, "club": 10}}),))
+        conn.execute("UPDATE products SET sizes = ? WHERE id = 2", (json.dumps({"S": {"online": 25, "club": 0}}),))
+        conn.commit()
+        conn.close()
+        
+        # Every order needs both products, so a partial reservation would show
+        # up as differing sales of the two
+        orders = [self.order((1, "170", 1 + n % 2), (2, "S", 1)) for n in range(300)]
+        with ThreadPoolExecutor(max_workers=32) as pool:
+            responses = list(pool.map(lambda order: client.post("/checkout", json=order), orders))
+        
+        statuses = [response.status_code for response in responses]
+        assert set(statuses) <= {200, 409}
+        accepted = [order for order, status in zip(orders, statuses) if status == 200]
+        gi_sold = sum(order["items"][0]["quantity"] for order in accepted)
+        belts_sold = len(accepted)
+        
+        stock = self.stock(test_db_with_data)
+        assert gi_sold + stock[1]["170"]["online"] + stock[1]["170"]["club"] == 40
+        assert belts_sold + stock[2]["S"]["online"] == 25
+        assert min(stock[1]["170"].values()) >= 0 and stock[2]["S"]["online"] >= 0
+        # Stock ran out, so most buyers were turned away
+        assert statuses.count(409) >= 275
+        
+        conn = sqlite3.connect(test_db_with_data)
+        assert conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0] == len(accepted)
+        sold = dict(conn.execute("SELECT product_id, SUM(quantity) FROM order_items GROUP BY product_id").fetchall())
+        conn.close()
+        assert sold == {1: gi_sold, 2: belts_sold}
+
+
+class TestOrderEmail:
+    """Tests for composing the order notification email."""
+    
+    ITEMS = [
+        {"id": 1, "name": "Judo Gi White", "price": 1500, "quantity": 1, "selectedSize": "170"},
+        {"id": 1, "name": "Judo Gi White", "price": 1500, "quantity": 1, "selectedSize": "200"},
+    ]
+    
+    def test_uses_preloaded_products_without_queries(self, app_with_test_db, test_db_with_data):
+        from app.services.email import EmailService
+        from app.services.inventory import InventoryService
+        conn = sqlite3.connect(test_db_with_data)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        products = InventoryService.get_products(cursor, [1])
+        statements = []
+        conn.set_trace_callback(statements.append)
+        
+        body = EmailService.compose_order_email({"firstName": "Anna"}, self.ITEMS, "swish", cursor, products)
+        conn.close()
+        
+        assert statements == []
+        lines = body.splitlines()
+        assert "Storlek finns ej i lager" not in lines[-2]
+        assert "Storlek finns ej i lager" in lines[-1]
+    
+    def test_looks_up_sizes_with_one_query(self, app_with_test_db, test_db_with_data):
+        from app.services.email import EmailService
+        conn = sqlite3.connect(test_db_with_data)
+        conn.row_factory = sqlite3.Row
+        statements = []
+        conn.set_trace_callback(statements.append)
+        
+        body = EmailService.compose_order_email({"firstName": "Anna"}, self.ITEMS, "swish", conn.cursor())
+        conn.close()
+        
+        assert len(statements) == 1
+        assert body.count("Storlek finns ej i lager") == 1
+    
+    def test_failed_lookup_closes_connection_and_is_logged(self, app_with_test_db, test_db_with_data, monkeypatch, capsys):
+        from app.services import email
+        from app.services.inventory import InventoryService
+        connections = []
+        
+        def tracking_get_db():
+            conn = sqlite3.connect(test_db_with_data)
+            conn.row_factory = sqlite3.Row
+            connections.append(conn)
+            return conn
+        
+        def failing_get_products(cursor, product_ids):
+            raise sqlite3.OperationalError("database is locked")
+        
+        monkeypatch.setattr("app.database.get_db", tracking_get_db)
+        monkeypatch.setattr(InventoryService, "get_products", failing_get_products)
+        
+        body = email.EmailService.compose_order_email({"firstName": "Anna"}, self.ITEMS, "swish")
+        
+        assert "Storlek finns ej i lager" not in body
+        assert len(connections) == 1
+        with pytest.raises(sqlite3.ProgrammingError):
+            connections[0].execute("SELECT 1")
+        assert "database is locked" in capsys.readouterr().out
+    
+    def test_checkout_reads_products_once(self, client, test_db_with_data, monkeypatch):
+        """Reserving stock, saving the order and composing its email share one product lookup."""
+        from app.config import settings
+        from app import database
+        monkeypatch.setattr(settings, "DB_FILE", test_db_with_data)
+        statements = []
+        connect = database.sqlite3.connect
+        
+        def traced_connect(*args, **kwargs):
+            conn = connect(*args, **kwargs)
+            conn.set_trace_callback(statements.append)
+            return conn
+        
+        order_data = {
+            "customer": {"firstName": "Anna", "lastName": "Berg", "email": "anna@example.com", "payment": "swish"},
+            "items": [
+                {"id": 1, "name": "Judo Gi White", "price": 1500, "quantity": 1, "selectedSize": "170"},
+                {"id": 1, "name": "Judo Gi White", "price": 1500, "quantity": 1, "selectedSize": "180"},
+                {"id": 2, "name": "Black Belt", "price": 250, "quantity": 1, "selectedSize": "S"},
+            ],
+        }
+        with patch.object(database.sqlite3, "connect", traced_connect):
+            response = client.post("/checkout", json=order_data)
+        
+        assert response.status_code == 200
+        product_reads = [s for s in statements if "FROM products" in s]
+        # One read prices the cart, the other serves the whole order transaction
+        assert len(product_reads) == 2
+        assert len([s for s in product_reads if "cost" in s]) == 1
 
 
 class TestConfirmPayment:
     """Tests for payment confirmation endpoint."""
     
-    @patch("stripe.PaymentIntent.retrieve")
-    @patch("app.services.email.EmailService.send_order_notification")
-    def test_confirm_payment_success(self, mock_email, mock_retrieve, client, test_db_with_data, monkeypatch):
+    def test_confirm_payment_success(self, client, test_db_with_data, monkeypatch, fake_stripe):
         """Should confirm payment and process order."""
         from app.config import settings
         monkeypatch.setattr(settings, "DB_FILE", test_db_with_data)
         
-        mock_intent = MagicMock()
-        mock_intent.status = "succeeded"
-        mock_retrieve.return_value = mock_intent
+        fake_stripe.pay("pi_test_123", amount=150000)
         
         payment_data = {
             "payment_intent_id": "pi_test_123",
@@ -185,13 +422,15 @@ class TestConfirmPayment:
         
         assert response.status_code == 200
         assert "Payment confirmed" in response.json()["message"]
+        
+        conn = sqlite3.connect(test_db_with_data)
+        subject = conn.execute("SELECT subject FROM email_outbox").fetchone()[0]
+        conn.close()
+        assert "Stripe" in subject
     
-    @patch("stripe.PaymentIntent.retrieve")
-    def test_confirm_payment_not_succeeded(self, mock_retrieve, client):
+    def test_confirm_payment_not_succeeded(self, client, fake_stripe):
         """Should reject if payment not succeeded."""
-        mock_intent = MagicMock()
-        mock_intent.status = "requires_payment_method"
-        mock_retrieve.return_value = mock_intent
+        fake_stripe.pay("pi_test_123", status="requires_payment_method")
         
         payment_data = {
             "payment_intent_id": "pi_test_123",
@@ -206,16 +445,12 @@ class TestConfirmPayment:
         assert response.status_code == 400
         assert "Payment not completed" in response.json()["detail"]
     
-    @patch("stripe.PaymentIntent.retrieve")
-    @patch("app.services.email.EmailService.send_order_notification")
-    def test_confirm_payment_updates_stock(self, mock_email, mock_retrieve, client, test_db_with_data, monkeypatch):
+    def test_confirm_payment_updates_stock(self, client, test_db_with_data, monkeypatch, fake_stripe):
         """Should update stock levels after payment confirmation."""
         from app.config import settings
         monkeypatch.setattr(settings, "DB_FILE", test_db_with_data)
         
-        mock_intent = MagicMock()
-        mock_intent.status = "succeeded"
-        mock_retrieve.return_value = mock_intent
+        fake_stripe.pay("pi_test_123", amount=300000)
         
         payment_data = {
             "payment_intent_id": "pi_test_123",
@@ -263,9 +498,7 @@ class TestConfirmPayment:
 class TestCheckoutOrderValidation:
     """Tests for order data validation in checkout."""
     
-    @patch("app.services.email.EmailService.send_order_notification")
-    @patch("app.services.inventory.InventoryService.reduce_stock")
-    def test_checkout_with_empty_items(self, mock_reduce, mock_email, client):
+    def test_checkout_with_empty_items(self, client):
         """Should handle empty items list."""
         order_data = {
             "customer": {
@@ -277,14 +510,16 @@ class TestCheckoutOrderValidation:
             "items": []
         }
         
-        response = client.post("/checkout", json=order_data)
+        with patch("app.services.orders.OrderService.save_order", return_value=1) as mock_save:
+            response = client.post("/checkout", json=order_data)
         
-        # Should still succeed (email sent, no stock to reduce)
+        # Should still succeed (email queued, no stock to reduce)
         assert response.status_code == 200
+        assert mock_save.call_args[0][1] == []
     
-    @patch("app.services.email.EmailService.send_order_notification")
-    @patch("app.services.inventory.InventoryService.reduce_stock")
-    def test_checkout_extracts_payment_from_customer(self, mock_reduce, mock_email, client):
+    @patch("app.services.email.EmailService.queue_order_notification")
+    @patch("app.services.inventory.InventoryService.reserve_stock", return_value={})
+    def test_checkout_extracts_payment_from_customer(self, mock_reserve, mock_email, client):
         """Should extract payment method from customer data."""
         order_data = {
             "customer": {
@@ -300,6 +535,8 @@ class TestCheckoutOrderValidation:
         response = client.post("/checkout", json=order_data)
         
         assert response.status_code == 200
+        mock_reserve.assert_called_once()
+        assert mock_reserve.call_args[0][1] == []
         # Verify email was called with payment info
         call_args = mock_email.call_args
-        assert call_args[0][2] == "swish"  # Third argument is payment
+        assert call_args[0][3] == "swish"  # Fourth argument (after the cursor) is payment
@@ -0,0 +1,152 @@
+"""
+Tests for reusing one payment intent per checkout session.
+"""
+import json
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+
+@pytest.fixture
+def shop_db(client, test_db_with_data, monkeypatch):
+    """Products with 2 gis in size 180."""
+    from app.config import settings
+    monkeypatch.setattr(settings, "DB_FILE", test_db_with_data)
+    conn = sqlite3.connect(test_db_with_data)
+    conn.execute("UPDATE products SET sizes = ? WHERE id = 1", (json.dumps({"180": {"online": 1, "club": 1}}),))
+    conn.commit()
+    conn.close()
+    return test_db_with_data
+
+
+def cart(quantity, token="session-1", delivery_method="pickup"):
+    order = {
+        "total": 1500 * quantity,
+        "deliveryMethod": delivery_method,
+        "customer": {"firstName": "Anna", "lastName": "Berg", "email": "anna@example.com"},
+        "items": [{"id": 1, "name": "Judo Gi", "price": 1500, "quantity": quantity, "selectedSize": "180"}],
+    }
+    if token:
+        order["sessionToken"] = token
+    return order
+
+
+def holds(db_file):
+    conn = sqlite3.connect(db_file)
+    rows = conn.execute("SELECT reference, quantity FROM stock_holds ORDER BY id").fetchall()
+    conn.close()
+    return rows
+
+
+def stored_cart(db_file, payment_intent_id):
+    conn = sqlite3.connect(db_file)
+    row = conn.execute(
+        "SELECT order_data FROM stripe_payments WHERE payment_intent_id = ?", (payment_intent_id,)
+    ).fetchone()
+    conn.close()
+    return json.loads(row[0])
+
+
+class TestCheckoutSessions:
+    """Tests for payment intents reused across calls with one session token."""
+    
+    def test_unchanged_cart_reuses_intent_without_calling_stripe(self, client, shop_db, fake_stripe):
+        first = client.post("/create-payment-intent", json=cart(1))
+        second = client.post("/create-payment-intent", json=cart(1))
+        
+        assert first.status_code == second.status_code == 200
+        assert second.json()["client_secret"] == first.json()["client_secret"] == "pi_1_secret"
+        assert len(fake_stripe.requests) == 1
+        assert holds(shop_db) == [("pi_1", 1)]
+    
+    def test_changed_cart_updates_the_intent(self, client, shop_db, fake_stripe):
+        client.post("/create-payment-intent", json=cart(1))
+        
+        response = client.post("/create-payment-intent", json=cart(2, delivery_method="postnord"))
+        
+        assert response.json()["client_secret"] == "pi_1_secret"
+        assert fake_stripe.calls("POST", "/v1/payment_intents/pi_1")[0]["amount"] == "308200"
+        assert fake_stripe.intents["pi_1"]["amount"] == 308200
+        assert len(fake_stripe.intents) == 1
+        # The session's own hold does not count against the larger cart
+        assert holds(shop_db) == [("pi_1", 2)]
+        assert stored_cart(shop_db, "pi_1")["deliveryCost"] == 82
+    
+    def test_requests_without_token_create_new_intents(self, client, shop_db, fake_stripe):
+        client.post("/create-payment-intent", json=cart(1, token=None))
+        client.post("/create-payment-intent", json=cart(1, token=None))
+        
+        assert len(fake_stripe.intents) == 2
+    
+    def test_sessions_are_independent(self, client, shop_db, fake_stripe):
+        client.post("/create-payment-intent", json=cart(1, token="a"))
+        client.post("/create-payment-intent", json=cart(1, token="b"))
+        
+        assert holds(shop_db) == [("pi_1", 1), ("pi_2", 1)]
+    
+    def test_paid_session_starts_a_new_intent(self, client, shop_db, fake_stripe):
+        client.post("/create-payment-intent", json=cart(1))
+        fake_stripe.pay("pi_1")
+        client.post("/confirm-payment", json={"payment_intent_id": "pi_1", "order": cart(1)})
+        
+        response = client.post("/create-payment-intent", json=cart(1))
+        
+        assert response.json()["client_secret"] == "pi_2_secret"
+    
+    def test_intent_that_cannot_be_updated_is_replaced(self, client, shop_db, fake_stripe):
+        client.post("/create-payment-intent", json=cart(1))
+        # Being paid at Stripe, but the order has not been saved yet
+        fake_stripe.pay("pi_1", status="processing")
+        
+        response = client.post("/create-payment-intent", json=cart(1, delivery_method="postnord"))
+        
+        assert response.status_code == 200
+        assert response.json()["client_secret"] == "pi_2_secret"
+    
+    def test_out_of_stock_cart_keeps_its_session(self, client, shop_db, fake_stripe):
+        from app.services.checkout_sessions import CheckoutSessionService
+        client.post("/create-payment-intent", json=cart(1))
+        # Someone else holds the other gi
+        client.post("/create-payment-intent", json=cart(1, token="other"))
+        
+        response = client.post("/create-payment-intent", json=cart(2))
+        
+        assert response.status_code == 409
+        assert len(fake_stripe.requests) == 2
+        assert CheckoutSessionService.get("session-1")["payment_intent_id"] == "pi_1"
+        assert holds(shop_db) == [("pi_1", 1), ("pi_2", 1)]
+    
+    def test_hold_lost_to_a_race_drops_the_session(self, client, shop_db, fake_stripe):
+        from unittest.mock import patch
+        from app.services.checkout_sessions import CheckoutSessionService
+        client.post("/create-payment-intent", json=cart(1))
+        client.post("/create-payment-intent", json=cart(1, token="other"))
+        
+        with patch("app.services.inventory.InventoryService.check_stock", return_value=[]):
+            response = client.post("/create-payment-intent", json=cart(2))
+        
+        assert response.status_code == 409
+        assert fake_stripe.intents["pi_1"]["status"] == "canceled"
+        assert CheckoutSessionService.get("session-1") is None
+        assert holds(shop_db) == [("pi_2", 1)]
+    
+    def test_expired_session_starts_over_and_is_purged(self, client, shop_db, fake_stripe):
+        from app.services.checkout_sessions import CheckoutSessionService
+        client.post("/create-payment-intent", json=cart(1))
+        conn = sqlite3.connect(shop_db)
+        past = (datetime.utcnow() - timedelta(seconds=1)).isoformat(timespec="microseconds")
+        conn.execute("UPDATE checkout_sessions SET expires_at = ?", (past,))
+        conn.commit()
+        conn.close()
+        
+        assert CheckoutSessionService.purge_expired(force=True) == 1
+        response = client.post("/create-payment-intent", json=cart(1))
+        
+        assert response.json()["client_secret"] == "pi_2_secret"
+    
+    def test_overlong_token_is_rejected(self, client, shop_db, fake_stripe):
+        response = client.post("/create-payment-intent", json=cart(1, token="x" * 300))
+        
+        assert response.status_code == 400
+        assert fake_stripe.requests == []
@@ -0,0 +1,336 @@
+"""
+Tests for the notification email outbox and its background sender.
+"""
+import socketserver
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from email import message_from_string
+from email.header import decode_header, make_header
+
+import pytest
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    """
+    Minimal local SMTP server that records what it receives.
+    
+    Set reject_mail to answer MAIL FROM with a temporary failure, or
+    drop_after to hang up after that many messages on a connection.
+    """
+    
+    daemon_threads = True
+    allow_reuse_address = True
+    
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), SMTPStandInHandler)
+        self.messages = []
+        self.connections = 0
+        self.reject_mail = False
+        self.drop_after = None
+    
+    @property
+    def port(self):
+        return self.server_address[1]
+    
+    def subjects(self):
+        return [str(make_header(decode_header(message["Subject"]))) for message in self.messages]
+
+
+class SMTPStandInHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+    
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        received = 0
+        self.reply("220 stand-in ESMTP")
+        data, in_data = [], False
+        for raw in self.rfile:
+            line = raw.decode("utf-8", "replace").rstrip("\r\n")
+            if in_data:
+                if line == ".":
+                    in_data = False
+                    server.messages.append(message_from_string("\n".join(data)))
+                    data = []
+                    received += 1
+                    self.reply("250 OK queued")
+                    if server.drop_after is not None and received >= server.drop_after:
+                        return
+                else:
+                    data.append(line[1:] if line.startswith("..") else line)
+                continue
+            
+            command = line[:4].upper()
+            if command == "EHLO":
+                self.wfile.write(b"250-stand-in\r\n250 8BITMIME\r\n")
+            elif command == "MAIL" and server.reject_mail:
+                self.reply("451 Try again later")
+            elif command in ("HELO", "MAIL", "RCPT", "RSET", "NOOP"):
+                self.reply("250 OK")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                in_data = True
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+@pytest.fixture
+def smtp_server(app_with_test_db, monkeypatch):
+    """Point the outbox at a local SMTP stand-in."""
+    from app.config import settings
+    from app.services.email_outbox import EmailOutboxService
+    
+    server = SMTPStandIn()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(settings, "SMTP_SERVER", "127.0.0.1")
+    monkeypatch.setattr(settings, "SMTP_PORT", server.port)
+    monkeypatch.setattr(settings, "SMTP_STARTTLS", False)
+    monkeypatch.setattr(settings, "SMTP_PASSWORD", "")
+    monkeypatch.setattr(settings, "SMTP_USER", "shop@example.com")
+    monkeypatch.setattr(settings, "EMAIL_RECEIVER", "owner@example.com")
+    
+    yield server
+    
+    with EmailOutboxService._send_lock:
+        EmailOutboxService._close()
+    server.shutdown()
+    server.server_close()
+
+
+def enqueue(subject="Ny beställning", body="Hej", order_id=None):
+    from app.database import get_db_context
+    from app.services.email_outbox import EmailOutboxService
+    with get_db_context() as conn:
+        return EmailOutboxService.enqueue(conn.cursor(), subject, body, order_id=order_id)
+
+
+def outbox_row(message_id):
+    from app.config import settings
+    conn = sqlite3.connect(settings.DB_FILE)
+    conn.row_factory = sqlite3.Row
+    row = conn.execute("SELECT * FROM email_outbox WHERE id = ?", (message_id,)).fetchone()
+    conn.close()
+    return dict(row)
+
+
+def make_due(message_id):
+    """Move a scheduled retry to now."""
+    from app.config import settings
+    conn = sqlite3.connect(settings.DB_FILE)
+    conn.execute(
+        "UPDATE email_outbox SET next_attempt_at = ? WHERE id = ?",
+        (datetime.utcnow().isoformat(timespec="microseconds"), message_id)
+    )
+    conn.commit()
+    conn.close()
+
+
+class TestEmailOutbox:
+    """Tests for queueing and sending notification emails."""
+    
+    def test_sends_due_messages(self, smtp_server):
+        from app.services.email_outbox import EmailOutboxService
+        
+        message_id = enqueue(subject="Ny beställning på Yakimoto Dojo (Swish)", body="Produkter:\n- Judo Gi")
+        result = EmailOutboxService.send_due()
+        
+        assert result == {"claimed": 1, "sent": 1, "retrying": 0, "failed": 0}
+        assert smtp_server.subjects() == ["Ny beställning på Yakimoto Dojo (Swish)"]
+        message = smtp_server.messages[0]
+        assert message["To"] == "owner@example.com"
+        assert message["From"] == "shop@example.com"
+        assert "Judo Gi" in message.get_payload()[0].get_payload(decode=True).decode()
+        row = outbox_row(message_id)
+        assert (row["status"], row["attempts"]) == ("sent", 1)
+        assert row["sent_at"]
+    
+    def test_reuses_one_connection(self, smtp_server):
+        from app.services.email_outbox import EmailOutboxService
+        
+        for n in range(3):
+            enqueue(subject=f"Order {n}")
+        EmailOutboxService.send_due()
+        enqueue(subject="Order 3")
+        EmailOutboxService.send_due()
+        
+        assert smtp_server.subjects() == ["Order 0", "Order 1", "Order 2", "Order 3"]
+        assert smtp_server.connections == 1
+    
+    def test_idle_connection_is_replaced(self, smtp_server, monkeypatch):
+        from app.config import settings
+        from app.services.email_outbox import EmailOutboxService
+        
+        enqueue()
+        EmailOutboxService.send_due()
+        monkeypatch.setattr(settings, "SMTP_IDLE_SECONDS", 0)
+        enqueue()
+        EmailOutboxService.send_due()
+        
+        assert len(smtp_server.messages) == 2
+        assert smtp_server.connections == 2
+    
+    def test_reconnects_when_server_hangs_up(self, smtp_server):
+        from app.services.email_outbox import EmailOutboxService
+        smtp_server.drop_after = 1
+        
+        enqueue(subject="first")
+        enqueue(subject="second")
+        result = EmailOutboxService.send_due()
+        
+        assert result["sent"] == 2
+        assert smtp_server.subjects() == ["first", "second"]
+        assert smtp_server.connections == 2
+    
+    def test_failure_is_retried_with_backoff(self, smtp_server, monkeypatch):
+        from app.config import settings
+        from app.services.email_outbox import EmailOutboxService
+        monkeypatch.setattr(settings, "EMAIL_RETRY_BASE_SECONDS", 30)
+        smtp_server.reject_mail = True
+        
+        message_id = enqueue()
+        before = datetime.utcnow()
+        first = EmailOutboxService.send_due()
+        row = outbox_row(message_id)
+        
+        assert first["retrying"] == 1
+        assert (row["status"], row["attempts"]) == ("pending", 1)
+        assert "451" in row["last_error"]
+        delay = datetime.fromisoformat(row["next_attempt_at"]) - before
+        assert timedelta(seconds=29) < delay < timedelta(seconds=32)
+        # Not due yet
+        assert EmailOutboxService.send_due()["claimed"] == 0
+        
+        make_due(message_id)
+        EmailOutboxService.send_due()
+        delay = datetime.fromisoformat(outbox_row(message_id)["next_attempt_at"]) - datetime.utcnow()
+        assert timedelta(seconds=58) < delay < timedelta(seconds=61)
+        
+        smtp_server.reject_mail = False
+        make_due(message_id)
+        assert EmailOutboxService.send_due()["sent"] == 1
+        assert outbox_row(message_id)["status"] == "sent"
+        assert len(smtp_server.messages) == 1
+    
+    def test_backoff_is_capped(self, monkeypatch):
+        from app.config import settings
+        from app.services.email_outbox import EmailOutboxService
+        monkeypatch.setattr(settings, "EMAIL_RETRY_BASE_SECONDS", 30)
+        monkeypatch.setattr(settings, "EMAIL_RETRY_MAX_SECONDS", 600)
+        
+        assert [EmailOutboxService.backoff_seconds(n) for n in range(1, 7)] == [30, 60, 120, 240, 480, 600]
+    
+    def test_gives_up_after_max_attempts(self, smtp_server, monkeypatch):
+        from app.config import settings
+        from app.services.email_outbox import EmailOutboxService
+        monkeypatch.setattr(settings, "EMAIL_MAX_ATTEMPTS", 2)
+        smtp_server.reject_mail = True
+        
+        message_id = enqueue()
+        EmailOutboxService.send_due()
+        make_due(message_id)
+        result = EmailOutboxService.send_due()
+        
+        assert result["failed"] == 1
+        assert outbox_row(message_id)["status"] == "failed"
+        make_due(message_id)
+        assert EmailOutboxService.send_due()["claimed"] == 0
+    
+    def test_unreachable_server_keeps_message(self, smtp_server, monkeypatch):
+        from app.config import settings
+        from app.services.email_outbox import EmailOutboxService
+        monkeypatch.setattr(settings, "SMTP_PORT", 1)
+        
+        message_id = enqueue()
+        result = EmailOutboxService.send_due()
+        
+        assert result["retrying"] == 1
+        assert outbox_row(message_id)["status"] == "pending"
+    
+    def test_leased_message_is_not_sent_twice(self, smtp_server):
+        from app.services.email_outbox import EmailOutboxService
+        
+        message_id = enqueue()
+        claimed = EmailOutboxService._claim(10)
+        
+        assert [row["id"] for row in claimed] == [message_id]
+        assert outbox_row(message_id)["status"] == "sending"
+        assert EmailOutboxService.send_due()["claimed"] == 0
+        
+        # A sender that died mid-send: the lease runs out and the message is retried
+        make_due(message_id)
+        assert EmailOutboxService.send_due()["sent"] == 1
+    
+    def test_rolled_back_order_sends_nothing(self, smtp_server):
+        from app.database import get_db_context
+        from app.services.email_outbox import EmailOutboxService
+        
+        with pytest.raises(RuntimeError):
+            with get_db_context() as conn:
+                EmailOutboxService.enqueue(conn.cursor(), "subject", "body")
+                raise RuntimeError("order failed")
+        
+        assert EmailOutboxService.send_due()["claimed"] == 0
+    
+    def test_checkout_email_is_delivered(self, client, smtp_server, test_db_with_data, monkeypatch):
+        from app.config import settings
+        from app.services.email_outbox import EmailOutboxService
+        monkeypatch.setattr(settings, "DB_FILE", test_db_with_data)
+        
+        response = client.post("/checkout", json={
+            "customer": {"firstName": "Anna", "lastName": "Berg", "email": "anna@example.com", "payment": "swish"},
+            "items": [{"id": 1, "name": "Judo Gi", "price": 1500, "quantity": 1, "selectedSize": "170"}],
+        })
+        
+        assert response.status_code == 200
+        assert smtp_server.messages == []
+        EmailOutboxService.send_due()
+        assert smtp_server.subjects() == ["Ny beställning på Yakimoto Dojo (Swish)"]
+    
+    def test_worker_sends_in_background(self, smtp_server, monkeypatch):
+        import time
+        from app.services.email_outbox import EmailOutboxService
+        
+        assert EmailOutboxService.start_worker()
+        try:
+            enqueue(subject="background")
+            EmailOutboxService.notify()
+            deadline = time.monotonic() + 5
+            while not smtp_server.messages and time.monotonic() < deadline:
+                time.sleep(0.02)
+        finally:
+            EmailOutboxService.stop_worker()
+            EmailOutboxService._worker.join(timeout=5)
+        
+        assert smtp_server.subjects() == ["background"]
+    
+    def test_worker_needs_smtp_server(self, app_with_test_db, monkeypatch):
+        from app.config import settings
+        from app.services.email_outbox import EmailOutboxService
+        monkeypatch.setattr(settings, "SMTP_SERVER", "")
+        
+        assert EmailOutboxService.start_worker() is False
+    
+    def test_admin_stats_and_retry(self, client, smtp_server, auth_headers, monkeypatch):
+        from app.config import settings
+        from app.services.email_outbox import EmailOutboxService
+        monkeypatch.setattr(settings, "EMAIL_MAX_ATTEMPTS", 1)
+        smtp_server.reject_mail = True
+        message_id = enqueue()
+        EmailOutboxService.send_due()
+        
+        stats = client.get("/admin/email-outbox", headers=auth_headers).json()
+        
+        assert stats["counts"]["failed"] == 1
+        assert stats["recent_failures"][0]["id"] == message_id
+        
+        smtp_server.reject_mail = False
+        assert client.post(f"/admin/email-outbox/{message_id}/retry", headers=auth_headers).status_code == 200
+        EmailOutboxService.send_due()
+        assert client.post(f"/admin/email-outbox/{message_id}/retry", headers=auth_headers).status_code == 404
+        assert client.get("/admin/email-outbox", headers=auth_headers).json()["counts"]["sent"] == 1
@@ -0,0 +1,198 @@
+"""
+Tests for Idempotency-Key handling on order endpoints.
+"""
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+import pytest
+
+
+@pytest.fixture
+def shop_db(client, test_db_with_data, monkeypatch):
+    from app.config import settings
+    monkeypatch.setattr(settings, "DB_FILE", test_db_with_data)
+    return test_db_with_data
+
+
+def order(quantity=1, size="170"):
+    return {
+        "customer": {"firstName": "Anna", "lastName": "Berg", "email": "anna@example.com", "payment": "swish"},
+        "items": [{"id": 1, "name": "Judo Gi", "price": 1500, "quantity": quantity, "selectedSize": size}],
+    }
+
+
+def counts(db_file):
+    conn = sqlite3.connect(db_file)
+    orders = conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+    emails = conn.execute("SELECT COUNT(*) FROM email_outbox").fetchone()[0]
+    sizes = json.loads(conn.execute("SELECT sizes FROM products WHERE id = 1").fetchone()[0])
+    conn.close()
+    return orders, emails, sizes["170"]["online"] + sizes["170"]["club"]
+
+
+def set_key_times(db_file, column, moment):
+    conn = sqlite3.connect(db_file)
+    conn.execute(f"UPDATE idempotency_keys SET {column} = ?", (moment.isoformat(timespec="microseconds"),))
+    conn.commit()
+    conn.close()
+
+
+class TestIdempotencyKeys:
+    """Tests for replaying stored responses to retried requests."""
+    
+    def test_retry_returns_stored_response(self, client, shop_db):
+        headers = {"Idempotency-Key": "order-1"}
+        
+        first = client.post("/checkout", json=order(), headers=headers)
+        second = client.post("/checkout", json=order(), headers=headers)
+        
+        assert first.status_code == second.status_code == 200
+        assert second.json() == first.json()
+        assert "idempotent-replayed" not in first.headers
+        assert second.headers["idempotent-replayed"] == "true"
+        assert counts(shop_db) == (1, 1, 6)
+    
+    def test_requests_without_key_run_every_time(self, client, shop_db):
+        client.post("/checkout", json=order())
+        client.post("/checkout", json=order())
+        
+        assert counts(shop_db) == (2, 2, 5)
+    
+    def test_different_keys_are_independent(self, client, shop_db):
+        client.post("/checkout", json=order(), headers={"Idempotency-Key": "a"})
+        client.post("/checkout", json=order(), headers={"Idempotency-Key": "b"})
+        
+        assert counts(shop_db) == (2, 2, 5)
+    
+    def test_key_reused_with_other_body_is_rejected(self, client, shop_db):
+        headers = {"Idempotency-Key": "order-1"}
+        client.post("/checkout", json=order(1), headers=headers)
+        
+        response = client.post("/checkout", json=order(2), headers=headers)
+        
+        assert response.status_code == 422
+        assert counts(shop_db) == (1, 1, 6)
+    
+    def test_overlong_key_is_rejected(self, client, shop_db):
+        response = client.post("/checkout", json=order(), headers={"Idempotency-Key": "x" * 300})
+        
+        assert response.status_code == 400
+    
+    def test_concurrent_duplicates_wait_for_the_first(self, client, shop_db):
+        from app.services.email import EmailService
+        original = EmailService.queue_order_notification.__func__
+        
+        def slow_queue(cls, *args, **kwargs):
+            time.sleep(0.3)
+            return original(cls, *args, **kwargs)
+        
+        with patch.object(EmailService, "queue_order_notification", classmethod(slow_queue)):
+            with ThreadPoolExecutor(max_workers=10) as pool:
+                responses = list(pool.map(
+                    lambda _: client.post("/checkout", json=order(), headers={"Idempotency-Key": "double-click"}),
+                    range(10)
+                ))
+        
+        assert [r.status_code for r in responses] == [200] * 10
+        assert sum("idempotent-replayed" in r.headers for r in responses) == 9
+        assert counts(shop_db) == (1, 1, 6)
+    
+    def test_server_error_is_not_stored(self, client, shop_db):
+        headers = {"Idempotency-Key": "order-1"}
+        with patch("app.services.orders.OrderService.save_order", side_effect=RuntimeError("disk full")):
+            assert client.post("/checkout", json=order(), headers=headers).status_code == 500
+        
+        response = client.post("/checkout", json=order(), headers=headers)
+        
+        assert response.status_code == 200
+        assert "idempotent-replayed" not in response.headers
+        assert counts(shop_db) == (1, 1, 6)
+    
+    def test_client_error_is_replayed(self, client, shop_db):
+        headers = {"Idempotency-Key": "too-many"}
+        
+        first = client.post("/checkout", json=order(8), headers=headers)
+        second = client.post("/checkout", json=order(8), headers=headers)
+        
+        assert first.status_code == second.status_code == 409
+        assert second.headers["idempotent-replayed"] == "true"
+    
+    def test_confirm_payment_runs_once(self, client, shop_db, fake_stripe):
+        payment = {"payment_intent_id": "pi_1", "order": order()}
+        headers = {"Idempotency-Key": "confirm-pi_1"}
+        fake_stripe.pay("pi_1", amount=150000)
+        
+        first = client.post("/confirm-payment", json=payment, headers=headers)
+        second = client.post("/confirm-payment", json=payment, headers=headers)
+        
+        assert first.status_code == second.status_code == 200
+        assert len(fake_stripe.calls("GET", "/v1/payment_intents/pi_1")) == 1
+        assert counts(shop_db) == (1, 1, 6)
+    
+    def test_manual_orders_are_scoped_to_the_caller(self, client, shop_db, auth_headers):
+        from app.config import settings
+        import jwt
+        body = {"customer_name": "Anna Berg", "items": [{"product_id": 1, "name": "Judo Gi", "price": 1500}]}
+        other_token = jwt.encode(
+            {"admin": True, "exp": datetime.utcnow() + timedelta(hours=1), "n": 2},
+            settings.JWT_SECRET, algorithm=settings.JWT_ALGORITHM
+        )
+        
+        first = client.post("/orders", json=body, headers={**auth_headers, "Idempotency-Key": "manual"})
+        again = client.post("/orders", json=body, headers={**auth_headers, "Idempotency-Key": "manual"})
+        other = client.post(
+            "/orders", json=body,
+            headers={"Authorization": f"Bearer {other_token}", "Idempotency-Key": "manual"}
+        )
+        
+        assert again.json() == first.json()
+        assert other.json()["order_id"] != first.json()["order_id"]
+        assert counts(shop_db)[0] == 2
+    
+    def test_expired_key_runs_again_and_is_purged(self, client, shop_db):
+        from app.services.idempotency import IdempotencyService
+        headers = {"Idempotency-Key": "order-1"}
+        client.post("/checkout", json=order(), headers=headers)
+        set_key_times(shop_db, "expires_at", datetime.utcnow() - timedelta(seconds=1))
+        
+        assert IdempotencyService.purge_expired(force=True) == 1
+        response = client.post("/checkout", json=order(), headers=headers)
+        
+        assert "idempotent-replayed" not in response.headers
+        assert counts(shop_db)[0] == 2
+    
+    def test_abandoned_request_can_be_taken_over(self, client, shop_db):
+        from app.services.idempotency import IdempotencyService
+        body = json.dumps(order()).encode()
+        scope = IdempotencyService.scope("POST", "/checkout", "", "order-1")
+        assert IdempotencyService.claim(scope, IdempotencyService.request_hash(body)) is None
+        # The process handling it died without storing a response
+        set_key_times(shop_db, "locked_until", datetime.utcnow() - timedelta(seconds=1))
+        
+        response = client.post(
+            "/checkout", content=body,
+            headers={"Idempotency-Key": "order-1", "Content-Type": "application/json"}
+        )
+        
+        assert response.status_code == 200
+        assert counts(shop_db)[0] == 1
+    
+    def test_gives_up_waiting_on_a_stuck_request(self, client, shop_db, monkeypatch):
+        from app.config import settings
+        from app.services.idempotency import IdempotencyService
+        monkeypatch.setattr(settings, "IDEMPOTENCY_WAIT_SECONDS", 0.1)
+        body = json.dumps(order()).encode()
+        scope = IdempotencyService.scope("POST", "/checkout", "", "order-1")
+        IdempotencyService.claim(scope, IdempotencyService.request_hash(body))
+        
+        response = client.post(
+            "/checkout", content=body,
+            headers={"Idempotency-Key": "order-1", "Content-Type": "application/json"}
+        )
+        
+        assert response.status_code == 409
+        assert counts(shop_db)[0] == 0
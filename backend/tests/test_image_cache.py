@@ -0,0 +1,252 @@
+"""
+Tests for on-demand image variants, their disk cache and image delivery.
+"""
+import io
+import os
+import threading
+import time
+from unittest.mock import patch
+
+from PIL import Image
+
+from app.services.image_paths import ImagePaths
+from tests.conftest import make_jpeg
+
+
+class TestImageVariantEndpoint:
+    """Tests for the /img/{filename} endpoint."""
+    
+    def test_variant_rendered_and_cached(self, client, uploaded_image):
+        """First request should render the variant and write it to the cache."""
+        from app.config import settings
+        from app.services.image_cache import ImageVariantCache
+        
+        response = client.get(f"/img/{uploaded_image}?w=400")
+        
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "image/jpeg"
+        assert "immutable" in response.headers["cache-control"]
+        assert Image.open(io.BytesIO(response.content)).size == (400, 320)
+        assert os.listdir(settings.IMAGE_CACHE_DIR) == [
+            ImageVariantCache.variant_filename(uploaded_image, 400, None, "contain", "jpeg")
+        ]
+    
+    def test_cache_hit_does_not_render(self, client, uploaded_image):
+        """Second request should be served from disk without re-rendering."""
+        from app.services.image import ImageService
+        
+        client.get(f"/img/{uploaded_image}?w=400")
+        with patch.object(ImageService, "render_variant") as mock_render:
+            response = client.get(f"/img/{uploaded_image}?w=400")
+        
+        assert response.status_code == 200
+        mock_render.assert_not_called()
+    
+    def test_disallowed_size(self, client, uploaded_image):
+        """Sizes outside the allow-list should be rejected."""
+        response = client.get(f"/img/{uploaded_image}?w=401")
+        
+        assert response.status_code == 400
+    
+    def test_invalid_format(self, client, uploaded_image):
+        """Unknown formats should be rejected."""
+        response = client.get(f"/img/{uploaded_image}?w=400&fmt=gif")
+        
+        assert response.status_code == 400
+    
+    def test_missing_original(self, client, app_with_test_db):
+        """Missing originals should return 404."""
+        response = client.get("/img/does-not-exist.jpg?w=400")
+        
+        assert response.status_code == 404
+    
+    def test_webp_variant(self, client, uploaded_image):
+        """WebP variants should be served with the WebP media type."""
+        response = client.get(f"/img/{uploaded_image}?w=160&h=160&fit=cover&fmt=webp")
+        
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "image/webp"
+        assert Image.open(io.BytesIO(response.content)).size == (160, 160)
+
+
+class TestImageVariantCache:
+    """Tests for cache eviction and request coalescing."""
+    
+    def test_lru_eviction(self, uploaded_image, monkeypatch):
+        """Least recently used variants should be evicted over the cap."""
+        from app.config import settings
+        from app.services.image_cache import ImageVariantCache
+        
+        first = ImageVariantCache.get_variant(uploaded_image, 160, None)
+        second = ImageVariantCache.get_variant(uploaded_image, 320, None)
+        third = ImageVariantCache.get_variant(uploaded_image, 480, None)
+        third_size = os.path.getsize(third)
+        os.remove(third)
+        ImageVariantCache.reset()
+        
+        # Make the first entry the most recently used
+        os.utime(second, (time.time() - 60, time.time() - 60))
+        ImageVariantCache.get_variant(uploaded_image, 160, None)
+        
+        # Room for the first and third entries, but not all three
+        monkeypatch.setattr(
+            settings, "IMAGE_CACHE_MAX_BYTES",
+            int((os.path.getsize(first) + third_size) / ImageVariantCache.EVICT_TARGET_RATIO) + 1
+        )
+        third = ImageVariantCache.get_variant(uploaded_image, 480, None)
+        
+        assert os.path.exists(first)
+        assert not os.path.exists(second)
+        assert os.path.exists(third)
+    
+    def test_concurrent_requests_render_once(self, uploaded_image):
+        """Concurrent requests for the same variant should share one render."""
+        from app.services.image import ImageService
+        from app.services.image_cache import ImageVariantCache
+        
+        original_render = ImageService.render_variant
+        calls = []
+        
+        def slow_render(*args, **kwargs):
+            calls.append(1)
+            time.sleep(0.2)
+            return original_render(*args, **kwargs)
+        
+        results = []
+        with patch.object(ImageService, "render_variant", side_effect=slow_render):
+            threads = [
+                threading.Thread(
+                    target=lambda: results.append(ImageVariantCache.get_variant(uploaded_image, 640, None))
+                )
+                for _ in range(8)
+            ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        
+        assert len(calls) == 1
+        assert len(set(results)) == 1
+    
+    def test_render_lock_kept_while_requests_wait(self, uploaded_image):
+        """Requests queued behind a render should share its lock until the last one is through."""
+        from app.services.image import ImageService
+        from app.services.image_cache import ImageVariantCache
+        
+        original_render = ImageService.render_variant
+        rendering = threading.Event()
+        release = threading.Event()
+        calls = []
+        
+        def blocking_render(*args, **kwargs):
+            calls.append(1)
+            rendering.set()
+            release.wait(5)
+            return original_render(*args, **kwargs)
+        
+        name = ImageVariantCache.variant_filename(uploaded_image, 640, None, "contain", "jpeg")
+        with patch.object(ImageService, "render_variant", side_effect=blocking_render):
+            threads = [
+                threading.Thread(target=ImageVariantCache.get_variant, args=(uploaded_image, 640, None))
+                for _ in range(3)
+            ]
+            threads[0].start()
+            assert rendering.wait(5)
+            for t in threads[1:]:
+                t.start()
+            deadline = time.time() + 5
+            while ImageVariantCache._inflight[name].users < 3 and time.time() < deadline:
+                time.sleep(0.01)
+            assert ImageVariantCache._inflight[name].users == 3
+            release.set()
+            for t in threads:
+                t.join()
+        
+        assert len(calls) == 1
+        assert ImageVariantCache._inflight == {}
+    
+    def test_stale_entry_found_without_scanning(self, uploaded_image, monkeypatch):
+        """A miss after a profile change should find the older entry through the index."""
+        from app.config import settings
+        from app.services.image import ImageService
+        from app.services.image_cache import ImageVariantCache
+        
+        old_path = ImageVariantCache.get_variant(uploaded_image, 320, None)
+        monkeypatch.setattr(settings, "IMAGE_QUALITY", 60)
+        
+        with patch("app.services.image_cache.os.scandir", side_effect=AssertionError("scanned")), \
+                patch.object(ImageService, "render_variant") as render:
+            assert ImageVariantCache.get_variant(uploaded_image, 320, None) == old_path
+        render.assert_not_called()
+        
+        # An entry removed behind the cache's back is dropped from the index
+        os.remove(old_path)
+        new_path = ImageVariantCache.get_variant(uploaded_image, 320, None)
+        
+        assert new_path != old_path
+        assert os.path.exists(new_path)
+
+
+class TestImageDelivery:
+    """Tests for caching headers, conditional requests and X-Accel-Redirect."""
+    
+    def test_originals_cached_forever_with_strong_etag(self, client, app_with_test_db):
+        import hashlib
+        from app.services.image import ImageService
+        
+        filename, _ = ImageService.save_product_image(make_jpeg(), "photo.jpg")
+        response = client.get(f"/uploads/{filename}")
+        
+        assert response.status_code == 200
+        assert response.headers["cache-control"] == "public, max-age=31536000, immutable"
+        assert response.headers["etag"] == f'"{hashlib.sha256(response.content).hexdigest()[:32]}"'
+    
+    def test_conditional_request_returns_304(self, client, app_with_test_db):
+        from app.services.image import ImageService
+        
+        filename, thumbnail = ImageService.save_product_image(make_jpeg(), "photo.jpg")
+        for url in (f"/uploads/{filename}", f"/thumbnails/{thumbnail}", f"/img/{filename}?w=160"):
+            etag = client.get(url).headers["etag"]
+            
+            not_modified = client.get(url, headers={"If-None-Match": f'"other", W/{etag}'})
+            changed = client.get(url, headers={"If-None-Match": '"other"'})
+            
+            assert not_modified.status_code == 304
+            assert not_modified.content == b""
+            assert not_modified.headers["etag"] == etag
+            assert changed.status_code == 200
+    
+    def test_rebuilt_thumbnail_gets_new_etag(self, client, app_with_test_db):
+        from app.services.image import ImageService
+        from app.services.storage import AREA_THUMBNAILS, get_storage
+        
+        _, thumbnail = ImageService.save_product_image(make_jpeg(), "photo.jpg")
+        first = client.get(f"/thumbnails/{thumbnail}").headers
+        get_storage().put(AREA_THUMBNAILS, thumbnail, make_jpeg(size=(40, 40)))
+        second = client.get(f"/thumbnails/{thumbnail}").headers
+        
+        assert "immutable" not in first["cache-control"]
+        assert first["etag"] != second["etag"]
+    
+    def test_accel_redirect_hands_transfer_to_nginx(self, client, app_with_test_db, monkeypatch):
+        from app.config import settings
+        from app.services.image import ImageService
+        monkeypatch.setattr(settings, "IMAGE_ACCEL_REDIRECT_PREFIX", "/_protected_images/")
+        
+        filename, thumbnail = ImageService.save_product_image(make_jpeg(), "photo.jpg")
+        upload = client.get(f"/uploads/{filename}")
+        thumb = client.get(f"/thumbnails/{thumbnail}")
+        variant = client.get(f"/img/{filename}?w=160&fmt=webp")
+        
+        first, second = ImagePaths.shard(filename)
+        assert upload.status_code == 200
+        assert upload.content == b""
+        assert upload.headers["x-accel-redirect"] == f"/_protected_images/{first}/{second}/{filename}"
+        assert upload.headers["content-type"] == "image/jpeg"
+        assert "immutable" in upload.headers["cache-control"]
+        assert thumb.headers["x-accel-redirect"].startswith("/_protected_images/thumbnails/")
+        assert variant.headers["x-accel-redirect"].startswith("/_protected_images/cache/")
+        assert variant.headers["content-type"] == "image/webp"
+    
+    def test_missing_file(self, client, app_with_test_db):
+        assert client.get("/thumbnails/missing_thumb.jpg").status_code == 404
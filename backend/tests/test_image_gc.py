@@ -0,0 +1,152 @@
+"""
+Tests for the image garbage collector.
+"""
+import os
+import time
+
+import pytest
+
+from app.services.image_paths import ImagePaths
+from tests.conftest import make_jpeg
+
+
+class TestImageGarbageCollector:
+    """Tests for orphaned image row and file cleanup."""
+    
+    @pytest.fixture
+    def garbage(self, app_with_test_db, test_db_with_data):
+        """Leave behind a deleted product's rows plus stray files on disk."""
+        import sqlite3
+        from app.config import settings
+        
+        old = time.time() - 3 * 24 * 3600
+        files = {
+            "live": os.path.join(settings.UPLOAD_DIR, "test_image_1.jpg"),
+            "dangling": os.path.join(settings.UPLOAD_DIR, "deleted_product.jpg"),
+            "dangling_thumb": os.path.join(settings.THUMBNAIL_DIR, "deleted_product_thumb.jpg"),
+            "stray": os.path.join(settings.UPLOAD_DIR, "failed_upload.jpg"),
+            "tmp": os.path.join(settings.THUMBNAIL_DIR, ".tmp-abc"),
+            "fresh": os.path.join(settings.UPLOAD_DIR, "just_uploaded.jpg"),
+        }
+        for name, path in files.items():
+            with open(path, "wb") as f:
+                f.write(b"x" * 100)
+            if name != "fresh":
+                os.utime(path, (old, old))
+        
+        conn = sqlite3.connect(test_db_with_data)
+        conn.execute(
+            "INSERT INTO product_images (product_id, filename, is_main) VALUES (999, 'deleted_product.jpg', 1)"
+        )
+        conn.execute("INSERT INTO product_categories (product_id, category_id) VALUES (999, 1)")
+        conn.commit()
+        conn.close()
+        return files
+    
+    def _count(self, db_file, sql):
+        import sqlite3
+        conn = sqlite3.connect(db_file)
+        count = conn.execute(sql).fetchone()[0]
+        conn.close()
+        return count
+    
+    def test_dry_run_reports_without_deleting(self, garbage, test_db_with_data):
+        from app.services.image_gc import ImageGarbageCollector
+        
+        report = ImageGarbageCollector.collect(dry_run=True)
+        
+        assert report["dangling_rows"] == {
+            "product_images": 1, "product_sizes": 0, "product_categories": 1
+        }
+        assert report["orphan_files"] == 4
+        assert report["reclaimed_bytes"] == 400
+        assert all(os.path.exists(path) for path in garbage.values())
+        assert self._count(test_db_with_data, "SELECT COUNT(*) FROM product_images WHERE product_id = 999") == 1
+    
+    def test_collect_deletes_in_batches(self, garbage, test_db_with_data):
+        from app.services.image_gc import ImageGarbageCollector
+        
+        report = ImageGarbageCollector.collect(dry_run=False, batch_size=1)
+        
+        assert report["orphan_files"] == 4
+        assert report["reclaimed_bytes"] == 400
+        for name in ("dangling", "dangling_thumb", "stray", "tmp"):
+            assert not os.path.exists(garbage[name])
+        assert os.path.exists(garbage["live"])
+        assert os.path.exists(garbage["fresh"])
+        assert self._count(test_db_with_data, "SELECT COUNT(*) FROM product_images WHERE product_id = 999") == 0
+        assert self._count(test_db_with_data, "SELECT COUNT(*) FROM product_categories WHERE product_id = 999") == 0
+        
+        again = ImageGarbageCollector.collect(dry_run=False)
+        assert again["orphan_files"] == 0
+        assert sum(again["dangling_rows"].values()) == 0
+    
+    def test_file_referenced_after_scan_is_kept(self, garbage, test_db_with_data, monkeypatch):
+        """A file an upload claims between the scan and the delete should survive."""
+        import sqlite3
+        from app.services.image_gc import ImageGarbageCollector
+        scan = ImageGarbageCollector._orphan_files
+        
+        def scan_then_reuse(referenced, cutoff):
+            orphans = scan(referenced, cutoff)
+            conn = sqlite3.connect(test_db_with_data)
+            conn.execute("INSERT INTO product_images (product_id, filename, is_main) VALUES (1, 'failed_upload.jpg', 0)")
+            conn.commit()
+            conn.close()
+            return orphans
+        
+        monkeypatch.setattr(ImageGarbageCollector, "_orphan_files", staticmethod(scan_then_reuse))
+        report = ImageGarbageCollector.collect(dry_run=False)
+        
+        assert report["orphan_files"] == 4
+        assert report["kept_files"] == 1
+        assert os.path.exists(garbage["stray"])
+        assert not os.path.exists(garbage["dangling"])
+    
+    def test_grace_period_can_be_overridden(self, garbage):
+        from app.services.image_gc import ImageGarbageCollector
+        
+        report = ImageGarbageCollector.collect(dry_run=True, grace_seconds=0)
+        
+        assert garbage["fresh"] in report["files"]
+    
+    def test_admin_endpoint_defaults_to_dry_run(self, client, garbage, test_db_with_data, auth_headers, monkeypatch):
+        from app.config import settings
+        monkeypatch.setattr(settings, "DB_FILE", test_db_with_data)
+        
+        response = client.post("/admin/image-gc", headers=auth_headers)
+        
+        assert response.status_code == 200
+        assert response.json()["dry_run"] is True
+        assert os.path.exists(garbage["stray"])
+    
+    def test_delete_product_removes_images(self, client, test_db_with_data, auth_headers, monkeypatch):
+        """Deleting a product should remove its image rows and unshared files."""
+        import sqlite3
+        from app.config import settings
+        from app.services.image import ImageService
+        monkeypatch.setattr(settings, "DB_FILE", test_db_with_data)
+        
+        own, own_thumb = ImageService.save_product_image(make_jpeg(color=(1, 2, 3)), "a.jpg")
+        shared, _ = ImageService.save_product_image(make_jpeg(color=(4, 5, 6)), "b.jpg")
+        conn = sqlite3.connect(test_db_with_data)
+        conn.execute("INSERT INTO product_images (product_id, filename) VALUES (1, ?)", (own,))
+        conn.execute("INSERT INTO product_images (product_id, filename) VALUES (1, ?)", (shared,))
+        conn.execute("INSERT INTO product_images (product_id, filename) VALUES (2, ?)", (shared,))
+        conn.commit()
+        conn.close()
+        
+        response = client.delete("/products/1", headers=auth_headers)
+        
+        assert response.status_code == 200
+        assert self._count(test_db_with_data, "SELECT COUNT(*) FROM product_images WHERE product_id = 1") == 0
+        assert not ImagePaths.exists(settings.UPLOAD_DIR, own)
+        assert not ImagePaths.exists(settings.THUMBNAIL_DIR, own_thumb)
+        assert ImagePaths.exists(settings.UPLOAD_DIR, shared)
+    
+    def test_scheduler_disabled_with_zero_interval(self, monkeypatch):
+        from app.config import settings
+        from app.services.image_gc import ImageGarbageCollector
+        monkeypatch.setattr(settings, "IMAGE_GC_INTERVAL_SECONDS", 0)
+        
+        assert ImageGarbageCollector.start_scheduler() is False
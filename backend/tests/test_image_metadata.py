@@ -0,0 +1,99 @@
+"""
+Tests for the persisted image metadata.
+"""
+import os
+
+from app.services.image_paths import ImagePaths
+from tests.conftest import make_jpeg
+
+
+class TestImageMetadata:
+    """Tests for the persisted image metadata table."""
+    
+    def _metadata(self, db_file):
+        import sqlite3
+        conn = sqlite3.connect(db_file)
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute("SELECT * FROM image_metadata ORDER BY variant").fetchall()
+        conn.close()
+        return {row["variant"]: dict(row) for row in rows}
+    
+    def test_upload_records_metadata(self, app_with_test_db, test_db_with_data):
+        """Saving an upload should record both stored files."""
+        import hashlib
+        import sqlite3
+        from app.config import settings
+        from app.services.image import ImageService
+        
+        conn = sqlite3.connect(test_db_with_data)
+        conn.row_factory = sqlite3.Row
+        filename, thumbnail = ImageService.save_product_image(
+            make_jpeg(size=(2400, 1200)), "a.jpg", conn.cursor()
+        )
+        conn.commit()
+        conn.close()
+        
+        metadata = self._metadata(test_db_with_data)
+        original = metadata["original"]
+        assert (original["filename"], original["width"], original["height"]) == (filename, 1920, 960)
+        assert original["format"] == "JPEG"
+        with open(ImagePaths.resolve(settings.UPLOAD_DIR, filename), "rb") as f:
+            data = f.read()
+        assert original["bytes"] == len(data)
+        assert original["content_hash"] == hashlib.sha256(data).hexdigest()
+        assert original["created_at"]
+        
+        thumb = metadata["thumbnail"]
+        assert (thumb["source_filename"], thumb["filename"]) == (filename, thumbnail)
+        assert (thumb["width"], thumb["height"]) == (400, 200)
+    
+    def test_release_removes_metadata(self, app_with_test_db, test_db_with_data):
+        """Deleting the last reference should drop the metadata too."""
+        import sqlite3
+        from app.services.image import ImageService
+        
+        conn = sqlite3.connect(test_db_with_data)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        filename, _ = ImageService.save_product_image(make_jpeg(), "a.jpg", cursor)
+        ImageService.release_image(cursor, filename)
+        conn.commit()
+        conn.close()
+        
+        assert self._metadata(test_db_with_data) == {}
+    
+    def test_product_response_has_dimensions(
+        self, client, test_db_with_data, auth_headers, monkeypatch
+    ):
+        """Products should expose the stored dimensions of their images."""
+        from app.config import settings
+        monkeypatch.setattr(settings, "DB_FILE", test_db_with_data)
+        
+        response = client.post(
+            "/products",
+            data={"name": "Bild", "price": "100", "sizes": "{}"},
+            files=[("images", ("a.jpg", make_jpeg(size=(1000, 800)), "image/jpeg"))],
+            headers=auth_headers,
+        )
+        assert response.status_code == 200
+        product_id = response.json()["id"]
+        
+        product = client.get(f"/products/{product_id}").json()
+        
+        assert product["image_dimensions"] == {
+            product["images"][0]: {"width": 1000, "height": 800}
+        }
+    
+    def test_backfill_records_existing_files(self, client, stored_originals, auth_headers):
+        """The backfill should record originals and thumbnails already on disk."""
+        from app.config import settings
+        
+        with open(os.path.join(settings.THUMBNAIL_DIR, "test_image_1_thumb.jpg"), "wb") as f:
+            f.write(make_jpeg(size=(400, 320)))
+        
+        backfill = client.post("/admin/backfill-image-metadata", headers=auth_headers).json()
+        again = client.post("/admin/backfill-image-metadata", headers=auth_headers).json()
+        
+        assert (backfill["originals"], backfill["thumbnails"]) == (2, 1)
+        assert (again["originals"], again["thumbnails"]) == (0, 0)
+        assert self._metadata(stored_originals)["thumbnail"]["width"] == 400
@@ -0,0 +1,207 @@
+"""
+Tests for image profile versions and re-rendering of stale files.
+"""
+import io
+import os
+from unittest.mock import patch
+
+import pytest
+from PIL import Image
+
+from app.services.image_paths import ImagePaths
+from tests.conftest import make_jpeg
+
+
+class TestImageProfiles:
+    """Tests for profile versioning and background re-rendering of stale files."""
+    
+    @pytest.fixture
+    def stored(self, client, test_db_with_data, monkeypatch):
+        """Store originals and current thumbnails for the two images of the test data."""
+        import sqlite3
+        from app.config import settings
+        from app.services.image import ImageService
+        from app.services.image_metadata import ImageMetadataService
+        from app.services.storage import AREA_ORIGINALS, AREA_THUMBNAILS, get_storage
+        monkeypatch.setattr(settings, "IMAGE_REFRESH_CPU_BUDGET", 1.0)
+        
+        storage = get_storage()
+        conn = sqlite3.connect(test_db_with_data)
+        conn.row_factory = sqlite3.Row
+        for filename in ("test_image_1.jpg", "test_image_2.jpg"):
+            storage.put(AREA_ORIGINALS, filename, make_jpeg())
+            thumbnail = ImageService.create_thumbnail(make_jpeg())
+            storage.put(AREA_THUMBNAILS, ImagePaths.thumbnail_name(filename), thumbnail)
+            ImageMetadataService.record(
+                conn.cursor(), filename, "thumbnail", ImagePaths.thumbnail_name(filename), thumbnail,
+                profile_version=self._version("thumbnail")
+            )
+        conn.commit()
+        conn.close()
+        return test_db_with_data
+    
+    def _version(self, profile):
+        from app.services.image_profiles import ImageProfiles
+        return ImageProfiles.version(profile)
+    
+    def _thumbnail_size(self, filename):
+        from app.services.storage import AREA_THUMBNAILS, get_storage
+        return Image.open(io.BytesIO(get_storage().get(AREA_THUMBNAILS, ImagePaths.thumbnail_name(filename)))).size
+    
+    def test_version_follows_profile_settings(self, monkeypatch):
+        from app.config import settings
+        
+        before = {profile: self._version(profile) for profile in ("original", "thumbnail", "variant")}
+        monkeypatch.setattr(settings, "THUMBNAIL_SIZE", (300, 300))
+        after = {profile: self._version(profile) for profile in ("original", "thumbnail", "variant")}
+        
+        assert after["thumbnail"] != before["thumbnail"]
+        assert after["original"] == before["original"]
+        assert after["variant"] == before["variant"]
+        
+        monkeypatch.setattr(settings, "IMAGE_TARGET_SSIM", 0.98)
+        assert self._version("variant") != before["variant"]
+    
+    def test_upload_records_profile_version(self, app_with_test_db, test_db_with_data):
+        import sqlite3
+        from app.services.image import ImageService
+        
+        conn = sqlite3.connect(test_db_with_data)
+        conn.row_factory = sqlite3.Row
+        ImageService.save_product_image(make_jpeg(), "a.jpg", conn.cursor())
+        rows = dict(conn.execute("SELECT variant, profile_version FROM image_metadata").fetchall())
+        conn.close()
+        
+        assert rows == {"original": self._version("original"), "thumbnail": self._version("thumbnail")}
+    
+    def test_changed_thumbnail_size_rerenders_thumbnails(self, stored, monkeypatch):
+        import sqlite3
+        from app.config import settings
+        from app.services.image_refresh import ImageProfileRefresher
+        
+        assert ImageProfileRefresher.run(throttle=False)["thumbnails"] == 0
+        
+        monkeypatch.setattr(settings, "THUMBNAIL_SIZE", (200, 200))
+        with sqlite3.connect(stored) as conn:
+            conn.row_factory = sqlite3.Row
+            assert ImageProfileRefresher.stale_thumbnails(conn.cursor()) == ["test_image_1.jpg", "test_image_2.jpg"]
+        # Old thumbnails are still in place until the worker gets to them
+        assert self._thumbnail_size("test_image_1.jpg") == (400, 320)
+        
+        report = ImageProfileRefresher.run(throttle=False)
+        
+        assert report["thumbnails"] == 2
+        assert report["errors"] == []
+        assert self._thumbnail_size("test_image_1.jpg") == (200, 160)
+        conn = sqlite3.connect(stored)
+        conn.row_factory = sqlite3.Row
+        row = conn.execute(
+            "SELECT width, profile_version FROM image_metadata WHERE source_filename = ? AND variant = 'thumbnail'",
+            ("test_image_1.jpg",)
+        ).fetchone()
+        placeholder = conn.execute(
+            "SELECT placeholder FROM product_images WHERE filename = ?", ("test_image_1.jpg",)
+        ).fetchone()["placeholder"]
+        conn.close()
+        assert (row["width"], row["profile_version"]) == (200, self._version("thumbnail"))
+        assert placeholder.startswith("data:image/webp;base64,")
+        assert ImageProfileRefresher.run(throttle=False)["thumbnails"] == 0
+    
+    def test_limit_refreshes_incrementally(self, stored, monkeypatch):
+        from app.config import settings
+        from app.services.image_refresh import ImageProfileRefresher
+        monkeypatch.setattr(settings, "THUMBNAIL_SIZE", (200, 200))
+        
+        assert ImageProfileRefresher.run(limit=1, throttle=False)["thumbnails"] == 1
+        assert ImageProfileRefresher.run(limit=1, throttle=False)["thumbnails"] == 1
+        assert ImageProfileRefresher.run(limit=1, throttle=False)["thumbnails"] == 0
+    
+    def test_stale_variant_served_until_replaced(self, client, stored, monkeypatch):
+        from app.config import settings
+        from app.services.image import ImageService
+        from app.services.image_cache import ImageVariantCache
+        from app.services.image_refresh import ImageProfileRefresher
+        
+        first = client.get("/img/test_image_1.jpg?w=320")
+        old_name = ImageVariantCache.variant_filename("test_image_1.jpg", 320, None, "contain", "jpeg")
+        monkeypatch.setattr(settings, "IMAGE_QUALITY", 60)
+        new_name = ImageVariantCache.variant_filename("test_image_1.jpg", 320, None, "contain", "jpeg")
+        
+        with patch.object(ImageService, "render_variant", wraps=ImageService.render_variant) as render:
+            stale = client.get("/img/test_image_1.jpg?w=320")
+        render.assert_not_called()
+        assert stale.content == first.content
+        assert [entry[2] for entry in ImageProfileRefresher.stale_variants()] == [
+            ImageVariantCache.parse_variant_filename(old_name)
+        ]
+        
+        report = ImageProfileRefresher.run(throttle=False)
+        
+        assert report["variants"] == 1
+        assert os.listdir(settings.IMAGE_CACHE_DIR) == [new_name]
+        assert ImageProfileRefresher.stale_variants() == []
+    
+    def test_stale_variant_rendered_when_refresher_disabled(self, client, stored, monkeypatch):
+        from app.config import settings
+        from app.services.image import ImageService
+        
+        client.get("/img/test_image_1.jpg?w=320")
+        monkeypatch.setattr(settings, "IMAGE_QUALITY", 60)
+        monkeypatch.setattr(settings, "IMAGE_REFRESH_INTERVAL_SECONDS", 0)
+        
+        with patch.object(ImageService, "render_variant", wraps=ImageService.render_variant) as render:
+            client.get("/img/test_image_1.jpg?w=320")
+        
+        render.assert_called_once()
+    
+    def test_unreferenced_stale_variant_is_dropped(self, stored):
+        from app.config import settings
+        from app.services.image_refresh import ImageProfileRefresher
+        
+        path = os.path.join(settings.IMAGE_CACHE_DIR, "gone_320x0_contain.jpg")
+        with open(path, "wb") as f:
+            f.write(make_jpeg())
+        
+        report = ImageProfileRefresher.run(throttle=False)
+        
+        assert report["variants"] == 0
+        assert not os.path.exists(path)
+    
+    def test_parse_variant_filename(self):
+        from app.services.image_cache import ImageVariantCache
+        
+        name = ImageVariantCache.variant_filename("ab_cd.jpg", None, 480, "cover", "webp")
+        
+        assert ImageVariantCache.parse_variant_filename(name) == {
+            "base": "ab_cd", "width": None, "height": 480, "fit": "cover", "fmt": "webp",
+            "version": self._version("variant"),
+        }
+        assert ImageVariantCache.parse_variant_filename("ab_160x0_contain.jpg")["version"] is None
+        assert ImageVariantCache.parse_variant_filename("notes.txt") is None
+    
+    def test_throttle_keeps_to_cpu_budget(self, monkeypatch):
+        from app.config import settings
+        from app.services.image_refresh import ImageProfileRefresher
+        monkeypatch.setattr(settings, "IMAGE_REFRESH_CPU_BUDGET", 0.25)
+        
+        with patch.object(ImageProfileRefresher._stop, "wait") as wait:
+            ImageProfileRefresher._throttle(0.1)
+        
+        assert wait.call_args.args[0] == pytest.approx(0.3)
+    
+    def test_status_endpoint(self, client, stored, auth_headers, monkeypatch):
+        from app.config import settings
+        monkeypatch.setattr(settings, "THUMBNAIL_SIZE", (200, 200))
+        
+        response = client.get("/admin/image-profiles", headers=auth_headers)
+        
+        assert response.status_code == 200
+        status = response.json()
+        assert status["versions"]["thumbnail"] == self._version("thumbnail")
+        assert status["stale"]["thumbnails"] == 2
+        assert status["running"] is False
+    
+    def test_refresh_endpoint_needs_running_worker(self, client, auth_headers):
+        response = client.post("/admin/image-profiles/refresh", headers=auth_headers)
+        
+        assert response.status_code == 409
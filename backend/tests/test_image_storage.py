@@ -0,0 +1,344 @@
+"""
+Tests for content-addressed image storage and the sharded layout.
+"""
+import os
+import time
+from unittest.mock import patch
+
+from app.services.image_paths import ImagePaths
+from tests.conftest import make_jpeg
+
+
+class TestContentAddressedStorage:
+    """Tests for hash-named image storage and reference counting."""
+    
+    def test_same_upload_reuses_file(self, app_with_test_db):
+        """Uploading identical bytes twice should store a single file."""
+        from app.config import settings
+        from app.services.image import ImageService
+        
+        image_bytes = make_jpeg()
+        first, first_thumb = ImageService.save_product_image(image_bytes, "a.jpg")
+        with patch.object(ImageService, "optimize_image") as mock_optimize, \
+                patch.object(ImageService, "create_thumbnail") as mock_thumbnail:
+            second, second_thumb = ImageService.save_product_image(image_bytes, "b.jpg")
+        
+        assert first == second
+        assert first_thumb == second_thumb
+        mock_optimize.assert_not_called()
+        mock_thumbnail.assert_not_called()
+        stored = [name for name, _ in ImagePaths.iter_files(settings.UPLOAD_DIR)]
+        assert stored.count(first) == 1
+    
+    def test_different_uploads_get_different_names(self, app_with_test_db):
+        """Different images should not collide."""
+        from app.services.image import ImageService
+        
+        first, _ = ImageService.save_product_image(make_jpeg(color=(0, 0, 0)), "a.jpg")
+        second, _ = ImageService.save_product_image(make_jpeg(color=(255, 255, 255)), "a.jpg")
+        
+        assert first != second
+    
+    def test_release_keeps_file_while_referenced(self, app_with_test_db, test_db_with_data):
+        """A shared file should only be removed when its last reference goes."""
+        import sqlite3
+        from app.config import settings
+        from app.services.image import ImageService
+        
+        filename, thumbnail = ImageService.save_product_image(make_jpeg(), "a.jpg")
+        conn = sqlite3.connect(test_db_with_data)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO product_images (product_id, filename, is_main) VALUES (1, ?, 0)", (filename,)
+        )
+        cursor.execute("UPDATE categories SET image_filename = ? WHERE id = 1", (filename,))
+        
+        cursor.execute("DELETE FROM product_images WHERE filename = ?", (filename,))
+        assert ImageService.release_image(cursor, filename) is False
+        assert ImagePaths.exists(settings.UPLOAD_DIR, filename)
+        
+        cursor.execute("UPDATE categories SET image_filename = NULL WHERE id = 1")
+        assert ImageService.release_image(cursor, filename) is True
+        # Files go only once the transaction has committed
+        assert ImagePaths.exists(settings.UPLOAD_DIR, filename)
+        conn.commit()
+        conn.close()
+        
+        assert ImageService.delete_released([filename]) == [filename]
+        assert not ImagePaths.exists(settings.UPLOAD_DIR, filename)
+        assert not ImagePaths.exists(settings.THUMBNAIL_DIR, thumbnail)
+    
+    def test_rolled_back_release_keeps_files(self, app_with_test_db, test_db_with_data):
+        """A release whose transaction rolls back should leave the files in place."""
+        import sqlite3
+        from app.config import settings
+        from app.services.image import ImageService
+        
+        filename, thumbnail = ImageService.save_product_image(make_jpeg(), "a.jpg")
+        conn = sqlite3.connect(test_db_with_data)
+        conn.row_factory = sqlite3.Row
+        conn.execute("INSERT INTO product_images (product_id, filename, is_main) VALUES (1, ?, 0)", (filename,))
+        conn.commit()
+        
+        conn.execute("DELETE FROM product_images WHERE filename = ?", (filename,))
+        assert ImageService.release_image(conn.cursor(), filename) is True
+        conn.rollback()
+        conn.close()
+        
+        assert ImagePaths.exists(settings.UPLOAD_DIR, filename)
+        assert ImagePaths.exists(settings.THUMBNAIL_DIR, thumbnail)
+    
+    def test_file_reused_after_release_is_kept(self, app_with_test_db, test_db_with_data):
+        """A file referenced again between release and deletion should survive."""
+        import sqlite3
+        from app.config import settings
+        from app.services.image import ImageService
+        
+        filename, _ = ImageService.save_product_image(make_jpeg(), "a.jpg")
+        conn = sqlite3.connect(test_db_with_data)
+        conn.row_factory = sqlite3.Row
+        assert ImageService.release_image(conn.cursor(), filename) is True
+        conn.commit()
+        
+        # Another upload of the same photo, committed before the files are deleted
+        cursor = conn.cursor()
+        ImageService.save_product_image(make_jpeg(), "b.jpg", cursor)
+        cursor.execute("INSERT INTO product_images (product_id, filename, is_main) VALUES (2, ?, 0)", (filename,))
+        conn.commit()
+        conn.close()
+        
+        assert ImageService.delete_released([filename]) == []
+        assert ImagePaths.exists(settings.UPLOAD_DIR, filename)
+    
+    def test_reuse_touches_stored_files(self, app_with_test_db):
+        """Reusing a stored file should restart the garbage collector's grace period."""
+        from app.config import settings
+        from app.services.image import ImageService
+        
+        filename, thumbnail = ImageService.save_product_image(make_jpeg(), "a.jpg")
+        paths = [
+            ImagePaths.resolve(settings.UPLOAD_DIR, filename),
+            ImagePaths.resolve(settings.THUMBNAIL_DIR, thumbnail),
+        ]
+        old = time.time() - 3 * 24 * 3600
+        for path in paths:
+            os.utime(path, (old, old))
+        
+        ImageService.save_product_image(make_jpeg(), "b.jpg")
+        
+        assert all(os.stat(path).st_mtime > old + 3600 for path in paths)
+    
+    def test_delete_product_image_keeps_shared_file(
+        self, client, test_db_with_data, auth_headers, monkeypatch
+    ):
+        """Deleting an image from one product should not break another product."""
+        import sqlite3
+        from app.config import settings
+        from app.services.image import ImageService
+        monkeypatch.setattr(settings, "DB_FILE", test_db_with_data)
+        
+        filename, _ = ImageService.save_product_image(make_jpeg(), "a.jpg")
+        conn = sqlite3.connect(test_db_with_data)
+        for product_id in (1, 2):
+            conn.execute(
+                "INSERT INTO product_images (product_id, filename, is_main) VALUES (?, ?, 0)",
+                (product_id, filename)
+            )
+        conn.commit()
+        conn.close()
+        
+        response = client.delete(f"/products/1/images/{filename}", headers=auth_headers)
+        
+        assert response.status_code == 200
+        assert ImagePaths.exists(settings.UPLOAD_DIR, filename)
+        assert filename in client.get("/products/2").json()["images"]
+    
+    def _image_rows(self, db_file, product_id):
+        import sqlite3
+        conn = sqlite3.connect(db_file)
+        rows = conn.execute(
+            "SELECT filename, is_main FROM product_images WHERE product_id = ? ORDER BY id", (product_id,)
+        ).fetchall()
+        conn.close()
+        return rows
+    
+    def test_create_product_links_repeated_upload_once(
+        self, client, test_db_with_data, auth_headers, monkeypatch
+    ):
+        """The same photo uploaded twice with a new product should be linked once."""
+        from app.config import settings
+        monkeypatch.setattr(settings, "DB_FILE", test_db_with_data)
+        
+        response = client.post(
+            "/products",
+            data={"name": "Bild", "price": "100", "sizes": "{}"},
+            files=[
+                ("images", ("a.jpg", make_jpeg(), "image/jpeg")),
+                ("images", ("b.jpg", make_jpeg(), "image/jpeg")),
+                ("images", ("c.jpg", make_jpeg(color=(1, 2, 3)), "image/jpeg")),
+            ],
+            headers=auth_headers,
+        )
+        
+        rows = self._image_rows(test_db_with_data, response.json()["id"])
+        assert len(rows) == 2
+        assert [is_main for _, is_main in rows] == [1, 0]
+    
+    def test_upload_is_encoded_without_the_write_lock(
+        self, client, test_db_with_data, auth_headers, monkeypatch
+    ):
+        """Other writers should not wait for an image to be encoded."""
+        import sqlite3
+        from app.config import settings
+        from app.services.image import ImageService
+        monkeypatch.setattr(settings, "DB_FILE", test_db_with_data)
+        optimize = ImageService.optimize_image
+        writable = []
+        
+        def optimize_and_write(source, **kwargs):
+            conn = sqlite3.connect(test_db_with_data, timeout=0)
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.rollback()
+                writable.append(True)
+            except sqlite3.OperationalError:
+                writable.append(False)
+            finally:
+                conn.close()
+            return optimize(source, **kwargs)
+        
+        monkeypatch.setattr(ImageService, "optimize_image", staticmethod(optimize_and_write))
+        response = client.post(
+            "/products",
+            data={"name": "Bild", "price": "100", "sizes": "{}"},
+            files=[("images", ("a.jpg", make_jpeg(), "image/jpeg"))],
+            headers=auth_headers,
+        )
+        
+        assert response.status_code == 200
+        assert writable == [True]
+    
+    def test_file_deleted_before_recording_is_stored_again(self, app_with_test_db, test_db):
+        """A reused file removed before its reference is recorded should be written back."""
+        import sqlite3
+        from app.config import settings
+        from app.services.image import ImageService
+        
+        ImageService.save_product_image(make_jpeg(), "a.jpg")
+        stored = ImageService.store_product_image(make_jpeg(), "b.jpg")
+        ImageService.delete_image(stored["filename"])
+        
+        conn = sqlite3.connect(test_db)
+        conn.row_factory = sqlite3.Row
+        ImageService.record_product_image(conn.cursor(), stored)
+        conn.commit()
+        conn.close()
+        
+        assert os.path.exists(ImagePaths.resolve(settings.UPLOAD_DIR, stored["filename"]))
+        assert os.path.exists(ImagePaths.resolve(settings.THUMBNAIL_DIR, stored["thumbnail_filename"]))
+    
+    def test_update_makes_first_linked_upload_main(
+        self, client, test_db_with_data, auth_headers, monkeypatch
+    ):
+        """A skipped duplicate should not stop the next upload from becoming the main image."""
+        import sqlite3
+        from app.config import settings
+        from app.services.image import ImageService
+        monkeypatch.setattr(settings, "DB_FILE", test_db_with_data)
+        
+        existing, _ = ImageService.save_product_image(make_jpeg(), "a.jpg")
+        conn = sqlite3.connect(test_db_with_data)
+        conn.execute("DELETE FROM product_images WHERE product_id = 2")
+        conn.execute("INSERT INTO product_images (product_id, filename, is_main) VALUES (2, ?, 0)", (existing,))
+        conn.commit()
+        conn.close()
+        
+        response = client.put(
+            "/products/2",
+            data={"name": "Black Belt", "price": "300", "sizes": "{}"},
+            files=[
+                ("images", ("a.jpg", make_jpeg(), "image/jpeg")),
+                ("images", ("b.jpg", make_jpeg(color=(1, 2, 3)), "image/jpeg")),
+            ],
+            headers=auth_headers,
+        )
+        
+        assert response.status_code == 200
+        rows = self._image_rows(test_db_with_data, 2)
+        assert [(filename == existing, is_main) for filename, is_main in rows] == [(True, 0), (False, 1)]
+
+
+class TestShardedLayout:
+    """Tests for the sharded storage layout and the flat-layout migration."""
+    
+    def test_new_uploads_are_sharded(self, app_with_test_db):
+        from app.config import settings
+        from app.services.image import ImageService
+        
+        filename, thumbnail = ImageService.save_product_image(make_jpeg(), "photo.jpg")
+        
+        assert ImagePaths.resolve(settings.UPLOAD_DIR, filename) == ImagePaths.sharded_path(settings.UPLOAD_DIR, filename)
+        assert ImagePaths.resolve(settings.THUMBNAIL_DIR, thumbnail) == ImagePaths.sharded_path(settings.THUMBNAIL_DIR, thumbnail)
+        assert not os.path.exists(os.path.join(settings.UPLOAD_DIR, filename))
+    
+    def test_resolve_rejects_unsafe_names(self, tmp_path):
+        (tmp_path / ".hidden").write_bytes(b"x")
+        
+        assert ImagePaths.resolve(str(tmp_path), ".hidden") is None
+        assert ImagePaths.resolve(str(tmp_path), "../etc/passwd") is None
+        assert ImagePaths.resolve(str(tmp_path), "") is None
+    
+    def test_migrate_moves_flat_files_in_batches(self, tmp_path):
+        root = str(tmp_path)
+        names = [f"img_{i}.jpg" for i in range(5)]
+        for name in names:
+            (tmp_path / name).write_bytes(name.encode())
+        
+        first = ImagePaths.migrate(root, batch_size=3)
+        second = ImagePaths.migrate(root, batch_size=3)
+        
+        assert first == {"moved": 3, "remaining": 2}
+        assert second == {"moved": 2, "remaining": 0}
+        for name in names:
+            path = ImagePaths.resolve(root, name)
+            assert path == ImagePaths.sharded_path(root, name)
+            with open(path, "rb") as f:
+                assert f.read() == name.encode()
+        assert sorted(name for name, _ in ImagePaths.iter_files(root)) == names
+    
+    def test_both_layouts_served(self, client, app_with_test_db):
+        from app.config import settings
+        from app.services.image import ImageService
+        
+        sharded, thumbnail = ImageService.save_product_image(make_jpeg(), "new.jpg")
+        with open(os.path.join(settings.UPLOAD_DIR, "legacy.jpg"), "wb") as f:
+            f.write(make_jpeg(color=(0, 0, 255)))
+        
+        assert client.get(f"/uploads/{sharded}").status_code == 200
+        assert client.get(f"/thumbnails/{thumbnail}").status_code == 200
+        assert client.get("/uploads/legacy.jpg").status_code == 200
+        assert client.get("/uploads/missing.jpg").status_code == 404
+        assert client.get("/img/legacy.jpg?w=160").status_code == 200
+    
+    def test_migrate_endpoint(self, client, app_with_test_db, auth_headers):
+        from app.config import settings
+        
+        for i in range(3):
+            with open(os.path.join(settings.UPLOAD_DIR, f"legacy_{i}.jpg"), "wb") as f:
+                f.write(make_jpeg())
+        with open(os.path.join(settings.THUMBNAIL_DIR, "legacy_0_thumb.jpg"), "wb") as f:
+            f.write(make_jpeg())
+        
+        first = client.post("/admin/migrate-image-layout?batch_size=2", headers=auth_headers).json()
+        second = client.post("/admin/migrate-image-layout?batch_size=2", headers=auth_headers).json()
+        
+        assert (first["moved"], first["remaining"]) == (2, 2)
+        assert (second["moved"], second["remaining"]) == (2, 0)
+        assert client.get("/uploads/legacy_2.jpg").status_code == 200
+        assert ImagePaths.resolve(settings.THUMBNAIL_DIR, "legacy_0_thumb.jpg") == ImagePaths.sharded_path(
+            settings.THUMBNAIL_DIR, "legacy_0_thumb.jpg"
+        )
+    
+    def test_migrate_requires_auth(self, client):
+        assert client.post("/admin/migrate-image-layout").status_code == 422  # Missing auth header
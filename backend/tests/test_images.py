@@ -0,0 +1,450 @@
+"""
+Tests for image processing, placeholders and upload validation.
+"""
+import io
+import warnings
+from functools import lru_cache
+from unittest.mock import patch
+
+import pytest
+from PIL import Image, ImageOps
+
+from tests.conftest import make_jpeg
+
+
+@lru_cache(maxsize=None)
+def make_detailed_jpeg(size=(4000, 3000), orientation=None) -> bytes:
+    """Create a large JPEG with fine detail, like a full-resolution phone photo."""
+    detail = Image.effect_mandelbrot(size, (-2.0, -1.2, 0.8, 1.2), 64)
+    gradient = Image.linear_gradient("L").resize(size)
+    img = Image.merge("RGB", (detail, gradient, ImageOps.invert(detail)))
+    exif = Image.Exif()
+    if orientation:
+        exif[0x0112] = orientation
+    output = io.BytesIO()
+    img.save(output, format="JPEG", quality=95, exif=exif)
+    return output.getvalue()
+
+
+def full_decode_resize(image_bytes: bytes, size: tuple) -> Image.Image:
+    """Reference downscale: decode every pixel, then LANCZOS."""
+    img = Image.open(io.BytesIO(image_bytes))
+    img = ImageOps.exif_transpose(img).convert("RGB")
+    img.thumbnail(size, Image.Resampling.LANCZOS, reducing_gap=None)
+    return img
+
+
+class TestRenderVariant:
+    """Tests for ImageService.render_variant."""
+    
+    def test_contain_keeps_aspect_ratio(self):
+        """Contain fit should scale inside the box without cropping."""
+        from app.services.image import ImageService
+        
+        result = ImageService.render_variant(make_jpeg((1000, 800)), 400, 400, "contain", "jpeg")
+        
+        img = Image.open(io.BytesIO(result))
+        assert img.size == (400, 320)
+        assert img.format == "JPEG"
+    
+    def test_cover_fills_box(self):
+        """Cover fit should crop to exactly the requested size."""
+        from app.services.image import ImageService
+        
+        result = ImageService.render_variant(make_jpeg((1000, 800)), 400, 400, "cover", "jpeg")
+        
+        assert Image.open(io.BytesIO(result)).size == (400, 400)
+    
+    def test_width_only(self):
+        """Height should follow the aspect ratio when only width is given."""
+        from app.services.image import ImageService
+        
+        result = ImageService.render_variant(make_jpeg((1000, 800)), 320, None, "contain", "webp")
+        
+        img = Image.open(io.BytesIO(result))
+        assert img.size == (320, 256)
+        assert img.format == "WEBP"
+
+
+class TestFastDownscale:
+    """Tests for the JPEG draft/reduce downscale path."""
+    
+    @pytest.mark.parametrize("size", [(400, 400), (1920, 1920)])
+    def test_quality_matches_full_decode(self, size):
+        """Fast path output should be visually equivalent to a full decode."""
+        from app.services.image import ImageService
+        from app.services.image_quality import psnr, ssim
+        
+        image_bytes = make_detailed_jpeg()
+        reference = full_decode_resize(image_bytes, size)
+        
+        img, source_size = ImageService.load_scaled(image_bytes, size)
+        fast = img.resize(ImageService.fit_size(source_size, size), Image.Resampling.LANCZOS)
+        
+        assert fast.size == reference.size
+        assert psnr(reference, fast) >= 38
+        assert ssim(reference, fast) >= 0.98
+    
+    def test_encoded_thumbnail_quality(self):
+        """Encoded thumbnails should stay close to a full-decode thumbnail."""
+        from app.services.image import ImageService
+        from app.services.image_quality import psnr, ssim
+        
+        image_bytes = make_detailed_jpeg()
+        reference = full_decode_resize(image_bytes, (400, 400))
+        
+        thumbnail = Image.open(io.BytesIO(ImageService.create_thumbnail(image_bytes)))
+        
+        assert thumbnail.size == reference.size
+        assert psnr(reference, thumbnail) >= 30
+        assert ssim(reference, thumbnail) >= 0.95
+    
+    def test_jpeg_decoded_at_reduced_size(self):
+        """Large JPEGs should never be decoded at full resolution for a thumbnail."""
+        from app.services.image import ImageService
+        
+        img, source_size = ImageService.load_scaled(make_detailed_jpeg(), (400, 400))
+        
+        assert source_size == (4000, 3000)
+        assert img.size[0] <= 4000 // 4
+        assert img.size[0] >= 400
+    
+    def test_exif_rotation_respected(self):
+        """Rotated photos should come out in display orientation."""
+        from app.services.image import ImageService
+        
+        # Orientation 6: stored landscape, displayed portrait
+        image_bytes = make_detailed_jpeg((2000, 1500), orientation=6)
+        
+        result = Image.open(io.BytesIO(ImageService.create_thumbnail(image_bytes)))
+        
+        assert result.size == (300, 400)
+    
+    def test_small_images_not_upscaled(self):
+        """Images smaller than the target should keep their size."""
+        from app.services.image import ImageService
+        
+        result = Image.open(io.BytesIO(ImageService.optimize_image(make_jpeg((640, 480)))))
+        
+        assert result.size == (640, 480)
+
+
+class TestPlaceholders:
+    """Tests for low-quality image placeholders."""
+    
+    def test_placeholder_is_small_data_uri(self):
+        """Placeholders should be tiny inline WebP data URIs."""
+        import base64
+        from app.services.image import ImageService
+        
+        placeholder = ImageService.create_placeholder(make_detailed_jpeg())
+        
+        assert placeholder.startswith("data:image/webp;base64,")
+        assert len(placeholder) < 400
+        img = Image.open(io.BytesIO(base64.b64decode(placeholder.split(",", 1)[1])))
+        assert img.size == (16, 12)
+    
+    def test_placeholder_returned_with_product(self, client, test_db_with_data, monkeypatch):
+        """Product JSON should carry placeholders keyed by filename."""
+        import sqlite3
+        from app.config import settings
+        monkeypatch.setattr(settings, "DB_FILE", test_db_with_data)
+        
+        conn = sqlite3.connect(test_db_with_data)
+        conn.execute(
+            "UPDATE product_images SET placeholder = 'data:image/webp;base64,AAAA' WHERE filename = 'test_image_1.jpg'"
+        )
+        conn.commit()
+        conn.close()
+        
+        product = client.get("/products/1").json()
+        
+        assert product["image_placeholders"] == {"test_image_1.jpg": "data:image/webp;base64,AAAA"}
+    
+    def test_backfill_placeholders(self, client, stored_originals, auth_headers):
+        """Backfill should fill placeholders for product and category images."""
+        import sqlite3
+        
+        conn = sqlite3.connect(stored_originals)
+        conn.execute("UPDATE categories SET image_filename = 'test_image_2.jpg' WHERE id = 1")
+        conn.commit()
+        conn.close()
+        
+        response = client.post("/admin/generate-placeholders", headers=auth_headers)
+        
+        assert response.status_code == 200
+        assert response.json()["processed"] == 2
+        product = client.get("/products/1").json()
+        assert set(product["image_placeholders"]) == {"test_image_1.jpg", "test_image_2.jpg"}
+        category = client.get("/categories/Gi").json()
+        assert category["image_placeholder"].startswith("data:image/webp")
+
+
+class TestUploadValidation:
+    """Tests for header-only upload checks and size limits."""
+    
+    def _create(self, client, auth_headers, files):
+        return client.post(
+            "/products",
+            data={"name": "Bild", "price": "100", "sizes": "{}"},
+            files=files,
+            headers=auth_headers,
+        )
+    
+    def _product_count(self, db_file):
+        import sqlite3
+        conn = sqlite3.connect(db_file)
+        count = conn.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+        conn.close()
+        return count
+    
+    def test_non_image_rejected(self, client, test_db, auth_headers):
+        """Files that are not images should be rejected before anything is stored."""
+        response = self._create(
+            client, auth_headers, [("images", ("notes.jpg", b"not an image", "image/jpeg"))]
+        )
+        
+        assert response.status_code == 400
+        assert "not a valid image" in response.json()["detail"]
+        assert self._product_count(test_db) == 0
+    
+    def test_unsupported_format_rejected(self, client, auth_headers):
+        """Only the configured image formats should be accepted."""
+        output = io.BytesIO()
+        Image.new("RGB", (10, 10)).save(output, format="BMP")
+        
+        response = self._create(
+            client, auth_headers, [("images", ("a.bmp", output.getvalue(), "image/bmp"))]
+        )
+        
+        assert response.status_code == 400
+        assert "unsupported image format" in response.json()["detail"]
+    
+    def test_pixel_limit(self, client, test_db, auth_headers, monkeypatch):
+        """Images over the pixel limit should be rejected from the header alone."""
+        from app.config import settings
+        monkeypatch.setattr(settings, "MAX_UPLOAD_PIXELS", 1000 * 800 - 1)
+        
+        with patch("app.services.image.ImageService.load_scaled") as mock_load:
+            response = self._create(
+                client, auth_headers, [("images", ("a.jpg", make_jpeg(), "image/jpeg"))]
+            )
+        
+        assert response.status_code == 400
+        assert "dimensions too large" in response.json()["detail"]
+        mock_load.assert_not_called()
+        assert self._product_count(test_db) == 0
+    
+    def test_pixel_limit_only_applies_to_uploads(self, monkeypatch):
+        """Pillow's process-wide bomb limit is left alone for other decoding."""
+        from app.config import settings
+        from app.services.image import ImageService
+        assert Image.MAX_IMAGE_PIXELS != settings.MAX_UPLOAD_PIXELS
+        monkeypatch.setattr(settings, "MAX_UPLOAD_PIXELS", 1000)
+        
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", Image.DecompressionBombWarning)
+            img = ImageService.open_image(make_jpeg())
+            img.load()
+        
+        assert img.size == (1000, 800)
+    
+    def test_decompression_bomb(self, client, auth_headers, monkeypatch):
+        """Pillow's decompression bomb check should surface as a 400."""
+        monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 1000)
+        
+        response = self._create(
+            client, auth_headers, [("images", ("a.jpg", make_jpeg(), "image/jpeg"))]
+        )
+        
+        assert response.status_code == 400
+        assert "dimensions too large" in response.json()["detail"]
+    
+    def test_file_size_limit(self, client, auth_headers, monkeypatch):
+        """A single file over the per-file cap should get a 413."""
+        from app.config import settings
+        data = make_jpeg()
+        monkeypatch.setattr(settings, "MAX_UPLOAD_FILE_BYTES", len(data) - 1)
+        
+        response = self._create(
+            client, auth_headers, [("images", ("a.jpg", data, "image/jpeg"))]
+        )
+        
+        assert response.status_code == 413
+    
+    def test_request_size_limit(self, client, auth_headers, monkeypatch):
+        """Requests over the total cap should be refused before the body is parsed."""
+        from app.config import settings
+        monkeypatch.setattr(settings, "MAX_UPLOAD_REQUEST_BYTES", 10_000)
+        
+        with patch("app.services.image.ImageService.probe_uploads") as mock_probe:
+            response = self._create(
+                client, auth_headers,
+                [("images", (f"{i}.jpg", make_jpeg(color=(i, 0, 0)), "image/jpeg")) for i in range(3)]
+            )
+        
+        assert response.status_code == 413
+        mock_probe.assert_not_called()
+    
+    def test_category_upload_validated(self, client, test_db_with_data, auth_headers, monkeypatch):
+        """Category image uploads go through the same checks."""
+        from app.config import settings
+        monkeypatch.setattr(settings, "DB_FILE", test_db_with_data)
+        
+        response = client.put(
+            "/categories/1",
+            data={"name": "Gi"},
+            files={"image": ("a.jpg", b"GIF89a-truncated", "image/jpeg")},
+            headers=auth_headers,
+        )
+        
+        assert response.status_code == 400
+        assert "not a valid image" in response.json()["detail"]
+    
+    def test_file_source_matches_bytes(self, app_with_test_db):
+        """Processing from a file object should give the same result as from bytes."""
+        import tempfile
+        from app.services.image import ImageService
+        
+        data = make_detailed_jpeg()
+        with tempfile.SpooledTemporaryFile(max_size=1024) as spooled:
+            spooled.write(data)
+            from_file = ImageService.save_product_image(spooled, "a.jpg")
+            placeholder = ImageService.create_placeholder(spooled)
+        
+        assert from_file == ImageService.save_product_image(data, "a.jpg")
+        assert placeholder == ImageService.create_placeholder(data)
+
+
+def make_gradient(size=(640, 480)) -> Image.Image:
+    """A smooth studio-style shot: soft colour gradients, no texture."""
+    horizontal = Image.linear_gradient("L").rotate(90).resize(size)
+    vertical = Image.linear_gradient("L").resize(size)
+    return Image.merge("RGB", (horizontal, vertical, ImageOps.invert(horizontal)))
+
+
+class TestAutoQuality:
+    """Tests for per-image quality selection against an SSIM target."""
+    
+    def test_smooth_image_goes_below_fixed_quality(self):
+        from app.config import settings
+        from app.services.image import ImageService
+        from app.services.image_quality import ssim
+        
+        img = make_gradient()
+        report = {}
+        data = ImageService.encode(img, report=report)
+        
+        assert report["quality"] < settings.IMAGE_QUALITY
+        assert 0 < report["trials"] <= settings.IMAGE_AUTO_QUALITY_MAX_TRIALS
+        assert report["ssim"] >= settings.IMAGE_TARGET_SSIM
+        assert len(data) < report["baseline_bytes"]
+        assert ssim(img, Image.open(io.BytesIO(data))) >= settings.IMAGE_TARGET_SSIM
+    
+    def test_detailed_image_gets_more_quality(self):
+        from app.config import settings
+        from app.services.image import ImageService
+        
+        from PIL import ImageFilter
+        
+        texture = Image.effect_noise((640, 480), 64).filter(ImageFilter.GaussianBlur(0.7))
+        detailed = Image.merge("RGB", (texture, Image.linear_gradient("L").resize((640, 480)), texture))
+        smooth, busy = {}, {}
+        ImageService.encode(make_gradient(), report=smooth)
+        ImageService.encode(detailed, report=busy)
+        
+        assert busy["quality"] > settings.IMAGE_QUALITY > smooth["quality"]
+    
+    def test_explicit_quality_skips_search(self):
+        from app.services.image import ImageService
+        
+        report = {}
+        with patch("app.services.image.SsimReference") as reference:
+            ImageService.encode(make_gradient(), quality=70, report=report)
+        
+        reference.assert_not_called()
+        assert report == {"quality": 70, "ssim": None, "trials": 0, "baseline_bytes": None}
+    
+    def test_final_jpeg_is_progressive(self):
+        from app.services.image import ImageService
+        
+        data = ImageService.encode(make_gradient())
+        
+        assert Image.open(io.BytesIO(data)).info.get("progressive")
+    
+    def test_webp(self):
+        from app.services.image import ImageService
+        
+        report = {}
+        data = ImageService.encode(make_gradient(), fmt="webp", report=report)
+        
+        assert Image.open(io.BytesIO(data)).format == "WEBP"
+        assert report["quality"] is not None
+    
+    def test_chroma_subsampling_keeps_colour_detail(self):
+        from PIL import JpegImagePlugin
+        from app.services.image import ImageService, SUBSAMPLING_420, SUBSAMPLING_444
+        
+        stripes = Image.new("RGB", (320, 240), (0, 0, 255))
+        for x in range(0, 320, 2):
+            stripes.paste((255, 0, 0), (x, 0, x + 1, 240))
+        
+        assert ImageService.chroma_subsampling(stripes) == SUBSAMPLING_444
+        assert ImageService.chroma_subsampling(make_gradient()) == SUBSAMPLING_420
+        encoded = Image.open(io.BytesIO(ImageService.encode(stripes)))
+        assert JpegImagePlugin.get_sampling(encoded) == SUBSAMPLING_444
+    
+    def test_incompressible_image_still_encodes(self):
+        from app.services.image import ImageService
+        
+        noise = Image.merge("RGB", [Image.effect_noise((256, 256), 128) for _ in range(3)])
+        report = {}
+        data = ImageService.encode(noise, report=report)
+        
+        assert Image.open(io.BytesIO(data)).size == (256, 256)
+        assert report["baseline_bytes"] > 0
+    
+    def test_disabled_uses_fixed_quality(self, app_with_test_db, monkeypatch):
+        from app.config import settings
+        from app.services.image import ImageService
+        monkeypatch.setattr(settings, "IMAGE_AUTO_QUALITY", False)
+        
+        report = {}
+        ImageService.optimize_image(make_jpeg(), report=report)
+        
+        assert report["quality"] == settings.IMAGE_QUALITY
+        assert report["baseline_bytes"] is None
+    
+    def test_upload_records_encoding(self, client, auth_headers, app_with_test_db, test_db_with_data):
+        import sqlite3
+        from app.services.image import ImageService
+        
+        conn = sqlite3.connect(test_db_with_data)
+        conn.row_factory = sqlite3.Row
+        output = io.BytesIO()
+        make_gradient((1200, 900)).save(output, format="JPEG", quality=95)
+        ImageService.save_product_image(output.getvalue(), "studio.jpg", conn.cursor())
+        conn.commit()
+        rows = {
+            row["variant"]: row
+            for row in conn.execute("SELECT variant, quality, ssim, baseline_bytes FROM image_metadata")
+        }
+        conn.close()
+        
+        for variant in ("original", "thumbnail"):
+            assert rows[variant]["quality"] is not None
+            assert rows[variant]["ssim"] is not None
+            assert rows[variant]["baseline_bytes"] > 0
+        
+        response = client.get("/admin/image-encoding-stats", headers=auth_headers)
+        
+        assert response.status_code == 200
+        stats = response.json()
+        assert stats["auto_quality"] is True
+        original = stats["variants"]["original"]
+        assert original["files"] == 1
+        assert original["saved_bytes"] > 0
+        assert original["bytes"] + original["saved_bytes"] == original["baseline_bytes"]
+    
+    def test_encoding_stats_requires_auth(self, client):
+        assert client.get("/admin/image-encoding-stats").status_code == 422
@@ -12,6 +12,8 @@ from app.services.inventory import (
     get_size_quantity_by_location,
     update_size_quantity,
     move_between_locations,
+    line_quantity,
+    InvalidOrderLineError,
     InventoryService,
 )
 
@@ -281,103 +283,110 @@ class TestMoveBetweenLocations:
         assert result["170"]["club"] == 2     # 0 + 2 = 2
 
 
-class TestInventoryServiceReduceStock:
-    """Tests for InventoryService.reduce_stock - critical for order processing."""
+class TestLineQuantity:
+    """Tests for line_quantity function."""
     
-    @pytest.fixture
-    def db_with_product(self, test_db):
-        """Create a database with a product for stock reduction tests."""
-        conn = sqlite3.connect(test_db)
+    def test_whole_numbers_are_accepted(self):
+        assert [line_quantity({"quantity": value}) for value in (2, "2", 2.0, -1)] == [2, 2, 2, -1]
+    
+    def test_missing_quantity_is_one(self):
+        assert line_quantity({"id": 1}) == 1
+    
+    @pytest.mark.parametrize("value", ["two", "", None, 1.5, True, [2], {"n": 2}])
+    def test_invalid_quantity_raises_error(self, value):
+        with pytest.raises(InvalidOrderLineError):
+            line_quantity({"quantity": value})
+    
+    def test_line_that_is_not_an_object_raises_error(self):
+        with pytest.raises(InvalidOrderLineError):
+            line_quantity("1 gi")
+
+
+class TestInventoryServiceGetProducts:
+    """Tests for InventoryService.get_products."""
+    
+    def test_loads_products_with_one_query(self, app_with_test_db, test_db_with_data):
+        conn = sqlite3.connect(test_db_with_data)
         conn.row_factory = sqlite3.Row
+        statements = []
+        conn.set_trace_callback(statements.append)
         
-        sizes = json.dumps({"170": {"online": 5, "club": 2}, "180": {"online": 3, "club": 0}})
-        conn.execute(
-            "INSERT INTO products (id, name, price, sizes) VALUES (?, ?, ?, ?)",
-            (1, "Test Gi", 1000, sizes)
-        )
-        conn.commit()
+        products = InventoryService.get_products(conn.cursor(), [1, 2, 1, None, 999])
         conn.close()
         
-        return test_db
+        assert sorted(products) == [1, 2]
+        assert "170" in json.loads(products[1]["sizes"])
+        assert len(statements) == 1
     
-    def test_reduce_stock_online_only(self, db_with_product, monkeypatch):
-        """Should reduce online stock when sufficient."""
-        from app import database
-        monkeypatch.setattr(database.settings, "DB_FILE", db_with_product)
-        
-        items = [{"id": 1, "selectedSize": "170", "quantity": 3}]
-        InventoryService.reduce_stock(items)
+    def test_no_ids_runs_no_query(self, app_with_test_db, test_db):
+        conn = sqlite3.connect(test_db)
+        statements = []
+        conn.set_trace_callback(statements.append)
         
-        # Verify stock was reduced
-        conn = sqlite3.connect(db_with_product)
-        conn.row_factory = sqlite3.Row
-        row = conn.execute("SELECT sizes FROM products WHERE id = 1").fetchone()
+        assert InventoryService.get_products(conn.cursor(), [None]) == {}
         conn.close()
-        
-        sizes = json.loads(row["sizes"])
-        assert sizes["170"]["online"] == 2  # 5 - 3 = 2
-        assert sizes["170"]["club"] == 2    # Unchanged
-    
-    def test_reduce_stock_overflow_to_club(self, db_with_product, monkeypatch):
-        """Should overflow to club stock when online insufficient."""
-        from app import database
-        monkeypatch.setattr(database.settings, "DB_FILE", db_with_product)
-        
-        items = [{"id": 1, "selectedSize": "170", "quantity": 6}]
-        InventoryService.reduce_stock(items)
-        
-        conn = sqlite3.connect(db_with_product)
-        conn.row_factory = sqlite3.Row
-        row = conn.execute("SELECT sizes FROM products WHERE id = 1").fetchone()
+        assert statements == []
+
+
+class TestInventoryServiceReserveStock:
+    """Tests for InventoryService.reserve_stock."""
+    
+    @staticmethod
+    def reserve(db_file, items):
+        from app.database import get_db_context
+        with get_db_context(immediate=True) as conn:
+            return InventoryService.reserve_stock(conn.cursor(), items)
+    
+    @staticmethod
+    def sizes(db_file, product_id):
+        conn = sqlite3.connect(db_file)
+        row = conn.execute("SELECT sizes FROM products WHERE id = ?", (product_id,)).fetchone()
         conn.close()
-        
-        sizes = json.loads(row["sizes"])
-        assert sizes["170"]["online"] == 0  # All online consumed
-        assert sizes["170"]["club"] == 1    # 2 - 1 (overflow) = 1
+        return json.loads(row[0])
     
-    def test_reduce_stock_multiple_items(self, db_with_product, monkeypatch):
-        """Should reduce stock for multiple items in order."""
-        from app import database
-        monkeypatch.setattr(database.settings, "DB_FILE", db_with_product)
+    def test_deducts_online_then_club(self, app_with_test_db, test_db_with_data):
+        self.reserve(test_db_with_data, [{"id": 1, "selectedSize": "170", "quantity": 6}])
         
+        assert self.sizes(test_db_with_data, 1)["170"] == {"online": 0, "club": 1}
+    
+    def test_lines_of_same_size_are_added_up(self, app_with_test_db, test_db_with_data):
+        from app.services.inventory import InsufficientStockError
         items = [
-            {"id": 1, "selectedSize": "170", "quantity": 2},
-            {"id": 1, "selectedSize": "180", "quantity": 1}
+            {"id": 1, "selectedSize": "180", "quantity": 2},
+            {"id": 1, "selectedSize": "180", "quantity": 2},
         ]
-        InventoryService.reduce_stock(items)
         
-        conn = sqlite3.connect(db_with_product)
-        conn.row_factory = sqlite3.Row
-        row = conn.execute("SELECT sizes FROM products WHERE id = 1").fetchone()
-        conn.close()
+        with pytest.raises(InsufficientStockError) as exc:
+            self.reserve(test_db_with_data, items)
         
-        sizes = json.loads(row["sizes"])
-        assert sizes["170"]["online"] == 3  # 5 - 2 = 3
-        assert sizes["180"]["online"] == 2  # 3 - 1 = 2
+        assert exc.value.shortages == [{"id": 1, "size": "180", "requested": 4, "available": 3}]
+        assert self.sizes(test_db_with_data, 1)["180"] == {"online": 3, "club": 0}
     
-    def test_reduce_stock_nonexistent_product(self, db_with_product, monkeypatch):
-        """Should handle nonexistent product gracefully."""
-        from app import database
-        monkeypatch.setattr(database.settings, "DB_FILE", db_with_product)
+    def test_all_or_nothing(self, app_with_test_db, test_db_with_data):
+        from app.services.inventory import InsufficientStockError
+        items = [
+            {"id": 2, "selectedSize": "S", "quantity": 1},
+            {"id": 1, "selectedSize": "170", "quantity": 1},
+            {"id": 999, "selectedSize": "170", "quantity": 1},
+        ]
+        
+        with pytest.raises(InsufficientStockError):
+            self.reserve(test_db_with_data, items)
         
-        items = [{"id": 999, "selectedSize": "170", "quantity": 1}]
-        # Should not raise exception
-        InventoryService.reduce_stock(items)
+        assert self.sizes(test_db_with_data, 1)["170"] == {"online": 5, "club": 2}
+        assert self.sizes(test_db_with_data, 2)["S"] == {"online": 10, "club": 5}
     
-    def test_reduce_stock_nonexistent_size(self, db_with_product, monkeypatch):
-        """Should handle nonexistent size gracefully."""
-        from app import database
-        monkeypatch.setattr(database.settings, "DB_FILE", db_with_product)
+    def test_rejects_non_positive_quantity(self, app_with_test_db, test_db_with_data):
+        from app.services.inventory import InsufficientStockError
         
-        items = [{"id": 1, "selectedSize": "999", "quantity": 1}]
-        # Should not raise exception
-        InventoryService.reduce_stock(items)
+        with pytest.raises(InsufficientStockError):
+            self.reserve(test_db_with_data, [{"id": 1, "selectedSize": "170", "quantity": -3}])
         
-        # Verify existing sizes unchanged
-        conn = sqlite3.connect(db_with_product)
-        conn.row_factory = sqlite3.Row
-        row = conn.execute("SELECT sizes FROM products WHERE id = 1").fetchone()
-        conn.close()
+        assert self.sizes(test_db_with_data, 1)["170"] == {"online": 5, "club": 2}
+    
+    def test_check_stock_does_not_reserve(self, app_with_test_db, test_db_with_data):
+        items = [{"id": 1, "selectedSize": "170", "quantity": 7}]
         
-        sizes = json.loads(row["sizes"])
-        assert sizes["170"]["online"] == 5  # Unchanged
+        assert InventoryService.check_stock(items) == []
+        assert InventoryService.check_stock(items + [{"id": 1, "selectedSize": "170", "quantity": 1}]) != []
+        assert self.sizes(test_db_with_data, 1)["170"] == {"online": 5, "club": 2}
@@ -0,0 +1,211 @@
+"""
+Tests for holding stock while a cart is being paid for.
+"""
+import json
+import sqlite3
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+import pytest
+
+
+@pytest.fixture
+def shop_db(client, test_db_with_data, monkeypatch):
+    """Products with 2 gis in size 180 and 15 belts in size S."""
+    from app.config import settings
+    monkeypatch.setattr(settings, "DB_FILE", test_db_with_data)
+    conn = sqlite3.connect(test_db_with_data)
+    conn.execute("UPDATE products SET sizes = ? WHERE id = 1", (json.dumps({"180": {"online": 1, "club": 1}}),))
+    conn.commit()
+    conn.close()
+    return test_db_with_data
+
+
+def cart(quantity, size="180", product_id=1):
+    return {
+        "total": 1500 * quantity,
+        "customer": {"firstName": "Anna", "lastName": "Berg", "email": "anna@example.com", "payment": "swish"},
+        "items": [{"id": product_id, "name": "Judo Gi", "price": 1500, "quantity": quantity, "selectedSize": size}],
+    }
+
+
+def holds(db_file):
+    conn = sqlite3.connect(db_file)
+    rows = conn.execute("SELECT reference, product_id, size, quantity FROM stock_holds ORDER BY id").fetchall()
+    conn.close()
+    return rows
+
+
+def expire_holds(db_file):
+    conn = sqlite3.connect(db_file)
+    past = (datetime.utcnow() - timedelta(seconds=1)).isoformat(timespec="microseconds")
+    conn.execute("UPDATE stock_holds SET expires_at = ?", (past,))
+    conn.commit()
+    conn.close()
+
+
+def gi_stock(db_file):
+    conn = sqlite3.connect(db_file)
+    sizes = json.loads(conn.execute("SELECT sizes FROM products WHERE id = 1").fetchone()[0])
+    conn.close()
+    return sizes["180"]
+
+
+class TestStockHolds:
+    """Tests for stock holds placed at payment intent creation."""
+    
+    def test_payment_intent_holds_stock(self, client, shop_db, fake_stripe):
+        response = client.post("/create-payment-intent", json=cart(2))
+        
+        assert response.status_code == 200
+        assert response.json()["hold_expires_at"]
+        assert holds(shop_db) == [("pi_1", 1, "180", 2)]
+        # Held, not deducted
+        assert gi_stock(shop_db) == {"online": 1, "club": 1}
+    
+    def test_held_stock_is_not_available_to_others(self, client, shop_db, fake_stripe):
+        assert client.post("/create-payment-intent", json=cart(1)).status_code == 200
+        
+        second = client.post("/create-payment-intent", json=cart(2))
+        third = client.post("/checkout", json=cart(2))
+        
+        assert second.status_code == 409
+        assert second.json()["detail"]["shortages"][0]["available"] == 1
+        assert third.status_code == 409
+        # The pre-check turns the second cart away before Stripe is called
+        assert len(fake_stripe.calls("POST", "/v1/payment_intents")) == 1
+        assert client.post("/checkout", json=cart(1)).status_code == 200
+    
+    def test_hold_lost_to_a_race_cancels_the_intent(self, client, shop_db, fake_stripe):
+        
+        # Another cart takes the stock after the pre-check but before the hold
+        with patch("app.services.inventory.InventoryService.check_stock", return_value=[]):
+            assert client.post("/create-payment-intent", json=cart(2)).status_code == 200
+            response = client.post("/create-payment-intent", json=cart(1))
+        
+        assert response.status_code == 409
+        assert [r["path"] for r in fake_stripe.requests][-1] == "/v1/payment_intents/pi_2/cancel"
+        assert fake_stripe.intents["pi_2"]["status"] == "canceled"
+        assert holds(shop_db) == [("pi_1", 1, "180", 2)]
+    
+    def test_confirmation_converts_the_hold(self, client, shop_db, fake_stripe):
+        client.post("/create-payment-intent", json=cart(2))
+        fake_stripe.pay("pi_1")
+        
+        response = client.post("/confirm-payment", json={"payment_intent_id": "pi_1", "order": cart(2)})
+        
+        assert response.status_code == 200
+        assert gi_stock(shop_db) == {"online": 0, "club": 0}
+        assert holds(shop_db) == []
+    
+    def test_confirmation_uses_the_stored_cart(self, client, shop_db, fake_stripe):
+        client.post("/create-payment-intent", json=cart(1))
+        fake_stripe.pay("pi_1")
+        
+        response = client.post("/confirm-payment", json={"payment_intent_id": "pi_1", "order": cart(2)})
+        
+        assert response.status_code == 200
+        assert sum(gi_stock(shop_db).values()) == 1
+    
+    def test_confirmation_rejects_order_not_matching_the_payment(self, client, shop_db, fake_stripe):
+        from app.services.orders import OrderService
+        fake_stripe.pay("pi_9")
+        fake_stripe.intents["pi_9"]["amount"] = 150000
+        
+        response = client.post("/confirm-payment", json={"payment_intent_id": "pi_9", "order": cart(2)})
+        
+        assert response.status_code == 400
+        assert OrderService.get_payment("pi_9") is None
+        assert gi_stock(shop_db) == {"online": 1, "club": 1}
+        assert client.post("/confirm-payment", json={"payment_intent_id": "pi_9", "order": cart(1)}).status_code == 200
+    
+    def test_invalid_quantity_is_rejected_before_stripe(self, client, shop_db, fake_stripe):
+        order = cart(1)
+        order["items"][0]["quantity"] = "one"
+        
+        intent = client.post("/create-payment-intent", json=order)
+        checkout = client.post("/checkout", json=order)
+        
+        assert [intent.status_code, checkout.status_code] == [400, 400]
+        assert fake_stripe.requests == []
+        assert gi_stock(shop_db) == {"online": 1, "club": 1}
+    
+    def test_expired_hold_no_longer_counts(self, client, shop_db, fake_stripe):
+        from app.services.stock_holds import StockHoldService
+        client.post("/create-payment-intent", json=cart(2))
+        expire_holds(shop_db)
+        
+        assert client.post("/checkout", json=cart(2)).status_code == 200
+        assert StockHoldService.sweep() == 1
+        assert holds(shop_db) == []
+    
+    def test_expired_hold_sold_meanwhile_is_refunded(self, client, shop_db, fake_stripe):
+        client.post("/create-payment-intent", json=cart(2))
+        expire_holds(shop_db)
+        client.post("/checkout", json=cart(1))
+        fake_stripe.pay("pi_1")
+        
+        response = client.post("/confirm-payment", json={"payment_intent_id": "pi_1", "order": cart(2)})
+        
+        assert response.status_code == 409
+        assert fake_stripe.calls("POST", "/v1/refunds") == [{"payment_intent": "pi_1"}]
+    
+    def test_placing_a_hold_again_replaces_it(self, shop_db):
+        from app.database import get_db_context
+        from app.services.inventory import InventoryService
+        
+        for quantity in (2, 1):
+            with get_db_context(immediate=True) as conn:
+                InventoryService.hold_stock(conn.cursor(), "cart-1", cart(quantity)["items"])
+        
+        assert holds(shop_db) == [("cart-1", 1, "180", 1)]
+    
+    def test_product_shows_held_sizes(self, client, shop_db, fake_stripe):
+        client.post("/create-payment-intent", json=cart(1))
+        
+        product = client.get("/products/1").json()
+        listed = {p["id"]: p for p in client.get("/products").json()}
+        
+        assert product["held_sizes"] == {"180": 1}
+        assert listed[1]["held_sizes"] == {"180": 1}
+        assert listed[2]["held_sizes"] == {}
+    
+    def test_availability_lookup_uses_index(self, shop_db):
+        conn = sqlite3.connect(shop_db)
+        plan = conn.execute(
+            """EXPLAIN QUERY PLAN SELECT product_id, size, SUM(quantity) FROM stock_holds
+               WHERE expires_at > ? AND product_id IN (1, 2) GROUP BY product_id, size""",
+            (datetime.utcnow().isoformat(),)
+        ).fetchall()
+        conn.close()
+        
+        assert any("idx_stock_holds_active" in row[-1] for row in plan)
+    
+    def test_sweeper_runs_in_background(self, shop_db, monkeypatch):
+        import time
+        from app.config import settings
+        from app.database import get_db_context
+        from app.services.inventory import InventoryService
+        from app.services.stock_holds import StockHoldService
+        monkeypatch.setattr(settings, "STOCK_HOLD_SWEEP_SECONDS", 0.05)
+        with get_db_context(immediate=True) as conn:
+            InventoryService.hold_stock(conn.cursor(), "cart-1", cart(1)["items"])
+        expire_holds(shop_db)
+        
+        assert StockHoldService.start_sweeper()
+        try:
+            deadline = time.monotonic() + 5
+            while holds(shop_db) and time.monotonic() < deadline:
+                time.sleep(0.02)
+        finally:
+            StockHoldService.stop_sweeper()
+            StockHoldService._sweeper.join(timeout=5)
+        
+        assert holds(shop_db) == []
+    
+    def test_sweeper_can_be_disabled(self, monkeypatch):
+        from app.config import settings
+        from app.services.stock_holds import StockHoldService
+        monkeypatch.setattr(settings, "STOCK_HOLD_SWEEP_SECONDS", 0)
+        
+        assert StockHoldService.start_sweeper() is False
@@ -0,0 +1,333 @@
+"""
+Tests for the image storage backends.
+"""
+import io
+import os
+import pickle
+import time
+import uuid
+from datetime import datetime, timezone
+
+import pytest
+
+from app.services.image_paths import ImagePaths
+from app.services.storage import (
+    AREA_ORIGINALS,
+    AREA_THUMBNAILS,
+    AREA_VARIANTS,
+    LocalStorage,
+    S3Storage,
+)
+from tests.conftest import make_jpeg
+
+
+class FakeS3Error(Exception):
+    """Stand-in for botocore's ClientError."""
+    
+    def __init__(self, code):
+        super().__init__(code)
+        self.response = {"Error": {"Code": code}}
+
+
+class FakeS3Client:
+    """In-memory subset of the boto3 S3 client used by S3Storage."""
+    
+    def __init__(self):
+        self.objects = {}
+    
+    def put_object(self, Bucket, Key, Body, ContentType, CacheControl):
+        self.objects[Key] = {
+            "Body": bytes(Body),
+            "ContentType": ContentType,
+            "CacheControl": CacheControl,
+            "LastModified": datetime.now(timezone.utc),
+        }
+    
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise FakeS3Error("NoSuchKey")
+        return {"Body": io.BytesIO(self.objects[Key]["Body"])}
+    
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise FakeS3Error("404")
+        return {}
+    
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+    
+    def copy_object(self, Bucket, Key, CopySource, MetadataDirective, ContentType, CacheControl):
+        source = self.objects[CopySource["Key"]]
+        self.put_object(Bucket, Key, source["Body"], ContentType, CacheControl)
+    
+    def get_paginator(self, operation):
+        return self
+    
+    def paginate(self, Bucket, Prefix):
+        keys = sorted(key for key in self.objects if key.startswith(Prefix))
+        # Two pages, like a real listing that got truncated
+        middle = len(keys) // 2
+        for page in (keys[:middle], keys[middle:]):
+            yield {"Contents": [
+                {"Key": key, "Size": len(self.objects[key]["Body"]), "LastModified": self.objects[key]["LastModified"]}
+                for key in page
+            ]}
+    
+    def generate_presigned_url(self, operation, Params, ExpiresIn):
+        return f"https://s3.test/{Params['Bucket']}/{Params['Key']}?X-Amz-Expires={ExpiresIn}"
+
+
+@pytest.fixture
+def s3_backend(app_with_test_db, monkeypatch):
+    """Switch the app to the S3 backend, backed by an in-memory client."""
+    from app.config import settings
+    from app.services import storage as storage_module
+    
+    client = FakeS3Client()
+    monkeypatch.setattr(settings, "IMAGE_STORAGE_BACKEND", "s3")
+    monkeypatch.setattr(storage_module, "_remote_storage", {})
+    monkeypatch.setattr(
+        S3Storage,
+        "from_settings",
+        classmethod(lambda cls: cls("images", key_prefix="shop/", public_base_url="https://cdn.test", client=client)),
+    )
+    return client
+
+
+@pytest.fixture(params=["local", "s3"])
+def storage(request, tmp_path):
+    if request.param == "local":
+        roots = {area: str(tmp_path / area) for area in (AREA_ORIGINALS, AREA_THUMBNAILS, AREA_VARIANTS)}
+        for root in roots.values():
+            os.makedirs(root)
+        return LocalStorage(roots, public_root=str(tmp_path), public_base_url="")
+    return S3Storage("images", key_prefix="shop/", client=FakeS3Client())
+
+
+class TestStorageBackends:
+    """Behaviour every backend must share."""
+    
+    def test_put_get_exists_delete(self, storage):
+        storage.put(AREA_ORIGINALS, "a.jpg", b"original")
+        
+        assert storage.exists(AREA_ORIGINALS, "a.jpg")
+        assert storage.get(AREA_ORIGINALS, "a.jpg") == b"original"
+        assert not storage.exists(AREA_THUMBNAILS, "a.jpg")
+        
+        assert storage.delete(AREA_ORIGINALS, "a.jpg") is True
+        assert storage.delete(AREA_ORIGINALS, "a.jpg") is False
+        assert storage.get(AREA_ORIGINALS, "a.jpg") is None
+        assert not storage.exists(AREA_ORIGINALS, "a.jpg")
+    
+    def test_touch_renews_modification_time(self, storage):
+        storage.put(AREA_ORIGINALS, "a.jpg", b"original")
+        before = next(storage.list(AREA_ORIGINALS)).mtime
+        time.sleep(0.01)
+        
+        assert storage.touch(AREA_ORIGINALS, "a.jpg") is True
+        assert next(storage.list(AREA_ORIGINALS)).mtime > before
+        assert storage.get(AREA_ORIGINALS, "a.jpg") == b"original"
+        assert storage.touch(AREA_ORIGINALS, "missing.jpg") is False
+    
+    def test_overwrite(self, storage):
+        storage.put(AREA_THUMBNAILS, "a_thumb.jpg", b"old")
+        storage.put(AREA_THUMBNAILS, "a_thumb.jpg", b"new")
+        
+        assert storage.get(AREA_THUMBNAILS, "a_thumb.jpg") == b"new"
+        assert [obj.name for obj in storage.list(AREA_THUMBNAILS)] == ["a_thumb.jpg"]
+    
+    def test_list_by_area_and_prefix(self, storage):
+        for name in ("a_160x0_contain.jpg", "a_320x0_contain.jpg", "b_160x0_contain.jpg"):
+            storage.put(AREA_VARIANTS, name, b"xx")
+        storage.put(AREA_ORIGINALS, "a.jpg", b"x")
+        
+        listed = sorted(storage.list(AREA_VARIANTS, prefix="a_"))
+        
+        assert [obj.name for obj in listed] == ["a_160x0_contain.jpg", "a_320x0_contain.jpg"]
+        assert all(obj.size == 2 and obj.area == AREA_VARIANTS for obj in listed)
+        
+        for obj in listed:
+            assert storage.delete_object(obj)
+        assert [obj.name for obj in storage.list(AREA_VARIANTS)] == ["b_160x0_contain.jpg"]
+    
+    def test_unsafe_names_are_not_found(self, storage):
+        assert storage.get(AREA_ORIGINALS, "../secret") is None
+        assert not storage.exists(AREA_ORIGINALS, ".hidden")
+        assert storage.url(AREA_ORIGINALS, "../secret") is None
+    
+    def test_picklable_for_job_workers(self, storage):
+        storage.put(AREA_ORIGINALS, "a.jpg", b"x")
+        
+        copy = pickle.loads(pickle.dumps(storage))
+        
+        if isinstance(storage, S3Storage):
+            assert copy._client is None
+        else:
+            assert copy.get(AREA_ORIGINALS, "a.jpg") == b"x"
+
+
+class TestStorageUrls:
+    """Public URLs let clients fetch images without going through the app."""
+    
+    def test_local_without_base_url_serves_from_app(self, tmp_path):
+        storage = LocalStorage({AREA_ORIGINALS: str(tmp_path)}, public_root=str(tmp_path), public_base_url="")
+        storage.put(AREA_ORIGINALS, "a.jpg", b"x")
+        
+        assert storage.url(AREA_ORIGINALS, "a.jpg") is None
+        assert storage.local_path(AREA_ORIGINALS, "a.jpg")
+    
+    def test_local_with_base_url(self, tmp_path):
+        thumbnails = tmp_path / "thumbnails"
+        storage = LocalStorage(
+            {AREA_ORIGINALS: str(tmp_path), AREA_THUMBNAILS: str(thumbnails)},
+            public_root=str(tmp_path),
+            public_base_url="https://img.test/uploads/",
+        )
+        storage.put(AREA_THUMBNAILS, "a_thumb.jpg", b"x")
+        first, second = ImagePaths.shard("a_thumb.jpg")
+        
+        assert storage.url(AREA_THUMBNAILS, "a_thumb.jpg") == (
+            f"https://img.test/uploads/thumbnails/{first}/{second}/a_thumb.jpg"
+        )
+        assert storage.url(AREA_THUMBNAILS, "missing.jpg") is None
+    
+    def test_s3_public_and_presigned(self):
+        public = S3Storage("images", key_prefix="shop/", public_base_url="https://cdn.test/", client=FakeS3Client())
+        private = S3Storage("images", url_expires_seconds=60, client=FakeS3Client())
+        
+        assert public.url(AREA_ORIGINALS, "a.jpg") == "https://cdn.test/shop/uploads/a.jpg"
+        assert private.url(AREA_THUMBNAILS, "a_thumb.jpg") == (
+            "https://s3.test/images/thumbnails/a_thumb.jpg?X-Amz-Expires=60"
+        )
+    
+    def test_s3_objects_carry_cache_headers(self):
+        client = FakeS3Client()
+        storage = S3Storage("images", client=client)
+        
+        storage.put(AREA_ORIGINALS, "a.jpg", b"x")
+        storage.put(AREA_THUMBNAILS, "a_thumb.jpg", b"x")
+        storage.put(AREA_VARIANTS, "a_160x0_contain.webp", b"x")
+        
+        assert client.objects["uploads/a.jpg"]["ContentType"] == "image/jpeg"
+        assert "immutable" in client.objects["uploads/a.jpg"]["CacheControl"]
+        assert "immutable" not in client.objects["thumbnails/a_thumb.jpg"]["CacheControl"]
+        assert client.objects["variants/a_160x0_contain.webp"]["ContentType"] == "image/webp"
+
+
+class TestS3BackendInApp:
+    """The app running against the S3 backend."""
+    
+    def test_upload_stored_in_bucket(self, s3_backend, app_with_test_db):
+        from app.config import settings
+        from app.services.image import ImageService
+        
+        filename, thumbnail = ImageService.save_product_image(make_jpeg(), "photo.jpg")
+        
+        assert f"shop/uploads/{filename}" in s3_backend.objects
+        assert f"shop/thumbnails/{thumbnail}" in s3_backend.objects
+        assert sorted(os.listdir(settings.UPLOAD_DIR)) == ["cache", "thumbnails"]
+    
+    def test_images_redirect_to_bucket(self, s3_backend, client):
+        from app.services.image import ImageService
+        
+        filename, thumbnail = ImageService.save_product_image(make_jpeg(), "photo.jpg")
+        
+        upload = client.get(f"/uploads/{filename}", follow_redirects=False)
+        thumb = client.get(f"/thumbnails/{thumbnail}", follow_redirects=False)
+        
+        assert upload.status_code == 302
+        assert upload.headers["location"] == f"https://cdn.test/shop/uploads/{filename}"
+        assert thumb.headers["location"] == f"https://cdn.test/shop/thumbnails/{thumbnail}"
+    
+    def test_variant_published_once(self, s3_backend, client):
+        from app.services.image import ImageService
+        from app.services.image_cache import ImageVariantCache
+        
+        filename, _ = ImageService.save_product_image(make_jpeg(), "photo.jpg")
+        variant = ImageVariantCache.variant_filename(filename, 160, None, "contain", "webp")
+        
+        first = client.get(f"/img/{filename}?w=160&fmt=webp", follow_redirects=False)
+        s3_backend.objects.pop(f"shop/variants/{variant}")
+        second = client.get(f"/img/{filename}?w=160&fmt=webp", follow_redirects=False)
+        
+        assert first.status_code == 302
+        assert first.headers["location"] == f"https://cdn.test/shop/variants/{variant}"
+        # Known variants are not re-checked or re-uploaded
+        assert second.status_code == 302
+        assert f"shop/variants/{variant}" not in s3_backend.objects
+        assert client.get("/img/missing.jpg?w=160", follow_redirects=False).status_code == 404
+    
+    def test_release_removes_objects_and_variants(self, s3_backend, client):
+        from app.services.image import ImageService
+        
+        filename, _ = ImageService.save_product_image(make_jpeg(), "photo.jpg")
+        client.get(f"/img/{filename}?w=160", follow_redirects=False)
+        
+        from app.services.image_cache import ImageVariantCache
+        ImageService.delete_image(filename)
+        ImageVariantCache.purge(filename)
+        
+        assert s3_backend.objects == {}
+    
+    def test_thumbnail_status_lists_bucket(self, s3_backend, client, test_db_with_data, auth_headers, monkeypatch):
+        from app.config import settings
+        from app.services.image import ImageService
+        monkeypatch.setattr(settings, "DB_FILE", test_db_with_data)
+        
+        ImageService.save_product_image(make_jpeg(), "orphan.jpg")
+        status = client.get("/admin/thumbnail-status", headers=auth_headers).json()
+        
+        assert status["missing_count"] == 2
+        assert status["orphan_original_count"] == 1
+    
+    def test_layout_migration_is_local_only(self, s3_backend, client, auth_headers):
+        response = client.post("/admin/migrate-image-layout", headers=auth_headers)
+        
+        assert response.status_code == 400
+
+
+@pytest.mark.skipif(
+    not os.getenv("S3_TEST_ENDPOINT_URL"),
+    reason="Set S3_TEST_ENDPOINT_URL (e.g. a local MinIO) to run object storage integration tests",
+)
+class TestMinioIntegration:
+    """Round trip against a real S3-compatible server such as MinIO."""
+    
+    @pytest.fixture
+    def minio(self):
+        pytest.importorskip("boto3")
+        storage = S3Storage(
+            bucket=os.getenv("S3_TEST_BUCKET", "yakimoto-test"),
+            endpoint_url=os.getenv("S3_TEST_ENDPOINT_URL"),
+            region=os.getenv("S3_TEST_REGION", "us-east-1"),
+            access_key_id=os.getenv("S3_TEST_ACCESS_KEY_ID", "minioadmin"),
+            secret_access_key=os.getenv("S3_TEST_SECRET_ACCESS_KEY", "minioadmin"),
+            key_prefix=f"test-{uuid.uuid4().hex}/",
+        )
+        try:
+            storage.client.create_bucket(Bucket=storage.bucket)
+        except Exception as e:
+            if "BucketAlready" not in type(e).__name__ and "BucketAlready" not in str(e):
+                raise
+        yield storage
+        for area in (AREA_ORIGINALS, AREA_THUMBNAILS, AREA_VARIANTS):
+            for obj in list(storage.list(area)):
+                storage.delete_object(obj)
+    
+    def test_round_trip(self, minio):
+        import requests
+        data = make_jpeg()
+        
+        minio.put(AREA_ORIGINALS, "a.jpg", data)
+        
+        assert minio.exists(AREA_ORIGINALS, "a.jpg")
+        assert minio.get(AREA_ORIGINALS, "a.jpg") == data
+        assert [obj.name for obj in minio.list(AREA_ORIGINALS)] == ["a.jpg"]
+        
+        response = requests.get(minio.url(AREA_ORIGINALS, "a.jpg"), timeout=10)
+        assert response.status_code == 200
+        assert response.content == data
+        assert response.headers["Content-Type"] == "image/jpeg"
+        
+        assert minio.delete(AREA_ORIGINALS, "a.jpg")
+        assert minio.get(AREA_ORIGINALS, "a.jpg") is None
@@ -0,0 +1,130 @@
+"""
+Tests for the Stripe client: pooling, timeouts, retries and the circuit breaker.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+
+@pytest.fixture
+def stripe_settings(fake_stripe, monkeypatch):
+    """Settings with no retries, so failures reach the circuit breaker directly."""
+    from app.config import settings
+    monkeypatch.setattr(settings, "STRIPE_MAX_RETRIES", 0)
+    return settings
+
+
+def create(client):
+    return client.post("/create-payment-intent", json={"total": 100})
+
+
+class TestStripeGateway:
+    """Tests for Stripe calls made through StripeGateway."""
+    
+    def test_connections_are_reused(self, client, fake_stripe):
+        for _ in range(3):
+            assert create(client).status_code == 200
+        
+        assert len(fake_stripe.requests) == 3
+        assert len({r["client_port"] for r in fake_stripe.requests}) == 1
+    
+    def test_slow_answer_times_out(self, client, fake_stripe, stripe_settings, monkeypatch):
+        monkeypatch.setattr(stripe_settings, "STRIPE_READ_TIMEOUT_SECONDS", 0.1)
+        fake_stripe.delay = 1
+        
+        started = time.monotonic()
+        response = create(client)
+        
+        assert response.status_code == 500
+        assert time.monotonic() - started < 0.9
+    
+    def test_failed_attempt_is_retried_with_same_idempotency_key(self, client, fake_stripe, monkeypatch):
+        from app.config import settings
+        monkeypatch.setattr(settings, "STRIPE_MAX_RETRIES", 1)
+        fake_stripe.fail_next(status=500)
+        
+        response = create(client)
+        
+        assert response.status_code == 200
+        attempts = [r["idempotency_key"] for r in fake_stripe.requests]
+        assert len(attempts) == 2
+        assert attempts[0] and attempts[0] == attempts[1]
+    
+    def test_circuit_opens_and_fails_fast(self, client, fake_stripe, stripe_settings, monkeypatch):
+        from app.services.stripe_gateway import CIRCUIT_OPEN, StripeGateway
+        monkeypatch.setattr(stripe_settings, "STRIPE_BREAKER_FAILURES", 2)
+        fake_stripe.fail_next(2, status=500)
+        
+        failures = [create(client).status_code for _ in range(2)]
+        refused = create(client)
+        
+        assert failures == [500, 500]
+        assert refused.status_code == 503
+        assert refused.headers["retry-after"] == "30"
+        assert len(fake_stripe.requests) == 2
+        stats = StripeGateway.stats()
+        assert stats["circuit"] == CIRCUIT_OPEN
+        assert stats["operations"]["create_payment_intent"]["rejected"] == 1
+    
+    def test_circuit_closes_after_successful_trial(self, client, fake_stripe, stripe_settings, monkeypatch):
+        from app.services.stripe_gateway import CIRCUIT_CLOSED, StripeGateway
+        monkeypatch.setattr(stripe_settings, "STRIPE_BREAKER_FAILURES", 1)
+        monkeypatch.setattr(stripe_settings, "STRIPE_BREAKER_RESET_SECONDS", 0.5)
+        fake_stripe.fail_next(status=500)
+        create(client)
+        
+        assert create(client).status_code == 503
+        time.sleep(0.6)
+        
+        assert create(client).status_code == 200
+        assert StripeGateway.stats()["circuit"] == CIRCUIT_CLOSED
+    
+    def test_failed_trial_opens_the_circuit_again(self):
+        from app.services.stripe_gateway import CIRCUIT_HALF_OPEN, CIRCUIT_OPEN, CircuitBreaker
+        breaker = CircuitBreaker(failure_threshold=3, reset_seconds=0.05)
+        for _ in range(3):
+            breaker.record_failure()
+        time.sleep(0.06)
+        
+        assert breaker.state == CIRCUIT_HALF_OPEN
+        assert breaker.allow() is True
+        # Only one trial at a time
+        assert breaker.allow() is False
+        breaker.record_failure()
+        assert breaker.state == CIRCUIT_OPEN
+    
+    def test_rejected_requests_do_not_open_the_circuit(self, client, fake_stripe, stripe_settings, monkeypatch):
+        from app.services.stripe_gateway import CIRCUIT_CLOSED, StripeGateway
+        monkeypatch.setattr(stripe_settings, "STRIPE_BREAKER_FAILURES", 2)
+        fake_stripe.fail_next(3, status=400)
+        
+        assert [create(client).status_code for _ in range(3)] == [500, 500, 500]
+        assert StripeGateway.stats()["circuit"] == CIRCUIT_CLOSED
+    
+    def test_too_many_waiting_calls_are_turned_away(self, client, fake_stripe, stripe_settings, monkeypatch):
+        monkeypatch.setattr(stripe_settings, "STRIPE_MAX_PENDING", 1)
+        fake_stripe.delay = 0.3
+        
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            responses = list(pool.map(lambda _: create(client), range(2)))
+        
+        assert sorted(r.status_code for r in responses) == [200, 503]
+        assert len(fake_stripe.requests) == 1
+    
+    def test_stats_report_calls_and_latency(self, client, fake_stripe, auth_headers):
+        fake_stripe.fail_next(status=400)
+        create(client)
+        create(client)
+        
+        stats = client.get("/admin/stripe-stats", headers=auth_headers).json()
+        
+        assert stats["circuit"] == "closed"
+        operation = stats["operations"]["create_payment_intent"]
+        assert operation["calls"] == 2
+        assert operation["errors"] == 1
+        assert operation["avg_ms"] is not None
+        assert operation["max_ms"] >= operation["p95_ms"] > 0
+    
+    def test_stats_require_auth(self, client):
+        assert client.get("/admin/stripe-stats").status_code == 422  # Missing auth header
@@ -0,0 +1,192 @@
+"""
+Tests for saving Stripe orders from webhook events.
+"""
+import json
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+
+@pytest.fixture
+def shop_db(client, test_db_with_data, monkeypatch):
+    """Products with 2 gis in size 180."""
+    from app.config import settings
+    monkeypatch.setattr(settings, "DB_FILE", test_db_with_data)
+    conn = sqlite3.connect(test_db_with_data)
+    conn.execute("UPDATE products SET sizes = ? WHERE id = 1", (json.dumps({"180": {"online": 1, "club": 1}}),))
+    conn.commit()
+    conn.close()
+    return test_db_with_data
+
+
+def cart(quantity, size="180"):
+    return {
+        "total": 1500 * quantity,
+        "customer": {"firstName": "Anna", "lastName": "Berg", "email": "anna@example.com"},
+        "items": [{"id": 1, "name": "Judo Gi", "price": 1500, "quantity": quantity, "selectedSize": size}],
+    }
+
+
+def state(db_file):
+    conn = sqlite3.connect(db_file)
+    orders = conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+    holds = conn.execute("SELECT COUNT(*) FROM stock_holds").fetchone()[0]
+    sizes = json.loads(conn.execute("SELECT sizes FROM products WHERE id = 1").fetchone()[0])
+    conn.close()
+    return {"orders": orders, "holds": holds, "stock": sizes["180"]["online"] + sizes["180"]["club"]}
+
+
+def events(db_file):
+    conn = sqlite3.connect(db_file)
+    rows = conn.execute("SELECT id, status, attempts FROM stripe_events ORDER BY received_at").fetchall()
+    conn.close()
+    return rows
+
+
+class TestStripeWebhook:
+    """Tests for the /stripe/webhook endpoint and its event worker."""
+    
+    def test_rejects_bad_signature(self, shop_db, stripe_webhook):
+        event = stripe_webhook.event("payment_intent.succeeded", "pi_1")
+        
+        wrong_secret = stripe_webhook.send(event, secret="whsec_other")
+        too_old = stripe_webhook.send(event, timestamp=int(datetime.utcnow().timestamp()) - 3600)
+        unsigned = stripe_webhook.client.post("/stripe/webhook", json=event)
+        
+        assert [r.status_code for r in (wrong_secret, too_old, unsigned)] == [400, 400, 400]
+        assert events(shop_db) == []
+    
+    def test_requires_configured_secret(self, client, shop_db):
+        response = client.post("/stripe/webhook", json={"id": "evt_1"})
+        
+        assert response.status_code == 500
+    
+    def test_succeeded_event_saves_the_order(self, client, shop_db, fake_stripe, stripe_webhook):
+        from app.services.stripe_events import StripeEventService
+        client.post("/create-payment-intent", json=cart(2))
+        
+        response = stripe_webhook.send(stripe_webhook.event("payment_intent.succeeded", "pi_1"))
+        
+        assert response.json() == {"received": True}
+        # Nothing is saved until the worker runs
+        assert state(shop_db)["orders"] == 0
+        assert StripeEventService.process_pending() == {"processed": 1, "failed": 0}
+        assert state(shop_db) == {"orders": 1, "holds": 0, "stock": 0}
+    
+    def test_redelivered_event_is_processed_once(self, client, shop_db, fake_stripe, stripe_webhook):
+        from app.services.stripe_events import StripeEventService
+        client.post("/create-payment-intent", json=cart(1))
+        event = stripe_webhook.event("payment_intent.succeeded", "pi_1")
+        
+        stripe_webhook.send(event)
+        StripeEventService.process_pending()
+        stripe_webhook.send(event)
+        
+        assert StripeEventService.process_pending() == {"processed": 0, "failed": 0}
+        assert state(shop_db)["orders"] == 1
+    
+    def test_confirm_payment_does_not_call_stripe(self, client, shop_db, fake_stripe, stripe_webhook):
+        from app.services.stripe_events import StripeEventService
+        client.post("/create-payment-intent", json=cart(1))
+        
+        before = client.post("/confirm-payment", json={"payment_intent_id": "pi_1", "order": cart(1)})
+        stripe_webhook.send(stripe_webhook.event("payment_intent.succeeded", "pi_1"))
+        StripeEventService.process_pending()
+        after = client.post("/confirm-payment", json={"payment_intent_id": "pi_1", "order": cart(1)})
+        
+        assert before.json()["status"] == "processing"
+        assert after.json()["order_id"]
+        assert fake_stripe.calls("GET", "/v1/payment_intents/pi_1") == []
+        assert state(shop_db)["orders"] == 1
+    
+    def test_event_after_synchronous_confirmation_adds_nothing(self, client, shop_db, fake_stripe, monkeypatch):
+        from app.config import settings
+        from app.services.stripe_events import StripeEventService
+        client.post("/create-payment-intent", json=cart(1))
+        fake_stripe.pay("pi_1")
+        client.post("/confirm-payment", json={"payment_intent_id": "pi_1", "order": cart(1)})
+        
+        # The webhook is configured later and Stripe delivers the event anyway
+        monkeypatch.setattr(settings, "STRIPE_WEBHOOK_SECRET", "whsec_test_secret")
+        StripeEventService.record({
+            "id": "evt_1", "type": "payment_intent.succeeded", "data": {"object": {"id": "pi_1"}}
+        })
+        
+        assert StripeEventService.process_pending() == {"processed": 1, "failed": 0}
+        assert len(fake_stripe.calls("GET", "/v1/payment_intents/pi_1")) == 1
+        assert state(shop_db)["orders"] == 1
+    
+    def test_canceled_event_releases_the_hold(self, client, shop_db, fake_stripe, stripe_webhook):
+        from app.services.stripe_events import StripeEventService
+        client.post("/create-payment-intent", json=cart(2))
+        
+        stripe_webhook.send(stripe_webhook.event("payment_intent.canceled", "pi_1"))
+        StripeEventService.process_pending()
+        
+        assert state(shop_db) == {"orders": 0, "holds": 0, "stock": 2}
+    
+    def test_sold_out_payment_is_refunded(self, client, shop_db, fake_stripe, stripe_webhook):
+        from app.services.stripe_events import StripeEventService
+        client.post("/create-payment-intent", json=cart(2))
+        conn = sqlite3.connect(shop_db)
+        conn.execute("UPDATE stock_holds SET expires_at = ?", ((datetime.utcnow() - timedelta(seconds=1)).isoformat(),))
+        conn.commit()
+        conn.close()
+        client.post("/checkout", json=cart(1))
+        
+        stripe_webhook.send(stripe_webhook.event("payment_intent.succeeded", "pi_1"))
+        result = StripeEventService.process_pending()
+        confirm = client.post("/confirm-payment", json={"payment_intent_id": "pi_1", "order": cart(2)})
+        
+        assert result == {"processed": 1, "failed": 0}
+        assert fake_stripe.calls("POST", "/v1/refunds") == [{"payment_intent": "pi_1"}]
+        assert confirm.status_code == 409
+        assert state(shop_db)["orders"] == 1
+    
+    def test_order_not_matching_the_amount_paid_is_not_saved(self, client, shop_db, stripe_webhook):
+        from app.services.stripe_events import StripeEventService
+        # No cart was stored with the intent, so the browser's order is kept
+        client.post("/confirm-payment", json={"payment_intent_id": "pi_1", "order": cart(2)})
+        
+        stripe_webhook.send(stripe_webhook.event("payment_intent.succeeded", "pi_1", amount=150000))
+        
+        assert StripeEventService.process_pending() == {"processed": 0, "failed": 1}
+        assert state(shop_db)["orders"] == 0
+    
+    def test_event_before_cart_is_retried(self, client, shop_db, stripe_webhook, monkeypatch):
+        from app.config import settings
+        from app.services.stripe_events import StripeEventService
+        monkeypatch.setattr(settings, "STRIPE_EVENT_MAX_ATTEMPTS", 2)
+        stripe_webhook.send(stripe_webhook.event("payment_intent.succeeded", "pi_unknown"))
+        
+        assert StripeEventService.process_pending() == {"processed": 0, "failed": 1}
+        assert events(shop_db) == [("evt_1", "pending", 1)]
+        StripeEventService.process_pending()
+        assert events(shop_db) == [("evt_1", "failed", 2)]
+    
+    def test_worker_processes_events_in_background(self, client, shop_db, fake_stripe, stripe_webhook, monkeypatch):
+        import time
+        from app.config import settings
+        from app.services.stripe_events import StripeEventService
+        monkeypatch.setattr(settings, "STRIPE_EVENT_POLL_SECONDS", 0.05)
+        client.post("/create-payment-intent", json=cart(1))
+        
+        assert StripeEventService.start_worker()
+        try:
+            stripe_webhook.send(stripe_webhook.event("payment_intent.succeeded", "pi_1"))
+            deadline = time.monotonic() + 5
+            while state(shop_db)["orders"] == 0 and time.monotonic() < deadline:
+                time.sleep(0.02)
+        finally:
+            StripeEventService.stop_worker()
+            StripeEventService._worker.join(timeout=5)
+        
+        assert state(shop_db)["orders"] == 1
+    
+    def test_worker_needs_a_webhook_secret(self, monkeypatch):
+        from app.config import settings
+        from app.services.stripe_events import StripeEventService
+        monkeypatch.setattr(settings, "STRIPE_WEBHOOK_SECRET", "")
+        
+        assert StripeEventService.start_worker() is False
@@ -0,0 +1,219 @@
+"""
+Tests for thumbnail status and background thumbnail regeneration.
+"""
+import os
+import time
+from unittest.mock import patch
+
+import pytest
+from PIL import Image
+
+from app.services.image_paths import ImagePaths
+from tests.conftest import make_jpeg
+
+
+class TestThumbnailStatus:
+    """Tests for the directory-scan based thumbnail status."""
+    
+    @pytest.fixture
+    def files(self, client, test_db_with_data, monkeypatch):
+        from app.config import settings
+        from app.services import image_status
+        monkeypatch.setattr(settings, "DB_FILE", test_db_with_data)
+        monkeypatch.setattr(image_status, "MTIME_RACE_SECONDS", 0)
+        
+        for filename in ("test_image_1.jpg", "orphan.jpg"):
+            with open(os.path.join(settings.UPLOAD_DIR, filename), "wb") as f:
+                f.write(b"x")
+        for filename in ("test_image_1_thumb.jpg", "gone_thumb.jpg"):
+            with open(os.path.join(settings.THUMBNAIL_DIR, filename), "wb") as f:
+                f.write(b"x")
+        return test_db_with_data
+    
+    def test_status_and_orphans(self, client, files, auth_headers):
+        """One scan should classify referenced images and find unreferenced files."""
+        from app.config import settings
+        exists = os.path.exists
+        with patch("os.path.exists", side_effect=exists) as mock_exists:
+            status = client.get("/admin/thumbnail-status", headers=auth_headers).json()
+        
+        checked = [str(call.args[0]) for call in mock_exists.call_args_list]
+        assert not [path for path in checked if path.startswith(settings.UPLOAD_DIR)]
+        assert status["with_thumbnails"] == ["test_image_1.jpg"]
+        assert status["missing_originals"] == ["test_image_2.jpg"]
+        assert status["orphan_originals"] == ["orphan.jpg"]
+        assert status["orphan_thumbnails"] == ["gone_thumb.jpg"]
+        assert (status["total"], status["thumbnail_count"], status["missing_count"]) == (2, 1, 1)
+    
+    def test_pagination(self, client, files, auth_headers):
+        """Lists are paginated while the counts cover everything."""
+        status = client.get(
+            "/admin/thumbnail-status?offset=1&limit=1", headers=auth_headers
+        ).json()
+        
+        assert status["with_thumbnails"] == []
+        assert status["thumbnail_count"] == 1
+        assert (status["offset"], status["limit"]) == (1, 1)
+    
+    def test_cached_until_directory_or_table_changes(self, client, files, auth_headers):
+        """Repeated calls should not rescan until something changes."""
+        import sqlite3
+        from app.config import settings
+        from app.services.image_status import ImageStatusService
+        
+        scan = ImageStatusService.scan_area
+        with patch.object(ImageStatusService, "scan_area", side_effect=scan) as mock_scan:
+            client.get("/admin/thumbnail-status", headers=auth_headers)
+            client.get("/admin/thumbnail-status", headers=auth_headers)
+            assert mock_scan.call_count == 2
+            
+            # New file on disk
+            os.remove(os.path.join(settings.UPLOAD_DIR, "orphan.jpg"))
+            os.utime(settings.UPLOAD_DIR, (1, time.time() - 60))
+            status = client.get("/admin/thumbnail-status", headers=auth_headers).json()
+            assert mock_scan.call_count == 4
+            assert status["orphan_originals"] == []
+            
+            # New reference in the database
+            conn = sqlite3.connect(files)
+            conn.execute("UPDATE categories SET image_filename = 'cat.jpg' WHERE id = 1")
+            conn.commit()
+            conn.close()
+            status = client.get("/admin/thumbnail-status", headers=auth_headers).json()
+            assert mock_scan.call_count == 6
+            assert "cat.jpg" in status["missing_originals"]
+
+
+class TestThumbnailJobs:
+    """Tests for background thumbnail regeneration."""
+    
+    @pytest.fixture
+    def originals(self, client, stored_originals, monkeypatch):
+        """Originals for the sample data, with a small fast-polling worker pool."""
+        from app.config import settings
+        monkeypatch.setattr(settings, "THUMBNAIL_JOB_WORKERS", 2)
+        monkeypatch.setattr(settings, "THUMBNAIL_JOB_POLL_INTERVAL", 0.05)
+        return stored_originals
+    
+    def _wait(self, job_id, timeout=60):
+        from app.services.thumbnail_jobs import ThumbnailJobService
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            job = ThumbnailJobService.get_job(job_id)
+            if job["status"] != "running":
+                return job
+            time.sleep(0.05)
+        raise AssertionError(f"Job {job_id} did not finish")
+    
+    def _thumbnail_path(self, filename):
+        """Flat-layout path, as used by thumbnails stored before sharding."""
+        from app.config import settings
+        return os.path.join(settings.THUMBNAIL_DIR, ImagePaths.thumbnail_name(filename))
+    
+    def _stored_thumbnail(self, filename):
+        from app.config import settings
+        return ImagePaths.resolve(settings.THUMBNAIL_DIR, ImagePaths.thumbnail_name(filename))
+    
+    def test_job_generates_missing_thumbnails(self, client, originals, auth_headers):
+        """The job should build missing thumbnails and skip existing ones."""
+        import sqlite3
+        with open(self._thumbnail_path("test_image_2.jpg"), "wb") as f:
+            f.write(make_jpeg(size=(400, 320)))
+        
+        response = client.post("/admin/generate-thumbnails", headers=auth_headers)
+        assert response.status_code == 200
+        job = self._wait(response.json()["id"])
+        
+        assert job["status"] == "completed"
+        assert (job["total"], job["processed"], job["skipped"], job["failed"]) == (2, 1, 1, 0)
+        assert self._stored_thumbnail("test_image_1.jpg")
+        conn = sqlite3.connect(originals)
+        recorded = conn.execute(
+            "SELECT source_filename FROM image_metadata WHERE variant = 'thumbnail'"
+        ).fetchall()
+        conn.close()
+        assert recorded == [("test_image_1.jpg",)]
+    
+    def test_missing_original_reported(self, client, originals, auth_headers):
+        """Files whose original is gone should be recorded as errors."""
+        from app.config import settings
+        os.remove(os.path.join(settings.UPLOAD_DIR, "test_image_2.jpg"))
+        
+        job_id = client.post("/admin/generate-thumbnails", headers=auth_headers).json()["id"]
+        job = self._wait(job_id)
+        
+        assert (job["processed"], job["failed"]) == (1, 1)
+        assert job["errors"] == ["test_image_2.jpg: Original image not found"]
+    
+    def test_interrupted_job_resumes(self, originals):
+        """Resuming should only process files not yet completed."""
+        import sqlite3
+        from app.services.thumbnail_jobs import ThumbnailJobService
+        
+        conn = sqlite3.connect(originals)
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO thumbnail_jobs (status, force, total, processed, skipped, failed) "
+            "VALUES ('running', 0, 2, 1, 0, 0)"
+        )
+        job_id = cursor.lastrowid
+        cursor.executemany(
+            "INSERT INTO thumbnail_job_items (job_id, filename, status) VALUES (?, ?, ?)",
+            [(job_id, "test_image_1.jpg", "done"), (job_id, "test_image_2.jpg", "pending")]
+        )
+        conn.commit()
+        conn.close()
+        
+        assert ThumbnailJobService.resume_interrupted() == [job_id]
+        job = self._wait(job_id)
+        
+        assert job["status"] == "completed"
+        assert job["processed"] == 2
+        assert self._stored_thumbnail("test_image_1.jpg") is None
+        assert self._stored_thumbnail("test_image_2.jpg")
+    
+    def test_force_rebuilds_all_variants(self, client, originals, auth_headers, uploaded_image):
+        """Force mode should rebuild existing thumbnails and drop cached variants."""
+        import sqlite3
+        from app.config import settings
+        
+        stale = make_jpeg(size=(10, 10))
+        for filename in ("test_image_1.jpg", "test_image_2.jpg"):
+            with open(self._thumbnail_path(filename), "wb") as f:
+                f.write(stale)
+        cached = os.path.join(settings.IMAGE_CACHE_DIR, "test_image_1_320x0_contain.jpg")
+        with open(cached, "wb") as f:
+            f.write(stale)
+        
+        job_id = client.post("/admin/generate-thumbnails?force=true", headers=auth_headers).json()["id"]
+        job = self._wait(job_id)
+        
+        assert job["force"] is True
+        assert job["processed"] == 2
+        assert not os.path.exists(self._thumbnail_path("test_image_1.jpg"))
+        with Image.open(self._stored_thumbnail("test_image_1.jpg")) as img:
+            assert img.size == (400, 320)
+        assert not os.path.exists(cached)
+        conn = sqlite3.connect(originals)
+        placeholders = conn.execute("SELECT placeholder FROM product_images").fetchall()
+        conn.close()
+        assert all(row[0].startswith("data:image/webp") for row in placeholders)
+    
+    def test_progress_streamed_as_sse(self, client, originals, auth_headers):
+        """The events endpoint should stream progress until the job is done."""
+        job_id = client.post("/admin/generate-thumbnails", headers=auth_headers).json()["id"]
+        
+        events = []
+        with client.stream(
+            "GET", f"/admin/thumbnail-jobs/{job_id}/events", headers=auth_headers
+        ) as response:
+            assert response.headers["content-type"].startswith("text/event-stream")
+            for line in response.iter_lines():
+                if line.startswith("event: "):
+                    events.append(line[len("event: "):])
+        
+        assert events[0] == "progress"
+        assert events[-1] == "done"
+    
+    def test_unknown_job(self, client, auth_headers):
+        assert client.get("/admin/thumbnail-jobs/999", headers=auth_headers).status_code == 404
@@ -4,8 +4,24 @@ const api = axios.create({
     baseURL: import.meta.env.VITE_API_URL,
 });
 
-export const checkout = async (orderData) => {
-    const response = await api.post('/checkout', orderData);
+// Pass the same idempotencyKey when retrying an order, so the server
+// returns the first result instead of placing the order twice
+export const checkout = async (orderData, idempotencyKey) => {
+    const headers = idempotencyKey ? { 'Idempotency-Key': idempotencyKey } : {};
+    const response = await api.post('/checkout', orderData, { headers });
+    return response.data;
+};
+
+// Current prices, stock and totals for a cart. Send quote_token with the
+// order so checkout charges these prices; it is null when something is
+// out of stock
+export const quoteCart = async (cart, deliveryMethod, sessionToken) => {
+    const items = cart.map(item => ({
+        id: item.id,
+        selectedSize: item.selectedSize,
+        quantity: item.quantity,
+    }));
+    const response = await api.post('/cart/quote', { items, deliveryMethod, sessionToken });
     return response.data;
 };
 
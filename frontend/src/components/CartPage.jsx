@@ -1,6 +1,6 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { Trash2 } from 'lucide-react';
-import { checkout } from '../api';
+import { checkout, quoteCart } from '../api';
 import { useNavigate } from 'react-router-dom';
 import { updatePageMeta } from '../seo.jsx';
 import { SmartImage } from './SmartImage';
@@ -8,6 +8,9 @@ import { SmartImage } from './SmartImage';
 export const CartPage = ({ cart, removeFromCart, updateQuantity }) => {
   const [loading, setLoading] = useState(false);
   const [message, setMessage] = useState('');
+  // The quoted order and its Idempotency-Key, resent unchanged when the
+  // customer retries the same order; cleared once the server has answered
+  const pendingOrder = useRef(null);
   const navigate = useNavigate();
 
   // Customer input states
@@ -42,31 +45,64 @@ export const CartPage = ({ cart, removeFromCart, updateQuantity }) => {
       return;
     }
 
+    const order = {
+      items: cart.map(item => ({
+        id: item.id,
+        name: item.name,
+        size: item.selectedSize,
+        selectedSize: item.selectedSize,
+        quantity: item.quantity,
+        price: item.sale_price || item.price,
+      })),
+      total,
+      customer: {
+        firstName,
+        lastName,
+        email,
+        phone,
+      },
+      payment,
+    };
+    const signature = JSON.stringify(order);
+
     setLoading(true);
     try {
-      const payload = {
-        items: cart.map(item => ({
-          id: item.id,
-          name: item.name,
-          size: item.selectedSize,
-          quantity: item.quantity,
-          price: item.sale_price || item.price,
-        })),
-        total,
-        customer: {
-          firstName,
-          lastName,
-          email,
-          phone,
-        },
-        payment,
-      };
-
-      await checkout(payload);
+      // A retry must send the very same body under the same key, or the
+      // server takes it for a different request; only a changed order
+      // gets a new quote and a new key
+      if (pendingOrder.current?.signature !== signature) {
+        const quote = await quoteCart(cart, 'pickup');
+        if (!quote.valid) {
+          setMessage('❌ En eller flera varor har tagit slut i lager.');
+          return;
+        }
+        pendingOrder.current = {
+          signature,
+          key: crypto.randomUUID(),
+          payload: { ...order, quoteToken: quote.quote_token },
+        };
+      }
+
+      await checkout(pendingOrder.current.payload, pendingOrder.current.key);
+      pendingOrder.current = null;
       setMessage('✅ Ordern är lagd!');
     } catch (err) {
       console.error('Checkout error:', err);
-      setMessage('❌ Något gick fel vid beställning.');
+      // After a network error, a 5xx or while the first attempt is still
+      // being processed the same request is retried; any other answer
+      // from the server means the next attempt starts over
+      const status = err.response?.status;
+      const inProgress = status === 409 && typeof err.response?.data?.detail === 'string';
+      if (status && status < 500 && !inProgress) {
+        pendingOrder.current = null;
+      }
+      setMessage(
+        inProgress
+          ? '⏳ Ordern behandlas redan, försök igen om en stund.'
+          : status === 409
+            ? '❌ En eller flera varor har tagit slut i lager.'
+            : '❌ Något gick fel vid beställning.'
+      );
     } finally {
       setLoading(false);
     }
@@ -87,6 +123,8 @@ export const CartPage = ({ cart, removeFromCart, updateQuantity }) => {
             >
               <SmartImage
                 src={item.images?.[0]}
+                placeholder={item.image_placeholders?.[item.images?.[0]]}
+                dimensions={item.image_dimensions?.[item.images?.[0]]}
                 alt={item.name}
                 className="w-28 h-28 object-cover rounded"
                 loading="lazy"
@@ -53,6 +53,7 @@ export const CategoriesSection = () => {
                   {category.image_filename ? (
                     <SmartImage
                       src={category.image_filename}
+                      placeholder={category.image_placeholder}
                       alt={displayName}
                       className="w-full h-full object-cover group-hover:scale-105 transition-transform duration-500"
                       loading="lazy"
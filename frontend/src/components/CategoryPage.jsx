@@ -113,6 +113,8 @@ export const CategoryPage = () => {
                 {product.images?.length > 0 && (
                   <SmartImage
                     src={product.images[0]}
+                    placeholder={product.image_placeholders?.[product.images[0]]}
+                    dimensions={product.image_dimensions?.[product.images[0]]}
                     alt={product.name}
                     className="w-full h-full object-cover"
                     loading="lazy"
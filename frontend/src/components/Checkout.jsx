@@ -1,7 +1,7 @@
 // Checkout.jsx
 import React, { useMemo, useState, useEffect } from 'react';
 import { toast } from 'react-hot-toast';
-import api from '../api';
+import api, { quoteCart } from '../api';
 import { Elements } from '@stripe/react-stripe-js';
 import { loadStripe } from '@stripe/stripe-js';
 import StripePaymentForm from './StripePaymentForm';
@@ -21,6 +21,8 @@ export default function Checkout({ cart, setCart }) {
   const [isSubmitting, setIsSubmitting] = useState(false);
   const [stripePublishableKey, setStripePublishableKey] = useState(null);
   const [validationErrors, setValidationErrors] = useState({});
+  // Server prices and totals for the cart; null until loaded
+  const [quote, setQuote] = useState(null);
 
   // Only create the Stripe promise when a key exists
   const stripePromise = useMemo(() => {
@@ -91,6 +93,32 @@ export default function Checkout({ cart, setCart }) {
     }
   }, [cart]);
 
+  // Re-price the cart whenever it or the delivery method changes
+  useEffect(() => {
+    if (cart.length === 0) {
+      setQuote(null);
+      return;
+    }
+    let cancelled = false;
+    quoteCart(cart, formData.deliveryMethod)
+      .then((data) => {
+        if (!cancelled) setQuote(data);
+      })
+      .catch((err) => console.error('Failed to quote cart:', err));
+    return () => {
+      cancelled = true;
+    };
+  }, [cart, formData.deliveryMethod]);
+
+  const localItemsTotal = cart.reduce((sum, item) => {
+    const itemPrice = item.sale_price || item.price;
+    return sum + itemPrice * item.quantity;
+  }, 0);
+  const localDeliveryCost = formData.deliveryMethod === 'postnord' ? 82 : 0;
+  const itemsTotal = quote ? quote.items_total : localItemsTotal;
+  const deliveryCost = quote ? quote.delivery_cost : localDeliveryCost;
+  const orderTotal = quote ? quote.total : localItemsTotal + localDeliveryCost;
+
   const handleSubmit = async (e) => {
     e.preventDefault();
     if (isSubmitting) return;
@@ -234,22 +262,21 @@ export default function Checkout({ cart, setCart }) {
              <div className="space-y-1">
                <div className="flex justify-between">
                  <span>Produkter:</span>
-                 <span>{cart.reduce((sum, item) => {
-                   const itemPrice = item.sale_price || item.price;
-                   return sum + itemPrice * item.quantity;
-                 }, 0)} SEK</span>
+                 <span>{itemsTotal} SEK</span>
                </div>
                <div className="flex justify-between">
                  <span>Leverans:</span>
-                 <span>{formData.deliveryMethod === 'postnord' ? '82 SEK' : 'Gratis'}</span>
+                 <span>{deliveryCost ? `${deliveryCost} SEK` : 'Gratis'}</span>
                </div>
                <div className="flex justify-between font-bold text-lg border-t pt-2">
                  <span>Totalt:</span>
-                 <span>{cart.reduce((sum, item) => {
-                   const itemPrice = item.sale_price || item.price;
-                   return sum + itemPrice * item.quantity;
-                 }, 0) + (formData.deliveryMethod === 'postnord' ? 82 : 0)} SEK</span>
+                 <span>{orderTotal} SEK</span>
                </div>
+               {quote && !quote.valid && (
+                 <p className="text-sm text-red-600 pt-2">
+                   En eller flera varor finns inte längre i lager i vald storlek.
+                 </p>
+               )}
              </div>
            </div>
 
@@ -79,12 +79,14 @@ export default function ProductDetailPage({ onAddToCart }) {
 
     // Parse sizes, handling old format (number), intermediate format (object with quantity/location), and new format (location-based)
     const sizesRaw = JSON.parse(product.sizes || '{}');
+    // Stock held for other customers' carts while they pay
+    const heldSizes = product.held_sizes || {};
     const sizes = Object.entries(sizesRaw).map(([size, value]) => {
         if (typeof value === 'object' && value !== null) {
             // New location-based format: {"online": 2, "club": 1}
             if ("online" in value || "club" in value) {
                 const total = (value.online || 0) + (value.club || 0);
-                return [size, total];
+                return [size, Math.max(0, total - (heldSizes[size] || 0))];
             }
             // Old intermediate format: {"quantity": 5, "location": "online"}
             else if ("quantity" in value) {
@@ -99,6 +101,8 @@ export default function ProductDetailPage({ onAddToCart }) {
         }
     });
     const images = product.images || [];
+    const placeholders = product.image_placeholders || {};
+    const dimensions = product.image_dimensions || {};
 
     const handleAddToCart = () => {
         if (!selectedSize) {
@@ -211,6 +215,12 @@ export default function ProductDetailPage({ onAddToCart }) {
                         className="w-full h-full object-cover transition duration-300 ease-in-out"
                         alt={`Produktbild ${selectedImageIndex + 1}`}
                         loading="eager"
+                        width={dimensions[images[selectedImageIndex]]?.width}
+                        height={dimensions[images[selectedImageIndex]]?.height}
+                        style={placeholders[images[selectedImageIndex]] ? {
+                            backgroundImage: `url(${placeholders[images[selectedImageIndex]]})`,
+                            backgroundSize: 'cover',
+                        } : undefined}
                     />
                 </div>
                 <div className="flex gap-2">
@@ -218,6 +228,7 @@ export default function ProductDetailPage({ onAddToCart }) {
                         <SmartImage
                             key={idx}
                             src={img}
+                            placeholder={placeholders[img]}
                             onClick={() => setSelectedImageIndex(idx)}
                             className={`w-20 h-20 object-cover rounded cursor-pointer border-2 ${selectedImageIndex === idx ? 'border-black' : 'border-transparent'
                                 }`}
@@ -92,6 +92,8 @@ export const ProductGroup = ({ category }) => {
                 {product.images?.length > 0 ? (
                   <SmartImage
                     src={product.images[0]}
+                    placeholder={product.image_placeholders?.[product.images[0]]}
+                    dimensions={product.image_dimensions?.[product.images[0]]}
                     alt={product.label || product.name}
                     className="w-full h-full object-cover group-hover:scale-105 transition-transform duration-500"
                     loading="lazy"
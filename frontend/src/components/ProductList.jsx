@@ -79,6 +79,8 @@ export const ProductList = () => {
             {product.images?.length > 0 && (
               <SmartImage
                 src={product.images[0]}
+                placeholder={product.image_placeholders?.[product.images[0]]}
+                dimensions={product.image_dimensions?.[product.images[0]]}
                 alt={product.name}
                 className="w-full h-full object-cover"
                 loading="lazy"
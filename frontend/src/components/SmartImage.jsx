@@ -3,9 +3,13 @@ import { getThumbnailUrl, getImageUrl } from '../utils/imageUtils';
 
 /**
  * Smart image component that tries to load thumbnail first,
- * then falls back to full image if thumbnail fails
+ * then falls back to full image if thumbnail fails.
+ * An optional placeholder (tiny data URI from the API) is painted
+ * as the background until the real image has loaded, and optional
+ * dimensions ({ width, height } of the original) are set as attributes
+ * so the browser reserves the right aspect ratio before loading.
  */
-export const SmartImage = ({ src, alt, className, loading = 'lazy', ...props }) => {
+export const SmartImage = ({ src, alt, className, loading = 'lazy', placeholder, dimensions, style, ...props }) => {
   const [imageSrc, setImageSrc] = useState(() => {
     if (!src) return null;
     
@@ -18,6 +22,7 @@ export const SmartImage = ({ src, alt, className, loading = 'lazy', ...props })
     return getThumbnailUrl(src);
   });
   const [hasError, setHasError] = useState(false);
+  const [isLoaded, setIsLoaded] = useState(false);
 
   const handleError = () => {
     if (!hasError && src) {
@@ -29,6 +34,15 @@ export const SmartImage = ({ src, alt, className, loading = 'lazy', ...props })
 
   if (!imageSrc) return null;
 
+  const placeholderStyle = placeholder && !isLoaded
+    ? {
+        backgroundImage: `url(${placeholder})`,
+        backgroundSize: 'cover',
+        backgroundPosition: 'center',
+        ...style,
+      }
+    : style;
+
   return (
     <img
       src={imageSrc}
@@ -36,6 +50,10 @@ export const SmartImage = ({ src, alt, className, loading = 'lazy', ...props })
       className={className}
       loading={loading}
       onError={handleError}
+      onLoad={() => setIsLoaded(true)}
+      style={placeholderStyle}
+      width={dimensions?.width}
+      height={dimensions?.height}
       {...props}
     />
   );
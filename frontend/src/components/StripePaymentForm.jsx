@@ -1,8 +1,8 @@
 // StripePaymentForm.jsx
-import React, { useState } from 'react';
+import React, { useRef, useState } from 'react';
 import { useStripe, useElements, CardElement } from '@stripe/react-stripe-js';
 import { toast } from 'react-hot-toast';
-import api from '../api';
+import api, { quoteCart } from '../api';
 import { trackPurchase } from '../analytics';
 
 export default function StripePaymentForm({ cart, setCart, formData, onSuccess, onValidationError }) {
@@ -10,6 +10,9 @@ export default function StripePaymentForm({ cart, setCart, formData, onSuccess,
   const elements = useElements();
   const [isProcessing, setIsProcessing] = useState(false);
   const [cardError, setCardError] = useState(false);
+  // One payment intent per checkout: the server updates it when the cart
+  // changes between attempts instead of creating a new one
+  const sessionToken = useRef(null);
 
   const handleCardChange = (event) => {
     // Clear error when user starts typing
@@ -53,15 +56,24 @@ export default function StripePaymentForm({ cart, setCart, formData, onSuccess,
     setIsProcessing(true);
 
     try {
-      // Calculate delivery cost
-      const deliveryCost = formData.deliveryMethod === 'postnord' ? 82 : 0;
-      const itemsTotal = cart.reduce((sum, item) => {
-        const itemPrice = item.sale_price || item.price;
-        return sum + itemPrice * item.quantity;
-      }, 0);
-      const total = itemsTotal + deliveryCost;
+      if (!sessionToken.current) {
+        sessionToken.current = crypto.randomUUID();
+      }
+
+      // Price the cart on the server right before paying; the quote token
+      // makes checkout charge exactly these prices
+      const quote = await quoteCart(cart, formData.deliveryMethod, sessionToken.current);
+      if (!quote.valid) {
+        toast.error('En eller flera varor har tagit slut i lager. Uppdatera varukorgen och försök igen.');
+        return;
+      }
+      const deliveryCost = quote.delivery_cost;
+      const itemsTotal = quote.items_total;
+      const total = quote.total;
 
       const orderData = {
+        quoteToken: quote.quote_token,
+        sessionToken: sessionToken.current,
         customer: formData,
         items: cart,
         deliveryMethod: formData.deliveryMethod,
@@ -100,22 +112,22 @@ export default function StripePaymentForm({ cart, setCart, formData, onSuccess,
         await api.post('/confirm-payment', {
           payment_intent_id: paymentIntent.id,
           order: orderData,
+        }, {
+          headers: { 'Idempotency-Key': `confirm-${paymentIntent.id}` },
         });
 
         // Track purchase event
-        const items = cart.map(item => {
-          const itemPrice = item.sale_price || item.price;
-          return {
-            item_id: item.id,
-            item_name: item.name,
-            item_category: item.category || 'Product',
-            quantity: item.quantity,
-            price: itemPrice,
-          };
-        });
+        const items = cart.map((item, index) => ({
+          item_id: item.id,
+          item_name: item.name,
+          item_category: item.category || 'Product',
+          quantity: item.quantity,
+          price: quote.lines[index].price,
+        }));
         
         trackPurchase(paymentIntent.id, total, 'SEK', items);
 
+        sessionToken.current = null;
         toast.success('Betalning genomförd!');
         setCart([]);
         localStorage.removeItem('yakimoto_cart');
@@ -123,6 +135,10 @@ export default function StripePaymentForm({ cart, setCart, formData, onSuccess,
       }
     } catch (err) {
       console.error('Stripe payment error:', err);
+      if (err.response?.status === 409) {
+        toast.error('En eller flera varor har tagit slut i lager. Uppdatera varukorgen och försök igen.');
+        return;
+      }
       setCardError(true);
       toast.error('Något gick fel vid betalning. Försök igen.');
     } finally {
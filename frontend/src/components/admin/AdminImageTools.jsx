@@ -6,6 +6,7 @@ const API_URL = import.meta.env.VITE_API_URL;
 export default function AdminImageTools({ token }) {
     const [isProcessing, setIsProcessing] = useState(false);
     const [result, setResult] = useState(null);
+    const [progress, setProgress] = useState(null);
 
     const checkStatus = async () => {
         setIsProcessing(true);
@@ -17,9 +18,10 @@ export default function AdminImageTools({ token }) {
                 type: "status",
                 message: `${status.thumbnail_count} av ${status.total} bilder har miniatyrer`,
                 details: {
-                    with: status.with_thumbnails.length,
-                    without: status.without_thumbnails.length,
-                    missing: status.missing_originals.length,
+                    with: status.thumbnail_count,
+                    without: status.without_count,
+                    missing: status.missing_count,
+                    orphans: status.orphan_original_count + status.orphan_thumbnail_count,
                 },
             });
         } catch (err) {
@@ -43,16 +45,70 @@ export default function AdminImageTools({ token }) {
         }
     };
 
-    const generateThumbnails = async () => {
+    // Read the job's Server-Sent Events with fetch so the auth header can be sent
+    const streamJobProgress = async (jobId) => {
+        const res = await fetch(`${API_URL}/admin/thumbnail-jobs/${jobId}/events`, {
+            headers: { Authorization: `Bearer ${token}` },
+        });
+        if (!res.ok || !res.body) throw new Error(`HTTP ${res.status}`);
+
+        const reader = res.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = "";
+        let job = null;
+        for (;;) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            const messages = buffer.split("\n\n");
+            buffer = messages.pop();
+            for (const message of messages) {
+                const data = message.split("\n").find((line) => line.startsWith("data: "));
+                if (!data) continue;
+                job = JSON.parse(data.slice(6));
+                setProgress(job);
+            }
+        }
+        return job;
+    };
+
+    const generateThumbnails = async (force = false) => {
+        if (force && !confirm("Bygg om alla miniatyrer och platshållare? Det kan ta en stund.")) return;
+        setIsProcessing(true);
+        setResult(null);
+        setProgress(null);
+        try {
+            const res = await axios.post(`${API_URL}/admin/generate-thumbnails`, {}, {
+                headers: { Authorization: `Bearer ${token}` },
+                params: force ? { force: true } : {},
+            });
+            setProgress(res.data);
+            const job = (await streamJobProgress(res.data.id)) || res.data;
+            setResult({
+                type: job.status === "completed" ? "success" : "error",
+                message: job.status === "completed" ? "Miniatyrerna är klara" : `Jobbet avbröts: ${job.error || job.status}`,
+                processed: job.processed,
+                skipped: job.skipped,
+                total: job.total,
+                errors: job.errors,
+            });
+        } catch (err) {
+            setResult({ type: "error", message: err.response?.data?.detail || err.message || "Okänt fel" });
+        } finally {
+            setProgress(null);
+            setIsProcessing(false);
+        }
+    };
+
+    const generatePlaceholders = async () => {
         setIsProcessing(true);
         setResult(null);
         try {
-            const res = await axios.post(`${API_URL}/admin/generate-thumbnails`, {}, { headers: { Authorization: `Bearer ${token}` } });
+            const res = await axios.post(`${API_URL}/admin/generate-placeholders`, {}, { headers: { Authorization: `Bearer ${token}` } });
             setResult({
                 type: "success",
                 message: res.data.message,
                 processed: res.data.processed,
-                skipped: res.data.skipped,
                 total: res.data.total,
                 errors: res.data.errors,
             });
@@ -63,6 +119,94 @@ export default function AdminImageTools({ token }) {
         }
     };
 
+    const backfillMetadata = async () => {
+        setIsProcessing(true);
+        setResult(null);
+        try {
+            const res = await axios.post(`${API_URL}/admin/backfill-image-metadata`, {}, { headers: { Authorization: `Bearer ${token}` } });
+            setResult({
+                type: "success",
+                message: res.data.message,
+                processed: res.data.originals + res.data.thumbnails,
+                total: res.data.total,
+                errors: res.data.errors,
+            });
+        } catch (err) {
+            setResult({ type: "error", message: err.response?.data?.detail || err.message || "Okänt fel" });
+        } finally {
+            setIsProcessing(false);
+        }
+    };
+
+    const migrateLayout = async () => {
+        setIsProcessing(true);
+        setResult(null);
+        let moved = 0;
+        try {
+            let remaining = 1;
+            while (remaining > 0) {
+                const res = await axios.post(`${API_URL}/admin/migrate-image-layout`, {}, { headers: { Authorization: `Bearer ${token}` } });
+                moved += res.data.moved;
+                remaining = res.data.remaining;
+                if (!res.data.moved) break;
+            }
+            setResult({ type: "success", message: `Flyttade ${moved} filer till den nya lagringsstrukturen` });
+        } catch (err) {
+            setResult({ type: "error", message: err.response?.data?.detail || err.message || "Okänt fel" });
+        } finally {
+            setIsProcessing(false);
+        }
+    };
+
+    const refreshProfiles = async () => {
+        setIsProcessing(true);
+        setResult(null);
+        const headers = { Authorization: `Bearer ${token}` };
+        try {
+            const status = await axios.get(`${API_URL}/admin/image-profiles`, { headers });
+            const stale = status.data.stale.thumbnails + status.data.stale.variants;
+            if (!stale) {
+                setResult({ type: "success", message: "Alla miniatyrer och varianter följer de aktuella inställningarna" });
+                return;
+            }
+            await axios.post(`${API_URL}/admin/image-profiles/refresh`, {}, { headers });
+            setResult({
+                type: "success",
+                message: `${status.data.stale.thumbnails} miniatyrer och ${status.data.stale.variants} varianter uppdateras i bakgrunden`,
+            });
+        } catch (err) {
+            setResult({ type: "error", message: err.response?.data?.detail || err.message || "Okänt fel" });
+        } finally {
+            setIsProcessing(false);
+        }
+    };
+
+    const collectGarbage = async () => {
+        setIsProcessing(true);
+        setResult(null);
+        const headers = { Authorization: `Bearer ${token}` };
+        try {
+            const preview = await axios.post(`${API_URL}/admin/image-gc`, {}, { headers, params: { dry_run: true } });
+            const rows = Object.values(preview.data.dangling_rows).reduce((sum, n) => sum + n, 0);
+            const megabytes = (preview.data.reclaimed_bytes / (1024 * 1024)).toFixed(1);
+            if (!preview.data.orphan_files && !rows) {
+                setResult({ type: "success", message: "Inga oanvända bilder hittades" });
+                return;
+            }
+            if (!confirm(`Ta bort ${preview.data.orphan_files} oanvända filer (${megabytes} MB) och ${rows} rader?`)) return;
+            const res = await axios.post(`${API_URL}/admin/image-gc`, {}, { headers, params: { dry_run: false } });
+            setResult({
+                type: "success",
+                message: `Raderade ${res.data.orphan_files} filer och frigjorde ${(res.data.reclaimed_bytes / (1024 * 1024)).toFixed(1)} MB`,
+                errors: res.data.errors,
+            });
+        } catch (err) {
+            setResult({ type: "error", message: err.response?.data?.detail || err.message || "Okänt fel" });
+        } finally {
+            setIsProcessing(false);
+        }
+    };
+
     return (
         <div className="space-y-6">
             <div className="bg-white rounded-xl border border-gray-100 p-6">
@@ -71,15 +215,39 @@ export default function AdminImageTools({ token }) {
                     Generera miniatyrer för produktbilder. Detta förbättrar laddningstiderna.
                 </p>
 
-                <div className="grid grid-cols-1 sm:grid-cols-3 gap-3">
+                <div className="grid grid-cols-1 sm:grid-cols-3 lg:grid-cols-4 gap-3">
                     <button onClick={checkStatus} disabled={isProcessing} className={`flex items-center justify-center gap-2 px-4 py-3 rounded-lg text-sm font-medium transition-colors ${isProcessing ? "bg-gray-100 text-gray-400" : "bg-blue-50 text-blue-700 hover:bg-blue-100"}`}>
                         <svg className="w-5 h-5" fill="none" stroke="currentColor" viewBox="0 0 24 24"><path strokeLinecap="round" strokeLinejoin="round" strokeWidth={2} d="M9 5H7a2 2 0 00-2 2v12a2 2 0 002 2h10a2 2 0 002-2V7a2 2 0 00-2-2h-2M9 5a2 2 0 002 2h2a2 2 0 002-2M9 5a2 2 0 012-2h2a2 2 0 012 2m-6 9l2 2 4-4" /></svg>
                         Kontrollera status
                     </button>
-                    <button onClick={generateThumbnails} disabled={isProcessing} className={`flex items-center justify-center gap-2 px-4 py-3 rounded-lg text-sm font-medium transition-colors ${isProcessing ? "bg-gray-100 text-gray-400" : "bg-green-50 text-green-700 hover:bg-green-100"}`}>
+                    <button onClick={() => generateThumbnails()} disabled={isProcessing} className={`flex items-center justify-center gap-2 px-4 py-3 rounded-lg text-sm font-medium transition-colors ${isProcessing ? "bg-gray-100 text-gray-400" : "bg-green-50 text-green-700 hover:bg-green-100"}`}>
                         <svg className="w-5 h-5" fill="none" stroke="currentColor" viewBox="0 0 24 24"><path strokeLinecap="round" strokeLinejoin="round" strokeWidth={2} d="M4 16l4.586-4.586a2 2 0 012.828 0L16 16m-2-2l1.586-1.586a2 2 0 012.828 0L20 14m-6-6h.01M6 20h12a2 2 0 002-2V6a2 2 0 00-2-2H6a2 2 0 00-2 2v12a2 2 0 002 2z" /></svg>
                         {isProcessing ? "Genererar..." : "Generera miniatyrer"}
                     </button>
+                    <button onClick={generatePlaceholders} disabled={isProcessing} className={`flex items-center justify-center gap-2 px-4 py-3 rounded-lg text-sm font-medium transition-colors ${isProcessing ? "bg-gray-100 text-gray-400" : "bg-purple-50 text-purple-700 hover:bg-purple-100"}`}>
+                        <svg className="w-5 h-5" fill="none" stroke="currentColor" viewBox="0 0 24 24"><path strokeLinecap="round" strokeLinejoin="round" strokeWidth={2} d="M4 5a1 1 0 011-1h14a1 1 0 011 1v14a1 1 0 01-1 1H5a1 1 0 01-1-1V5z" /></svg>
+                        Generera platshållare
+                    </button>
+                    <button onClick={backfillMetadata} disabled={isProcessing} className={`flex items-center justify-center gap-2 px-4 py-3 rounded-lg text-sm font-medium transition-colors ${isProcessing ? "bg-gray-100 text-gray-400" : "bg-gray-50 text-gray-700 hover:bg-gray-100"}`}>
+                        <svg className="w-5 h-5" fill="none" stroke="currentColor" viewBox="0 0 24 24"><path strokeLinecap="round" strokeLinejoin="round" strokeWidth={2} d="M4 7v10c0 2 1 3 3 3h10c2 0 3-1 3-3V7M4 7c0-2 1-3 3-3h10c2 0 3 1 3 3M4 7h16M9 12h6" /></svg>
+                        Uppdatera bildregister
+                    </button>
+                    <button onClick={() => generateThumbnails(true)} disabled={isProcessing} className={`flex items-center justify-center gap-2 px-4 py-3 rounded-lg text-sm font-medium transition-colors ${isProcessing ? "bg-gray-100 text-gray-400" : "bg-amber-50 text-amber-700 hover:bg-amber-100"}`}>
+                        <svg className="w-5 h-5" fill="none" stroke="currentColor" viewBox="0 0 24 24"><path strokeLinecap="round" strokeLinejoin="round" strokeWidth={2} d="M4 4v5h.582m15.356 2A8.001 8.001 0 004.582 9m0 0H9m11 11v-5h-.581m0 0a8.003 8.003 0 01-15.357-2m15.357 2H15" /></svg>
+                        Bygg om alla
+                    </button>
+                    <button onClick={refreshProfiles} disabled={isProcessing} className={`flex items-center justify-center gap-2 px-4 py-3 rounded-lg text-sm font-medium transition-colors ${isProcessing ? "bg-gray-100 text-gray-400" : "bg-amber-50 text-amber-700 hover:bg-amber-100"}`}>
+                        <svg className="w-5 h-5" fill="none" stroke="currentColor" viewBox="0 0 24 24"><path strokeLinecap="round" strokeLinejoin="round" strokeWidth={2} d="M12 8v4l3 3m6-3a9 9 0 11-18 0 9 9 0 0118 0z" /></svg>
+                        Uppdatera till nya inställningar
+                    </button>
+                    <button onClick={migrateLayout} disabled={isProcessing} className={`flex items-center justify-center gap-2 px-4 py-3 rounded-lg text-sm font-medium transition-colors ${isProcessing ? "bg-gray-100 text-gray-400" : "bg-gray-50 text-gray-700 hover:bg-gray-100"}`}>
+                        <svg className="w-5 h-5" fill="none" stroke="currentColor" viewBox="0 0 24 24"><path strokeLinecap="round" strokeLinejoin="round" strokeWidth={2} d="M3 7v10a2 2 0 002 2h14a2 2 0 002-2V9a2 2 0 00-2-2h-6l-2-2H5a2 2 0 00-2 2z" /></svg>
+                        Migrera bildlagring
+                    </button>
+                    <button onClick={collectGarbage} disabled={isProcessing} className={`flex items-center justify-center gap-2 px-4 py-3 rounded-lg text-sm font-medium transition-colors ${isProcessing ? "bg-gray-100 text-gray-400" : "bg-gray-50 text-gray-700 hover:bg-gray-100"}`}>
+                        <svg className="w-5 h-5" fill="none" stroke="currentColor" viewBox="0 0 24 24"><path strokeLinecap="round" strokeLinejoin="round" strokeWidth={2} d="M5 8h14M5 8a2 2 0 110-4h14a2 2 0 110 4M5 8v10a2 2 0 002 2h10a2 2 0 002-2V8m-9 4h4" /></svg>
+                        Rensa oanvända
+                    </button>
                     <button onClick={deleteThumbnails} disabled={isProcessing} className={`flex items-center justify-center gap-2 px-4 py-3 rounded-lg text-sm font-medium transition-colors ${isProcessing ? "bg-gray-100 text-gray-400" : "bg-red-50 text-red-700 hover:bg-red-100"}`}>
                         <svg className="w-5 h-5" fill="none" stroke="currentColor" viewBox="0 0 24 24"><path strokeLinecap="round" strokeLinejoin="round" strokeWidth={2} d="M19 7l-.867 12.142A2 2 0 0116.138 21H7.862a2 2 0 01-1.995-1.858L5 7m5 4v6m4-6v6m1-10V4a1 1 0 00-1-1h-4a1 1 0 00-1 1v3M4 7h16" /></svg>
                         Ta bort alla
@@ -87,13 +255,29 @@ export default function AdminImageTools({ token }) {
                 </div>
             </div>
 
+            {/* Job progress */}
+            {progress && (
+                <div className="bg-white rounded-xl border border-blue-200 p-6">
+                    <div className="flex justify-between text-sm text-gray-600 mb-2">
+                        <span>{progress.force ? "Bygger om miniatyrer..." : "Genererar miniatyrer..."}</span>
+                        <span>{progress.completed} / {progress.total}</span>
+                    </div>
+                    <div className="w-full bg-gray-100 rounded-full h-2">
+                        <div
+                            className="bg-blue-600 h-2 rounded-full transition-all"
+                            style={{ width: `${progress.total ? Math.round((progress.completed / progress.total) * 100) : 100}%` }}
+                        />
+                    </div>
+                </div>
+            )}
+
             {/* Result */}
             {result && (
                 <div className={`bg-white rounded-xl border p-6 ${result.type === "error" ? "border-red-200" : result.type === "status" ? "border-blue-200" : "border-green-200"}`}>
                     <p className={`font-medium ${result.type === "error" ? "text-red-700" : result.type === "status" ? "text-blue-700" : "text-green-700"}`}>{result.message}</p>
 
                     {result.details && (
-                        <div className="mt-3 grid grid-cols-3 gap-4">
+                        <div className="mt-3 grid grid-cols-2 sm:grid-cols-4 gap-4">
                             <div className="bg-green-50 rounded-lg p-3 text-center">
                                 <p className="text-2xl font-bold text-green-700">{result.details.with}</p>
                                 <p className="text-xs text-green-600">Med miniatyrer</p>
@@ -106,6 +290,10 @@ export default function AdminImageTools({ token }) {
                                 <p className="text-2xl font-bold text-red-700">{result.details.missing}</p>
                                 <p className="text-xs text-red-600">Saknade original</p>
                             </div>
+                            <div className="bg-gray-50 rounded-lg p-3 text-center">
+                                <p className="text-2xl font-bold text-gray-700">{result.details.orphans}</p>
+                                <p className="text-xs text-gray-600">Oanvända filer</p>
+                            </div>
                         </div>
                     )}
 